@@ -0,0 +1,18 @@
+"""Per-connection database tuning."""
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Tune every new SQLite connection.
+
+    journal_mode=WAL is persistent in the database file, but busy_timeout and
+    synchronous are per connection and have to be set each time.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    timeout_ms = int(connection.settings_dict.get('OPTIONS', {}).get('timeout', 5) * 1000)
+    with connection.cursor() as cursor:
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE};")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS};")
+        cursor.execute(f"PRAGMA busy_timeout={timeout_ms};")
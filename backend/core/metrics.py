@@ -0,0 +1,102 @@
+"""
+Lightweight in-process metrics.
+
+Counters and timers live in module-level dictionaries guarded by a lock, so
+they are per worker process: with several workers each reports its own
+numbers. They are exposed to staff users at /api/metrics/ (see
+core.views.MetricsView) and are cheap enough to record on every request.
+
+Metric names are dotted strings; labels are keyword arguments and become
+part of the key, e.g. incr('storage.round_trips', op='get') is reported as
+"storage.round_trips{op=get}".
+
+Gauges of state kept elsewhere (e.g. a queue in the database) are set by
+collectors registered with add_collector(), which snapshot() calls first.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_gauges = {}
+_collectors = []
+_started_at = time.time()
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={labels[k]}' for k in sorted(labels)) + '}'
+
+
+def incr(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """Record one duration for a timer metric."""
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            timer = _timers[key] = {'count': 0, 'total_s': 0.0, 'max_s': 0.0}
+        timer['count'] += 1
+        timer['total_s'] += seconds
+        if seconds > timer['max_s']:
+            timer['max_s'] = seconds
+
+
+@contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def add_collector(collector):
+    """Have `collector()` called by every snapshot(), to refresh the gauges it sets."""
+    with _lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+
+def snapshot():
+    """Return a JSON-serializable copy of all metrics."""
+    for collector in list(_collectors):
+        try:
+            collector()
+        except Exception:  # The other metrics are still worth reporting
+            incr('metrics.collector_errors')
+    with _lock:
+        timers = {
+            key: {
+                'count': t['count'],
+                'mean_ms': round(t['total_s'] / t['count'] * 1000, 3) if t['count'] else None,
+                'max_ms': round(t['max_s'] * 1000, 3),
+            }
+            for key, t in _timers.items()
+        }
+        return {
+            'uptime_s': round(time.time() - _started_at, 1),
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timers': timers,
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _gauges.clear()
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
   "django.contrib.staticfiles",
   "rest_framework",
   "corsheaders",
+  "core",
   "users",
   "files",
 ]
@@ -53,6 +54,7 @@ MIDDLEWARE = [
   "django.contrib.sessions.middleware.SessionMiddleware",
   "corsheaders.middleware.CorsMiddleware",
   "django.middleware.common.CommonMiddleware",
+  'files.admission.AdmissionMiddleware',  # Per-user upload limits, before the body is read
   "django.middleware.csrf.CsrfViewMiddleware",
   "django.contrib.auth.middleware.AuthenticationMiddleware",
   "django.contrib.messages.middleware.MessageMiddleware",
@@ -85,12 +87,52 @@ WSGI_APPLICATION = "core.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-  "default": {
-    "ENGINE": "django.db.backends.sqlite3",
-    "NAME": os.path.join(BASE_DIR, 'data', 'db.sqlite3'),
-  }
-}
+# DB_ENGINE: 'sqlite' (development default) or 'postgres' (production profile)
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+# Keep connections open between requests instead of reconnecting every time.
+# Each worker thread holds one persistent connection; put PgBouncer in front of
+# PostgreSQL (DB_POOLER=pgbouncer) to pool them across processes.
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60)) # Seconds; 0 closes after every request
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv('POSTGRES_DB', 'secure_file_vault'),
+            "USER": os.getenv('POSTGRES_USER', 'vault'),
+            "PASSWORD": os.getenv('POSTGRES_PASSWORD', ''),
+            "HOST": os.getenv('POSTGRES_HOST', '127.0.0.1'),
+            "PORT": os.getenv('POSTGRES_PORT', '5432'),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True, # Drop dead persistent connections before reuse
+            # Transaction-level poolers cannot keep server-side cursors across transactions
+            "DISABLE_SERVER_SIDE_CURSORS": os.getenv('DB_POOLER', '') == 'pgbouncer',
+            "OPTIONS": {
+                "connect_timeout": int(os.getenv('POSTGRES_CONNECT_TIMEOUT', 5)),
+            },
+        }
+    }
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv('SQLITE_PATH', os.path.join(BASE_DIR, 'data', 'db.sqlite3')),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "OPTIONS": {
+                # Seconds a writer waits for the lock before "database is locked"
+                "timeout": float(os.getenv('SQLITE_BUSY_TIMEOUT', 20)),
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured("DB_ENGINE setting is invalid. Must be 'sqlite' or 'postgres'.")
+
+# Applied to every new SQLite connection by core.db.configure_sqlite.
+# WAL lets readers proceed while a writer commits; NORMAL sync is durable in WAL mode
+# except for the last transactions on power loss.
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
 
 
 # Password validation
@@ -143,7 +185,7 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated'
@@ -163,6 +205,11 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
 }
 
+# Authenticated user snapshot cache (users.authentication.CachedJWTAuthentication)
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', 30)) # Seconds; bounds staleness across processes
+AUTH_USER_CACHE_SIZE = int(os.getenv('AUTH_USER_CACHE_SIZE', 1024)) # Users kept per process
+AUTH_USER_CACHE_ALIAS = os.getenv('AUTH_USER_CACHE_ALIAS') or None # CACHES alias shared by all workers for instant invalidation
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # Configure appropriately in production
 CORS_ALLOW_CREDENTIALS = True
@@ -219,6 +266,111 @@ if not os.path.exists('logs'):
 # Encryption settings
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', "a-y9AZNVRZsdeag-1VtQkIfkVzcJxyBUAmN4TVFgZZw=")
 
+# Cipher engine for new blobs: 'aes-gcm', 'chacha20-poly1305' or the legacy 'aes-cfb'.
+# Run `python manage.py benchmark_ciphers` to pick the fastest one for the host CPU.
+FILE_CIPHER = os.getenv('FILE_CIPHER', 'aes-gcm')
+FILE_CIPHER_SEGMENT_SIZE = int(os.getenv('FILE_CIPHER_SEGMENT_SIZE', 64 * 1024)) # Plaintext bytes per authenticated segment
+
+# Compression applied before encryption: 'zstd', 'zlib' or 'none'.
+# zstd needs the optional `zstandard` package and falls back to zlib without it.
+FILE_COMPRESSION = os.getenv('FILE_COMPRESSION', 'zlib')
+FILE_COMPRESSION_LEVEL = int(os.getenv('FILE_COMPRESSION_LEVEL')) if os.getenv('FILE_COMPRESSION_LEVEL') else None
+FILE_COMPRESSION_MIN_SIZE = int(os.getenv('FILE_COMPRESSION_MIN_SIZE', 1024)) # Smaller files are stored as-is
+
+# Blob key layout, see files/layout.py: 'sharded' (ab/cd/<sha256>) or 'flat' (legacy)
+STORAGE_LAYOUT = os.getenv('STORAGE_LAYOUT', 'sharded')
+STORAGE_SHARD_DEPTH = int(os.getenv('STORAGE_SHARD_DEPTH', 2)) # Directory levels
+STORAGE_SHARD_WIDTH = int(os.getenv('STORAGE_SHARD_WIDTH', 2)) # Hex characters per level
+
+# Cached blob metadata (HEAD results) in files/blobs.py, in seconds
+STORAGE_META_CACHE_TTL = int(os.getenv('STORAGE_META_CACHE_TTL', 30))
+STORAGE_META_NEGATIVE_TTL = int(os.getenv('STORAGE_META_NEGATIVE_TTL', 5)) # For blobs found missing
+
+# Node-local disk cache of ciphertext blobs in front of S3/MinIO (files/blob_cache.py); unset disables it
+BLOB_CACHE_DIR = os.getenv('BLOB_CACHE_DIR') or None
+BLOB_CACHE_MAX_BYTES = int(os.getenv('BLOB_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+BLOB_CACHE_TRUST_SECONDS = int(os.getenv('BLOB_CACHE_TRUST_SECONDS', 0)) # Skip ETag revalidation this long after a hit
+
+# At-rest integrity index of stored blobs (files/integrity.py) and the scrub_blobs command
+INTEGRITY_CHUNK_SIZE = int(os.getenv('INTEGRITY_CHUNK_SIZE', 64 * 1024)) # Stored bytes per hashed chunk
+INTEGRITY_VERIFY_DOWNLOADS = os.getenv('INTEGRITY_VERIFY_DOWNLOADS', 'True') == 'True' # Check chunks as downloads stream
+SCRUB_RATE_MB_S = float(os.getenv('SCRUB_RATE_MB_S', 20)) # Read budget of the background scrubber
+SCRUB_INTERVAL_HOURS = float(os.getenv('SCRUB_INTERVAL_HOURS', 24 * 7)) # Re-verify each blob this often
+
+# Hot/cold storage tiers (files/storage_tiers.py) and the tier_blobs command (files/tiering.py)
+STORAGE_COLD_TIER = os.getenv('STORAGE_COLD_TIER') or None # 'local' or 's3'; unset keeps every blob on default storage
+STORAGE_COLD_TIER_ROOT = os.getenv('STORAGE_COLD_TIER_ROOT', os.path.join(MAIN_DIR, 'cold_files')) # Directory of a 'local' cold tier
+STORAGE_COLD_TIER_BUCKET = os.getenv('STORAGE_COLD_TIER_BUCKET', '') # Bucket of an 's3' cold tier, on the same server
+TIER_COLD_AFTER_DAYS = float(os.getenv('TIER_COLD_AFTER_DAYS', 30)) # Move blobs not downloaded for this long
+TIER_MIN_SIZE = int(os.getenv('TIER_MIN_SIZE', 1024 * 1024)) # Smaller blobs stay hot
+TIER_PROMOTE_WITHIN_HOURS = float(os.getenv('TIER_PROMOTE_WITHIN_HOURS', 24)) # Bring back cold blobs downloaded this recently
+TIER_RATE_MB_S = float(os.getenv('TIER_RATE_MB_S', 20)) # Read budget of tier_blobs
+
+# Blob replicas (files/storage_tiers.py), the replication queue (files/outbox.py) and replicate_blobs (files/replication.py)
+STORAGE_REPLICAS = os.getenv('STORAGE_REPLICAS', '') # name=local:/dir or name=s3:bucket, comma separated; unset disables replication
+STORAGE_REPLICA_HEDGE_MS = float(os.getenv('STORAGE_REPLICA_HEDGE_MS', 0)) # Also read from a replica when storage has not answered within this; 0 only fails over on errors
+REPLICATION_BATCH_SIZE = int(os.getenv('REPLICATION_BATCH_SIZE', 100)) # Queued changes a worker claims at a time
+REPLICATION_LEASE_SECONDS = int(os.getenv('REPLICATION_LEASE_SECONDS', 300)) # A claimed change is handed out again after this
+REPLICATION_RETRY_MAX_SECONDS = int(os.getenv('REPLICATION_RETRY_MAX_SECONDS', 3600)) # Longest wait between retries of a failing change
+REPLICATION_RATE_MB_S = float(os.getenv('REPLICATION_RATE_MB_S', 0)) # Read budget of replicate_blobs and repair_replicas; 0 unlimited
+
+# Snapshots of the database rows and blobs, backup_vault and restore_vault (files/backup.py)
+BACKUP_TARGET = os.getenv('BACKUP_TARGET', 'local:' + os.path.join(MAIN_DIR, 'backups')) # local:/dir or s3:bucket (on the storage's S3 server)
+BACKUP_WORKERS = int(os.getenv('BACKUP_WORKERS', 8)) # Blobs copied in parallel
+
+# Thumbnails and previews (files/previews.py), encrypted with a server key shared by all users
+PREVIEWS_ENABLED = os.getenv('PREVIEWS_ENABLED', 'False') == 'True' # Previews are readable with the server key
+PREVIEW_KEY = os.getenv('PREVIEW_KEY') or None # Defaults to a key derived from ENCRYPTION_KEY
+PREVIEW_THUMB_SIZE = int(os.getenv('PREVIEW_THUMB_SIZE', 256)) # Longest side in px
+PREVIEW_LARGE_SIZE = int(os.getenv('PREVIEW_LARGE_SIZE', 1024))
+PREVIEW_WORKERS = int(os.getenv('PREVIEW_WORKERS', 2)) # Background render threads per process
+PREVIEW_QUEUE_BYTES = int(os.getenv('PREVIEW_QUEUE_BYTES', 64 * 1024 * 1024)) # Plaintext held by queued jobs; jobs beyond this are dropped (see generate_previews)
+PREVIEW_MAX_SOURCE_BYTES = int(os.getenv('PREVIEW_MAX_SOURCE_BYTES', 25 * 1024 * 1024))
+
+# File versions (files/versions.py)
+VERSION_DELTA_MAX_RATIO = float(os.getenv('VERSION_DELTA_MAX_RATIO', 0.5)) # Keep a version in full if its delta is bigger than this share of it
+VERSION_MAX_CHAIN = int(os.getenv('VERSION_MAX_CHAIN', 8)) # rebase_versions keeps reads within this many deltas
+
+# Folders (files/folders.py)
+FOLDER_MAX_DEPTH = int(os.getenv('FOLDER_MAX_DEPTH', 32)) # Bounds path length and the ancestors updated per upload
+
+# Admin changelists (files/admin.py)
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv('ADMIN_EXACT_COUNT_LIMIT', 10000)) # Larger unfiltered tables show an estimated count
+
+# Storage statistics (files/stats.py)
+STORAGE_STATS_CACHE_ALIAS = os.getenv('STORAGE_STATS_CACHE_ALIAS', 'default') # Use a shared backend so all workers see invalidations at once
+STORAGE_STATS_CACHE_TTL = int(os.getenv('STORAGE_STATS_CACHE_TTL', 300)) # Seconds; bounds staleness in other processes otherwise
+
+# Download counters written in batches (files/access.py)
+ACCESS_FLUSH_INTERVAL = float(os.getenv('ACCESS_FLUSH_INTERVAL', 10)) # Seconds between flushes of a worker's pending counts
+ACCESS_FLUSH_MAX_PENDING = int(os.getenv('ACCESS_FLUSH_MAX_PENDING', 10000)) # Flush early once this many files are pending
+
+# Uploads hashed, encrypted and stored while the body is parsed (files/uploads.py)
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', 'True') == 'True' # False: spool to memory/temp file and read back
+S3_UPLOAD_PART_SIZE = int(os.getenv('S3_UPLOAD_PART_SIZE', 8 * 1024 * 1024)) # Multipart part size for streamed blobs (min 5 MiB)
+
+# Upload admission control (files/admission.py); limits are per worker process
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'True') == 'True'
+ADMISSION_MAX_INFLIGHT_BYTES = int(os.getenv('ADMISSION_MAX_INFLIGHT_BYTES', 512 * 1024 * 1024)) # Upload bytes all users may have in flight at once
+ADMISSION_USER_MAX_CONCURRENT = int(os.getenv('ADMISSION_USER_MAX_CONCURRENT', 4)) # Uploads in flight per user
+ADMISSION_USER_REQUESTS_PER_SECOND = float(os.getenv('ADMISSION_USER_REQUESTS_PER_SECOND', 5))
+ADMISSION_USER_REQUEST_BURST = int(os.getenv('ADMISSION_USER_REQUEST_BURST', 20))
+ADMISSION_USER_BYTES_PER_SECOND = int(os.getenv('ADMISSION_USER_BYTES_PER_SECOND', 50 * 1024 * 1024))
+ADMISSION_USER_BYTE_BURST = int(os.getenv('ADMISSION_USER_BYTE_BURST', 200 * 1024 * 1024)) # At least the largest upload, or it waits for a full bucket
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 2)) # Seconds to wait for the in-flight budget before 503
+ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', 32)) # Waiting uploads beyond this get 503 at once
+
+# Resized profile photo variants (users/avatars.py)
+AVATAR_SIZES = tuple(int(size) for size in os.getenv('AVATAR_SIZES', '32,64,256').split(',')) # Square px, stored as WebP
+
+# Signed download links (files/signed_urls.py)
+SIGNED_URL_TTL = int(os.getenv('SIGNED_URL_TTL', 300)) # Seconds a link stays valid
+SIGNED_URL_KEY = os.getenv('SIGNED_URL_KEY') or None # Defaults to a key derived from SECRET_KEY
+
+# Proof of possession for dedup references (files/possession.py)
+POSSESSION_CHALLENGE_LEAVES = int(os.getenv('POSSESSION_CHALLENGE_LEAVES', 8)) # Chunks challenged per proof
+POSSESSION_CHALLENGE_TTL = int(os.getenv('POSSESSION_CHALLENGE_TTL', 300)) # Seconds to answer a challenge
+
 # STORAGE_BACKEND: 'local' or 'minio'
 STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local') # Default to local if not set
 
@@ -1,6 +1,7 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import permissions, status
+from . import metrics
 from .logging import log_exception
 import sys
 
@@ -15,4 +16,11 @@ class BaseAPIView(APIView):
     def handle_exception(self, exc):
         """Log exceptions with request context"""
         log_exception(self.request, sys.exc_info())
-        return super().handle_exception(exc) 
\ No newline at end of file
+        return super().handle_exception(exc)
+
+class MetricsView(BaseAPIView):
+    """In-process metrics of the worker serving the request (staff only)"""
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return Response(metrics.snapshot())
@@ -0,0 +1,153 @@
+"""
+Download counters.
+
+File.download_count and File.last_accessed are bumped by every download.
+Writing them from the request would add an UPDATE of the (often same, hot)
+File row to every download, so record() only adds the download to an
+in-process table keyed by file id: a file downloaded a thousand times
+between flushes is one entry. A background thread writes the table with
+flush() every ACCESS_FLUSH_INTERVAL seconds, or as soon as it holds
+ACCESS_FLUSH_MAX_PENDING files, as one UPDATE per BATCH_SIZE files:
+
+    UPDATE files_file
+       SET download_count = download_count + CASE id WHEN ... END,
+           last_accessed = GREATEST(COALESCE(last_accessed, ...), CASE id WHEN ... END)
+     WHERE id IN (...)
+
+Increments are relative and the timestamp only moves forward, so worker
+processes flushing their own tables do not overwrite each other. What is
+still pending when the process exits is flushed by an atexit hook, which
+does nothing (and needs no database) when nothing is pending; a hard kill
+loses at most one interval of counts, which the download access log
+(FileAccessLog) still records.
+
+Readers (?ordering=popular and ?ordering=recent_access on the listing,
+tiering decisions) see the counters as of the last flush.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, DateTimeField, F, PositiveBigIntegerField, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from core import metrics
+
+from .models import File
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500  # Files per UPDATE
+
+_lock = threading.Lock()
+_pending = {}  # str(File id) -> [downloads, last download time]
+_flusher = None
+_wakeup = threading.Event()
+
+
+def _interval():
+    return getattr(settings, 'ACCESS_FLUSH_INTERVAL', 10)
+
+
+def _max_pending():
+    return getattr(settings, 'ACCESS_FLUSH_MAX_PENDING', 10000)
+
+
+def _merge(entries):
+    """Add {file id: (downloads, last time)} to the pending table. Called with the lock held."""
+    for file_id, (count, when) in entries.items():
+        entry = _pending.get(file_id)
+        if entry is None:
+            _pending[file_id] = [count, when]
+        else:
+            entry[0] += count
+            if when > entry[1]:
+                entry[1] = when
+
+
+def record(file_id, when=None):
+    """Count one download of `file_id`; no database access."""
+    with _lock:
+        _merge({str(file_id): (1, when or timezone.now())})
+        pending = len(_pending)
+    metrics.incr('access.recorded')
+    metrics.set_gauge('access.pending', pending)
+    _start_flusher()
+    if pending >= _max_pending():
+        _wakeup.set()
+
+
+def pending():
+    """A copy of the counts not flushed yet, {file id: (downloads, last time)}."""
+    with _lock:
+        return {file_id: tuple(entry) for file_id, entry in _pending.items()}
+
+
+def _update(batch):
+    counts = [When(pk=file_id, then=Value(count)) for file_id, (count, _) in batch]
+    times = Case(
+        *[When(pk=file_id, then=Value(when)) for file_id, (_, when) in batch], output_field=DateTimeField()
+    )
+    return File.objects.filter(pk__in=[file_id for file_id, _ in batch]).update(
+        download_count=F('download_count') + Case(*counts, output_field=PositiveBigIntegerField()),
+        last_accessed=Greatest(Coalesce('last_accessed', times), times),
+    )
+
+
+def flush():
+    """Write the pending counts to their File rows; returns how many rows were updated."""
+    global _pending
+    with _lock:
+        entries, _pending = _pending, {}
+    metrics.set_gauge('access.pending', 0)
+    if not entries:
+        return 0
+    items = list(entries.items())
+    updated = 0
+    started = time.perf_counter()
+    for start in range(0, len(items), BATCH_SIZE):
+        try:
+            updated += _update(items[start:start + BATCH_SIZE])
+        except Exception:
+            with _lock:  # Kept for the next flush
+                _merge(dict(items[start:]))
+            raise
+    metrics.observe('access.flush', time.perf_counter() - started)
+    metrics.incr('access.flushed', updated)
+    return updated
+
+
+def _run():
+    while True:
+        _wakeup.wait(_interval())
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Failed to flush download counters: {e}", exc_info=True)
+        finally:
+            connections.close_all()  # This thread's connections would otherwise linger
+
+
+def _flush_at_exit():
+    if not _pending:  # The database may already be gone (e.g. the test database)
+        return
+    try:
+        flush()
+    except Exception as e:
+        logger.error(f"Failed to flush download counters at exit: {e}")
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run, name='access-flush', daemon=True)
+            _flusher.start()
+            atexit.register(_flush_at_exit)
@@ -1,13 +1,98 @@
-from django.contrib import admin
-from .models import File, FileAccessLog
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from . import folders, integrity, stats
+from .models import BlobIntegrity, BlobTier, File, FileAccessLog, FileVersion, Folder, ReplicationTask, StorageStat
+from .services import delete_file
+
+
+def estimated_row_count(model, using):
+    """The table's row count from planner statistics, or None where there are none to read."""
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'sqlite':
+            # Rowids are handed out in ascending order, so the largest is an upper bound read off the b-tree
+            cursor.execute(f'SELECT MAX(rowid) FROM {table}')
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None  # -1: never analyzed
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Pagination for tables with millions of rows: the unfiltered changelist
+    takes its total from the database's statistics instead of a COUNT(*)
+    that reads the whole table. Filtered lists, and tables estimated below
+    ADMIN_EXACT_COUNT_LIMIT rows, are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 10000):
+                return estimate
+        return queryset.count()
+
+
+class TypeBucketFilter(admin.SimpleListFilter):
+    """file_type grouped like the storage statistics; a filter on the raw field would SELECT DISTINCT over all files"""
+    title = 'type'
+    parameter_name = 'type'
+
+    def lookups(self, request, model_admin):
+        return [(bucket, bucket.capitalize()) for bucket, _ in stats.TYPE_BUCKETS] + [(stats.OTHER, 'Other')]
+
+    def queryset(self, request, queryset):
+        buckets = dict(stats.TYPE_BUCKETS)
+        if self.value() == stats.OTHER:
+            for prefixes in buckets.values():
+                for prefix in prefixes:
+                    queryset = queryset.exclude(file_type__startswith=prefix)
+        elif self.value() in buckets:
+            match = Q()
+            for prefix in buckets[self.value()]:
+                match |= Q(file_type__startswith=prefix)
+            queryset = queryset.filter(match)
+        return queryset
+
+
+class AccessActionFilter(admin.SimpleListFilter):
+    """Fixed choices, so the filter sidebar does not SELECT DISTINCT over the whole log"""
+    title = 'action'
+    parameter_name = 'action'
+    ACTIONS = ('upload', 'reference', 'version', 'download', 'download_link')
+
+    def lookups(self, request, model_admin):
+        return [(action, action.replace('_', ' ')) for action in self.ACTIONS]
+
+    def queryset(self, request, queryset):
+        return queryset.filter(action=self.value()) if self.value() else queryset
+
 
 @admin.register(File)
 class FileAdmin(admin.ModelAdmin):
     list_display = ('original_filename', 'owner', 'file_type', 'get_size_display', 'uploaded_at', 'is_encrypted')
-    list_filter = ('file_type', 'is_encrypted', 'uploaded_at')
+    list_select_related = ('owner',)
+    list_filter = (TypeBucketFilter, 'is_encrypted')
+    date_hierarchy = 'uploaded_at'
     search_fields = ('original_filename', 'owner__username')
     ordering = ('-uploaded_at',)
-    readonly_fields = ('id', 'uploaded_at', 'last_accessed')
+    readonly_fields = ('id', 'uploaded_at', 'last_accessed', 'download_count')
+    autocomplete_fields = ('owner',)
+    raw_id_fields = ('folder',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('rebuild_owner_counters', 'verify_blobs')
 
     def get_size_display(self, obj):
         """Convert size to human-readable format"""
@@ -20,10 +105,117 @@ class FileAdmin(admin.ModelAdmin):
     
     get_size_display.short_description = 'Size'
 
+    # Deleting goes through the same path as the API, so blobs, quota and counters follow
+
+    def delete_model(self, request, obj):
+        delete_file(obj)
+
+    def delete_queryset(self, request, queryset):
+        for file_instance in queryset.select_related('owner').iterator(chunk_size=100):
+            delete_file(file_instance)
+
+    def get_deleted_objects(self, objs, request):
+        # The default lists every access log and version that goes with the files
+        objs = list(objs)
+        perms_needed = set() if self.has_delete_permission(request) else {File._meta.verbose_name}
+        return [str(obj) for obj in objs], {File._meta.verbose_name_plural: len(objs)}, perms_needed, []
+
+    @admin.action(description='Rebuild storage statistics and folder totals of their owners')
+    def rebuild_owner_counters(self, request, queryset):
+        owner_ids = set(queryset.values_list('owner', flat=True).order_by())
+        for owner_id in owner_ids:
+            stats.rebuild(owner_id)
+            folders.recalculate(owner_id)
+        self.message_user(request, f"Rebuilt the counters of {len(owner_ids)} owner(s).")
+
+    @admin.action(description='Verify stored blobs against the integrity index')
+    def verify_blobs(self, request, queryset):
+        names = set(queryset.values_list('file', flat=True).order_by())
+        counts = {}
+        for index in BlobIntegrity.objects.filter(name__in=names):
+            status = integrity.scrub(index)
+            counts[status] = counts.get(status, 0) + 1
+        unindexed = len(names) - sum(counts.values())
+        if unindexed:
+            counts['not indexed'] = unindexed
+        summary = ', '.join(f"{n} {status}" for status, n in sorted(counts.items()))
+        ok = set(counts) <= {BlobIntegrity.OK, 'not indexed'}
+        self.message_user(request, f"Blobs: {summary}.", messages.SUCCESS if ok else messages.ERROR)
+
 @admin.register(FileAccessLog)
 class FileAccessLogAdmin(admin.ModelAdmin):
-    list_display = ('file', 'user', 'action', 'access_time', 'ip_address')
-    list_filter = ('action', 'access_time')
+    list_display = ('get_file_name', 'user', 'action', 'access_time', 'ip_address')
+    list_select_related = ('file', 'user')
+    list_filter = (AccessActionFilter,)
+    date_hierarchy = 'access_time'
     search_fields = ('file__original_filename', 'user__username', 'ip_address')
     ordering = ('-access_time',)
-    readonly_fields = ('id', 'access_time') 
\ No newline at end of file
+    readonly_fields = ('id', 'access_time') 
+    raw_id_fields = ('file', 'user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    @admin.display(description='File', ordering='file__original_filename')
+    def get_file_name(self, obj):
+        return obj.file.original_filename
+
+@admin.register(BlobIntegrity)
+class BlobIntegrityAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'size', 'verified_at', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('name', 'root')
+    ordering = ('status', 'name')
+    readonly_fields = ('name', 'size', 'chunk_size', 'root', 'created_at', 'verified_at')
+    exclude = ('leaves',)
+
+
+@admin.register(BlobTier)
+class BlobTierAdmin(admin.ModelAdmin):
+    # Maintained by files/tiering.py; a row edited here would not move the blob
+    list_display = ('name', 'tier', 'size', 'moved_at')
+    list_filter = ('tier',)
+    search_fields = ('name',)
+    ordering = ('name',)
+    readonly_fields = ('name', 'tier', 'size', 'moved_at')
+
+
+@admin.register(ReplicationTask)
+class ReplicationTaskAdmin(admin.ModelAdmin):
+    # Maintained by files/outbox.py; the replicate_blobs command works through it
+    list_display = ('name', 'replica', 'op', 'created_at', 'attempts', 'next_attempt_at')
+    list_filter = ('replica', 'op')
+    search_fields = ('name',)
+    ordering = ('next_attempt_at',)
+    readonly_fields = ('name', 'replica', 'op', 'created_at', 'changed_at', 'attempts', 'next_attempt_at', 'last_error')
+
+
+@admin.register(FileVersion)
+class FileVersionAdmin(admin.ModelAdmin):
+    list_display = ('file', 'number', 'kind', 'size', 'original_size', 'created_at')
+    list_filter = ('kind',)
+    list_select_related = ('file__owner',)
+    search_fields = ('file__original_filename', 'file__owner__username', 'file_hash')
+    ordering = ('file_id', '-number')  # 'file' would sort by the File's own ordering, through a join
+    readonly_fields = ('file', 'number', 'kind', 'storage_name', 'size', 'original_size', 'file_hash', 'created_at')
+
+
+
+@admin.register(Folder)
+class FolderAdmin(admin.ModelAdmin):
+    # Paths and totals are maintained by files/folders.py; editing them here would corrupt the tree
+    list_display = ('name', 'owner', 'depth', 'total_size', 'file_count', 'created_at')
+    list_select_related = ('owner',)
+    search_fields = ('name', 'owner__username')
+    ordering = ('owner', 'path')
+    readonly_fields = ('id', 'owner', 'parent', 'name', 'path', 'depth', 'total_size', 'file_count', 'created_at')
+
+
+@admin.register(StorageStat)
+class StorageStatAdmin(admin.ModelAdmin):
+    # Maintained by files/stats.py; fix drift with the rebuild_storage_stats command
+    list_display = ('owner', 'dimension', 'bucket', 'count', 'bytes')
+    list_select_related = ('owner',)
+    list_filter = ('dimension',)
+    search_fields = ('owner__username', 'bucket')
+    ordering = ('owner', 'dimension', 'bucket')
+    readonly_fields = ('owner', 'dimension', 'bucket', 'count', 'bytes')
@@ -0,0 +1,348 @@
+"""
+Admission control for uploads.
+
+An upload holds a worker and, once its body is parsed, up to MAX_FILE_SIZE
+of memory, so one user starting dozens of large uploads at once could take
+every worker and most of the process's memory from everybody else.
+AdmissionMiddleware decides before the body is parsed, from the JWT's user
+id (no database query) and Content-Length:
+
+  1. Each user may have ADMISSION_USER_MAX_CONCURRENT uploads in flight and
+     is rate limited by two token buckets, one for requests and one for
+     bytes. Over the limit means 429 with a Retry-After telling when the
+     bucket will have refilled.
+  2. All uploads of the process share ADMISSION_MAX_INFLIGHT_BYTES. When
+     it is used up, requests wait up to ADMISSION_QUEUE_TIMEOUT seconds.
+     Freed budget goes to the waiter whose user has the fewest bytes in
+     flight (max-min fairness), so a user with one small upload gets in
+     ahead of one with twenty big ones. A user already holding more than
+     their fair share of a contended budget is turned away at once
+     (429) instead of occupying a worker while waiting. Waiters that time
+     out, or find ADMISSION_MAX_QUEUED others ahead, get 503 with a
+     Retry-After.
+
+Under WSGI the body is still unread at that point: a rejected upload is
+answered before it is received. Under ASGI, Django's handler receives the
+whole body (spooled to a temporary file past FILE_UPLOAD_MAX_MEMORY_SIZE)
+before any middleware or view runs, so admission there only spares the
+server the parsing, encryption and storage of a rejected upload, not its
+transfer; cap request bodies at the proxy to bound that.
+
+State is per process, like core.metrics: with several worker processes
+each enforces the limits on its own share of the traffic.
+"""
+import asyncio
+import math
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from core import metrics
+
+from .services import MAX_FILE_SIZE
+
+MB = 1024 * 1024
+
+# Upload routes (URL names) that go through admission, with the method that uploads
+UPLOAD_ROUTES = {
+    'file-list': 'POST',
+    'file-versions': 'POST',
+    'async_file_upload': 'POST',
+}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`; not thread-safe on its own."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill(now)
+        amount = min(amount, self.burst)  # Anything bigger than the burst waits for a full bucket
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.burst)
+
+    def give_back(self, amount):
+        self.tokens = min(self.burst, self.tokens + min(amount, self.burst))
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Rejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class _UserState:
+    def __init__(self, now):
+        self.requests = TokenBucket(
+            _setting('ADMISSION_USER_REQUESTS_PER_SECOND', 5), _setting('ADMISSION_USER_REQUEST_BURST', 20), now
+        )
+        self.bytes = TokenBucket(
+            _setting('ADMISSION_USER_BYTES_PER_SECOND', 50 * MB), _setting('ADMISSION_USER_BYTE_BURST', 200 * MB), now
+        )
+        self.inflight_bytes = 0
+        self.inflight_count = 0
+        self.waiting = 0
+
+
+class _Waiter:
+    """A request queued for budget; woken from whichever thread releases it."""
+
+    def __init__(self, key, nbytes, loop=None):
+        self.key = key
+        self.nbytes = nbytes
+        self.granted = False
+        self.enqueued = time.monotonic()
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class AdmissionController:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._inflight_bytes = 0
+        self._waiters = []
+
+    @property
+    def budget(self):
+        return _setting('ADMISSION_MAX_INFLIGHT_BYTES', 512 * MB)
+
+    def _user(self, key, now):
+        state = self._users.get(key)
+        if state is None:
+            if len(self._users) >= 10000:
+                self._prune(now)
+            state = self._users[key] = _UserState(now)
+        return state
+
+    def _prune(self, now):
+        for key in [k for k, s in self._users.items()
+                    if not s.inflight_count and not s.waiting and s.requests.full(now) and s.bytes.full(now)]:
+            del self._users[key]
+
+    def _fair_share(self):
+        active = {k for k, s in self._users.items() if s.inflight_count or s.waiting}
+        return self.budget / max(1, len(active))
+
+    def _check_limits(self, key, nbytes, now):
+        """Per-user limits; takes the user's tokens. Called with the lock held; raises Rejected."""
+        state = self._user(key, now)
+        if state.inflight_count >= _setting('ADMISSION_USER_MAX_CONCURRENT', 4):
+            raise Rejected(429, 'concurrency', 1)
+        wait = max(state.requests.wait_time(1, now), state.bytes.wait_time(nbytes, now))
+        if wait:
+            raise Rejected(429, 'rate', wait)
+        state.requests.take(1)
+        state.bytes.take(nbytes)
+        return state
+
+    def _grant(self, state, nbytes):
+        state.inflight_bytes += nbytes
+        state.inflight_count += 1
+        self._inflight_bytes += nbytes
+        metrics.set_gauge('admission.inflight_bytes', self._inflight_bytes)
+
+    def _fits(self, nbytes):
+        return self._inflight_bytes + nbytes <= self.budget or not self._inflight_bytes
+
+    def _enqueue(self, key, nbytes, state, now, loop=None):
+        """Admit at once, or return a _Waiter to wait on. Called with the lock held; raises Rejected."""
+        if not self._waiters and self._fits(nbytes):
+            self._grant(state, nbytes)
+            return None
+        if state.inflight_bytes + nbytes > self._fair_share():
+            raise Rejected(429, 'fair_share', _setting('ADMISSION_QUEUE_TIMEOUT', 2))
+        if len(self._waiters) >= _setting('ADMISSION_MAX_QUEUED', 32):
+            raise Rejected(503, 'queue_full', _setting('ADMISSION_QUEUE_TIMEOUT', 2))
+        waiter = _Waiter(key, nbytes, loop)
+        state.waiting += 1
+        self._waiters.append(waiter)
+        return waiter
+
+    def _dispatch(self):
+        """Hand free budget to waiters, least-served user first. Called with the lock held."""
+        while self._waiters:
+            waiter = min(self._waiters, key=lambda w: (self._users[w.key].inflight_bytes, w.enqueued))
+            if not self._fits(waiter.nbytes):
+                return
+            self._waiters.remove(waiter)
+            state = self._users[waiter.key]
+            state.waiting -= 1
+            self._grant(state, waiter.nbytes)
+            waiter.wake()
+
+    def _give_up(self, waiter):
+        """A waiter timed out; returns True if it was granted at the last moment after all."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            state = self._users[waiter.key]
+            state.waiting -= 1
+            state.requests.give_back(1)
+            state.bytes.give_back(waiter.nbytes)
+            self._dispatch()  # A smaller request behind it may fit now
+        return False
+
+    def _timed_out(self, waiter):
+        metrics.incr('admission.rejected', reason='timeout')
+        return Rejected(503, 'timeout', _setting('ADMISSION_QUEUE_TIMEOUT', 2))
+
+    def acquire(self, key, nbytes):
+        """Block until `nbytes` of `key`'s upload are admitted; raises Rejected."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._check_limits(key, nbytes, now)
+            waiter = self._enqueue(key, nbytes, state, now)
+        if waiter is not None:
+            waiter.event.wait(_setting('ADMISSION_QUEUE_TIMEOUT', 2))
+            if not waiter.granted and not self._give_up(waiter):
+                raise self._timed_out(waiter)
+            metrics.observe('admission.queue_wait', time.monotonic() - now)
+
+    async def aacquire(self, key, nbytes):
+        """acquire() for the event loop: waits without holding a thread."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._check_limits(key, nbytes, now)
+            waiter = self._enqueue(key, nbytes, state, now, loop=asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), _setting('ADMISSION_QUEUE_TIMEOUT', 2))
+            except asyncio.TimeoutError:
+                if not self._give_up(waiter):
+                    raise self._timed_out(waiter)
+            metrics.observe('admission.queue_wait', time.monotonic() - now)
+
+    def release(self, key, nbytes):
+        with self._lock:
+            state = self._users[key]
+            state.inflight_bytes -= nbytes
+            state.inflight_count -= 1
+            self._inflight_bytes -= nbytes
+            metrics.set_gauge('admission.inflight_bytes', self._inflight_bytes)
+            self._dispatch()
+
+
+controller = AdmissionController()
+
+
+def _user_key(request):
+    """The user id claim of a valid bearer token, or None (the view then answers 401)."""
+    auth = JWTAuthentication()
+    header = auth.get_header(request)
+    raw = auth.get_raw_token(header) if header else None
+    if raw is None:
+        return None
+    try:
+        return str(auth.get_validated_token(raw)[api_settings.USER_ID_CLAIM])
+    except (InvalidToken, TokenError, KeyError):
+        return None
+
+
+def _upload_size(request):
+    try:
+        size = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        size = 0
+    return min(size, MAX_FILE_SIZE) if size > 0 else MAX_FILE_SIZE  # Unknown length: assume the worst
+
+
+def _is_upload(request):
+    if not _setting('ADMISSION_ENABLED', True):
+        return False
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return False
+    return UPLOAD_ROUTES.get(match.url_name) == request.method
+
+
+def _rejection(rejected):
+    metrics.incr('admission.rejected', reason=rejected.reason)
+    message = ('Too many uploads; retry later.' if rejected.status_code == 429
+               else 'The server is busy with other uploads; retry later.')
+    response = JsonResponse({'error': message}, status=rejected.status_code)
+    response['Retry-After'] = str(rejected.retry_after)
+    return response
+
+
+class AdmissionMiddleware:
+    """Admits upload requests through `controller` before their body is parsed (see above for ASGI)."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        key = _user_key(request) if _is_upload(request) else None
+        if key is None:
+            return self.get_response(request)
+        nbytes = _upload_size(request)
+        try:
+            controller.acquire(key, nbytes)
+        except Rejected as e:
+            return _rejection(e)
+        try:
+            return self.get_response(request)
+        finally:
+            controller.release(key, nbytes)
+
+    async def __acall__(self, request):
+        key = _user_key(request) if _is_upload(request) else None
+        if key is None:
+            return await self.get_response(request)
+        nbytes = _upload_size(request)
+        try:
+            await controller.aacquire(key, nbytes)
+        except Rejected as e:
+            return _rejection(e)
+        try:
+            return await self.get_response(request)
+        finally:
+            controller.release(key, nbytes)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class FilesConfig(AppConfig):
   default_auto_field = "django.db.models.BigAutoField"
   name = "files"
+
+  def ready(self):
+    from core import metrics
+
+    from . import outbox
+    metrics.add_collector(outbox.publish)  # Replication lag, read from the queue
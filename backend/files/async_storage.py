@@ -0,0 +1,132 @@
+"""
+Async access to blob storage for the ASGI views.
+
+FileSystemStorage (and any other Django storage) is driven from a worker
+thread with asyncio.to_thread, one read at a time, so the event loop never
+blocks on disk. When the S3 backend is configured and aiobotocore is
+installed, objects are streamed with a native async S3 client instead.
+
+Each S3 operation opens its own client as an async context manager, so
+the client and its connection pool are closed when the operation ends.
+Under WSGI every async request runs on an event loop of its own, so a
+client kept per loop would leak with each of them.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from core import metrics
+
+from . import blob_cache, storage_tiers
+from .blobs import BlobNotFound, is_not_found, open_blob, record_write, s3_key, save_blob
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:  # Optional; falls back to thread-offloaded boto3
+    get_session = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def _uses_s3():
+    return getattr(settings, 'STORAGE_BACKEND', 'local') == 's3'
+
+
+def _use_native_s3():
+    # The disk cache sits behind the sync client, and the native client only knows
+    # the hot tier (no failover, no replication queue); files.blobs is used instead
+    return (
+        _uses_s3() and get_session is not None and not blob_cache.enabled()
+        and not storage_tiers.enabled() and not storage_tiers.replicas()
+    )
+
+
+_session = None
+
+
+def _s3_client():
+    """An aiobotocore client for one operation; use it as an async context manager."""
+    global _session
+    if _session is None:
+        _session = get_session()
+    return _session.create_client(
+        's3',
+        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME,
+    )
+
+
+async def _iter_s3(name, chunk_size):
+    async with _s3_client() as client:
+        started = time.perf_counter()
+        try:
+            response = await client.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key(name))
+        except Exception as e:
+            if is_not_found(e):
+                raise BlobNotFound(name) from e
+            raise
+        finally:
+            metrics.incr('storage.round_trips', op='get')
+            metrics.observe('storage.latency', time.perf_counter() - started, op='get')
+        async with response['Body'] as stream:
+            while True:
+                chunk = await stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+async def _iter_threaded(name, chunk_size):
+    f = await asyncio.to_thread(open_blob, name)  # raises BlobNotFound
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def open_chunks(name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Open a blob for streaming and return an async iterator of its chunks.
+
+    The first chunk is read eagerly so that a missing blob raises
+    BlobNotFound here, before a response has been started.
+    """
+    source = _iter_s3(name, chunk_size) if _use_native_s3() else _iter_threaded(name, chunk_size)
+    try:
+        first = await source.__anext__()
+    except StopAsyncIteration:
+        first = b''
+
+    async def chunks():
+        try:
+            if first:
+                yield first
+            async for chunk in source:
+                yield chunk
+        finally:
+            await source.aclose()  # Closes the blob, or the S3 client, if the response is abandoned
+
+    return chunks()
+
+
+async def save(name, content):
+    """Save bytes to storage and return the name actually used."""
+    if _use_native_s3():
+        # Mirror the name-collision behaviour of the sync storage
+        name = await asyncio.to_thread(default_storage.get_available_name, name)
+        async with _s3_client() as client:
+            await client.put_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key(name), Body=content)
+        record_write(name, len(content))
+        return name
+    return await asyncio.to_thread(save_blob, name, content)
@@ -0,0 +1,255 @@
+"""
+Async (ASGI) upload and download endpoints.
+
+These mirror FileViewSet.create and FileViewSet.download, but the
+transfer itself runs on the event loop: a slow client only costs an idle
+coroutine instead of a pinned worker thread. DB access goes through
+Django's async ORM methods or sync_to_async; CPU-bound hashing, encryption
+and decryption is pushed to a worker thread so the loop stays responsive.
+
+Run under an ASGI server to get the benefit, e.g.
+    uvicorn core.asgi:application
+"""
+import asyncio
+import logging
+import mimetypes
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from users.authentication import CachedJWTAuthentication
+
+from . import access, async_storage, folders, integrity, previews, signed_urls, uploads
+from .async_storage import BlobNotFound
+from .blobs import locate_blob
+from .conditional import file_etag, not_modified, set_validators
+from .models import BlobIntegrity, File
+from .possession import merkle_root
+from .serializers import FileSerializer
+from .services import (
+    BlobDecoder, FileServiceError, STREAM_CHUNK_SIZE, add_file_reference, backfill_merkle_root,
+    check_upload_allowed, create_file_record, encode_content, hash_content, log_access, new_storage_name,
+    plaintext_size,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def _authenticate(request):
+    """Authenticate the request with the same JWT scheme as the DRF views."""
+    try:
+        result = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None
+    return result[0] if result else None
+
+
+def _unauthorized():
+    return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+
+def _serialize(file_instance, request):
+    return FileSerializer(file_instance, context={'request': request}).data
+
+
+async def download(request, pk):
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    file_instance = await File.objects.filter(pk=pk, owner=user).afirst()
+    if file_instance is None:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    if not file_instance.file or not file_instance.file.name:
+        return JsonResponse({'error': 'File not found or path is missing'}, status=404)
+
+    etag, last_modified = file_etag(file_instance, user), file_instance.uploaded_at
+    not_modified_response = not_modified(request, etag, last_modified)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    index = None
+    if integrity.verify_downloads():
+        index = await sync_to_async(integrity.get_index)(file_instance.file.name)
+    try:
+        decoder = await sync_to_async(BlobDecoder)(file_instance, user) # may load the user's key
+        chunks = await async_storage.open_chunks(file_instance.file.name, STREAM_CHUNK_SIZE)
+    except FileServiceError as e:
+        return JsonResponse({'error': e.message}, status=e.status_code)
+    except BlobNotFound:
+        return JsonResponse({'error': 'File not found on storage backend'}, status=404)
+
+    await sync_to_async(log_access)(file_instance, user, 'download', request.META)
+
+    # Stored bytes are verified chunk by chunk before they are decrypted and sent
+    verifier = integrity.ChunkVerifier(index) if index is not None else None
+
+    def decode(chunk):
+        return decoder.update(verifier.update(chunk) if verifier else chunk)
+
+    def decode_tail():
+        plain = decoder.update(verifier.finalize()) if verifier else b''
+        return plain + decoder.finalize()
+
+    async def stream():
+        try:
+            async for chunk in chunks:
+                plain = await asyncio.to_thread(decode, chunk)
+                if plain:
+                    yield plain
+            tail = decode_tail()
+            if tail:
+                yield tail
+        except integrity.IntegrityFailure as e:
+            await sync_to_async(integrity.report)(index, BlobIntegrity.CORRUPT, e.detail)
+            raise
+
+    content_type, _ = mimetypes.guess_type(file_instance.original_filename)
+    response = StreamingHttpResponse(stream(), content_type=content_type or 'application/octet-stream')
+    size = plaintext_size(file_instance)
+    if size is not None:
+        response['Content-Length'] = str(size)
+    response['Content-Disposition'] = f'attachment; filename="{file_instance.original_filename}"'
+    return set_validators(response, etag, last_modified)
+
+
+async def signed_download(request, token):
+    """
+    Serve a link issued by FileViewSet.download_token.
+
+    The token only names the file, so there is no authentication here: the
+    File row and its owner are loaded with one query and the owner's key is
+    derived on the server. Plain blobs on S3/MinIO are handed off to a
+    presigned URL expiring with the token; everything else is streamed and
+    decoded on the fly.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        payload = signed_urls.verify(token)
+        file_instance, decoder = await sync_to_async(signed_urls.redeem)(payload)
+    except signed_urls.ExpiredDownloadToken:
+        return JsonResponse({'error': 'Download link has expired.'}, status=410)
+    except signed_urls.InvalidDownloadToken:
+        return JsonResponse({'error': 'Invalid download link.'}, status=403)
+    except FileServiceError as e:
+        return JsonResponse({'error': e.message}, status=e.status_code)
+
+    name = file_instance.file.name
+    content_type, _ = mimetypes.guess_type(file_instance.original_filename)
+    content_type = content_type or 'application/octet-stream'
+    access.record(file_instance.id)  # Counted like any download, without another query here
+    disposition = f'attachment; filename="{file_instance.original_filename}"'
+    if (not file_instance.is_encrypted and not file_instance.compression
+            and getattr(settings, 'STORAGE_BACKEND', 'local') == 's3'):
+        # The bucket of the blob's storage tier; no request unless a cold tier is configured
+        tier = await asyncio.to_thread(locate_blob, name)
+        if tier is not None and tier.is_s3:
+            url = await asyncio.to_thread(
+                tier.storage.url, name,
+                parameters={'ResponseContentDisposition': disposition, 'ResponseContentType': content_type},
+                expire=max(1, int(payload['exp'] - time.time())),
+            )
+            response = HttpResponseRedirect(url)
+            response['Cache-Control'] = 'private, no-store'
+            return response
+
+    try:
+        chunks = await async_storage.open_chunks(name, STREAM_CHUNK_SIZE)
+    except BlobNotFound:
+        return JsonResponse({'error': 'File not found on storage backend'}, status=404)
+
+    async def stream():
+        async for chunk in chunks:
+            plain = await asyncio.to_thread(decoder.update, chunk)
+            if plain:
+                yield plain
+        tail = decoder.finalize()
+        if tail:
+            yield tail
+
+    response = StreamingHttpResponse(stream(), content_type=content_type)
+    size = plaintext_size(file_instance)
+    if size is not None:
+        response['Content-Length'] = str(size)
+    response['Content-Disposition'] = disposition
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+async def upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    user = await _authenticate(request)
+    if user is None:
+        return _unauthorized()
+
+    # The ASGI handler has already buffered the body off the event loop; multipart
+    # parsing touches the spooled temp file and (see files/uploads.py) hashes,
+    # encrypts and stores the file as it goes, so keep it off the loop too.
+    uploads.install(request, user)
+    uploaded_file = await sync_to_async(lambda: request.FILES.get('file'))()
+    if not uploaded_file:
+        return JsonResponse({'error': 'No file provided'}, status=400)
+
+    try:
+        folder = await sync_to_async(folders.owned)(user, request.POST.get('folder'))
+    except folders.FolderError as e:
+        await sync_to_async(uploads.discard)(uploaded_file)
+        return JsonResponse({'error': e.message}, status=e.status_code)
+
+    if isinstance(uploaded_file, uploads.StoredUpload):
+        try:
+            file_instance = await sync_to_async(uploads.store)(user, uploaded_file, request.META, folder)
+        except FileServiceError as e:
+            return JsonResponse({'error': e.message}, status=e.status_code)
+        data = await sync_to_async(_serialize)(file_instance, request)
+        return JsonResponse(data, status=201)
+
+    try:
+        await sync_to_async(check_upload_allowed)(user, uploaded_file.size) # reads current used_storage
+        content = await asyncio.to_thread(uploaded_file.read)
+        file_hash = await asyncio.to_thread(hash_content, content)
+
+        existing_file = await File.objects.filter(file_hash=file_hash).afirst()
+        if existing_file:
+            await sync_to_async(backfill_merkle_root)(existing_file, content)
+            file_instance = await sync_to_async(add_file_reference)(
+                user, existing_file, uploaded_file.name, uploaded_file.content_type, request_meta=request.META,
+                folder=folder
+            )
+        else:
+            encoded = await asyncio.to_thread(
+                encode_content, user, content, uploaded_file.name, uploaded_file.content_type
+            )
+            try:
+                name = await asyncio.to_thread(new_storage_name, encoded['is_encrypted'], encoded['content'])
+                stored_path = await async_storage.save(name, encoded['content'])
+                await sync_to_async(integrity.record)(stored_path, encoded['content'])
+            except Exception as e:
+                logger.error(f"Failed to save file to storage: {e}", exc_info=True)
+                raise FileServiceError('Failed to save file to storage.', status_code=500)
+            root = await asyncio.to_thread(merkle_root, content)
+            file_instance = await sync_to_async(create_file_record)(
+                user, stored_path, uploaded_file.name, uploaded_file.content_type,
+                len(encoded['content']), len(content), file_hash, encoded, request.META, root=root, folder=folder
+            )
+            await sync_to_async(previews.schedule)(
+                file_hash, content, uploaded_file.name, uploaded_file.content_type
+            )
+    except FileServiceError as e:
+        return JsonResponse({'error': e.message}, status=e.status_code)
+
+    data = await sync_to_async(_serialize)(file_instance, request)
+    return JsonResponse(data, status=201)
+
+
+# Token auth only; there is no session cookie to protect
+upload.csrf_exempt = True
+download.csrf_exempt = True
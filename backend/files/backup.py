@@ -0,0 +1,360 @@
+"""
+Vault backups.
+
+backup_vault writes a snapshot of the vault to BACKUP_TARGET, a directory
+('local:<dir>') or a bucket on the S3 server ('s3:<bucket>'). A snapshot
+holds the database rows (dumpdata) and every blob they refer to. Blobs are
+stored once by address, shared by all snapshots:
+
+    blobs/<ab>/<address>               the stored bytes, as on the vault's storage
+    blobs/<ab>/<address>.sha256        their SHA-256, for blobs without an integrity index
+    snapshots/<id>/metadata.jsonl.gz   the rows
+    snapshots/<id>/blobs.jsonl.gz      name, address and size of every blob
+    snapshots/<id>/manifest.json       totals; written last, so only finished snapshots have one
+
+The address of a blob with an integrity index (files/integrity.py) is its
+Merkle root, which is known without reading the blob. A snapshot therefore
+costs one lookup per blob on the backup target and only reads the blobs no
+earlier snapshot holds: new ones and those rewritten by a key rotation.
+Identical content under several names is stored once. Blobs without an
+index (previews, profile photos and avatar variants) never change under
+their name, so they are addressed by name and size, at the cost of a HEAD
+each.
+
+The rows and the blob list are read in one transaction (REPEATABLE READ on
+PostgreSQL), so they match each other. The blobs are copied afterwards,
+outside of it, by BACKUP_WORKERS threads streaming READ_CHUNK_SIZE pieces,
+so memory use does not depend on the size or number of blobs. Each copy is
+checked as it is read, against its address or by hashing it. A blob
+deleted or rewritten between the two steps no longer matches the list; it
+is left out and counted in the manifest (avoid key rotations during
+backups). A backup that fails leaves no manifest; running it again copies
+only what is still missing.
+
+restore_vault loads a snapshot's rows into an empty database and copies its
+blobs back to the hot tier, checking every blob as it is read.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import posixpath
+import secrets
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import integrity, storage_tiers
+from .blobs import BlobNotFound, BlobWriter, blob_size, blob_size_on, open_blob
+from .models import BlobIntegrity
+from .replication import referenced_names
+
+BLOBS = 'blobs'
+SNAPSHOTS = 'snapshots'
+MANIFEST = 'manifest.json'
+METADATA = 'metadata.jsonl.gz'
+BLOB_LIST = 'blobs.jsonl.gz'
+
+# The queue of files/outbox.py and the tier placement describe the current
+# storage, not the vault; a restore puts every blob on the hot tier
+DUMP = ['auth.group', 'users', 'files']
+DUMP_EXCLUDE = ['files.ReplicationTask', 'files.BlobTier']
+
+LISTING_BATCH = 500
+
+COPIED = 'copied'
+PRESENT = 'present'  # Already on the target
+MISSING = 'missing'  # Deleted since it was listed
+CHANGED = 'changed'  # No longer matches its address: rewritten since it was listed, or corrupt
+
+
+def target():
+    """The backup target, as a storage_tiers.Tier."""
+    return storage_tiers.from_spec('backup', settings.BACKUP_TARGET, 'BACKUP_TARGET')
+
+
+def workers():
+    return getattr(settings, 'BACKUP_WORKERS', 8)
+
+
+def _blob_path(address):
+    return posixpath.join(BLOBS, address[:2], address)
+
+
+def _snapshot_path(snapshot_id, name):
+    return posixpath.join(SNAPSHOTS, snapshot_id, name)
+
+
+class _WriterFile(io.RawIOBase):
+    """A BlobWriter as a writable binary file, for gzip."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.writer.write(bytes(data))
+        return len(data)
+
+
+class _GzipLines:
+    """Text lines written gzip-compressed to `path` on the target; nothing is visible until close()."""
+
+    def __init__(self, tier, path):
+        self._writer = BlobWriter(path, tier=tier)
+        self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=_WriterFile(self._writer), mode='wb'), encoding='utf-8')
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.file.close()
+            self._writer.close()
+        else:
+            self._writer.abort()
+
+
+def _read_lines(tier, path):
+    """The lines of a gzip-compressed file on the target, streamed."""
+    with open_blob(path, use_cache=False, tier=tier) as f:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='rb'), encoding='utf-8') as lines:
+            yield from lines
+
+
+def _parallel(function, items, threads):
+    """function(item) for every item, in completion order, on `threads` threads with a bounded backlog."""
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='backup') as pool:
+        pending = set()
+        try:
+            for item in items:
+                pending.add(pool.submit(function, item))
+                if len(pending) >= threads * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _listing():
+    """(name, index values or None) of every blob the database refers to; LISTING_BATCH names per query."""
+    batch = []
+    for name in referenced_names():
+        batch.append(name)
+        if len(batch) >= LISTING_BATCH:
+            yield from _with_indexes(batch)
+            batch = []
+    yield from _with_indexes(batch)
+
+
+def _with_indexes(names):
+    indexes = {
+        row['name']: row
+        for row in BlobIntegrity.objects.filter(name__in=names).values('name', 'root', 'size', 'chunk_size')
+    }
+    for name in names:
+        yield name, indexes.get(name)
+
+
+def _unindexed_address(name, size):
+    return 'n' + hashlib.sha256(f'{name}\0{size}'.encode()).hexdigest()
+
+
+def _backup_blob(tier, entry):
+    """Copy one listed blob to the target unless it is there; returns (blob list line or None, result, bytes read)."""
+    name, index = entry['name'], entry['index']
+    if index is not None:
+        address, size = index['root'], index['size']
+    else:
+        size = blob_size(name)
+        if size is None:
+            return None, MISSING, 0
+        address = _unindexed_address(name, size)
+    line = {'name': name, 'address': address, 'size': size}
+    if index is not None:
+        line['chunk_size'] = index['chunk_size']
+    path = _blob_path(address)
+    if blob_size_on(path, tier) == size:
+        return line, PRESENT, 0
+
+    check = integrity.IndexBuilder(index['chunk_size']) if index is not None else hashlib.sha256()
+    writer = BlobWriter(path, tier=tier)
+    read = 0
+    try:
+        with open_blob(name, use_cache=False) as f:
+            for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                check.update(data)
+                writer.write(data)
+                read += len(data)
+        if index is not None and (read != size or check.finish()['root'] != address):
+            writer.abort()
+            return None, CHANGED, read
+        if index is None:
+            if read != size:
+                writer.abort()
+                return None, CHANGED, read
+            # Before the blob itself: a stored blob always has its hash
+            _write_small(tier, path + '.sha256', check.hexdigest().encode())
+        writer.close()
+    except BlobNotFound:
+        writer.abort()
+        return None, MISSING, read
+    except BaseException:
+        writer.abort()
+        raise
+    return line, COPIED, read
+
+
+def _write_small(tier, path, content):
+    writer = BlobWriter(path, tier=tier)
+    writer.write(content)
+    writer.close()
+
+
+def _read_small(tier, path):
+    with open_blob(path, use_cache=False, tier=tier) as f:
+        return f.read()
+
+
+def create(tier, threads=None):
+    """Write a new snapshot to `tier` (see target()); returns its manifest."""
+    threads = threads or workers()
+    started = timezone.now()
+    # Sorts by time; the suffix keeps backups started in the same instant apart
+    snapshot_id = f"{started:%Y%m%dT%H%M%S.%fZ}-{secrets.token_hex(3)}"
+    with tempfile.TemporaryFile() as listing:
+        # The rows and the names of their blobs, from one view of the database
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            with _GzipLines(tier, _snapshot_path(snapshot_id, METADATA)) as out:
+                call_command(
+                    'dumpdata', *DUMP, exclude=DUMP_EXCLUDE, format='jsonl',
+                    use_natural_foreign_keys=True, stdout=out, verbosity=0,
+                )
+            with gzip.GzipFile(fileobj=listing, mode='wb') as out:
+                for name, index in _listing():
+                    out.write(json.dumps({'name': name, 'index': index}).encode() + b'\n')
+        listing.seek(0)
+
+        counts = {COPIED: 0, PRESENT: 0, MISSING: 0, CHANGED: 0}
+        total = copied_bytes = 0
+        entries = (json.loads(line) for line in gzip.GzipFile(fileobj=listing, mode='rb'))
+        with _GzipLines(tier, _snapshot_path(snapshot_id, BLOB_LIST)) as out:
+            for line, result, read in _parallel(lambda entry: _backup_blob(tier, entry), entries, threads):
+                counts[result] += 1
+                if line is None:
+                    continue  # Left out; counted as missing
+                out.write(json.dumps(line) + '\n')
+                total += line['size']
+                if result == COPIED:
+                    copied_bytes += read
+
+    manifest = {
+        'id': snapshot_id,
+        'started_at': started.isoformat(),
+        'finished_at': timezone.now().isoformat(),
+        'blobs': counts[COPIED] + counts[PRESENT],
+        'bytes': total,
+        'copied': counts[COPIED],
+        'copied_bytes': copied_bytes,
+        'missing': counts[MISSING] + counts[CHANGED],
+    }
+    _write_small(tier, _snapshot_path(snapshot_id, MANIFEST), json.dumps(manifest, indent=2).encode())
+    return manifest
+
+
+def snapshots(tier):
+    """Ids of the finished snapshots on `tier`, oldest first."""
+    try:
+        directories, _ = tier.storage.listdir(SNAPSHOTS)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        snapshot_id for snapshot_id in directories
+        if blob_size_on(_snapshot_path(snapshot_id, MANIFEST), tier) is not None
+    )
+
+
+def manifest(tier, snapshot_id):
+    """The manifest of a finished snapshot; raises BlobNotFound."""
+    return json.loads(_read_small(tier, _snapshot_path(snapshot_id, MANIFEST)))
+
+
+def restore_metadata(tier, snapshot_id):
+    """Load a snapshot's rows (into an empty database)."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, METADATA)  # loaddata tells the format from the name
+        with open_blob(_snapshot_path(snapshot_id, METADATA), use_cache=False, tier=tier) as src:
+            with open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, integrity.READ_CHUNK_SIZE)
+        call_command('loaddata', path, verbosity=0)
+
+
+def _restore_blob(tier, line, verify_only, overwrite):
+    """Check one blob of a snapshot and copy it back; returns (name, result, bytes read)."""
+    name, address, size = line['name'], line['address'], line['size']
+    hot = storage_tiers.hot()
+    if not verify_only and not overwrite and blob_size(name) == size:
+        return name, PRESENT, 0
+    path = _blob_path(address)
+    if 'chunk_size' in line:
+        check, expected = integrity.IndexBuilder(line['chunk_size']), address
+    else:
+        try:
+            check, expected = hashlib.sha256(), _read_small(tier, path + '.sha256').decode()
+        except BlobNotFound:
+            return name, MISSING, 0
+    writer = None if verify_only else BlobWriter(name, tier=hot)
+    read = 0
+    try:
+        with open_blob(path, use_cache=False, tier=tier) as f:
+            for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                check.update(data)
+                if writer:
+                    writer.write(data)
+                read += len(data)
+        digest = check.finish()['root'] if 'chunk_size' in line else check.hexdigest()
+        if read != size or digest != expected:
+            if writer:
+                writer.abort()
+            return name, CHANGED, read
+        if writer:
+            writer.close()
+    except BlobNotFound:
+        if writer:
+            writer.abort()
+        return name, MISSING, read
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    return name, COPIED, read
+
+
+def restore_blobs(tier, snapshot_id, verify_only=False, overwrite=False, threads=None):
+    """
+    Check every blob of a snapshot against its address or hash and, unless
+    verify_only, copy it to the hot tier under its name (blobs already
+    there with the right size are kept unless `overwrite`). Yields (name,
+    result, bytes read): COPIED (or checked), PRESENT, MISSING or CHANGED.
+    """
+    lines = (json.loads(line) for line in _read_lines(tier, _snapshot_path(snapshot_id, BLOB_LIST)))
+    yield from _parallel(
+        lambda line: _restore_blob(tier, line, verify_only, overwrite), lines, threads or workers()
+    )
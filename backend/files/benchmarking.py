@@ -0,0 +1,242 @@
+"""
+Small helpers shared by the benchmark management commands.
+
+Every benchmark writes the same JSON envelope ({"benchmark", "environment",
+"results"}) so runs from different commands and hosts can be compared.
+"""
+import json
+import math
+import os
+import platform
+import random
+import string
+import time
+from datetime import datetime, timezone
+
+MB = 1024 * 1024
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile (0-100) of samples using nearest-rank."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def summarize_latencies(samples):
+    """Summarize a list of durations in seconds as milliseconds."""
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'min_ms': round(min(samples) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def throughput_mb_s(nbytes, seconds):
+    """Return throughput in MB/s, or None if the duration is too small to measure."""
+    if seconds <= 0:
+        return None
+    return round(nbytes / MB / seconds, 2)
+
+
+def best_of(fn, repeat=3):
+    """Run fn() `repeat` times and return (best duration in seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def environment_info():
+    """Describe the host so results from different machines are not mixed up."""
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_results(path, benchmark, results, **extra):
+    """Write results in the shared JSON envelope and return the document."""
+    document = {'benchmark': benchmark, 'environment': environment_info(), **extra, 'results': results}
+    if path:
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2, default=str)
+    return document
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_size(value):
+    """Parse a human size like '64KB', '1MB' or '512' (bytes) into bytes."""
+    value = value.strip().upper()
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', MB), ('KB', 1024), ('B', 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def format_size(nbytes):
+    """Inverse of parse_size for labels: 1024 -> '1KB'."""
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', MB), ('KB', 1024)):
+        if nbytes >= factor and nbytes % factor == 0:
+            return f"{nbytes // factor}{suffix}"
+    return f"{nbytes}B"
+
+
+def flatten_metrics(results, prefix=''):
+    """Flatten nested result dicts into {'a.b.c': number} for comparison."""
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten_metrics(value, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix] = results
+    return flat
+
+
+# Metric name suffixes and whether a larger value is better
+_METRIC_DIRECTIONS = (
+    ('_ms', False),
+    ('_s', False),
+    ('_mb_s', True),
+    ('_ops_s', True),
+    ('ratio', True),
+)
+
+
+def metric_direction(name):
+    """Return True if higher is better, False if lower is better, None if not a tracked metric."""
+    leaf = name.rsplit('.', 1)[-1]
+    if leaf in ('count', 'min_ms', 'max_ms'):
+        return None  # too noisy / not a performance signal
+    # Check longest suffixes first so '_mb_s' is not mistaken for '_s'
+    for suffix, higher_is_better in sorted(_METRIC_DIRECTIONS, key=lambda d: -len(d[0])):
+        if leaf.endswith(suffix):
+            return higher_is_better
+    return None
+
+
+def compare_results(baseline, candidate, threshold_pct=10.0):
+    """
+    Compare two result documents metric by metric.
+
+    Returns a list of dicts (metric, baseline, candidate, change_pct, status)
+    where status is 'regression', 'improvement' or 'ok'. Metrics only
+    present in one run are skipped.
+    """
+    base = flatten_metrics(baseline.get('results', baseline))
+    cand = flatten_metrics(candidate.get('results', candidate))
+    rows = []
+    for metric in sorted(set(base) & set(cand)):
+        higher_is_better = metric_direction(metric)
+        if higher_is_better is None:
+            continue
+        old, new = base[metric], cand[metric]
+        if not old:
+            continue
+        change = (new - old) / abs(old) * 100
+        worse = change < -threshold_pct if higher_is_better else change > threshold_pct
+        better = change > threshold_pct if higher_is_better else change < -threshold_pct
+        rows.append({
+            'metric': metric,
+            'baseline': old,
+            'candidate': new,
+            'change_pct': round(change, 1),
+            'status': 'regression' if worse else 'improvement' if better else 'ok',
+        })
+    return rows
+
+
+# --- Synthetic payloads -------------------------------------------------------
+
+_WORDS = (
+    'vault file storage secure upload download encrypt decrypt hash quota user '
+    'owner share folder document report invoice backup archive photo project '
+    'meeting notes budget draft final review data export import log event'
+).split()
+
+
+def _text(rng, size):
+    out = []
+    total = 0
+    while total < size:
+        line = ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(6, 14))).capitalize() + '.\n'
+        out.append(line)
+        total += len(line)
+    return ''.join(out).encode()[:size]
+
+
+def _csv(rng, size):
+    out = ['id,name,email,amount,created_at\n']
+    total = len(out[0])
+    i = 0
+    while total < size:
+        name = ''.join(rng.choice(string.ascii_lowercase) for _ in range(8))
+        line = f"{i},{name},{name}@example.com,{rng.uniform(0, 10000):.2f},2025-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}\n"
+        out.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(out).encode()[:size]
+
+
+def _json(rng, size):
+    out = ['[']
+    total = 1
+    i = 0
+    while total < size:
+        item = json.dumps({'id': i, 'type': rng.choice(_WORDS), 'value': rng.randint(0, 10 ** 6),
+                           'tags': rng.sample(_WORDS, 3), 'active': rng.random() > 0.5})
+        out.append(item + ',')
+        total += len(item) + 1
+        i += 1
+    return ''.join(out).encode()[:size]
+
+
+def _log(rng, size):
+    out = []
+    total = 0
+    while total < size:
+        line = (f"2025-06-01T12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}Z INFO "
+                f"{rng.choice(['api', 'worker', 'db'])} request_id={rng.getrandbits(64):016x} "
+                f"path=/api/files/ status={rng.choice([200, 200, 201, 404])} duration={rng.random():.3f}s\n")
+        out.append(line)
+        total += len(line)
+    return ''.join(out).encode()[:size]
+
+
+def _random(rng, size):
+    return rng.randbytes(size)
+
+
+SYNTHETIC_TYPES = {
+    # name: (generator, content type, filename)
+    'text': (_text, 'text/plain', 'sample.txt'),
+    'csv': (_csv, 'text/csv', 'sample.csv'),
+    'json': (_json, 'application/json', 'sample.json'),
+    'log': (_log, 'text/plain', 'sample.log'),
+    'binary': (_random, 'application/octet-stream', 'sample.bin'),
+    'jpeg': (_random, 'image/jpeg', 'sample.jpg'),
+}
+
+
+def synthetic_payload(kind, size, seed=0):
+    """Generate `size` bytes of reproducible sample content of the given kind."""
+    generator = SYNTHETIC_TYPES[kind][0]
+    return generator(random.Random(seed), size)
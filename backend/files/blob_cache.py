@@ -0,0 +1,214 @@
+"""
+Node-local read-through disk cache for blobs on the S3/MinIO backend.
+
+Dedup makes popular blobs common: one stored object, many File rows, and
+every download of any of them used to pull the whole object from MinIO.
+With BLOB_CACHE_DIR set, blobs read through files.blobs.open_blob() are
+kept on local disk and revalidated with a conditional GET
+(If-None-Match: <ETag>), so a hit costs one small 304 instead of the body.
+
+Only stored bytes are cached, i.e. ciphertext for encrypted blobs; nothing
+is ever decrypted into the cache. Entries live at
+
+    <BLOB_CACHE_DIR>/<h[:2]>/<h>/<etag>      h = sha256(storage name)
+
+so several worker processes can share the directory: entries are written
+to a temp file and renamed into place, and LRU order is the file mtime,
+refreshed on every hit. The total size is bounded by BLOB_CACHE_MAX_BYTES;
+a sweep evicts the least recently used entries whenever roughly 5% of the
+budget has been written since the last one.
+
+Deletes and in-place rewrites (key rotation) through files.blobs evict the
+entry on this node; other nodes notice the ETag change on their next
+conditional GET. BLOB_CACHE_TRUST_SECONDS > 0 skips revalidation for that
+long after a hit, trading a staleness window for fewer round trips.
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_written_since_sweep = 0
+_stats = {'hits': 0, 'misses': 0}
+
+
+def enabled():
+    return bool(getattr(settings, 'BLOB_CACHE_DIR', None))
+
+
+def _root():
+    return settings.BLOB_CACHE_DIR
+
+
+def _max_bytes():
+    return getattr(settings, 'BLOB_CACHE_MAX_BYTES', 10 * 1024 ** 3)
+
+
+def _entry_dir(name):
+    h = hashlib.sha256(name.encode()).hexdigest()
+    return os.path.join(_root(), h[:2], h)
+
+
+def _etag_filename(etag):
+    return re.sub(r'[^A-Za-z0-9_-]', '', etag or '') or 'noetag'
+
+
+def lookup(name):
+    """Return (etag_filename, path, size, mtime) of the cached copy of `name`, or None."""
+    entry_dir = _entry_dir(name)
+    try:
+        candidates = [e for e in os.scandir(entry_dir) if e.is_file() and not e.name.startswith('.')]
+    except FileNotFoundError:
+        return None
+    if not candidates:
+        return None
+    entry = max(candidates, key=lambda e: e.stat().st_mtime)
+    st = entry.stat()
+    return entry.name, entry.path, st.st_size, st.st_mtime
+
+
+def evict(name):
+    """Drop the cached copy of `name` on this node, if any."""
+    if not enabled():
+        return
+    shutil.rmtree(_entry_dir(name), ignore_errors=True)
+
+
+def _record(result, size=0):
+    with _lock:
+        _stats['hits' if result != 'miss' else 'misses'] += 1
+        total = _stats['hits'] + _stats['misses']
+        ratio = _stats['hits'] / total
+    metrics.incr('blob_cache.requests', result=result)
+    if result != 'miss':
+        metrics.incr('blob_cache.bytes_saved', size)
+    metrics.set_gauge('blob_cache.hit_ratio', round(ratio, 4))
+
+
+def _store(name, body, etag):
+    """Copy a response body into the cache and return the path of the new entry."""
+    global _written_since_sweep
+    entry_dir = _entry_dir(name)
+    os.makedirs(entry_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=entry_dir, prefix='.incoming-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: body.read(COPY_CHUNK_SIZE), b''):
+                f.write(chunk)
+                written += len(chunk)
+        path = os.path.join(entry_dir, _etag_filename(etag))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Older versions of the same blob
+    for other in os.listdir(entry_dir):
+        if other != os.path.basename(path) and not other.startswith('.'):
+            try:
+                os.remove(os.path.join(entry_dir, other))
+            except FileNotFoundError:
+                pass
+    with _lock:
+        _written_since_sweep += written
+        sweep_due = _written_since_sweep > _max_bytes() // 20
+        if sweep_due:
+            _written_since_sweep = 0
+    if sweep_due:
+        sweep()
+    return path
+
+
+def sweep():
+    """Evict least recently used entries until the cache fits in BLOB_CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(_root()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if filename.startswith('.incoming-') and st.st_mtime > time.time() - 3600:
+                continue  # Being written right now
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    limit = _max_bytes()
+    evicted = 0
+    if total > limit:
+        entries.sort()
+        target = int(limit * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except FileNotFoundError:
+                pass
+    metrics.set_gauge('blob_cache.bytes', total)
+    if evicted:
+        metrics.incr('blob_cache.evictions', evicted)
+    return total
+
+
+def open_s3(name, client, bucket, key):
+    """
+    Open `name` through the cache with exactly one request to S3.
+
+    Returns a binary file object. Errors from S3 (including not found)
+    propagate to the caller; the stale entry is dropped first.
+    """
+    cached = lookup(name)
+    if cached is not None:
+        etag_name, path, size, mtime = cached
+        trust = getattr(settings, 'BLOB_CACHE_TRUST_SECONDS', 0)
+        if trust and time.time() - mtime < trust:
+            _record('hit', size)
+            return open(path, 'rb')
+        try:
+            response = client.get_object(Bucket=bucket, Key=key, IfNoneMatch=f'"{etag_name}"')
+        except Exception as e:
+            status = getattr(e, 'response', {}).get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if status == 304:
+                try:
+                    os.utime(path)  # Refresh LRU position
+                    f = open(path, 'rb')
+                except FileNotFoundError:  # Evicted between lookup and open
+                    f = None
+                if f is not None:
+                    _record('revalidated', size)
+                    return f
+                response = client.get_object(Bucket=bucket, Key=key)
+            else:
+                evict(name)
+                raise
+    else:
+        response = client.get_object(Bucket=bucket, Key=key)
+
+    _record('miss')
+    body = response['Body']
+    length = response.get('ContentLength') or 0
+    if length > _max_bytes() // 10:
+        return body  # Too big to be worth caching here
+    try:
+        path = _store(name, body, response.get('ETag'))
+    finally:
+        body.close()
+    return open(path, 'rb')
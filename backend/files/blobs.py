@@ -0,0 +1,457 @@
+"""
+Blob access with one storage round trip per operation.
+
+Views used to call default_storage.exists() before open() or delete(). On
+the S3 backend every exists() is a HEAD request, and django-storages'
+open() adds another HEAD inside download_fileobj() before the GET. This
+module instead:
+
+  * reads a blob with a single GET (get_object on S3, a plain open() on
+    the filesystem) and turns "not found" into BlobNotFound;
+  * writes blobs that arrive in pieces (streamed uploads) through
+    BlobWriter, straight to their final location;
+  * deletes with a single DELETE, which is already idempotent;
+  * answers metadata questions (exists/size) from a short-lived cache of
+    HEAD results, positive and negative, that writes and deletes made
+    through this module keep up to date.
+
+Every request to the backend is counted in core.metrics as
+storage.round_trips{op=...} together with its latency. On S3, reads can
+additionally go through the local disk cache in files/blob_cache.py.
+
+With a cold storage tier configured (files/storage_tiers.py), reads,
+metadata lookups and in-place rewrites find the blob on whichever tier holds
+it, and deletes remove it from all of them; new blobs are written to the hot
+tier.
+
+With replicas configured, every write and delete made through this module is
+queued for them (files/outbox.py), and a read that finds the blob on no tier,
+or fails, is served from the first replica holding it. With
+STORAGE_REPLICA_HEDGE_MS set, a read the tiers have not answered within
+that many milliseconds is also sent to the replicas, and whichever answers
+first wins; the other answer is closed as it arrives.
+"""
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from storages.utils import clean_name
+
+from core import metrics
+
+from . import blob_cache, outbox, storage_tiers
+
+logger = logging.getLogger(__name__)
+
+HEDGE_WORKERS = 16
+
+
+class BlobNotFound(Exception):
+    """The requested blob does not exist in storage"""
+
+
+def is_not_found(exc):
+    """Whether a storage exception means the object does not exist."""
+    if isinstance(exc, (FileNotFoundError, BlobNotFound)):
+        return True
+    response = getattr(exc, 'response', None)
+    if isinstance(response, dict):
+        code = str(response.get('Error', {}).get('Code', ''))
+        status_code = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in ('NoSuchKey', '404', 'NotFound') or status_code == 404
+    return False
+
+
+def s3_key(name):
+    """Object key of a blob under the hot storage's location prefix."""
+    return default_storage._normalize_name(clean_name(name))
+
+
+class _MetadataCache:
+    """Small TTL cache of blob sizes; None records a blob known not to exist."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+            expires_at, size = entry
+            if expires_at <= time.monotonic():
+                del self._entries[name]
+                return False, None
+            return True, size
+
+    def set(self, name, size):
+        ttl = (getattr(settings, 'STORAGE_META_CACHE_TTL', 30) if size is not None
+               else getattr(settings, 'STORAGE_META_NEGATIVE_TTL', 5))
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()  # Crude but bounded; entries are short-lived anyway
+            self._entries[name] = (time.monotonic() + ttl, size)
+
+    def forget(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+metadata_cache = _MetadataCache()
+
+
+def _record(op, started):
+    metrics.incr('storage.round_trips', op=op)
+    metrics.observe('storage.latency', time.perf_counter() - started, op=op)
+
+
+def _open_on(tier, name, use_cache):
+    if tier.is_filesystem:
+        return open(tier.storage.path(name), 'rb')
+    if tier.is_s3 and use_cache and blob_cache.enabled():
+        return blob_cache.open_s3(name, tier.client, tier.bucket, tier.s3_key(name))
+    if tier.is_s3:
+        response = tier.client.get_object(Bucket=tier.bucket, Key=tier.s3_key(name))
+        metadata_cache.set(name, response.get('ContentLength'))
+        return response['Body']
+    return tier.storage.open(name, 'rb')
+
+
+def _open_first(candidates, name, use_cache, remember=True):
+    """Open `name` on the first of `candidates` holding it; raises BlobNotFound."""
+    for candidate in candidates:
+        started = time.perf_counter()
+        try:
+            f = _open_on(candidate, name, use_cache)
+        except Exception as e:
+            if is_not_found(e):
+                continue
+            raise
+        finally:
+            _record('get', started)
+        if remember:
+            storage_tiers.found(name, candidate)
+        return f
+    raise BlobNotFound(name)
+
+
+def _open_tiers(name, use_cache):
+    try:
+        return _open_first(storage_tiers.candidates(name), name, use_cache)
+    except BlobNotFound:
+        metadata_cache.set(name, None)
+        raise
+
+
+def _fail_over(name, replicas, error):
+    """Open `name` on a replica after the tiers failed with `error`; re-raises it if no replica has the blob."""
+    try:
+        f = _open_first(replicas, name, use_cache=False, remember=False)
+    except Exception:
+        raise error
+    reason = 'missing' if is_not_found(error) else 'error'
+    logger.warning(f"Reading blob {name} from a replica ({reason} on the primary storage: {error})")
+    metrics.incr('replication.failover', reason=reason)
+    return f
+
+
+_hedge_pool = None
+_hedge_lock = threading.Lock()
+
+
+def _hedge_executor():
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_lock:
+            if _hedge_pool is None:
+                _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='blob-hedge')
+    return _hedge_pool
+
+
+def _close_unused(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def _open_hedged(name, use_cache, replicas, delay):
+    pool = _hedge_executor()
+    primary = pool.submit(_open_tiers, name, use_cache)
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeout:
+        pass
+    except Exception as e:
+        return _fail_over(name, replicas, e)
+    metrics.incr('replication.hedged')
+    backup = pool.submit(_open_first, replicas, name, False, False)
+    for future in as_completed((primary, backup)):
+        if future.exception() is None:
+            (backup if future is primary else primary).add_done_callback(_close_unused)
+            if future is backup:
+                metrics.incr('replication.failover', reason='slow')
+            return future.result()
+    raise primary.exception()
+
+
+def open_blob(name, use_cache=True, tier=None, failover=True):
+    """
+    Open a blob for reading with a single request (per tier tried).
+
+    Returns a binary file-like object (read(n), close(), context manager).
+    Raises BlobNotFound if it does not exist. use_cache=False reads from the
+    backend even when the local blob cache is enabled; `tier` reads the copy
+    on that tier only. failover=False never reads from a replica (checks of
+    the primary copy).
+    """
+    if tier is not None:
+        return _open_first([tier], name, use_cache)
+    replicas = storage_tiers.replicas() if failover else []
+    if not replicas:
+        return _open_tiers(name, use_cache)
+    delay = getattr(settings, 'STORAGE_REPLICA_HEDGE_MS', 0) / 1000
+    if delay > 0:
+        return _open_hedged(name, use_cache, replicas, delay)
+    try:
+        return _open_tiers(name, use_cache)
+    except Exception as e:
+        return _fail_over(name, replicas, e)
+
+
+def read_blob(name):
+    """Read a whole blob with a single request; raises BlobNotFound."""
+    f = open_blob(name)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def blob_size(name):
+    """Size of a blob, or None if it does not exist (HEAD, cached)."""
+    hit, size = metadata_cache.get(name)
+    metrics.incr('storage.metadata_cache', result='hit' if hit else 'miss')
+    if hit:
+        return size
+    size = None
+    for tier in storage_tiers.candidates(name):
+        size = _size_on(tier, name)
+        if size is not None:
+            storage_tiers.found(name, tier)
+            break
+    metadata_cache.set(name, size)
+    return size
+
+
+def _size_on(tier, name):
+    started = time.perf_counter()
+    try:
+        return tier.storage.size(name)
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+        return None
+    finally:
+        _record('head', started)
+
+
+def blob_size_on(name, tier):
+    """Size of the copy of a blob on `tier` (a tier or a replica), or None; an uncached HEAD."""
+    return _size_on(tier, name)
+
+
+def locate_blob(name):
+    """
+    The tier holding a blob, or None if there is none. Costs no request
+    with a single tier (returns it), else a HEAD per tier tried.
+    """
+    candidates = storage_tiers.candidates(name)
+    if len(candidates) == 1:
+        return candidates[0]
+    for tier in candidates:
+        if _size_on(tier, name) is not None:
+            storage_tiers.found(name, tier)
+            return tier
+    return None
+
+
+def blob_exists(name):
+    return blob_size(name) is not None
+
+
+def _delete_on(tier, name):
+    started = time.perf_counter()
+    try:
+        tier.storage.delete(name)
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+    finally:
+        _record('delete', started)
+
+
+def delete_blob(name, tier=None):
+    """
+    Delete a blob with a single request per tier; deleting a missing blob is
+    not an error. `tier` deletes only the copy on that tier (after a move).
+    """
+    for candidate in [tier] if tier is not None else storage_tiers.tiers():
+        _delete_on(candidate, name)
+    if tier is None:
+        metadata_cache.set(name, None)
+        storage_tiers.placements.forget(name)
+        outbox.enqueue(name, outbox.DELETE)
+    blob_cache.evict(name)
+
+
+def save_blob(name, content):
+    """Save bytes under `name` (or a free variant of it) and return the name used."""
+    started = time.perf_counter()
+    try:
+        name = default_storage.save(name, ContentFile(content))
+    finally:
+        _record('put', started)
+    metadata_cache.set(name, len(content))
+    outbox.enqueue(name, outbox.PUT)
+    return name
+
+
+class BlobWriter:
+    """
+    Writes a new blob as its bytes arrive: write() pieces in order, then
+    close() to make it visible under its name, or abort() to drop it.
+
+    On the filesystem the bytes go to a temp file next to the target, renamed
+    into place on close(). On S3 they are sent as a multipart upload in parts
+    of S3_UPLOAD_PART_SIZE (a single PUT if the blob stays smaller). Other
+    backends get the whole blob at close().
+
+    New blobs go to the hot tier under a free variant of `name`. Given a
+    `tier`, the blob is written there under exactly `name`, replacing what
+    is there (a copy made by files/tiering.py or files/replication.py),
+    and it is not queued for replication.
+    """
+
+    def __init__(self, name, tier=None):
+        self.size = 0
+        self._replicate = tier is None
+        self._tier = tier or storage_tiers.hot()
+        storage = self._tier.storage
+        if self._tier.is_filesystem:
+            self.name = name if tier is not None else storage.get_available_name(name)
+            self._path = storage.path(self.name)
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            fd, self._tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix='.upload-')
+            self._file = os.fdopen(fd, 'wb')
+        else:
+            self.name = name
+            self._buffer = bytearray() if self._tier.is_s3 else io.BytesIO()
+            self._upload_id = None
+            self._parts = []
+
+    def _s3_call(self, method, **kwargs):
+        started = time.perf_counter()
+        try:
+            return getattr(self._tier.client, method)(
+                Bucket=self._tier.bucket, Key=self._tier.s3_key(self.name), **kwargs
+            )
+        finally:
+            _record('put', started)
+
+    def _s3_params(self):
+        get_parameters = getattr(self._tier.storage, 'get_object_parameters', None)
+        return get_parameters(self.name) if get_parameters else {}
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self._s3_call('create_multipart_upload', **self._s3_params())['UploadId']
+        number = len(self._parts) + 1
+        response = self._s3_call('upload_part', UploadId=self._upload_id, PartNumber=number, Body=bytes(body))
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def write(self, data):
+        self.size += len(data)
+        if self._tier.is_filesystem:
+            self._file.write(data)
+        elif self._tier.is_s3:
+            self._buffer += data
+            part_size = getattr(settings, 'S3_UPLOAD_PART_SIZE', 8 * 1024 * 1024)
+            while len(self._buffer) >= part_size:
+                self._upload_part(self._buffer[:part_size])
+                del self._buffer[:part_size]
+        else:
+            self._buffer.write(data)
+
+    def close(self):
+        """Finish the blob and return its name."""
+        if self._tier.is_filesystem:
+            self._file.close()
+            if self._tier.storage.file_permissions_mode is not None:
+                os.chmod(self._tmp_path, self._tier.storage.file_permissions_mode)
+            os.replace(self._tmp_path, self._path)
+            record_write(self.name, self.size, replicate=self._replicate)
+        elif self._tier.is_s3:
+            if self._upload_id is None:
+                self._s3_call('put_object', Body=bytes(self._buffer), **self._s3_params())
+            else:
+                if self._buffer:
+                    self._upload_part(self._buffer)
+                self._s3_call(
+                    'complete_multipart_upload', UploadId=self._upload_id, MultipartUpload={'Parts': self._parts}
+                )
+            metadata_cache.set(self.name, self.size)
+            blob_cache.evict(self.name)
+            if self._replicate:
+                outbox.enqueue(self.name, outbox.PUT)
+        else:
+            self.name = save_blob(self.name, self._buffer.getvalue())
+        return self.name
+
+    def abort(self):
+        """Drop whatever was written so far; safe to call more than once."""
+        if self._tier.is_filesystem:
+            self._file.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+        elif self._tier.is_s3 and self._upload_id is not None:
+            self._s3_call('abort_multipart_upload', UploadId=self._upload_id)
+            self._upload_id = None
+
+
+class Throttle:
+    """Sleeps as needed to keep the average transfer rate of background jobs under `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.total = 0
+
+    def __call__(self, nbytes):
+        self.total += nbytes
+        if self.rate:
+            ahead = self.total / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def record_write(name, size, replicate=True):
+    """Note a blob written outside this module (e.g. in-place overwrite); queues it for the replicas."""
+    metrics.incr('storage.round_trips', op='put')
+    metadata_cache.set(name, size)
+    blob_cache.evict(name)
+    if replicate:
+        outbox.enqueue(name, outbox.PUT)
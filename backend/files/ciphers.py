@@ -0,0 +1,263 @@
+"""
+Pluggable cipher engines for blob encryption.
+
+Every engine exposes streaming encryptor/decryptor objects with
+update(data) -> bytes and finalize() -> bytes, plus one-shot helpers. The
+engine used for a blob is recorded on File.cipher so old blobs stay
+readable when the default changes.
+
+Engines:
+  aes-cfb            Legacy format: 16-byte IV + AES-256-CFB8 (pycryptodome).
+                     Unauthenticated and slow; kept for existing blobs.
+  aes-gcm            Segmented AES-256-GCM (cryptography). Fastest with AES-NI.
+  chacha20-poly1305  Segmented ChaCha20-Poly1305 (cryptography). Fastest
+                     on CPUs without AES instructions.
+
+The authenticated engines use a STREAM-style online AEAD layout so blobs can
+be encrypted and decrypted in bounded memory:
+
+  header  = version (1) | segment size (4, big-endian) | nonce prefix (7)
+  segment = AEAD(plaintext[i*S:(i+1)*S], nonce = prefix | counter (4) | last (1))
+
+Each segment carries its own 16-byte tag; the "last" flag in the nonce
+detects truncation and the counter detects reordering.
+"""
+import abc
+import os
+import struct
+
+from Crypto.Cipher import AES
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from django.conf import settings
+
+AES_CFB = 'aes-cfb'
+AES_GCM = 'aes-gcm'
+CHACHA20_POLY1305 = 'chacha20-poly1305'
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+
+
+class CipherError(ValueError):
+    """Decryption failed: wrong key, corrupted or truncated ciphertext"""
+
+
+class CipherEngine(abc.ABC):
+    name = None
+    authenticated = False
+
+    @abc.abstractmethod
+    def encryptor(self, key):
+        """A streaming encryptor: update(data) -> bytes, finalize() -> bytes."""
+
+    @abc.abstractmethod
+    def decryptor(self, key):
+        """A streaming decryptor; raises CipherError on bad ciphertext."""
+
+    def encrypt(self, key, data):
+        encryptor = self.encryptor(key)
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, key, data):
+        decryptor = self.decryptor(key)
+        return decryptor.update(data) + decryptor.finalize()
+
+    @abc.abstractmethod
+    def plaintext_size(self, stored_size):
+        """Size of the plaintext for a blob of stored_size bytes."""
+
+
+# --- Legacy AES-CFB ----------------------------------------------------------
+
+class _CFBEncryptor:
+    def __init__(self, key):
+        iv = os.urandom(AESCFBEngine.IV_SIZE)
+        self._cipher = AES.new(key, AES.MODE_CFB, iv=iv)
+        self._header = iv
+
+    def update(self, data):
+        out = self._cipher.encrypt(data)
+        if self._header:
+            out, self._header = self._header + out, b''
+        return out
+
+    def finalize(self):
+        out, self._header = self._header, b''
+        return out
+
+
+class _CFBDecryptor:
+    def __init__(self, key):
+        self._key = key
+        self._cipher = None
+        self._pending = b''
+
+    def update(self, data):
+        if self._cipher is None:
+            self._pending += data
+            if len(self._pending) < AESCFBEngine.IV_SIZE:
+                return b''
+            iv, data = self._pending[:AESCFBEngine.IV_SIZE], self._pending[AESCFBEngine.IV_SIZE:]
+            self._pending = b''
+            self._cipher = AES.new(self._key, AES.MODE_CFB, iv=iv)
+        return self._cipher.decrypt(data)
+
+    def finalize(self):
+        if self._cipher is None:
+            raise CipherError('Ciphertext is shorter than the IV')
+        return b''
+
+
+class AESCFBEngine(CipherEngine):
+    name = AES_CFB
+    IV_SIZE = 16
+
+    def encryptor(self, key):
+        return _CFBEncryptor(key)
+
+    def decryptor(self, key):
+        return _CFBDecryptor(key)
+
+    def plaintext_size(self, stored_size):
+        return max(0, stored_size - self.IV_SIZE)
+
+
+# --- Segmented AEAD ----------------------------------------------------------
+
+class _SegmentedEncryptor:
+    def __init__(self, engine, key, segment_size):
+        self._aead = engine.aead_class(key)
+        self._segment_size = segment_size
+        self._prefix = os.urandom(SegmentedAEADEngine.NONCE_PREFIX_SIZE)
+        self._counter = 0
+        self._buffer = bytearray()
+        self._header = struct.pack('>BI', SegmentedAEADEngine.VERSION, segment_size) + self._prefix
+
+    def _seal(self, plaintext, last):
+        nonce = self._prefix + struct.pack('>IB', self._counter, 1 if last else 0)
+        self._counter += 1
+        return self._aead.encrypt(nonce, bytes(plaintext), None)
+
+    def update(self, data):
+        self._buffer += data
+        out = [self._header] if self._header else []
+        self._header = b''
+        # Hold back at least one byte so the final segment is never empty
+        # unless the whole plaintext is.
+        while len(self._buffer) > self._segment_size:
+            out.append(self._seal(self._buffer[:self._segment_size], last=False))
+            del self._buffer[:self._segment_size]
+        return b''.join(out)
+
+    def finalize(self):
+        out = self._header + self._seal(self._buffer, last=True)
+        self._header = b''
+        self._buffer = bytearray()
+        return out
+
+
+class _SegmentedDecryptor:
+    def __init__(self, engine, key):
+        self._aead = engine.aead_class(key)
+        self._buffer = bytearray()
+        self._prefix = None
+        self._segment_size = None
+        self._counter = 0
+
+    def _open(self, segment, last):
+        nonce = self._prefix + struct.pack('>IB', self._counter, 1 if last else 0)
+        self._counter += 1
+        try:
+            return self._aead.decrypt(nonce, bytes(segment), None)
+        except InvalidTag:
+            raise CipherError('Authentication failed: wrong key or corrupted data')
+
+    def _read_header(self):
+        if self._prefix is None and len(self._buffer) >= SegmentedAEADEngine.HEADER_SIZE:
+            version, self._segment_size = struct.unpack('>BI', self._buffer[:5])
+            if version != SegmentedAEADEngine.VERSION or not self._segment_size:
+                raise CipherError(f'Unsupported ciphertext format version {version}')
+            self._prefix = bytes(self._buffer[5:SegmentedAEADEngine.HEADER_SIZE])
+            del self._buffer[:SegmentedAEADEngine.HEADER_SIZE]
+
+    def update(self, data):
+        self._buffer += data
+        self._read_header()
+        if self._prefix is None:
+            return b''
+        out = []
+        stride = self._segment_size + SegmentedAEADEngine.TAG_SIZE
+        # A full segment is only known not to be the last once more bytes follow it
+        while len(self._buffer) > stride:
+            out.append(self._open(self._buffer[:stride], last=False))
+            del self._buffer[:stride]
+        return b''.join(out)
+
+    def finalize(self):
+        self._read_header()
+        if self._prefix is None or len(self._buffer) < SegmentedAEADEngine.TAG_SIZE:
+            raise CipherError('Ciphertext is truncated')
+        out = self._open(self._buffer, last=True)
+        self._buffer = bytearray()
+        return out
+
+
+class SegmentedAEADEngine(CipherEngine):
+    authenticated = True
+    aead_class = None
+    VERSION = 1
+    NONCE_PREFIX_SIZE = 7
+    HEADER_SIZE = 1 + 4 + NONCE_PREFIX_SIZE
+    TAG_SIZE = 16
+
+    def __init__(self, segment_size=None):
+        self.segment_size = segment_size
+
+    def _segment_size(self):
+        return self.segment_size or getattr(settings, 'FILE_CIPHER_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+
+    def encryptor(self, key):
+        return _SegmentedEncryptor(self, key, self._segment_size())
+
+    def decryptor(self, key):
+        return _SegmentedDecryptor(self, key)
+
+    def stored_size(self, plaintext_size, segment_size=None):
+        segment_size = segment_size or self._segment_size()
+        segments = max(1, -(-plaintext_size // segment_size))
+        return self.HEADER_SIZE + plaintext_size + segments * self.TAG_SIZE
+
+    def plaintext_size(self, stored_size, segment_size=None):
+        # Exact only if the blob was written with the same segment size;
+        # callers should prefer File.original_size when it is recorded.
+        segment_size = segment_size or self._segment_size()
+        body = stored_size - self.HEADER_SIZE
+        stride = segment_size + self.TAG_SIZE
+        segments = max(1, -(-body // stride))
+        return max(0, body - segments * self.TAG_SIZE)
+
+
+class AESGCMEngine(SegmentedAEADEngine):
+    name = AES_GCM
+    aead_class = AESGCM
+
+
+class ChaCha20Poly1305Engine(SegmentedAEADEngine):
+    name = CHACHA20_POLY1305
+    aead_class = ChaCha20Poly1305
+
+
+ENGINES = {
+    AES_CFB: AESCFBEngine(),
+    AES_GCM: AESGCMEngine(),
+    CHACHA20_POLY1305: ChaCha20Poly1305Engine(),
+}
+
+
+def get_engine(name=None):
+    """Return the engine called `name`, or the configured default engine."""
+    name = name or getattr(settings, 'FILE_CIPHER', AES_GCM)
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError(f"Unknown cipher engine {name!r}. Choose from: {', '.join(ENGINES)}")
@@ -0,0 +1,179 @@
+"""
+Optional compress-then-encrypt stage for stored blobs.
+
+Ciphertext does not compress, so anything we want to save on text-like
+uploads has to happen before encryption. The algorithm used is recorded on
+the File row (`File.compression`) so downloads can undo it transparently.
+"""
+import logging
+import os
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+# Exceptions raised when a blob does not decompress (corrupted data or wrong key)
+DECOMPRESSION_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Content types that are already compressed (or close enough that a second
+# pass only burns CPU).
+INCOMPRESSIBLE_TYPE_PREFIXES = ('image/', 'video/', 'audio/', 'font/woff')
+INCOMPRESSIBLE_TYPES = {
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    'application/zstd',
+    'application/pdf',
+    'application/epub+zip',
+    'application/java-archive',
+    'application/vnd.android.package-archive',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.spreadsheet',
+}
+INCOMPRESSIBLE_EXTENSIONS = {
+    'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'zst', 'lz4',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'avif',
+    'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac',
+    'mp4', 'm4v', 'mkv', 'mov', 'avi', 'webm',
+    'pdf', 'docx', 'xlsx', 'pptx', 'odt', 'ods', 'epub', 'jar', 'apk',
+}
+# Media types that look incompressible by prefix but are not.
+COMPRESSIBLE_OVERRIDES = {'image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'audio/wav', 'audio/x-wav'}
+
+
+def available_algorithms():
+    """Return the compression algorithms usable on this host."""
+    algorithms = [ZLIB]
+    if zstandard is not None:
+        algorithms.append(ZSTD)
+    return algorithms
+
+
+def get_configured_algorithm():
+    """Return the algorithm configured by FILE_COMPRESSION, or None if disabled."""
+    algorithm = (getattr(settings, 'FILE_COMPRESSION', ZLIB) or 'none').lower()
+    if algorithm == 'none':
+        return None
+    if algorithm == ZSTD and zstandard is None:
+        logger.warning("FILE_COMPRESSION=zstd but the zstandard package is not installed; falling back to zlib.")
+        return ZLIB
+    if algorithm not in (ZLIB, ZSTD):
+        logger.warning(f"Unknown FILE_COMPRESSION value {algorithm!r}; compression disabled.")
+        return None
+    return algorithm
+
+
+def is_compressible(filename, content_type):
+    """Check whether a file is worth compressing based on its type and extension"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in COMPRESSIBLE_OVERRIDES:
+        return True
+    if content_type in INCOMPRESSIBLE_TYPES or content_type.startswith(INCOMPRESSIBLE_TYPE_PREFIXES):
+        return False
+    ext = os.path.splitext(filename or '')[1].lstrip('.').lower()
+    return ext not in INCOMPRESSIBLE_EXTENSIONS
+
+
+def choose_compression(filename, content_type, size=None):
+    """
+    Pick the compression algorithm for a new upload.
+
+    Returns None when compression is disabled, the file is too small to
+    benefit, or its type is already compressed.
+    """
+    algorithm = get_configured_algorithm()
+    if algorithm is None:
+        return None
+    min_size = getattr(settings, 'FILE_COMPRESSION_MIN_SIZE', 1024)
+    if size is not None and size < min_size:
+        return None
+    if not is_compressible(filename, content_type):
+        return None
+    return algorithm
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class _ZstdDecompressor:
+    def __init__(self):
+        self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+def compressor(algorithm, level=None):
+    """Return a streaming compressor with compress(chunk) and flush() methods."""
+    if level is None:
+        level = getattr(settings, 'FILE_COMPRESSION_LEVEL', None)
+    if algorithm == ZLIB:
+        return zlib.compressobj(6 if level is None else level)
+    if algorithm == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression requested but the zstandard package is not installed")
+        return _ZstdCompressor(3 if level is None else level)
+    raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+
+
+def decompressor(algorithm):
+    """Return a streaming decompressor with decompress(chunk) and flush() methods."""
+    if algorithm == ZLIB:
+        return zlib.decompressobj()
+    if algorithm == ZSTD:
+        if zstandard is None:
+            raise ValueError("File is zstd-compressed but the zstandard package is not installed")
+        return _ZstdDecompressor()
+    raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+
+
+def compress(data, algorithm, level=None):
+    """Compress a whole buffer in one go."""
+    c = compressor(algorithm, level)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data, algorithm):
+    """Decompress a whole buffer in one go."""
+    d = decompressor(algorithm)
+    return d.decompress(data) + d.flush()
+
+
+def iter_decompress(chunks, algorithm):
+    """Decompress an iterable of chunks lazily, yielding plaintext chunks."""
+    d = decompressor(algorithm)
+    for chunk in chunks:
+        out = d.decompress(chunk)
+        if out:
+            yield out
+    tail = d.flush()
+    if tail:
+        yield tail
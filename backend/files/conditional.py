@@ -0,0 +1,63 @@
+"""
+HTTP validators for downloads and the file listing.
+
+Both are computed from database metadata alone, so a repeat request with
+If-None-Match / If-Modified-Since is answered with 304 before any storage
+I/O or decryption happens.
+
+  download  strong ETag over the plaintext hash (File.file_hash) and the
+            owner's key_version; Last-Modified is the upload time, since a
+            File row's content never changes.
+  listing   weak ETag over one aggregate of File columns of the filtered
+            queryset (count, newest upload, latest download), the owner's
+            profile and the query string: one query over the listed rows
+            per poll, however long the access log grows. The access logs
+            nested in the listing show up with the next download-counter
+            flush (files/access.py), new thumbnails with the next change.
+            No Last-Modified: deletions would not advance it.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+CACHE_CONTROL = 'private, no-cache'  # Always revalidate; never shared between users
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'  # Content-addressed responses (previews)
+
+
+def file_etag(file_instance, user):
+    """Strong ETag of a download, or None for rows without a content hash."""
+    if not file_instance.file_hash:
+        return None
+    digest = hashlib.sha256(f'{file_instance.file_hash}:{user.key_version}'.encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def listing_etag(queryset, user, query_string=''):
+    # New versions advance uploaded_at; downloads advance last_accessed when they are flushed
+    stats = queryset.order_by().aggregate(n=Count('id'), newest=Max('uploaded_at'), accessed=Max('last_accessed'))
+    parts = [stats['n'], stats['newest'], stats['accessed'], user.updated_at, user.key_version, query_string]
+    digest = hashlib.sha256('|'.join(str(p) for p in parts).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def not_modified(request, etag=None, last_modified=None, cache_control=CACHE_CONTROL):
+    """Return a 304/412 response if the request's validators match, else None."""
+    if etag is None and last_modified is None:
+        return None
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified, cache_control)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None, cache_control=CACHE_CONTROL):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,157 @@
+"""
+Binary deltas between two versions of a file (see files/versions.py).
+
+A delta rebuilds a target from a base as a list of operations: copy a
+range of the base, or insert literal bytes. Matching ranges are found the
+way rsync and backup tools find them: both buffers are cut into chunks at
+content-defined boundaries, so an insertion or deletion only changes the
+chunks around it, and target chunks whose hash also occurs in the base
+become copies.
+
+Boundaries are where the bytes, mapped onto two classes, spell out ANCHOR.
+The mapping and the search are bytes.translate() and a regex, so chunking
+runs at C speed rather than a byte-at-a-time rolling hash in Python. The
+chunking only decides how good a delta is; the encoded operations carry
+explicit offsets, so it can be tuned without breaking stored deltas.
+
+Format (all integers are unsigned LEB128 varints):
+
+    b'FHD1' base_length target_length op*
+    op := b'C' base_offset length  |  b'L' length bytes
+"""
+import hashlib
+import re
+
+MAGIC = b'FHD1'
+COPY = ord('C')
+LITERAL = ord('L')
+
+MIN_CHUNK = 1024
+MAX_CHUNK = 64 * 1024
+
+# Each byte value maps to 'a' or 'b' (fixed, pseudo-random); a boundary follows every
+# ANCHOR in the mapped buffer, about one per 4 KiB of random data. A run of one byte
+# value can never match a mixed pattern, so long runs of zeros do not fragment.
+_CLASSES = bytes(b'ab'[hashlib.sha256(bytes([i])).digest()[0] & 1] for i in range(256))
+ANCHOR = re.compile(b'abbabaabbbab')
+
+
+class DeltaError(Exception):
+    """A delta is malformed or does not fit the base it is applied to"""
+
+
+def chunk_bounds(data):
+    """End offsets of the content-defined chunks of `data`."""
+    bounds = []
+    last = 0
+    for match in ANCHOR.finditer(data.translate(_CLASSES)):
+        end = match.end()
+        if end - last < MIN_CHUNK:
+            continue
+        while end - last > MAX_CHUNK:
+            last += MAX_CHUNK
+            bounds.append(last)
+        bounds.append(end)
+        last = end
+    while len(data) - last > MAX_CHUNK:
+        last += MAX_CHUNK
+        bounds.append(last)
+    if last < len(data):
+        bounds.append(len(data))
+    return bounds
+
+
+def _digest(chunk):
+    return hashlib.blake2b(chunk, digest_size=16).digest()
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode(base, target):
+    """Return a delta that rebuilds `target` from `base`."""
+    base_view, target_view = memoryview(base), memoryview(target)
+    index = {}
+    start = 0
+    for end in chunk_bounds(base):
+        index.setdefault(_digest(base_view[start:end]), (start, end - start))
+        start = end
+
+    ops = []  # [COPY, offset, length] or [LITERAL, start, end] into target
+    start = 0
+    for end in chunk_bounds(target):
+        hit = index.get(_digest(target_view[start:end]))
+        last = ops[-1] if ops else None
+        if hit is not None:
+            offset, length = hit
+            if last and last[0] == COPY and last[1] + last[2] == offset:
+                last[2] += length
+            else:
+                ops.append([COPY, offset, length])
+        elif last and last[0] == LITERAL:
+            last[2] = end
+        else:
+            ops.append([LITERAL, start, end])
+        start = end
+
+    out = [MAGIC, _varint(len(base)), _varint(len(target))]
+    for kind, a, b in ops:
+        if kind == COPY:
+            out += [b'C', _varint(a), _varint(b)]
+        else:
+            out += [b'L', _varint(b - a), target_view[a:b]]
+    return b''.join(out)
+
+
+def _read_varint(delta, pos):
+    n = shift = 0
+    while True:
+        if pos >= len(delta) or shift > 63:
+            raise DeltaError('truncated delta')
+        byte = delta[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def apply(base, delta):
+    """Rebuild the target of `delta` from `base`; raises DeltaError."""
+    if delta[:len(MAGIC)] != MAGIC:
+        raise DeltaError('not a delta')
+    base_length, pos = _read_varint(delta, len(MAGIC))
+    target_length, pos = _read_varint(delta, pos)
+    if base_length != len(base):
+        raise DeltaError(f'delta expects a {base_length} byte base, got {len(base)}')
+    base_view, delta_view = memoryview(base), memoryview(delta)
+    parts = []
+    while pos < len(delta):
+        kind = delta[pos]
+        if kind == COPY:
+            offset, pos = _read_varint(delta, pos + 1)
+            length, pos = _read_varint(delta, pos)
+            if offset + length > len(base):
+                raise DeltaError('copy past the end of the base')
+            parts.append(base_view[offset:offset + length])
+        elif kind == LITERAL:
+            length, pos = _read_varint(delta, pos + 1)
+            if pos + length > len(delta):
+                raise DeltaError('truncated literal')
+            parts.append(delta_view[pos:pos + length])
+            pos += length
+        else:
+            raise DeltaError(f'unknown operation {kind!r}')
+    target = b''.join(parts)
+    if len(target) != target_length:
+        raise DeltaError(f'delta produced {len(target)} bytes, expected {target_length}')
+    return target
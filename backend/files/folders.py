@@ -0,0 +1,208 @@
+"""
+Folders.
+
+Every Folder stores a materialized path: the 32-character hex ids of its
+ancestors and itself, concatenated root first. Ids are fixed width, so the
+path needs no separator, the ancestors of a folder are read off its own
+path without a query, and its subtree is every path in the range
+
+    path >= P  AND  path < P + 'g'
+
+('g' sorts after every hex digit). That is an ordinary range scan of the
+unique index on path on SQLite and PostgreSQL alike, whatever the
+collation, with no LIKE involved. So:
+
+  list a folder     File/Folder rows by folder_id / parent_id (FK indexes)
+  list a subtree    one range query on path (joined for files)
+  move a folder     one UPDATE rewriting the path prefix of the subtree,
+                    plus the totals of the old and new ancestors
+
+Each folder also carries total_size and file_count of its whole subtree.
+They are adjusted incrementally (one UPDATE over the ancestor ids) whenever
+a file is added, removed, moved or changes size, so showing a folder's size
+never sums over its files. recalculate() rebuilds them from scratch.
+"""
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Concat, Substr
+
+from .models import File, Folder
+
+ID_WIDTH = 32  # uuid.hex
+_PAST_HEX = 'g'
+
+
+class FolderError(Exception):
+    """A folder operation that maps onto an API error response"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def max_depth():
+    return getattr(settings, 'FOLDER_MAX_DEPTH', 32)
+
+
+def ancestor_ids(path):
+    """Ids of the folders on a path, root first (the folder itself last)."""
+    return [uuid.UUID(path[i:i + ID_WIDTH]) for i in range(0, len(path), ID_WIDTH)]
+
+
+def subtree_q(path, prefix=''):
+    """Q for rows whose `<prefix>path` lies in the subtree rooted at `path`."""
+    return Q(**{f'{prefix}path__gte': path, f'{prefix}path__lt': path + _PAST_HEX})
+
+
+def subtree(folder):
+    """The folder and all folders below it."""
+    return Folder.objects.filter(subtree_q(folder.path))
+
+
+def subtree_files(folder):
+    """Files anywhere in the folder's subtree."""
+    return File.objects.filter(subtree_q(folder.path, prefix='folder__'))
+
+
+def _path_of(folder):
+    if folder is None:
+        return None
+    if isinstance(folder, Folder):
+        return folder.path
+    return Folder.objects.filter(pk=folder).values_list('path', flat=True).first()
+
+
+def adjust(folder, size_delta, count_delta=0):
+    """Add to the totals of a folder (instance or id) and all its ancestors; None is the top level."""
+    path = _path_of(folder)
+    if not path or (not size_delta and not count_delta):
+        return
+    Folder.objects.filter(pk__in=ancestor_ids(path)).update(
+        total_size=F('total_size') + size_delta, file_count=F('file_count') + count_delta
+    )
+
+
+def owned(owner, folder_id):
+    """The owner's folder with this id; None/'' mean the top level. Raises FolderError."""
+    if folder_id in (None, ''):
+        return None
+    try:
+        return Folder.objects.get(pk=uuid.UUID(str(folder_id)), owner=owner)
+    except (ValueError, Folder.DoesNotExist):
+        raise FolderError('Folder not found.')
+
+
+def _validate_name(name):
+    name = (name or '').strip()
+    if not name or '/' in name or name in ('.', '..') or len(name) > 255:
+        raise FolderError('Invalid folder name.')
+    return name
+
+
+def _save(folder):
+    try:
+        with transaction.atomic():
+            folder.save()
+    except IntegrityError:
+        raise FolderError('A folder with this name already exists here.', status_code=409)
+
+
+def create(owner, name, parent=None):
+    name = _validate_name(name)
+    depth = parent.depth + 1 if parent else 0
+    if depth >= max_depth():
+        raise FolderError(f'Folders can be nested at most {max_depth()} deep.')
+    folder = Folder(owner=owner, parent=parent, name=name, depth=depth)
+    folder.path = (parent.path if parent else '') + folder.id.hex
+    _save(folder)
+    return folder
+
+
+def rename(folder, name):
+    folder.name = _validate_name(name)
+    _save(folder)
+    return folder
+
+
+def move(folder, new_parent):
+    """Move a folder and its subtree under `new_parent` (None for the top level)."""
+    if new_parent is not None and new_parent.path.startswith(folder.path):
+        raise FolderError('A folder cannot be moved into itself.')
+    if (new_parent.pk if new_parent else None) == folder.parent_id:
+        return folder
+    with transaction.atomic():
+        # Row lock, so totals read here cannot change underneath (PostgreSQL)
+        folder = Folder.objects.select_for_update().get(pk=folder.pk)
+        old_path = folder.path
+        new_path = (new_parent.path if new_parent else '') + folder.id.hex
+        depth_delta = (new_parent.depth + 1 if new_parent else 0) - folder.depth
+        deepest = subtree(folder).order_by('-depth').values_list('depth', flat=True).first()
+        if deepest + depth_delta >= max_depth():
+            raise FolderError(f'Folders can be nested at most {max_depth()} deep.')
+        try:
+            with transaction.atomic():
+                Folder.objects.filter(pk=folder.pk).update(parent=new_parent)
+        except IntegrityError:
+            raise FolderError('A folder with this name already exists here.', status_code=409)
+        Folder.objects.filter(subtree_q(old_path)).update(
+            path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+            depth=F('depth') + depth_delta,
+        )
+        # Ancestors on both sides keep their totals
+        old_ancestors = set(ancestor_ids(old_path)[:-1])
+        new_ancestors = set(ancestor_ids(new_path)[:-1])
+        Folder.objects.filter(pk__in=old_ancestors - new_ancestors).update(
+            total_size=F('total_size') - folder.total_size, file_count=F('file_count') - folder.file_count
+        )
+        Folder.objects.filter(pk__in=new_ancestors - old_ancestors).update(
+            total_size=F('total_size') + folder.total_size, file_count=F('file_count') + folder.file_count
+        )
+    folder.refresh_from_db()
+    return folder
+
+
+def delete(folder):
+    """Delete an empty folder together with its (equally empty) subfolders."""
+    if folder.file_count:
+        raise FolderError('Folder is not empty.', status_code=409)
+    with transaction.atomic():
+        if subtree_files(folder).exists():
+            raise FolderError('Folder is not empty.', status_code=409)
+        subtree(folder).delete()
+
+
+def move_file(file_instance, folder):
+    """Put a file into `folder` (None for the top level)."""
+    if file_instance.folder_id == (folder.pk if folder else None):
+        return file_instance
+    with transaction.atomic():
+        adjust(file_instance.folder_id, -file_instance.size, -1)
+        adjust(folder, file_instance.size, 1)
+        File.objects.filter(pk=file_instance.pk).update(folder=folder)
+    file_instance.folder = folder
+    return file_instance
+
+
+def recalculate(owner):
+    """Rebuild the subtree totals of all of an owner's folders from their files; returns the folders changed."""
+    folders = {f.pk: f for f in Folder.objects.filter(owner=owner).only('pk', 'path', 'total_size', 'file_count')}
+    totals = {pk: [0, 0] for pk in folders}
+    direct = (
+        File.objects.filter(owner=owner, folder__isnull=False)
+        .values('folder').annotate(size=Sum('size'), n=Count('id'))
+    )
+    for row in direct:
+        for ancestor in ancestor_ids(folders[row['folder']].path):
+            totals[ancestor][0] += row['size'] or 0
+            totals[ancestor][1] += row['n']
+    changed = []
+    for pk, (size, count) in totals.items():
+        folder = folders[pk]
+        if (folder.total_size, folder.file_count) != (size, count):
+            folder.total_size, folder.file_count = size, count
+            changed.append(folder)
+    Folder.objects.bulk_update(changed, ['total_size', 'file_count'], batch_size=500)
+    return len(changed)
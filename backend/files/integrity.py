@@ -0,0 +1,252 @@
+"""
+At-rest integrity index for stored blobs.
+
+Blobs encrypted with the legacy AES-CFB engine, and unencrypted blobs, carry
+no authentication tag: bit rot or tampering in storage decrypts silently into
+garbage. Every blob written through the upload and key-rotation paths
+therefore gets a BlobIntegrity row holding the SHA-256 of each
+INTEGRITY_CHUNK_SIZE chunk of the stored bytes (the leaves of the Merkle tree
+in files/merkle.py) and the tree's root.
+
+The index is used in two places:
+
+  * downloads feed the stored bytes through a ChunkVerifier as they are
+    read, so each chunk is checked before it is decrypted and sent, without
+    a second pass over the blob (INTEGRITY_VERIFY_DOWNLOADS);
+  * the scrub_blobs command re-reads blobs in the background, oldest
+    verification first and rate limited, and records the outcome.
+
+A mismatch marks the row corrupt, is logged and counted in core.metrics
+(integrity.failures), and fails the download. Links served by
+files.async_views.signed_download are not checked inline, since that path
+does not touch the database; the scrubber covers them.
+"""
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+
+from core import metrics
+
+from . import merkle
+from .blobs import BlobNotFound, open_blob
+from .models import BlobIntegrity
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class IntegrityFailure(Exception):
+    """Stored bytes do not match the blob's integrity index"""
+
+    def __init__(self, name, detail):
+        super().__init__(f'{name}: {detail}')
+        self.name = name
+        self.detail = detail
+
+
+def _chunk_size():
+    return getattr(settings, 'INTEGRITY_CHUNK_SIZE', 64 * 1024)
+
+
+def verify_downloads():
+    return getattr(settings, 'INTEGRITY_VERIFY_DOWNLOADS', True)
+
+
+class IndexBuilder:
+    """Incrementally hashes stored bytes into leaves; feed it chunks of any size."""
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or _chunk_size()
+        self.size = 0
+        self.leaves = []
+        self._pending = bytearray()
+
+    def update(self, data):
+        self.size += len(data)
+        self._pending += data
+        if len(self._pending) >= self.chunk_size:
+            view = memoryview(self._pending)
+            whole = len(view) - len(view) % self.chunk_size
+            for i in range(0, whole, self.chunk_size):
+                self.leaves.append(merkle.leaf_hash(view[i:i + self.chunk_size]))
+            view.release()
+            del self._pending[:whole]
+
+    def finish(self):
+        if self._pending or not self.leaves:
+            self.leaves.append(merkle.leaf_hash(bytes(self._pending)))
+            self._pending.clear()
+        return {
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'leaves': b''.join(self.leaves),
+            'root': merkle.root(self.leaves).hex(),
+        }
+
+
+def build_index(content):
+    builder = IndexBuilder()
+    builder.update(content)
+    return builder.finish()
+
+
+def record(name, content=None, index=None):
+    """Store the index of the blob just written under `name`."""
+    index = index or build_index(content)
+    BlobIntegrity.objects.update_or_create(
+        name=name,
+        defaults={**index, 'status': BlobIntegrity.OK, 'detail': '', 'verified_at': timezone.now()},
+    )
+
+
+def rename(name, target):
+    """Follow a blob moved to `target` (files/layout.py migration)."""
+    if BlobIntegrity.objects.filter(name=target).exists():
+        BlobIntegrity.objects.filter(name=name).delete()
+    else:
+        BlobIntegrity.objects.filter(name=name).update(name=target)
+
+
+def forget(name):
+    BlobIntegrity.objects.filter(name=name).delete()
+
+
+def get_index(name):
+    return BlobIntegrity.objects.filter(name=name).first()
+
+
+def report(index, status, detail=''):
+    """Record the outcome of a verification on the index row."""
+    if status != BlobIntegrity.OK:
+        logger.error(f"Integrity check failed for blob {index.name}: {detail}")
+        metrics.incr('integrity.failures', status=status)
+    BlobIntegrity.objects.filter(pk=index.pk).update(status=status, detail=detail, verified_at=timezone.now())
+
+
+class ChunkVerifier:
+    """
+    Checks stored bytes against an index while they are being read.
+
+    update() returns the bytes of every chunk completed and verified so
+    far, finalize() the verified tail; both raise IntegrityFailure.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.chunk_size = index.chunk_size
+        self.leaves = bytes(index.leaves)
+        self.count = len(self.leaves) // merkle.HASH_SIZE
+        self.position = 0
+        self._pending = bytearray()
+
+    def _check(self, chunk):
+        if self.position >= self.count:
+            raise IntegrityFailure(self.index.name, f'more data than the {self.index.size} bytes indexed')
+        expected = self.leaves[self.position * merkle.HASH_SIZE:(self.position + 1) * merkle.HASH_SIZE]
+        if merkle.leaf_hash(chunk) != expected:
+            raise IntegrityFailure(self.index.name, f'chunk {self.position} does not match its hash')
+        self.position += 1
+
+    def update(self, data):
+        self._pending += data
+        if len(self._pending) < self.chunk_size:
+            return b''
+        whole = len(self._pending) - len(self._pending) % self.chunk_size
+        verified = bytes(self._pending[:whole])
+        del self._pending[:whole]
+        view = memoryview(verified)
+        for i in range(0, whole, self.chunk_size):
+            self._check(view[i:i + self.chunk_size])
+        return verified
+
+    def finalize(self):
+        tail = bytes(self._pending)
+        self._pending.clear()
+        if tail or self.position == 0:
+            self._check(tail)
+        if self.position != self.count:
+            raise IntegrityFailure(self.index.name, f'blob ends after {self.position} of {self.count} chunks')
+        return tail
+
+
+def verify_content(index, content):
+    """Check a whole stored blob against its index; raises IntegrityFailure."""
+    verifier = ChunkVerifier(index)
+    verifier.update(content)
+    verifier.finalize()
+
+
+class VerifyingReader:
+    """Read-only file wrapper that verifies a blob as it is read (for FileResponse)."""
+
+    def __init__(self, f, index):
+        self._f = f
+        self._verifier = ChunkVerifier(index)
+        self._buffer = b''
+        self._offset = 0
+        self._done = False
+
+    def _fill(self):
+        data = self._f.read(READ_CHUNK_SIZE)
+        try:
+            if data:
+                self._buffer = self._verifier.update(data)
+            else:
+                self._buffer = self._verifier.finalize()
+                self._done = True
+        except IntegrityFailure as e:
+            report(self._verifier.index, BlobIntegrity.CORRUPT, e.detail)
+            raise
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer[self._offset:]]
+            while not self._done:
+                self._fill()
+                parts.append(self._buffer)
+            self._buffer, self._offset = b'', 0
+            return b''.join(parts)
+        while self._offset >= len(self._buffer) and not self._done:
+            self._fill()
+        result = self._buffer[self._offset:self._offset + size]
+        self._offset += len(result)
+        return result
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def scrub(index, throttle=None):
+    """
+    Re-read one blob from storage (bypassing the local blob cache and the
+    replicas) and verify it; returns the resulting status. `throttle(nbytes)`
+    is called after every read so the caller can rate limit.
+    """
+    try:
+        f = open_blob(index.name, use_cache=False, failover=False)
+    except BlobNotFound:
+        report(index, BlobIntegrity.MISSING, 'blob is missing from storage')
+        return BlobIntegrity.MISSING
+    verifier = ChunkVerifier(index)
+    try:
+        for data in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            verifier.update(data)
+            if throttle:
+                throttle(len(data))
+        verifier.finalize()
+    except IntegrityFailure as e:
+        report(index, BlobIntegrity.CORRUPT, e.detail)
+        return BlobIntegrity.CORRUPT
+    finally:
+        f.close()
+    report(index, BlobIntegrity.OK)
+    return BlobIntegrity.OK
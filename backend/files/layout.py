@@ -0,0 +1,73 @@
+"""
+Storage key layout for blobs.
+
+The original layout put every blob directly in the storage root as
+`ecry::<8 hex>` or `<8 hex>`. With millions of blobs a single directory makes
+lookups, collision probing in get_available_name() and backups slow on
+ext4/xfs. The sharded layout fans keys out over nested directories:
+
+    blobs/ab/cd/abcdef0123...   (STORAGE_SHARD_DEPTH=2, STORAGE_SHARD_WIDTH=2)
+
+The key is the SHA-256 of the stored bytes when they are all at hand before
+the write, and a random id when they are not: uploads stored while they are
+parsed (files/uploads.py, the main upload path) must name their blob before
+its first byte is written, and an S3 multipart upload cannot be renamed
+afterwards. Either spreads keys evenly over the shards. Keys are names, not
+content addresses: deduplication goes through File.file_hash, key rotation
+rewrites a blob in place under its old key, and the plaintext hash is never
+used, as bucket listings would then show which content is stored.
+
+Whether a blob is encrypted is recorded on the File row, so the key no
+longer carries the `ecry::` marker. Existing blobs keep working under their
+flat names and can be moved with the migrate_storage_layout command.
+"""
+import hashlib
+import posixpath
+import uuid
+
+from django.conf import settings
+
+FLAT = 'flat'
+SHARDED = 'sharded'
+LAYOUTS = (FLAT, SHARDED)
+
+BLOB_PREFIX = 'blobs'
+
+
+def get_layout():
+    layout = getattr(settings, 'STORAGE_LAYOUT', SHARDED)
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown STORAGE_LAYOUT {layout!r}. Choose from: {', '.join(LAYOUTS)}")
+    return layout
+
+
+def content_digest(content):
+    """Hex SHA-256 of the bytes as stored (ciphertext for encrypted blobs)."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def sharded_name(digest, depth=None, width=None):
+    """Fan a hex digest out into `blobs/<d[0:w]>/<d[w:2w]>/.../<digest>`."""
+    depth = getattr(settings, 'STORAGE_SHARD_DEPTH', 2) if depth is None else depth
+    width = getattr(settings, 'STORAGE_SHARD_WIDTH', 2) if width is None else width
+    shards = [digest[i * width:(i + 1) * width] for i in range(depth)]
+    return posixpath.join(BLOB_PREFIX, *shards, digest)
+
+
+def flat_name(is_encrypted):
+    """The legacy flat name: a short random id, prefixed when encrypted."""
+    short_uuid = str(uuid.uuid4())[:8]
+    return f"ecry::{short_uuid}" if is_encrypted else short_uuid
+
+
+def is_sharded(name):
+    return bool(name) and name.startswith(BLOB_PREFIX + '/')
+
+
+def storage_name(is_encrypted, content=None):
+    """Storage key for a new blob under the configured layout."""
+    if get_layout() == FLAT:
+        return flat_name(is_encrypted)
+    # Without the bytes at hand (e.g. streamed uploads) shard on a random id
+    digest = content_digest(content) if content is not None else uuid.uuid4().hex
+    return sharded_name(digest)
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from files import backup
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes a snapshot of the database rows and the blobs they refer to to BACKUP_TARGET '
+        '(files/backup.py). Blobs already in an earlier snapshot are not copied again, so a nightly '
+        'run only copies what changed. Avoid running it during key rotations.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Blobs copied in parallel (default: BACKUP_WORKERS).')
+        parser.add_argument('--list', action='store_true', help='Only list the snapshots on the target.')
+
+    def handle(self, *args, **options):
+        tier = backup.target()
+        if options['list']:
+            for snapshot_id in backup.snapshots(tier):
+                m = backup.manifest(tier, snapshot_id)
+                self.stdout.write(
+                    f"{snapshot_id}: {m['blobs']} blob(s), {m['bytes'] / (1024 * 1024):.1f} MB, "
+                    f"{m['copied']} copied, {m['missing']} missing"
+                )
+            return
+        started = time.monotonic()
+        m = backup.create(tier, options['workers'])
+        message = (
+            f"Snapshot {m['id']}: {m['blobs']} blob(s), {m['bytes'] / (1024 * 1024):.1f} MB; copied {m['copied']} "
+            f"({m['copied_bytes'] / (1024 * 1024):.1f} MB) in {time.monotonic() - started:.1f}s."
+        )
+        if m['missing']:
+            self.stdout.write(self.style.WARNING(
+                f"{message} {m['missing']} blob(s) deleted or changed during the backup are not in it."
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,100 @@
+import os
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.benchmarking import MB, best_of, format_size, parse_size, throughput_mb_s, write_results
+from files.ciphers import ENGINES, AESCFBEngine, SegmentedAEADEngine
+
+
+def has_aes_instructions():
+    """Best-effort detection of hardware AES support (AES-NI on x86, AES on ARMv8)."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.lower().startswith(('flags', 'features')):
+                    return 'aes' in line.split(':', 1)[1].split()
+    except OSError:
+        pass
+    if platform.system() == 'Darwin' and platform.machine() == 'arm64':
+        return True  # Apple silicon always has the ARMv8 crypto extensions
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Reports encryption/decryption throughput per cipher engine and chunk size on this CPU.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engines', default=','.join(ENGINES), help='Comma-separated engine names.')
+        parser.add_argument('--chunk-sizes', default='16KB,64KB,256KB,1MB',
+                            help='Segment sizes for AEAD engines / write sizes for AES-CFB.')
+        parser.add_argument('--size-mb', type=float, default=32, help='Plaintext per measurement in MB (default: 32).')
+        parser.add_argument('--legacy-size-mb', type=float, default=4,
+                            help='Plaintext for the (much slower) legacy AES-CFB engine in MB.')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement; the best is reported.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        names = [n for n in options['engines'].split(',') if n]
+        unknown = set(names) - set(ENGINES)
+        if unknown:
+            raise CommandError(f"Unknown engines: {', '.join(sorted(unknown))}. Choose from: {', '.join(ENGINES)}")
+        chunk_sizes = [parse_size(c) for c in options['chunk_sizes'].split(',') if c]
+        key = os.urandom(32)
+        aes_hw = has_aes_instructions()
+        self.stdout.write(f"Hardware AES support: {'yes' if aes_hw else 'no' if aes_hw is False else 'unknown'}")
+
+        results = []
+        for name in names:
+            base_engine = ENGINES[name]
+            legacy = isinstance(base_engine, AESCFBEngine)
+            size = int((options['legacy_size_mb'] if legacy else options['size_mb']) * MB)
+            data = os.urandom(size)
+            for chunk_size in chunk_sizes:
+                engine = type(base_engine)(chunk_size) if isinstance(base_engine, SegmentedAEADEngine) else base_engine
+
+                def encrypt():
+                    encryptor = engine.encryptor(key)
+                    out = [encryptor.update(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+                    out.append(encryptor.finalize())
+                    return b''.join(out)
+
+                encrypt_s, ciphertext = best_of(encrypt, options['repeat'])
+
+                def decrypt():
+                    decryptor = engine.decryptor(key)
+                    out = [decryptor.update(ciphertext[i:i + chunk_size]) for i in range(0, len(ciphertext), chunk_size)]
+                    out.append(decryptor.finalize())
+                    return b''.join(out)
+
+                decrypt_s, plaintext = best_of(decrypt, options['repeat'])
+                if plaintext != data:
+                    raise CommandError(f"{name} round trip mismatch at chunk size {chunk_size}")
+                row = {
+                    'engine': name,
+                    'authenticated': engine.authenticated,
+                    'chunk_size': chunk_size,
+                    'bytes': size,
+                    'overhead_bytes': len(ciphertext) - size,
+                    'encrypt_mb_s': throughput_mb_s(size, encrypt_s),
+                    'decrypt_mb_s': throughput_mb_s(size, decrypt_s),
+                }
+                results.append(row)
+                self.stdout.write(
+                    f"{name:<18} chunk {format_size(chunk_size):>6}: encrypt {row['encrypt_mb_s']:>9} MB/s, "
+                    f"decrypt {row['decrypt_mb_s']:>9} MB/s, overhead {row['overhead_bytes']} B"
+                )
+
+        authenticated = [r for r in results if r['authenticated']]
+        recommendation = None
+        if authenticated:
+            best = max(authenticated, key=lambda r: min(r['encrypt_mb_s'] or 0, r['decrypt_mb_s'] or 0))
+            recommendation = {'FILE_CIPHER': best['engine'], 'FILE_CIPHER_SEGMENT_SIZE': best['chunk_size']}
+            self.stdout.write(self.style.SUCCESS(
+                f"\nFastest authenticated engine here: {best['engine']} with {format_size(best['chunk_size'])} segments "
+                f"(set FILE_CIPHER={best['engine']} FILE_CIPHER_SEGMENT_SIZE={best['chunk_size']})"
+            ))
+
+        write_results(options['json_path'], 'ciphers', results, hardware_aes=aes_hw, recommendation=recommendation)
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
@@ -0,0 +1,90 @@
+import os
+import mimetypes
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.benchmarking import (
+    MB, SYNTHETIC_TYPES, best_of, synthetic_payload, throughput_mb_s, write_results,
+)
+from files.ciphers import get_engine
+from files.compression import available_algorithms, compress, decompress, is_compressible
+
+
+class Command(BaseCommand):
+    help = 'Measures compression ratio and throughput cost of compress-then-encrypt per content type.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Optional real files to benchmark in addition to synthetic samples.')
+        parser.add_argument('--size-mb', type=float, default=8, help='Size of each synthetic sample in MB (default: 8).')
+        parser.add_argument('--types', default=','.join(SYNTHETIC_TYPES), help='Comma-separated synthetic content types.')
+        parser.add_argument('--algorithms', default=','.join(available_algorithms()), help='Comma-separated algorithms to test.')
+        parser.add_argument('--levels', default='', help='Comma-separated compression levels (default: library default).')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement; the best is reported.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        algorithms = [a for a in options['algorithms'].split(',') if a]
+        unknown = set(algorithms) - set(available_algorithms())
+        if unknown:
+            raise CommandError(f"Algorithms not available on this host: {', '.join(sorted(unknown))}")
+        levels = [int(l) for l in options['levels'].split(',') if l] or [None]
+        size = int(options['size_mb'] * MB)
+        repeat = options['repeat']
+
+        samples = []
+        for kind in [t for t in options['types'].split(',') if t]:
+            if kind not in SYNTHETIC_TYPES:
+                raise CommandError(f"Unknown content type {kind!r}. Choose from: {', '.join(SYNTHETIC_TYPES)}")
+            _, content_type, filename = SYNTHETIC_TYPES[kind]
+            samples.append((kind, filename, content_type, synthetic_payload(kind, size)))
+        for path in options['paths']:
+            with open(path, 'rb') as f:
+                content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+                samples.append((os.path.basename(path), os.path.basename(path), content_type, f.read()))
+
+        key = os.urandom(32)
+        engine = get_engine()  # the configured FILE_CIPHER, as used on upload
+
+        def encrypt(data):
+            return engine.encrypt(key, data)
+
+        self.stdout.write(f"Cipher engine: {engine.name}")
+        results = []
+        for name, filename, content_type, data in samples:
+            encrypt_raw_s, _ = best_of(lambda: encrypt(data), repeat)
+            self.stdout.write(f"\n{name} ({content_type}, {len(data) / MB:.2f} MB, "
+                              f"policy: {'compress' if is_compressible(filename, content_type) else 'skip'})")
+            self.stdout.write(f"  encrypt only: {throughput_mb_s(len(data), encrypt_raw_s)} MB/s")
+            for algorithm in algorithms:
+                for level in levels:
+                    compress_s, packed = best_of(lambda: compress(data, algorithm, level), repeat)
+                    decompress_s, unpacked = best_of(lambda: decompress(packed, algorithm), repeat)
+                    if unpacked != data:
+                        raise CommandError(f"{algorithm} round trip mismatch for {name}")
+                    encrypt_packed_s, _ = best_of(lambda: encrypt(packed), repeat)
+                    row = {
+                        'content': name,
+                        'content_type': content_type,
+                        'policy_compresses': is_compressible(filename, content_type),
+                        'algorithm': algorithm,
+                        'level': level,
+                        'input_bytes': len(data),
+                        'output_bytes': len(packed),
+                        'ratio': round(len(data) / len(packed), 3) if packed else None,
+                        'compress_mb_s': throughput_mb_s(len(data), compress_s),
+                        'decompress_mb_s': throughput_mb_s(len(data), decompress_s),
+                        'encrypt_only_s': round(encrypt_raw_s, 4),
+                        'compress_then_encrypt_s': round(compress_s + encrypt_packed_s, 4),
+                        # >1.0 means the compression stage makes the upload path slower
+                        'upload_cpu_cost': round((compress_s + encrypt_packed_s) / encrypt_raw_s, 2) if encrypt_raw_s else None,
+                    }
+                    results.append(row)
+                    self.stdout.write(
+                        f"  {algorithm}{'' if level is None else f'-{level}'}: ratio {row['ratio']}x, "
+                        f"compress {row['compress_mb_s']} MB/s, decompress {row['decompress_mb_s']} MB/s, "
+                        f"upload CPU cost {row['upload_cpu_cost']}x"
+                    )
+
+        write_results(options['json_path'], 'compression', results)
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"\nResults written to {options['json_path']}"))
@@ -0,0 +1,143 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.db.models import F
+from django.test.utils import setup_databases, teardown_databases
+
+from files.benchmarking import summarize_latencies, write_results
+from files.models import File, FileAccessLog
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Concurrency benchmark of the upload and access-log write paths against the configured '
+        'database engine (a throwaway test database is used). Run it once per configuration, e.g. '
+        'DB_ENGINE=sqlite and DB_ENGINE=postgres, or SQLITE_JOURNAL_MODE=DELETE vs WAL, and compare '
+        'the JSON outputs with `benchmark_vault --compare`.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', default='1,4,16,32', help='Comma-separated concurrency levels.')
+        parser.add_argument('--ops', type=int, default=200, help='Operations per thread per level.')
+        parser.add_argument('--workloads', default='upload,log,mixed',
+                            help='upload: File row + quota update + access log; log: access log only; '
+                                 'mixed: 80%% listing reads / 20%% uploads.')
+        parser.add_argument('--users', type=int, default=8, help='Distinct users the threads write for.')
+        parser.add_argument('--label', default='', help='Free-form label stored with the results.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp(prefix='vault-dbbench-')
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self._run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        write_results(options['json_path'], 'db_writes', results, parameters={
+            'vendor': connection.vendor,
+            'label': options['label'],
+            'conn_max_age': connection.settings_dict.get('CONN_MAX_AGE'),
+            'sqlite_journal_mode': settings.SQLITE_JOURNAL_MODE if connection.vendor == 'sqlite' else None,
+            'ops_per_thread': options['ops'],
+        })
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    def _run(self, options):
+        users = []
+        for i in range(options['users']):
+            users.append(User.objects.create_user(f'dbbench{i}', f'dbbench{i}@bench.local', 'bench-password-123'))
+        # Seed some rows so listing reads have something to scan
+        seed = [File(owner=users[i % len(users)], file=f'seed/{i}', original_filename=f'seed-{i}.txt',
+                     file_type='text/plain', size=1024, file_hash=uuid.uuid4().hex) for i in range(2000)]
+        File.objects.bulk_create(seed, batch_size=500)
+
+        self.stdout.write(f"Database: {connection.vendor}"
+                          + (f" (journal_mode={settings.SQLITE_JOURNAL_MODE})" if connection.vendor == 'sqlite' else ''))
+        results = {}
+        for workload in [w for w in options['workloads'].split(',') if w]:
+            results[workload] = {}
+            for threads in [int(t) for t in options['threads'].split(',') if t]:
+                row = self._run_level(workload, threads, options['ops'], users)
+                results[workload][str(threads)] = row
+                self.stdout.write(
+                    f"{workload:<7} threads={threads:<3} {row['throughput_ops_s']:>9} ops/s  "
+                    f"p50 {row['latency']['p50_ms']} ms  p99 {row['latency']['p99_ms']} ms  errors {row['errors']}"
+                )
+        return results
+
+    def _upload(self, user, rng):
+        size = rng.randint(1024, 1024 * 1024)
+        file_instance = File.objects.create(
+            owner=user, file=f'bench/{uuid.uuid4().hex}', original_filename='bench.bin',
+            file_type='application/octet-stream', size=size, file_hash=uuid.uuid4().hex,
+        )
+        User.objects.filter(pk=user.pk).update(used_storage=F('used_storage') + size)
+        FileAccessLog.objects.create(file=file_instance, user=user, action='upload', ip_address='127.0.0.1')
+        return file_instance
+
+    def _run_level(self, workload, threads, ops, users):
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        targets = list(File.objects.values_list('pk', flat=True)[:500])
+        start_barrier = threading.Barrier(threads)
+
+        def worker(index):
+            rng = random.Random(index)
+            user = users[index % len(users)]
+            local = []
+            local_errors = 0
+            try:
+                start_barrier.wait()
+                for _ in range(ops):
+                    started = time.perf_counter()
+                    try:
+                        if workload == 'upload':
+                            self._upload(user, rng)
+                        elif workload == 'log':
+                            FileAccessLog.objects.create(file_id=rng.choice(targets), user=user,
+                                                         action='download', ip_address='127.0.0.1')
+                        elif rng.random() < 0.8:
+                            list(File.objects.filter(owner=user).order_by('-uploaded_at')[:50])
+                        else:
+                            self._upload(user, rng)
+                    except OperationalError:
+                        local_errors += 1  # e.g. SQLite "database is locked" after busy_timeout
+                        continue
+                    local.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+            with lock:
+                latencies.extend(local)
+                errors[0] += local_errors
+
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        started = time.perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - started
+        return {
+            'threads': threads,
+            'ops': len(latencies),
+            'errors': errors[0],
+            'throughput_ops_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency': summarize_latencies(latencies),
+        }
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+
+from files import folders
+from files.benchmarking import best_of, write_results
+from files.models import File, Folder
+
+User = get_user_model()
+
+PAGE = 50
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the folder operations of files/folders.py on a throwaway test database: listing a '
+        'folder, listing a subtree, reading a subtree size (precomputed vs summed), moving a folder and '
+        'the per-upload total update, on a tree --depth levels deep holding --files files.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=20, help='Depth of the deepest folder.')
+        parser.add_argument('--fanout', type=int, default=10, help='Subfolders per folder along the deep path.')
+        parser.add_argument('--files', type=int, default=1000000, help='Files spread over the folders.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per operation; the best is reported.')
+        parser.add_argument('--label', default='', help='Free-form label stored with the results.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp(prefix='vault-folderbench-')
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self._run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        write_results(options['json_path'], 'folders', results, parameters={
+            'vendor': connection.vendor,
+            'label': options['label'],
+            'depth': options['depth'],
+            'fanout': options['fanout'],
+            'files': options['files'],
+        })
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    def _build(self, user, depth, fanout, nfiles):
+        """One top folder over a path of nested folders, each with `fanout` subfolders; returns the path."""
+        spine, parent = [], None
+        for level in range(depth):
+            children = [folders.create(user, f'dir-{level}-{i}', parent) for i in range(fanout if level else 1)]
+            parent = children[0]
+            spine.append(parent)
+        all_ids = list(Folder.objects.filter(owner=user).values_list('pk', flat=True))
+
+        started = time.perf_counter()
+        batch = []
+        for i in range(nfiles):
+            batch.append(File(
+                owner=user, file=f'bench/{i}', original_filename=f'file-{i}.bin',
+                file_type='application/octet-stream', size=1024 + i % 4096, file_hash=uuid.uuid4().hex,
+                folder_id=all_ids[i % len(all_ids)],
+            ))
+            if len(batch) == 10000:
+                File.objects.bulk_create(batch)
+                batch = []
+        File.objects.bulk_create(batch)
+        folders.recalculate(user)
+        self.stdout.write(f"Seeded {len(all_ids)} folders and {nfiles} files in {time.perf_counter() - started:.1f}s")
+        return spine
+
+    def _measure(self, fn, repeat):
+        seconds, _ = best_of(fn, repeat)
+        with CaptureQueriesContext(connection) as queries:
+            fn()
+        return {'best_ms': round(seconds * 1000, 3), 'queries': len(queries)}
+
+    def _run(self, options):
+        user = User.objects.create_user('folderbench', 'folderbench@bench.local', 'bench-password-123')
+        spine = self._build(user, options['depth'], options['fanout'], options['files'])
+        top, middle, deepest = spine[0], spine[len(spine) // 2], spine[-1]
+        repeat = options['repeat']
+
+        def list_folder():
+            list(Folder.objects.filter(parent=middle))
+            list(File.objects.filter(folder=middle)[:PAGE])
+
+        # Alternate the middle folder between two parents, so every run really moves it
+        targets = [spine[len(spine) // 2 - 2] if len(spine) > 2 else None, middle.parent]
+        moving = [middle, 0]
+
+        def move_folder():
+            moving[0] = folders.move(moving[0], targets[moving[1] % 2])
+            moving[1] += 1
+
+        results = {
+            'list_folder': self._measure(list_folder, repeat),
+            'list_subtree_folders': self._measure(lambda: list(folders.subtree(top)), repeat),
+            'list_subtree_files_page': self._measure(lambda: list(folders.subtree_files(top)[:PAGE]), repeat),
+            'subtree_size_precomputed': self._measure(
+                lambda: Folder.objects.filter(pk=top.pk).values_list('total_size', 'file_count').get(), repeat
+            ),
+            'subtree_size_summed': self._measure(
+                lambda: folders.subtree_files(top).aggregate(Sum('size')), repeat
+            ),
+            'move_folder': self._measure(move_folder, repeat),
+        }
+        deepest.refresh_from_db()  # Its path changed with the moves
+        results['adjust_deepest'] = self._measure(lambda: folders.adjust(deepest, 1, 0), repeat)
+        top.refresh_from_db()
+        expected = File.objects.filter(owner=user).count()
+        if top.file_count != expected:  # Every folder lives under the top one
+            self.stderr.write(self.style.ERROR(f"Totals drifted: {top.file_count} counted, {expected} files"))
+        for name, row in results.items():
+            self.stdout.write(f"{name:<26} {row['best_ms']:>10} ms  {row['queries']} queries")
+        return results
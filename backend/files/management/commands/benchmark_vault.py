@@ -0,0 +1,300 @@
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from files.benchmarking import (
+    compare_results, format_size, load_results, parse_size, summarize_latencies,
+    throughput_mb_s, write_results,
+)
+from files.models import File
+
+User = get_user_model()
+
+DEFAULT_SIZES = '1KB,64KB,1MB,10MB,100MB'
+DEFAULT_LIST_SIZES = '1000,10000'
+
+
+class Command(BaseCommand):
+    help = (
+        'End-to-end benchmark of the vault API (upload, download, dedup, listing, search, '
+        'key rotation, delete) against a throwaway database and storage. '
+        'Use --compare BASELINE CANDIDATE to flag regressions between two JSON runs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--storage', choices=['local', 's3'], default='local',
+                            help="'local' uses a temporary FileSystemStorage; 's3' uses the configured MinIO "
+                                 "bucket (run with STORAGE_BACKEND=s3 and `docker compose up minio`).")
+        parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'Upload/download sizes (default: {DEFAULT_SIZES}).')
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per size for small files.')
+        parser.add_argument('--max-bytes-per-size', default='300MB',
+                            help='Caps iterations for large sizes so each size moves at most this much data.')
+        parser.add_argument('--list-sizes', default=DEFAULT_LIST_SIZES,
+                            help=f'File counts for listing/search (default: {DEFAULT_LIST_SIZES}; up to 1000000).')
+        parser.add_argument('--list-iterations', type=int, default=5, help='Requests per listing/search measurement.')
+        parser.add_argument('--rotate-files', type=int, default=100, help='Number of files re-encrypted by key rotation.')
+        parser.add_argument('--scenarios', default='upload,download,dedup,listing,search,rotation,delete',
+                            help='Comma-separated subset of scenarios to run.')
+        parser.add_argument('--seed', type=int, default=1234)
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+        parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'),
+                            help='Compare two result files instead of running the benchmark.')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percent change treated as a regression in --compare mode (default: 10).')
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            return self._compare(*options['compare'], threshold=options['threshold'])
+
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        scenarios = [s for s in options['scenarios'].split(',') if s]
+        tmpdir = tempfile.mkdtemp(prefix='vault-bench-')
+        overrides = {'DEBUG': False}
+        if options['storage'] == 'local':
+            overrides.update(
+                DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+                MEDIA_ROOT=os.path.join(tmpdir, 'media'),
+                STORAGE_BACKEND='local',
+            )
+        elif settings.STORAGE_BACKEND != 's3':
+            raise CommandError('--storage s3 requires STORAGE_BACKEND=s3 and a reachable MinIO.')
+
+        # Per-request logging would dominate small-request latency and flood the console
+        django_logger = logging.getLogger('django')
+        previous_level = django_logger.level
+        django_logger.setLevel(logging.WARNING)
+
+        # Benchmark against an on-disk throwaway DB; SQLite test DBs default to in-memory
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(**overrides):
+                results = self._run(scenarios)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            django_logger.setLevel(previous_level)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        write_results(options['json_path'], 'vault_e2e', results, parameters={
+            'storage': options['storage'], 'database': connection.vendor,
+            'sizes': options['sizes'], 'list_sizes': options['list_sizes'],
+            'rotate_files': options['rotate_files'],
+        })
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    # --- helpers -------------------------------------------------------------
+
+    def _make_user(self, username, with_key=True):
+        user = User.objects.create_user(username, f'{username}@bench.local', 'bench-password-123')
+        user.storage_quota = 1 << 50
+        if with_key:
+            user.set_raw_key(f'{username}-key')
+        user.save()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return user, client
+
+    def _payload(self, size):
+        return self.rng.randbytes(size)
+
+    def _timed(self, fn, expected_status):
+        start = time.perf_counter()
+        response = fn()
+        if getattr(response, 'streaming', False):
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - start
+        if response.status_code != expected_status:
+            raise CommandError(f'Unexpected status {response.status_code}: {getattr(response, "data", "")}')
+        return elapsed, response
+
+    def _iterations_for(self, size):
+        cap = parse_size(self.options['max_bytes_per_size'])
+        return max(1, min(self.options['iterations'], cap // max(size, 1)))
+
+    def _report(self, name, summary):
+        self.stdout.write(f"  {name}: {summary}")
+
+    # --- scenarios -----------------------------------------------------------
+
+    def _run(self, scenarios):
+        results = {}
+        sizes = [parse_size(s) for s in self.options['sizes'].split(',') if s]
+        _, client = self._make_user('bench_transfer')
+        uploaded = {}
+
+        if {'upload', 'download', 'dedup', 'delete'} & set(scenarios):
+            self.stdout.write('upload')
+            results['upload'] = {}
+            for size in sizes:
+                latencies = []
+                uploaded[size] = []
+                for i in range(self._iterations_for(size)):
+                    upload = SimpleUploadedFile(f'bench-{size}-{i}.bin', self._payload(size),
+                                                content_type='application/octet-stream')
+                    elapsed, response = self._timed(
+                        lambda: client.post('/api/files/', {'file': upload}, format='multipart'), 201)
+                    latencies.append(elapsed)
+                    uploaded[size].append(response.data['id'])
+                results['upload'][format_size(size)] = self._transfer_summary(latencies, size)
+                self._report(format_size(size), results['upload'][format_size(size)])
+
+        if 'download' in scenarios:
+            self.stdout.write('download')
+            results['download'] = {}
+            for size in sizes:
+                latencies = []
+                for file_id in uploaded[size]:
+                    elapsed, _ = self._timed(lambda: client.get(f'/api/files/{file_id}/download/'), 200)
+                    latencies.append(elapsed)
+                results['download'][format_size(size)] = self._transfer_summary(latencies, size)
+                self._report(format_size(size), results['download'][format_size(size)])
+
+        if 'dedup' in scenarios:
+            self.stdout.write('dedup')
+            results['dedup'] = {}
+            _, other = self._make_user('bench_dedup')
+            for size in sizes:
+                # Re-upload content that is already stored: only a reference is created
+                content = self._payload(size)
+                first = SimpleUploadedFile('dedup-source.bin', content, content_type='application/octet-stream')
+                self._timed(lambda: client.post('/api/files/', {'file': first}, format='multipart'), 201)
+                latencies = []
+                for i in range(self._iterations_for(size)):
+                    upload = SimpleUploadedFile(f'dedup-{i}.bin', content, content_type='application/octet-stream')
+                    elapsed, _ = self._timed(
+                        lambda: other.post('/api/files/', {'file': upload}, format='multipart'), 201)
+                    latencies.append(elapsed)
+                results['dedup'][format_size(size)] = self._transfer_summary(latencies, size)
+                self._report(format_size(size), results['dedup'][format_size(size)])
+
+        if {'listing', 'search'} & set(scenarios):
+            self._listing_and_search(scenarios, results)
+
+        if 'rotation' in scenarios:
+            self._rotation(results)
+
+        if 'delete' in scenarios:
+            self.stdout.write('delete')
+            latencies = []
+            for size in sizes:
+                for file_id in uploaded[size]:
+                    elapsed, _ = self._timed(lambda: client.delete(f'/api/files/{file_id}/'), 204)
+                    latencies.append(elapsed)
+            results['delete'] = summarize_latencies(latencies)
+            self._report('delete', results['delete'])
+
+        return results
+
+    def _transfer_summary(self, latencies, size):
+        summary = summarize_latencies(latencies)
+        summary['throughput_mb_s'] = throughput_mb_s(size * len(latencies), sum(latencies))
+        return summary
+
+    def _listing_and_search(self, scenarios, results):
+        list_sizes = sorted(int(n) for n in self.options['list_sizes'].split(',') if n)
+        iterations = self.options['list_iterations']
+        user, client = self._make_user('bench_listing')
+        file_types = ['text/plain', 'text/csv', 'image/jpeg', 'application/pdf', 'application/json']
+        now = timezone.now()
+        created = 0
+        if 'listing' in scenarios:
+            results['listing'] = {}
+        if 'search' in scenarios:
+            results['search'] = {}
+
+        for count in list_sizes:
+            # Metadata-only rows: listing never touches blob storage
+            batch = []
+            while created < count:
+                batch.append(File(
+                    owner=user,
+                    file=f'bench/{created}',
+                    original_filename=f'report-{created}-{self.rng.choice(["alpha", "beta", "gamma"])}.dat',
+                    file_type=self.rng.choice(file_types),
+                    size=self.rng.randint(1024, 50 * 1024 * 1024),
+                    file_hash=f'{created:064x}',
+                ))
+                created += 1
+                if len(batch) >= 5000:
+                    File.objects.bulk_create(batch)
+                    batch = []
+            if batch:
+                File.objects.bulk_create(batch)
+            # Spread upload dates so date filters select a subset
+            if connection.vendor != 'sqlite' or count <= 100000:
+                for offset, pk in enumerate(File.objects.filter(owner=user).values_list('pk', flat=True)[:count:10]):
+                    File.objects.filter(pk=pk).update(uploaded_at=now - timedelta(days=offset % 365))
+
+            label = str(count)
+            if 'listing' in scenarios:
+                latencies = [self._timed(lambda: client.get('/api/files/'), 200)[0] for _ in range(iterations)]
+                results['listing'][label] = summarize_latencies(latencies)
+                self._report(f'listing {label}', results['listing'][label])
+
+            if 'search' in scenarios:
+                date_from = (now - timedelta(days=30)).strftime('%Y-%m-%d')
+                filters = {
+                    'filename': 'filename=gamma',
+                    'file_type': 'file_type=csv',
+                    'size_range': 'size_min=1048576&size_max=2097152',
+                    'date_range': f'date_from={date_from}&date_to={now.strftime("%Y-%m-%d")}',
+                    'combined': 'filename=alpha&file_type=image&size_min=1048576',
+                }
+                results['search'][label] = {}
+                for name, query in filters.items():
+                    latencies = [self._timed(lambda: client.get(f'/api/files/?{query}'), 200)[0]
+                                 for _ in range(iterations)]
+                    results['search'][label][name] = summarize_latencies(latencies)
+                    self._report(f'search {label} {name}', results['search'][label][name])
+
+    def _rotation(self, results):
+        n = self.options['rotate_files']
+        self.stdout.write(f'rotation ({n} files)')
+        user, client = self._make_user('bench_rotation')
+        for i in range(n):
+            upload = SimpleUploadedFile(f'rotate-{i}.txt', self._payload(4096), content_type='text/plain')
+            self._timed(lambda: client.post('/api/files/', {'file': upload}, format='multipart'), 201)
+        elapsed, _ = self._timed(
+            lambda: client.post('/api/auth/rotate-key/', {'new_encryption_key': 'rotated-key'}, format='json'), 200)
+        results['rotation'] = {
+            'files': n,
+            'total_ms': round(elapsed * 1000, 3),
+            'per_file_ms': round(elapsed * 1000 / max(n, 1), 3),
+            'files_ops_s': round(n / elapsed, 2) if elapsed else None,
+        }
+        self._report('rotation', results['rotation'])
+
+    # --- compare mode --------------------------------------------------------
+
+    def _compare(self, baseline_path, candidate_path, threshold):
+        baseline, candidate = load_results(baseline_path), load_results(candidate_path)
+        rows = compare_results(baseline, candidate, threshold)
+        regressions = [r for r in rows if r['status'] == 'regression']
+        for row in rows:
+            line = f"{row['metric']}: {row['baseline']} -> {row['candidate']} ({row['change_pct']:+.1f}%)"
+            if row['status'] == 'regression':
+                self.stdout.write(self.style.ERROR(f"REGRESSION {line}"))
+            elif row['status'] == 'improvement':
+                self.stdout.write(self.style.SUCCESS(f"improved   {line}"))
+            else:
+                self.stdout.write(f"ok         {line}")
+        self.stdout.write(f"\n{len(rows)} metrics compared, {len(regressions)} regressions beyond {threshold}%.")
+        if regressions:
+            raise CommandError(f"{len(regressions)} metric(s) regressed by more than {threshold}%")
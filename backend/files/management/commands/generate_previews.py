@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from files import previews
+from files.blobs import BlobNotFound, read_blob
+from files.models import File, Preview
+from files.services import FileServiceError, decode_content
+
+
+class Command(BaseCommand):
+    help = (
+        'Renders thumbnails and previews (files/previews.py) for stored content that has none yet, '
+        'e.g. files uploaded before previews existed or jobs dropped while the worker pool was busy.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many contents.')
+        parser.add_argument('--retry-failed', action='store_true', help='Also retry contents whose rendering failed.')
+
+    def handle(self, *args, **options):
+        if not previews.enabled():
+            raise CommandError('PREVIEWS_ENABLED is off.')
+
+        done = Preview.objects.all()
+        if options['retry_failed']:
+            done = done.exclude(status=Preview.FAILED)
+        pending = (
+            File.objects.exclude(file_hash=None).exclude(file_hash__in=done.values('file_hash'))
+            .order_by('file_hash').values_list('file_hash', flat=True).distinct()
+        )
+        max_bytes = getattr(settings, 'PREVIEW_MAX_SOURCE_BYTES', 25 * 1024 * 1024)
+        counts = {}
+        for file_hash in pending.iterator(chunk_size=100):
+            if options['limit'] is not None and sum(counts.values()) >= options['limit']:
+                break
+            # The first row of a content belongs to whoever uploaded (and encrypted) it
+            file_instance = File.objects.filter(file_hash=file_hash).select_related('owner').order_by('uploaded_at').first()
+            if previews.renderer_for(file_instance.original_filename, file_instance.file_type) is None:
+                status = previews.generate(file_hash, b'', file_instance.original_filename, file_instance.file_type)
+            elif (file_instance.original_size or file_instance.size) > max_bytes:
+                continue
+            else:
+                try:
+                    content = decode_content(file_instance, file_instance.owner, read_blob(file_instance.file.name))
+                except (BlobNotFound, FileServiceError) as e:
+                    self.stderr.write(self.style.WARNING(f"Skipping {file_hash}: {e}"))
+                    continue
+                status = previews.generate(file_hash, content, file_instance.original_filename, file_instance.file_type)
+            counts[status] = counts.get(status, 0) + 1
+
+        summary = ', '.join(f"{n} {status}" for status, n in sorted(counts.items())) or 'nothing to do'
+        self.stdout.write(self.style.SUCCESS(f"Previews: {summary}."))
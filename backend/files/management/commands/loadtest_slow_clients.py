@@ -0,0 +1,165 @@
+import asyncio
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.benchmarking import MB, summarize_latencies, throughput_mb_s, write_results
+
+
+class Command(BaseCommand):
+    help = (
+        'Opens many concurrent, deliberately slow HTTP downloads against a running server and '
+        'measures whether it keeps serving them (and a fast probe endpoint) without stalling. '
+        'Point it at the async download endpoint under an ASGI server, e.g. '
+        '`uvicorn core.asgi:application`, and compare against the sync endpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True, help='Download URL, e.g. http://127.0.0.1:8000/api/files/async/<id>/download/')
+        parser.add_argument('--token', required=True, help='JWT access token sent as a Bearer token.')
+        parser.add_argument('--clients', type=int, default=1000, help='Number of concurrent slow clients (default: 1000).')
+        parser.add_argument('--rate-kb', type=float, default=64, help='Per-client read rate in KB/s (default: 64).')
+        parser.add_argument('--read-size', type=int, default=16 * 1024, help='Bytes read per socket read.')
+        parser.add_argument('--ramp', type=float, default=5.0, help='Seconds over which clients are started.')
+        parser.add_argument('--timeout', type=float, default=600.0, help='Give up on a client after this many seconds.')
+        parser.add_argument('--probe-url', help='Cheap authenticated URL polled during the test, e.g. /api/auth/storage/.')
+        parser.add_argument('--probe-interval', type=float, default=0.25, help='Seconds between probe requests.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1:
+            raise CommandError('--clients must be at least 1')
+        results = asyncio.run(self._run(options))
+        write_results(options['json_path'], 'slow_clients', results, parameters={
+            k: options[k] for k in ('url', 'clients', 'rate_kb', 'read_size', 'ramp', 'probe_url')
+        })
+
+        self.stdout.write(f"Clients: {results['completed']} completed, {results['failed']} failed "
+                          f"(statuses: {results['statuses']})")
+        self.stdout.write(f"Peak concurrent transfers: {results['peak_concurrency']}")
+        self.stdout.write(f"Time to first byte: {results['ttfb']}")
+        self.stdout.write(f"Transfer time: {results['transfer']}")
+        self.stdout.write(f"Aggregate throughput: {results['aggregate_mb_s']} MB/s over {results['wall_s']}s")
+        if results.get('probe'):
+            self.stdout.write(f"Probe latency while loaded: {results['probe']}")
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    async def _request(self, url, token, deadline):
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl.create_default_context() if secure else None),
+            timeout=max(1.0, deadline - time.monotonic()),
+        )
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nAuthorization: Bearer {token}\r\n"
+            f"User-Agent: vault-loadtest\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1]) if status_line else 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return reader, writer, status
+
+    async def _slow_client(self, options, state, delay):
+        await asyncio.sleep(delay)
+        start = time.monotonic()
+        deadline = start + options['timeout']
+        rate = options['rate_kb'] * 1024
+        read_size = options['read_size']
+        received = 0
+        writer = None
+        try:
+            reader, writer, status = await self._request(options['url'], options['token'], deadline)
+            ttfb = time.monotonic() - start
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            try:
+                while time.monotonic() < deadline:
+                    chunk = await asyncio.wait_for(reader.read(read_size), timeout=deadline - time.monotonic())
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    # Throttle to the target rate to mimic a slow mobile link
+                    await asyncio.sleep(len(chunk) / rate)
+            finally:
+                state['active'] -= 1
+            state['statuses'][status] = state['statuses'].get(status, 0) + 1
+            if status != 200:
+                state['failed'] += 1
+                return
+            state['ttfb'].append(ttfb)
+            state['transfer'].append(time.monotonic() - start)
+            state['bytes'] += received
+            state['completed'] += 1
+        except Exception as e:
+            state['failed'] += 1
+            key = type(e).__name__
+            state['statuses'][key] = state['statuses'].get(key, 0) + 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def _probe(self, options, state, stop):
+        parts = urlsplit(options['url'])
+        url = options['probe_url']
+        if url.startswith('/'):
+            url = f"{parts.scheme}://{parts.netloc}{url}"
+        while not stop.is_set():
+            start = time.monotonic()
+            try:
+                reader, writer, status = await self._request(url, options['token'], start + 30)
+                await reader.read()
+                writer.close()
+                if status == 200:
+                    state['probe'].append(time.monotonic() - start)
+                else:
+                    state['probe_errors'] += 1
+            except Exception:
+                state['probe_errors'] += 1
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=options['probe_interval'])
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, options):
+        state = {
+            'active': 0, 'peak': 0, 'completed': 0, 'failed': 0, 'bytes': 0,
+            'statuses': {}, 'ttfb': [], 'transfer': [], 'probe': [], 'probe_errors': 0,
+        }
+        clients = options['clients']
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(self._probe(options, state, stop)) if options['probe_url'] else None
+
+        start = time.monotonic()
+        await asyncio.gather(*[
+            self._slow_client(options, state, options['ramp'] * i / clients) for i in range(clients)
+        ])
+        wall = time.monotonic() - start
+        stop.set()
+        if probe_task:
+            await probe_task
+
+        return {
+            'completed': state['completed'],
+            'failed': state['failed'],
+            'statuses': {str(k): v for k, v in state['statuses'].items()},
+            'peak_concurrency': state['peak'],
+            'ttfb': summarize_latencies(state['ttfb']),
+            'transfer': summarize_latencies(state['transfer']),
+            'bytes': state['bytes'],
+            'wall_s': round(wall, 2),
+            'aggregate_mb_s': throughput_mb_s(state['bytes'], wall),
+            'mb_received': round(state['bytes'] / MB, 2),
+            'probe': summarize_latencies(state['probe']) if options['probe_url'] else None,
+            'probe_errors': state['probe_errors'],
+        }
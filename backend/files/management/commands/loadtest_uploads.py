@@ -0,0 +1,152 @@
+import asyncio
+import os
+import ssl
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.benchmarking import MB, summarize_latencies, write_results
+
+CHUNK = 256 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs an abusive user (many parallel large uploads, ignoring Retry-After) against a running '
+        'server while well-behaved users upload small files one at a time, and reports the well-behaved '
+        "users' latency and everybody's status codes. Run it with ADMISSION_ENABLED=False and True on "
+        'the server to compare. Uploads are not deleted afterwards; use throwaway accounts.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True, help='Upload URL, e.g. http://127.0.0.1:8000/api/files/')
+        parser.add_argument('--abuser-token', required=True, help='JWT access token of the abusive user.')
+        parser.add_argument('--victim-token', required=True, action='append',
+                            help='JWT access token of a well-behaved user; repeat for several users.')
+        parser.add_argument('--abusers', type=int, default=32, help='Parallel uploads of the abusive user.')
+        parser.add_argument('--abuser-size-mb', type=float, default=20, help='Size of each abusive upload.')
+        parser.add_argument('--victim-size-kb', type=float, default=64, help='Size of each well-behaved upload.')
+        parser.add_argument('--victim-interval', type=float, default=0.2, help='Seconds between a victim\'s uploads.')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds to keep the load up.')
+        parser.add_argument('--baseline', type=float, default=5.0,
+                            help='Seconds of victim-only traffic measured before the abuse starts.')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Give up on an upload after this many seconds.')
+        parser.add_argument('--json', dest='json_path', help='Write machine-readable results to this path.')
+
+    def handle(self, *args, **options):
+        if options['abusers'] < 1:
+            raise CommandError('--abusers must be at least 1')
+        results = asyncio.run(self._run(options))
+        write_results(options['json_path'], 'upload_admission', results, parameters={
+            k: options[k] for k in (
+                'url', 'abusers', 'abuser_size_mb', 'victim_size_kb', 'victim_interval', 'duration', 'baseline',
+            )
+        })
+
+        self.stdout.write(f"Victim latency alone:       {results['victim_baseline']}")
+        self.stdout.write(f"Victim latency under abuse: {results['victim_loaded']}")
+        self.stdout.write(f"Victim statuses: {results['victim_statuses']}")
+        self.stdout.write(f"Abuser statuses: {results['abuser_statuses']} "
+                          f"({results['abuser_mb_accepted']} MB accepted)")
+        if options['json_path']:
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json_path']}"))
+
+    async def _upload(self, url, token, prefix, body):
+        """POST one multipart upload of prefix + body; returns the status code."""
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        boundary = uuid.uuid4().hex
+        head = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="load-{boundary[:8]}.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        body = memoryview(body)  # Sliced without copying
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80),
+            ssl=ssl.create_default_context() if secure else None,
+        )
+        response = None
+        try:
+            writer.write(
+                f"POST {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\nAuthorization: Bearer {token}\r\n"
+                f"Content-Type: multipart/form-data; boundary={boundary}\r\n"
+                f"Content-Length: {len(head) + len(prefix) + len(body) + len(tail)}\r\n"
+                f"User-Agent: vault-loadtest\r\nConnection: close\r\n\r\n".encode() + head + prefix
+            )
+            response = asyncio.ensure_future(reader.readline())
+            sent = False
+            try:
+                # Like curl, stop sending the body once the server has answered (e.g. 429 up front)
+                for offset in range(0, len(body), CHUNK):
+                    if response.done():
+                        break
+                    writer.write(body[offset:offset + CHUNK])
+                    await writer.drain()
+                else:
+                    writer.write(tail)
+                    await writer.drain()
+                    sent = True
+            except ConnectionError:
+                pass  # The server closed early
+            status_line = await response
+            if sent:
+                await reader.read()
+            return int(status_line.split()[1]) if status_line else 0
+        finally:
+            if response is not None:
+                response.cancel()
+            writer.close()
+
+    async def _client(self, url, token, size, interval, until, latencies, statuses, timeout):
+        # Generated once, as the client shares the CPU with the server under test;
+        # a fresh prefix per upload still keeps every upload from deduplicating.
+        body = os.urandom(max(0, size - 16))
+        while time.monotonic() < until:
+            start = time.monotonic()
+            try:
+                status = await asyncio.wait_for(self._upload(url, token, os.urandom(16), body), timeout)
+            except Exception as e:
+                status = type(e).__name__
+            statuses[status] = statuses.get(status, 0) + 1
+            if status in (200, 201):
+                latencies.append(time.monotonic() - start)
+            if interval:
+                await asyncio.sleep(interval)
+
+    def _victims(self, options, until, latencies, statuses):
+        size = int(options['victim_size_kb'] * 1024)
+        return [
+            self._client(
+                options['url'], token, size, options['victim_interval'], until, latencies, statuses, options['timeout']
+            )
+            for token in options['victim_token']
+        ]
+
+    async def _run(self, options):
+        baseline, loaded = [], []
+        victim_statuses, abuser_statuses, abuser_ok = {}, {}, []
+
+        if options['baseline'] > 0:
+            await asyncio.gather(*self._victims(options, time.monotonic() + options['baseline'], baseline, {}))
+
+        until = time.monotonic() + options['duration']
+        abuser_size = int(options['abuser_size_mb'] * MB)
+        abusers = [
+            self._client(
+                options['url'], options['abuser_token'], abuser_size, 0, until, abuser_ok, abuser_statuses,
+                options['timeout'],
+            )
+            for _ in range(options['abusers'])
+        ]
+        await asyncio.gather(*abusers, *self._victims(options, until, loaded, victim_statuses))
+
+        return {
+            'victim_baseline': summarize_latencies(baseline),
+            'victim_loaded': summarize_latencies(loaded),
+            'victim_statuses': {str(k): v for k, v in victim_statuses.items()},
+            'abuser_statuses': {str(k): v for k, v in abuser_statuses.items()},
+            'abuser_mb_accepted': round(len(abuser_ok) * abuser_size / MB, 2),
+        }
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import shutil
+import time
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from files import integrity
+from files.blobs import delete_blob, record_write
+from files.layout import SHARDED, get_layout, is_sharded, sharded_name
+from files.models import File
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves blobs stored under the legacy flat names into the sharded layout (files/layout.py) '
+        'in batches and rewrites File.file. Safe to run while the app is serving traffic and to '
+        'interrupt; already moved blobs are skipped. Avoid running it during key rotations.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Blobs per batch (default: 200).')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to pause between batches.')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many blobs.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved.')
+
+    def handle(self, *args, **options):
+        if get_layout() != SHARDED:
+            raise CommandError("STORAGE_LAYOUT is not 'sharded'; new uploads would keep using flat names.")
+
+        pending = File.objects.exclude(file='').exclude(file__startswith='blobs/')
+        total = pending.values('file').distinct().count()
+        self.stdout.write(f"{total} blob(s) to migrate.")
+        if options['dry_run'] or not total:
+            return
+
+        moved = skipped = missing = rows_updated = 0
+        last_name = ''
+        started = time.perf_counter()
+        while options['limit'] is None or moved + skipped + missing < options['limit']:
+            batch = list(
+                pending.filter(file__gt=last_name).order_by('file')
+                .values_list('file', flat=True).distinct()[:options['batch_size']]
+            )
+            if not batch:
+                break
+            for name in batch:
+                last_name = name
+                if options['limit'] is not None and moved + skipped + missing >= options['limit']:
+                    break
+                if is_sharded(name):
+                    continue
+                try:
+                    result, updated = self._migrate_blob(name)
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"Failed to migrate {name}: {e}"))
+                    skipped += 1
+                    continue
+                if result == 'missing':
+                    missing += 1
+                elif result == 'changed':
+                    skipped += 1
+                else:
+                    moved += 1
+                    rows_updated += updated
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"  {moved + skipped + missing}/{total} processed ({moved} moved, {skipped} skipped, "
+                f"{missing} missing) in {elapsed:.1f}s"
+            )
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {moved} blob(s) moved, {rows_updated} File row(s) updated, {skipped} skipped, "
+            f"{missing} missing from storage."
+        ))
+
+    def _fingerprint(self, name):
+        try:
+            return default_storage.size(name), default_storage.get_modified_time(name)
+        except NotImplementedError:
+            return default_storage.size(name), None
+
+    def _digest(self, name):
+        sha = hashlib.sha256()
+        with default_storage.open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _place(self, name, target):
+        """Make the blob available under `target` without removing `name`."""
+        if isinstance(default_storage, FileSystemStorage):
+            source_path, target_path = default_storage.path(name), default_storage.path(target)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            try:
+                os.link(source_path, target_path)  # Same filesystem: no data is copied
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+        else:
+            with default_storage.open(name, 'rb') as f:
+                target = default_storage.save(target, f)
+        record_write(target, default_storage.size(target))  # Size cache and replicas, as for any new blob
+        return target
+
+    def _migrate_blob(self, name):
+        if not default_storage.exists(name):
+            self.stderr.write(self.style.WARNING(f"Blob {name} is referenced but missing from storage."))
+            return 'missing', 0
+
+        before = self._fingerprint(name)
+        target = sharded_name(self._digest(name))
+        created = True
+        if default_storage.exists(target) and default_storage.size(target) == before[0]:
+            created = False  # Same content already stored under its content address
+        else:
+            if default_storage.exists(target):
+                target = default_storage.get_available_name(target)
+            target = self._place(name, target)
+
+        row_ids = list(File.objects.filter(file=name).values_list('pk', flat=True))
+        updated = File.objects.filter(pk__in=row_ids, file=name).update(file=target)
+
+        # The blob was rewritten in place (key rotation) while we copied it:
+        # point the rows back at the old name and retry on the next run.
+        if self._fingerprint(name) != before:
+            File.objects.filter(pk__in=row_ids, file=target).update(file=name)
+            if created:
+                delete_blob(target)
+            self.stderr.write(self.style.WARNING(f"Blob {name} changed during migration; will retry later."))
+            return 'changed', 0
+
+        integrity.rename(name, target)
+        delete_blob(name)
+        return 'moved', updated
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from files import delta, versions
+from files.models import File
+from files.services import FileServiceError
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrites file versions that are more than VERSION_MAX_CHAIN deltas away from full content '
+        'as full snapshots (files/versions.py), so reading old versions stays bounded. Run it periodically.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-chain', type=int, default=None,
+                            help='Longest allowed run of deltas (default: VERSION_MAX_CHAIN).')
+        parser.add_argument('--loop', action='store_true', help='Keep running, one pass every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds between passes with --loop.')
+
+    def handle(self, *args, **options):
+        limit = versions.max_chain() if options['max_chain'] is None else options['max_chain']
+        while True:
+            self._pass(limit)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def _pass(self, limit):
+        # Only files with more versions than the limit can have a chain that long
+        candidates = (
+            File.objects.annotate(n=Count('versions')).filter(n__gt=limit)
+            .select_related('owner').order_by('pk')
+        )
+        files = rewritten = 0
+        for file_instance in candidates.iterator(chunk_size=100):
+            try:
+                count = versions.rebase(file_instance, limit)
+            except (FileServiceError, delta.DeltaError) as e:
+                self.stderr.write(self.style.WARNING(f"Skipping {file_instance.pk}: {e}"))
+                continue
+            if count:
+                files += 1
+                rewritten += count
+        self.stdout.write(self.style.SUCCESS(f"Rewrote {rewritten} version(s) of {files} file(s) as full snapshots."))
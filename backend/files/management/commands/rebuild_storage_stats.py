@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from files import stats
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the per-user storage statistics (files/stats.py) from the File and FileVersion tables, '
+        'e.g. after rows were changed outside the API.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only this username.')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('username')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f"No user named {options['user']!r}.")
+        fixed = 0
+        for user in users.iterator():
+            wrong = stats.rebuild(user.pk)
+            if wrong:
+                fixed += 1
+                self.stdout.write(f"Rebuilt {user.username}: {wrong} counter(s) were off")
+        self.stdout.write(self.style.SUCCESS(f"Storage statistics rebuilt; {fixed} user(s) had drifted."))
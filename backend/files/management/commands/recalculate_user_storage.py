@@ -1,12 +1,16 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from django.db.models import Sum
-from files.models import File # Assuming your File model is in the 'files' app
+from files import folders
+from files.models import File, FileVersion # Assuming your File model is in the 'files' app
 
 User = get_user_model()
 
 class Command(BaseCommand):
-    help = 'Recalculates the used_storage for all users based on their owned File objects.'
+    help = (
+        'Recalculates the used_storage for all users based on their owned File objects and earlier versions, '
+        'and rebuilds the size and file count totals of their folders.'
+    )
 
     def handle(self, *args, **options):
         self.stdout.write("Starting recalculation of used_storage for all users...")
@@ -20,6 +24,8 @@ class Command(BaseCommand):
             try:
                 actual_used_storage_data = File.objects.filter(owner=user).aggregate(total_size=Sum('size'))
                 actual_used_storage = actual_used_storage_data['total_size'] if actual_used_storage_data['total_size'] is not None else 0
+                # Earlier versions count against the quota too (files/versions.py)
+                actual_used_storage += FileVersion.objects.filter(file__owner=user).aggregate(total_size=Sum('size'))['total_size'] or 0
             except Exception as e:
                 self.stderr.write(self.style.ERROR(f"Error calculating storage for user {user.username} ({user.id}): {e}"))
                 continue # Skip this user if there's an error in calculation
@@ -38,6 +44,10 @@ class Command(BaseCommand):
             else:
                 self.stdout.write(self.style.SUCCESS(f"User {user.username} (ID: {user.id}) storage is already correct: {user.used_storage}"))
 
+            folders_fixed = folders.recalculate(user)
+            if folders_fixed:
+                self.stdout.write(f"Rebuilt totals of {folders_fixed} folder(s) of user {user.username} (ID: {user.id})")
+
         self.stdout.write(self.style.SUCCESS(
             f"Recalculation complete. {updated_count} out of {user_count} users' storage updated."
         )) 
\ No newline at end of file
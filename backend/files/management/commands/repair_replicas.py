@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from files import outbox, replication, storage_tiers
+from files.blobs import Throttle
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares every blob the database refers to across the primary storage and the replicas '
+        '(files/replication.py). Missing or wrong replica copies are queued for replicate_blobs; a '
+        'missing or wrong primary copy is restored from a good replica. Sizes only, unless --verify.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Also read the copies of indexed blobs and check them against their index.')
+        parser.add_argument('--rate-mb', type=float, default=getattr(settings, 'REPLICATION_RATE_MB_S', 0),
+                            help='Maximum read rate in MB/s; 0 for unlimited (default: REPLICATION_RATE_MB_S).')
+        parser.add_argument('--max-blobs', type=int, default=None, help='Stop after this many blobs.')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Stop after this long.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be repaired.')
+
+    def handle(self, *args, **options):
+        if not storage_tiers.replicas():
+            raise CommandError('No replicas are configured; set STORAGE_REPLICAS.')
+        throttle = Throttle(options['rate_mb'] * 1024 * 1024)
+        deadline = time.monotonic() + options['max_seconds'] if options['max_seconds'] else None
+        limit = options['max_blobs']
+        dropped = 0 if options['dry_run'] else outbox.forget_unconfigured()
+
+        counts = {}
+        checked = 0
+        for name in replication.referenced_names():
+            if (limit is not None and checked >= limit) or (deadline and time.monotonic() > deadline):
+                break
+            checked += 1
+            try:
+                result = replication.check(name, options['verify'], throttle, options['dry_run'])
+            except Exception as e:  # Storage unavailable etc.
+                self.stderr.write(self.style.ERROR(f"Could not check {name}: {e}"))
+                continue
+            counts[result] = counts.get(result, 0) + 1
+            if result == replication.LOST:
+                self.stderr.write(self.style.ERROR(f"No good copy left: {name}"))
+            elif result != replication.OK and options['dry_run']:
+                self.stdout.write(f"{name}: would be {result}")
+
+        summary = ', '.join(f"{n} {result}" for result, n in sorted(counts.items())) or 'nothing to check'
+        message = f"Checked {checked} blob(s): {summary}; dropped {dropped} change(s) queued for removed replicas."
+        if counts.get(replication.LOST):
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from files import outbox, replication, storage_tiers
+from files.blobs import Throttle
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies queued blob changes to the replicas in STORAGE_REPLICAS (files/replication.py), '
+        'in batches, retrying failures with backoff. Several can run at once; each claims its own batches. '
+        'Also sets the replication.pending and replication.lag_seconds gauges.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'REPLICATION_BATCH_SIZE', 100),
+                            help='Changes claimed at a time (default: REPLICATION_BATCH_SIZE).')
+        parser.add_argument('--rate-mb', type=float, default=getattr(settings, 'REPLICATION_RATE_MB_S', 0),
+                            help='Maximum read rate in MB/s; 0 for unlimited (default: REPLICATION_RATE_MB_S).')
+        parser.add_argument('--loop', action='store_true', help='Keep running; wait --interval seconds when idle.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait with --loop once the queue is drained.')
+        parser.add_argument('--report', action='store_true', help='Only show the queue of each replica.')
+
+    def handle(self, *args, **options):
+        if not storage_tiers.replicas():
+            raise CommandError('No replicas are configured; set STORAGE_REPLICAS.')
+        if options['report']:
+            self._report()
+            return
+        throttle = Throttle(options['rate_mb'] * 1024 * 1024)
+        totals = {'applied': 0, 'requeued': 0, 'failed': 0}
+        while True:
+            counts = replication.run(options['batch_size'], throttle)
+            for key, value in counts.items():
+                totals[key] += value
+            outbox.publish()
+            if sum(counts.values()) == 0:  # Drained, or only changes waiting for a retry
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        # Only reached without --loop
+        message = (f"{totals['applied']} change(s) replicated, {totals['failed']} failed, "
+                   f"{totals['requeued']} changed meanwhile.")
+        self.stdout.write(self.style.WARNING(message) if totals['failed'] else self.style.SUCCESS(message))
+
+    def _report(self):
+        for replica, row in outbox.status().items():
+            self.stdout.write(
+                f"{replica}: {row['pending']} change(s) queued, {row['failing']} failing, lag {row['lag_seconds']:.0f}s"
+            )
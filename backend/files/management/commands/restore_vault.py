@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from files import backup
+from files.blobs import BlobNotFound
+from files.models import File
+
+
+class Command(BaseCommand):
+    help = (
+        'Restores a snapshot written by backup_vault (files/backup.py): loads its database rows into '
+        'an empty database and copies its blobs back to storage, checking every blob against its '
+        'address or hash as it is read.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('snapshot', nargs='?', default='latest', help="Snapshot id (default: 'latest').")
+        parser.add_argument('--verify-only', action='store_true',
+                            help='Only check that every blob of the snapshot is intact; change nothing.')
+        parser.add_argument('--blobs-only', action='store_true',
+                            help='Only copy blobs back (the database is intact, storage was lost).')
+        parser.add_argument('--overwrite', action='store_true',
+                            help='Also copy blobs that storage already has with the right size.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Blobs copied in parallel (default: BACKUP_WORKERS).')
+
+    def handle(self, *args, **options):
+        tier = backup.target()
+        snapshot_id = options['snapshot']
+        if snapshot_id == 'latest':
+            found = backup.snapshots(tier)
+            if not found:
+                raise CommandError('There are no snapshots on BACKUP_TARGET.')
+            snapshot_id = found[-1]
+        try:
+            m = backup.manifest(tier, snapshot_id)
+        except BlobNotFound:
+            raise CommandError(f'No finished snapshot {snapshot_id!r} on BACKUP_TARGET.')
+        if m['missing']:
+            self.stderr.write(self.style.WARNING(
+                f"{m['missing']} blob(s) were deleted or changed while snapshot {snapshot_id} was taken; "
+                'their rows are restored without them.'
+            ))
+
+        verify_only = options['verify_only']
+        if not verify_only and not options['blobs_only']:
+            if File.objects.exists() or get_user_model().objects.exists():
+                raise CommandError('The database is not empty; restore into a freshly migrated database, '
+                                   'or use --blobs-only.')
+            backup.restore_metadata(tier, snapshot_id)
+            self.stdout.write(f"Restored the rows of snapshot {snapshot_id}.")
+
+        counts = {}
+        read = 0
+        for name, result, nbytes in backup.restore_blobs(
+            tier, snapshot_id, verify_only=verify_only, overwrite=options['overwrite'], threads=options['workers']
+        ):
+            counts[result] = counts.get(result, 0) + 1
+            read += nbytes
+            if result in (backup.MISSING, backup.CHANGED):
+                self.stderr.write(self.style.ERROR(f"{'Missing' if result == backup.MISSING else 'Corrupt'}: {name}"))
+
+        if verify_only:
+            message = f"{counts.get(backup.COPIED, 0)} blob(s) intact, read {read / (1024 * 1024):.1f} MB."
+        else:
+            message = (f"{counts.get(backup.COPIED, 0)} blob(s) restored, {counts.get(backup.PRESENT, 0)} already "
+                       f"in storage, read {read / (1024 * 1024):.1f} MB.")
+        failed = counts.get(backup.MISSING, 0) + counts.get(backup.CHANGED, 0)
+        if failed:
+            self.stdout.write(self.style.WARNING(f"{message} {failed} blob(s) missing or corrupt in the backup."))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,117 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+from django.utils import timezone
+
+from files import integrity
+from files.blobs import BlobNotFound, Throttle, open_blob
+from files.models import BlobIntegrity, File, FileVersion
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-reads stored blobs and checks them against their integrity index (files/integrity.py), '
+        'least recently verified first and rate limited, so it can run next to live traffic. '
+        'Corrupt and missing blobs are recorded on BlobIntegrity and reported.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate-mb', type=float, default=getattr(settings, 'SCRUB_RATE_MB_S', 20),
+                            help='Maximum read rate in MB/s; 0 for unlimited (default: SCRUB_RATE_MB_S).')
+        parser.add_argument('--min-age-hours', type=float,
+                            default=getattr(settings, 'SCRUB_INTERVAL_HOURS', 24 * 7),
+                            help='Only re-verify blobs last verified longer ago than this.')
+        parser.add_argument('--max-blobs', type=int, default=None, help='Stop a pass after this many blobs.')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Stop a pass after this long.')
+        parser.add_argument('--adopt', action='store_true',
+                            help='Index blobs that have none yet (uploaded before indexing existed), '
+                                 'taking their current content as the reference.')
+        parser.add_argument('--loop', action='store_true', help='Keep running, one pass every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds between passes with --loop.')
+        parser.add_argument('--report', action='store_true', help='Only list blobs recorded as corrupt or missing.')
+
+    def handle(self, *args, **options):
+        if options['report']:
+            self._report()
+            return
+        while True:
+            self._pass(options)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def _report(self):
+        bad = BlobIntegrity.objects.exclude(status=BlobIntegrity.OK).order_by('name')
+        for index in bad:
+            rows = File.objects.filter(file=index.name).count()
+            self.stdout.write(f"{index.status:8} {index.name} ({rows} file row(s)): {index.detail}")
+        self.stdout.write(f"{len(bad)} blob(s) need attention.")
+
+    def _pass(self, options):
+        throttle = Throttle(options['rate_mb'] * 1024 * 1024)
+        deadline = time.monotonic() + options['max_seconds'] if options['max_seconds'] else None
+        limit = options['max_blobs']
+
+        # Index rows whose blob no File or FileVersion row references any more
+        pruned, _ = (
+            BlobIntegrity.objects.exclude(name__in=File.objects.values('file'))
+            .exclude(name__in=FileVersion.objects.values('storage_name')).delete()
+        )
+        adopted = self._adopt(throttle, limit, deadline) if options['adopt'] else 0
+
+        cutoff = timezone.now() - timedelta(hours=options['min_age_hours'])
+        due = (
+            BlobIntegrity.objects.filter(Q(verified_at__isnull=True) | Q(verified_at__lt=cutoff))
+            .order_by(F('verified_at').asc(nulls_first=True))
+        )
+        counts = {BlobIntegrity.OK: 0, BlobIntegrity.CORRUPT: 0, BlobIntegrity.MISSING: 0}
+        for index in due.iterator(chunk_size=100):
+            if limit is not None and sum(counts.values()) + adopted >= limit:
+                break
+            if deadline and time.monotonic() > deadline:
+                break
+            try:
+                status = integrity.scrub(index, throttle)
+            except Exception as e:  # Storage unavailable etc.; try again next pass
+                self.stderr.write(self.style.ERROR(f"Could not scrub {index.name}: {e}"))
+                continue
+            counts[status] += 1
+            if status != BlobIntegrity.OK:
+                self.stderr.write(self.style.ERROR(f"{status}: {index.name}"))
+
+        mb = throttle.total / (1024 * 1024)
+        elapsed = time.monotonic() - throttle.started
+        message = (
+            f"Verified {counts[BlobIntegrity.OK]} blob(s) OK, {counts[BlobIntegrity.CORRUPT]} corrupt, "
+            f"{counts[BlobIntegrity.MISSING]} missing; adopted {adopted}, pruned {pruned} stale index row(s). "
+            f"Read {mb:.1f} MB in {elapsed:.1f}s."
+        )
+        if counts[BlobIntegrity.CORRUPT] or counts[BlobIntegrity.MISSING]:
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
+
+    def _adopt(self, throttle, limit, deadline):
+        adopted = 0
+        unindexed = (
+            File.objects.exclude(file='').exclude(file__in=BlobIntegrity.objects.values('name'))
+            .order_by('file').values_list('file', flat=True).distinct()
+        )
+        for name in unindexed.iterator(chunk_size=100):
+            if (limit is not None and adopted >= limit) or (deadline and time.monotonic() > deadline):
+                break
+            builder = integrity.IndexBuilder()
+            try:
+                with open_blob(name, use_cache=False, failover=False) as f:
+                    for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                        builder.update(data)
+                        throttle(len(data))
+            except BlobNotFound:
+                self.stderr.write(self.style.WARNING(f"Blob {name} is referenced but missing from storage."))
+                continue
+            integrity.record(name, index=builder.finish())
+            adopted += 1
+        return adopted
@@ -0,0 +1,84 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from files import storage_tiers, tiering
+from files.blobs import Throttle
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves blobs between the hot and cold storage tiers (files/tiering.py): blobs not downloaded '
+        'for TIER_COLD_AFTER_DAYS go cold, largest first; cold blobs downloaded again come back. '
+        'Rate limited, so it can run next to live traffic, and safe to interrupt. Avoid running it '
+        'during key rotations.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate-mb', type=float, default=getattr(settings, 'TIER_RATE_MB_S', 20),
+                            help='Maximum read rate in MB/s; 0 for unlimited (default: TIER_RATE_MB_S).')
+        parser.add_argument('--max-blobs', type=int, default=None, help='Stop a pass after this many moves.')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Stop a pass after this long.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the blobs that would be moved.')
+        parser.add_argument('--loop', action='store_true', help='Keep running, one pass every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds between passes with --loop.')
+        parser.add_argument('--report', action='store_true', help='Only show what is stored on each tier.')
+
+    def handle(self, *args, **options):
+        if not storage_tiers.enabled():
+            raise CommandError('No cold tier is configured; set STORAGE_COLD_TIER.')
+        if options['report']:
+            self._report()
+            return
+        while True:
+            self._pass(options)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def _report(self):
+        for tier, totals in sorted(tiering.summary().items()):
+            self.stdout.write(f"{tier:6} {totals['count']} blob(s), {totals['bytes'] / (1024 * 1024):.1f} MB")
+        due = sum(1 for _ in tiering.demotion_candidates())
+        back = sum(1 for _ in tiering.promotion_candidates())
+        self.stdout.write(f"{due} blob(s) due for the cold tier, {back} due back on the hot tier.")
+
+    def _pass(self, options):
+        throttle = Throttle(options['rate_mb'] * 1024 * 1024)
+        deadline = time.monotonic() + options['max_seconds'] if options['max_seconds'] else None
+        limit = options['max_blobs']
+        pruned = 0 if options['dry_run'] else tiering.prune()
+
+        # Promotions first: those blobs are being read
+        hot, cold = storage_tiers.get(storage_tiers.HOT), storage_tiers.get(storage_tiers.COLD)
+        counts = {}
+        done = 0
+        for target, candidates in ((hot, tiering.promotion_candidates()), (cold, tiering.demotion_candidates())):
+            for name, size in candidates:
+                if (limit is not None and done >= limit) or (deadline and time.monotonic() > deadline):
+                    break
+                done += 1
+                if options['dry_run']:
+                    self.stdout.write(f"{name} ({size} bytes) -> {target.name}")
+                    continue
+                try:
+                    result = tiering.move(name, target, throttle)
+                except Exception as e:  # Storage unavailable etc.; try again next pass
+                    self.stderr.write(self.style.ERROR(f"Could not move {name}: {e}"))
+                    continue
+                counts[(target.name, result)] = counts.get((target.name, result), 0) + 1
+                if result in (tiering.CORRUPT, tiering.MISSING):
+                    self.stderr.write(self.style.ERROR(f"{result}: {name}"))
+
+        if options['dry_run']:
+            self.stdout.write(f"{done} blob(s) would be moved.")
+            return
+        mb = throttle.total / (1024 * 1024)
+        elapsed = time.monotonic() - throttle.started
+        moved = ', '.join(f"{n} {result} to {tier}" for (tier, result), n in sorted(counts.items())) or 'nothing moved'
+        message = f"{moved}; pruned {pruned} deleted blob(s). Read {mb:.1f} MB in {elapsed:.1f}s."
+        if any(result in (tiering.CORRUPT, tiering.MISSING) for _, result in counts):
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,65 @@
+"""
+Binary Merkle tree over fixed-size chunks.
+
+Shared by the proof of possession (files/possession.py, over plaintext)
+and the at-rest integrity index (files/integrity.py, over stored bytes):
+
+  * leaf = sha256(0x00 || chunk), node = sha256(0x01 || left || right);
+  * an empty input is a single empty chunk;
+  * the last node of a level with an odd width is carried up unchanged.
+"""
+import hashlib
+import hmac
+
+HASH_SIZE = 32
+
+_LEAF = b'\x00'
+_NODE = b'\x01'
+
+
+def leaf_hash(chunk):
+    return hashlib.sha256(_LEAF + chunk).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(_NODE + left + right).digest()
+
+
+def leaf_count(size, chunk_size):
+    return max(1, -(-size // chunk_size))
+
+
+def leaf_hashes(content, chunk_size):
+    view = memoryview(content)
+    return [leaf_hash(view[i:i + chunk_size]) for i in range(0, max(len(content), 1), chunk_size)]
+
+
+def root(leaves):
+    """Root (bytes) of the tree over a list of leaf hashes."""
+    level = list(leaves)
+    while len(level) > 1:
+        paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def verify_path(expected_root, index, count, leaf, siblings):
+    """Whether `leaf` at `index` of `count` leaves hashes up to `expected_root` via `siblings` (bottom-up)."""
+    node = leaf
+    siblings = iter(siblings)
+    width = count
+    while width > 1:
+        try:
+            if index % 2:
+                node = node_hash(next(siblings), node)
+            elif index + 1 < width:
+                node = node_hash(node, next(siblings))
+        except StopIteration:
+            return False
+        index //= 2
+        width = -(-width // 2)
+    if next(siblings, None) is not None:
+        return False
+    return hmac.compare_digest(node, expected_root)
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.21 on 2026-10-19 05:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_file_file_hash_alter_file_file_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='compression',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='original_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
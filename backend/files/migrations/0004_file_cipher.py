@@ -0,0 +1,25 @@
+# Generated by Django 4.2.21 on 2026-10-19 05:45
+
+from django.db import migrations, models
+
+
+def mark_legacy_cipher(apps, schema_editor):
+    # Everything encrypted before cipher engines existed is 16-byte IV + AES-CFB
+    File = apps.get_model('files', 'File')
+    File.objects.filter(is_encrypted=True, cipher__isnull=True).update(cipher='aes-cfb')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0003_file_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='cipher',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(mark_legacy_cipher, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_file_cipher'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='merkle_root',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
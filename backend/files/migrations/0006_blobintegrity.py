@@ -0,0 +1,28 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_file_merkle_root'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobIntegrity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('leaves', models.BinaryField()),
+                ('root', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('corrupt', 'Corrupt'), ('missing', 'Missing')], db_index=True, default='ok', max_length=16)),
+                ('detail', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('verified_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_blobintegrity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Preview',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_hash', models.CharField(db_index=True, max_length=128)),
+                ('kind', models.CharField(max_length=16)),
+                ('status', models.CharField(choices=[('ready', 'Ready'), ('failed', 'Failed'), ('unsupported', 'Unsupported')], default='ready', max_length=16)),
+                ('storage_name', models.CharField(blank=True, default='', max_length=255)),
+                ('content_type', models.CharField(blank=True, default='', max_length=50)),
+                ('width', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.PositiveIntegerField(blank=True, null=True)),
+                ('size', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('file_hash', 'kind')},
+            },
+        ),
+    ]
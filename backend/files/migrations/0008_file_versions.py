@@ -0,0 +1,40 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_preview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='FileVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('full', 'Full'), ('delta', 'Delta')], max_length=16)),
+                ('storage_name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('original_size', models.BigIntegerField()),
+                ('file_hash', models.CharField(max_length=128)),
+                ('is_encrypted', models.BooleanField(default=False)),
+                ('cipher', models.CharField(blank=True, max_length=32, null=True)),
+                ('compression', models.CharField(blank=True, max_length=16, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='files.file')),
+            ],
+            options={
+                'ordering': ['-number'],
+                'unique_together': {('file', 'number')},
+            },
+        ),
+    ]
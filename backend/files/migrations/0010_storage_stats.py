@@ -0,0 +1,55 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from files.stats import compute
+
+
+def build_stats(apps, schema_editor):
+    # Counters for files uploaded before statistics existed; kept up to date from here on
+    File = apps.get_model('files', 'File')
+    FileVersion = apps.get_model('files', 'FileVersion')
+    StorageStat = apps.get_model('files', 'StorageStat')
+    for owner_id in File.objects.values_list('owner', flat=True).distinct().order_by():
+        totals = compute(File.objects.filter(owner_id=owner_id), FileVersion.objects.filter(file__owner_id=owner_id))
+        StorageStat.objects.bulk_create([
+            StorageStat(owner_id=owner_id, dimension=dimension, bucket=bucket, count=count, bytes=nbytes)
+            for (dimension, bucket), (count, nbytes) in totals.items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('files', '0009_folders'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('total', 'Total'), ('physical', 'Physical'), ('versions', 'Versions'), ('type', 'Type'), ('month', 'Month')], max_length=16)),
+                ('bucket', models.CharField(blank=True, default='', max_length=32)),
+                ('count', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', '-size'], name='file_owner_size_idx'),
+        ),
+        migrations.AddField(
+            model_name='storagestat',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='storage_stats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='storagestat',
+            unique_together={('owner', 'dimension', 'bucket')},
+        ),
+        migrations.RunPython(build_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_storage_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='uploaded_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='fileaccesslog',
+            name='access_time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.21 on 2026-10-19 07:08
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_counters(apps, schema_editor):
+    # last_accessed was the time of the row's last save; rebuild both from the download log
+    File = apps.get_model('files', 'File')
+    FileAccessLog = apps.get_model('files', 'FileAccessLog')
+    File.objects.update(last_accessed=None)
+    downloads = FileAccessLog.objects.filter(action='download').values('file').annotate(
+        n=Count('id'), last=Max('access_time')
+    ).order_by()
+    for row in downloads.iterator():
+        File.objects.filter(pk=row['file']).update(download_count=row['n'], last_accessed=row['last'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_admin_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='download_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='last_accessed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', '-download_count'], name='file_owner_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['last_accessed'], name='file_last_accessed_idx'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.21 on 2026-10-19 07:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0012_access_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobTier',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('tier', models.CharField(choices=[('hot', 'Hot'), ('cold', 'Cold')], db_index=True, max_length=16)),
+                ('size', models.BigIntegerField()),
+                ('moved_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.21 on 2026-10-19 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0013_blob_tiers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplicationTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('replica', models.CharField(max_length=64)),
+                ('op', models.CharField(choices=[('put', 'Put'), ('delete', 'Delete')], max_length=8)),
+                ('created_at', models.DateTimeField()),
+                ('changed_at', models.DateTimeField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(db_index=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'unique_together': {('name', 'replica')},
+            },
+        ),
+    ]
@@ -11,6 +11,29 @@ def file_upload_path(instance, filename):
     # Include user ID in path for better organization
     return os.path.join('uploads', str(instance.owner.id), filename)
 
+class Folder(models.Model):
+    """A folder of an owner's files; path and subtree totals are maintained by files/folders.py"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='folders')
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    name = models.CharField(max_length=255)
+    path = models.CharField(max_length=2048, unique=True)  # Hex ids of the ancestors and itself, root first
+    depth = models.PositiveSmallIntegerField(default=0)  # 0 for top-level folders
+    total_size = models.BigIntegerField(default=0)  # Stored bytes of all files in the subtree
+    file_count = models.PositiveIntegerField(default=0)  # Files in the subtree
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(fields=['parent', 'name'], name='unique_folder_name'),
+            models.UniqueConstraint(fields=['owner', 'name'], condition=models.Q(parent__isnull=True),
+                                    name='unique_top_level_folder_name'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.owner.username})"
+
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='files')
@@ -18,14 +41,31 @@ class File(models.Model):
     original_filename = models.CharField(max_length=255)
     file_type = models.CharField(max_length=50)
     size = models.BigIntegerField()  # File size in bytes
-    uploaded_at = models.DateTimeField(auto_now_add=True)
-    last_accessed = models.DateTimeField(auto_now=True)
+    uploaded_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_accessed = models.DateTimeField(null=True, blank=True)  # Last download; kept by files/access.py
+    download_count = models.PositiveBigIntegerField(default=0)  # Kept by files/access.py
     is_encrypted = models.BooleanField(default=False)
     encryption_key_id = models.CharField(max_length=255, null=True, blank=True)
     file_hash = models.CharField(max_length=128, null=True, blank=True, db_index=True)
+    cipher = models.CharField(max_length=32, null=True, blank=True)  # Cipher engine name, see files/ciphers.py
+    compression = models.CharField(max_length=16, null=True, blank=True)  # e.g. 'zlib', 'zstd'; None if stored as-is
+    original_size = models.BigIntegerField(null=True, blank=True)  # Plaintext size before compression/encryption
+    merkle_root = models.CharField(max_length=64, null=True, blank=True)  # Of the plaintext, see files/possession.py
+    version = models.PositiveIntegerField(default=1)  # Number of the current content; earlier ones are FileVersion rows
+    folder = models.ForeignKey(Folder, on_delete=models.SET_NULL, null=True, blank=True, related_name='files')  # None: top level
     
     class Meta:
         ordering = ['-uploaded_at']
+        indexes = [
+            # A folder listing in its default order is one index range scan
+            models.Index(fields=['folder', '-uploaded_at'], name='file_folder_listing_idx'),
+            # Largest files of an owner (files/stats.py) without sorting all of them
+            models.Index(fields=['owner', '-size'], name='file_owner_size_idx'),
+            # Most downloaded files of an owner (?ordering=popular)
+            models.Index(fields=['owner', '-download_count'], name='file_owner_popular_idx'),
+            # Files not downloaded since a given time
+            models.Index(fields=['last_accessed'], name='file_last_accessed_idx'),
+        ]
     
     def __str__(self):
         return f"{self.original_filename} (uploaded by {self.owner.username})"
@@ -38,11 +78,36 @@ class File(models.Model):
     def stored_filename(self): #A UUID-based filename we generate to safely store the file
         return os.path.basename(self.file.name) if self.file else None
 
+class FileVersion(models.Model):
+    """An earlier content of a File, stored in full or as a delta against the next newer one (see files/versions.py)"""
+    FULL = 'full'
+    DELTA = 'delta'
+    KIND_CHOICES = [(FULL, 'Full'), (DELTA, 'Delta')]
+
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    storage_name = models.CharField(max_length=255)  # Blob of this version alone, never shared
+    size = models.BigIntegerField()  # Stored bytes, charged to the owner's quota
+    original_size = models.BigIntegerField()  # Plaintext size of the version
+    file_hash = models.CharField(max_length=128)  # Of the plaintext; checked after rebuilding it
+    is_encrypted = models.BooleanField(default=False)
+    cipher = models.CharField(max_length=32, null=True, blank=True)
+    compression = models.CharField(max_length=16, null=True, blank=True)
+    created_at = models.DateTimeField()  # When this content was uploaded
+
+    class Meta:
+        ordering = ['-number']
+        unique_together = ('file', 'number')
+
+    def __str__(self):
+        return f"{self.file.original_filename} v{self.number} ({self.kind})"
+
 class FileAccessLog(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='access_logs')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    access_time = models.DateTimeField(auto_now_add=True)
+    access_time = models.DateTimeField(auto_now_add=True, db_index=True)
     action = models.CharField(max_length=50)  # e.g., 'upload', 'download', 'delete'
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(null=True, blank=True)
@@ -51,4 +116,111 @@ class FileAccessLog(models.Model):
         ordering = ['-access_time']
 
     def __str__(self):
-        return f"{self.user.username} {self.action} {self.file.original_filename} at {self.access_time}"
+        # Ids only: rendering a row must not load the user and the file
+        return f"{self.action} of file {self.file_id} by user {self.user_id} at {self.access_time}"
+
+
+class BlobIntegrity(models.Model):
+    """Chunk hash index of a stored blob, used to detect corruption at rest (see files/integrity.py)"""
+    OK = 'ok'
+    CORRUPT = 'corrupt'
+    MISSING = 'missing'
+    STATUS_CHOICES = [(OK, 'OK'), (CORRUPT, 'Corrupt'), (MISSING, 'Missing')]
+
+    name = models.CharField(max_length=255, unique=True)  # Storage name, shared by every File row of the blob
+    size = models.BigIntegerField()  # Stored (ciphertext) size in bytes
+    chunk_size = models.PositiveIntegerField()
+    leaves = models.BinaryField()  # Concatenated SHA-256 leaf hashes, one per chunk
+    root = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=OK, db_index=True)
+    detail = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    verified_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class BlobTier(models.Model):
+    """Storage tier of a blob moved off the hot tier (see files/tiering.py); blobs without a row are hot"""
+    HOT = 'hot'
+    COLD = 'cold'
+    TIER_CHOICES = [(HOT, 'Hot'), (COLD, 'Cold')]
+
+    name = models.CharField(max_length=255, unique=True)  # Storage name, shared by every File row of the blob
+    tier = models.CharField(max_length=16, choices=TIER_CHOICES, db_index=True)
+    size = models.BigIntegerField()  # Stored bytes
+    moved_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} ({self.tier})"
+
+
+class ReplicationTask(models.Model):
+    """A blob change not yet applied to a replica (see files/outbox.py); one row per blob and replica"""
+    PUT = 'put'
+    DELETE = 'delete'
+    OP_CHOICES = [(PUT, 'Put'), (DELETE, 'Delete')]
+
+    name = models.CharField(max_length=255)  # Storage name
+    replica = models.CharField(max_length=64)  # Name in STORAGE_REPLICAS
+    op = models.CharField(max_length=8, choices=OP_CHOICES)
+    created_at = models.DateTimeField()  # Oldest change still to be replicated; replication lag counts from here
+    changed_at = models.DateTimeField()  # Latest change; a worker only drops the row if this has not moved
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(db_index=True)  # Due time, pushed out while a worker holds the row
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        unique_together = ('name', 'replica')
+
+    def __str__(self):
+        return f"{self.op} {self.name} -> {self.replica}"
+
+
+class Preview(models.Model):
+    """Encrypted thumbnail or preview of a content hash, shared by all its File rows (see files/previews.py)"""
+    READY = 'ready'
+    FAILED = 'failed'
+    UNSUPPORTED = 'unsupported'
+    STATUS_CHOICES = [(READY, 'Ready'), (FAILED, 'Failed'), (UNSUPPORTED, 'Unsupported')]
+
+    file_hash = models.CharField(max_length=128, db_index=True)
+    kind = models.CharField(max_length=16)  # 'thumb' or 'preview'
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=READY)
+    storage_name = models.CharField(max_length=255, blank=True, default='')
+    content_type = models.CharField(max_length=50, blank=True, default='')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    size = models.PositiveIntegerField(null=True, blank=True)  # Bytes of the decrypted image
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('file_hash', 'kind')
+
+    def __str__(self):
+        return f"{self.kind} of {self.file_hash[:12]} ({self.status})"
+
+
+class StorageStat(models.Model):
+    """One counter of an owner's storage breakdown, maintained by files/stats.py"""
+    TOTAL = 'total'  # All File rows, as charged to the quota
+    PHYSICAL = 'physical'  # Distinct contents among them (dedup references counted once)
+    VERSIONS = 'versions'  # Earlier versions (FileVersion rows)
+    TYPE = 'type'  # Per type bucket, e.g. 'image'
+    MONTH = 'month'  # Per upload month, 'YYYY-MM'
+    DIMENSION_CHOICES = [
+        (TOTAL, 'Total'), (PHYSICAL, 'Physical'), (VERSIONS, 'Versions'), (TYPE, 'Type'), (MONTH, 'Month'),
+    ]
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='storage_stats')
+    dimension = models.CharField(max_length=16, choices=DIMENSION_CHOICES)
+    bucket = models.CharField(max_length=32, blank=True, default='')
+    count = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)  # Stored bytes
+
+    class Meta:
+        unique_together = ('owner', 'dimension', 'bucket')
+
+    def __str__(self):
+        return f"{self.dimension}:{self.bucket} of {self.owner_id}"
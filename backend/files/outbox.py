@@ -0,0 +1,153 @@
+"""
+Replication queue.
+
+Every blob written or deleted through files.blobs while replicas are
+configured (STORAGE_REPLICAS, see files/storage_tiers.py) is queued here for
+each replica, as a ReplicationTask row; the replicate_blobs command applies
+the queue (files/replication.py). The row is written in the same database
+transaction as the change that triggered it, so a change is either queued or
+rolled back with the rest, and a crashed worker loses nothing.
+
+There is one row per blob and replica. A blob changed again before it was
+replicated updates its row (the operation and changed_at) instead of adding
+one, so a blob rewritten many times in a row is copied once, and a blob
+deleted before it was replicated is never copied. created_at keeps the time
+of the oldest change still waiting, which makes the age of the oldest row the
+replication lag.
+
+Workers claim due rows in batches by pushing next_attempt_at out by
+REPLICATION_LEASE_SECONDS, one conditional UPDATE per row, so several
+workers can share the queue. A row is dropped after it was applied only if
+changed_at has not moved meanwhile; otherwise it is due again at once, and
+the newer change is applied by the next claim. A failed row is retried after
+an exponential backoff, capped at REPLICATION_RETRY_MAX_SECONDS; a row held
+by a worker that died is due again when its lease runs out.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from core import metrics
+
+from . import storage_tiers
+from .models import ReplicationTask
+
+PUT = ReplicationTask.PUT
+DELETE = ReplicationTask.DELETE
+
+RETRY_BASE_SECONDS = 10
+
+
+def _lease():
+    return timedelta(seconds=getattr(settings, 'REPLICATION_LEASE_SECONDS', 300))
+
+
+def _backoff(attempts):
+    cap = getattr(settings, 'REPLICATION_RETRY_MAX_SECONDS', 3600)
+    return timedelta(seconds=min(cap, RETRY_BASE_SECONDS * 2 ** min(attempts, 20)))
+
+
+def enqueue(name, op, replicas=None):
+    """
+    Queue `op` (PUT or DELETE) of blob `name` for every replica, or for the
+    replica names given. Costs no query without replicas.
+    """
+    targets = replicas if replicas is not None else [replica.name for replica in storage_tiers.replicas()]
+    if not targets:
+        return
+    now = timezone.now()
+    tasks = ReplicationTask.objects.filter(name=name, replica__in=targets)
+    # A queued row keeps its due time: a worker holding it finds it changed and releases it
+    if tasks.update(op=op, changed_at=now) < len(targets):
+        existing = set(tasks.values_list('replica', flat=True))
+        for replica in targets:
+            if replica in existing:
+                continue
+            try:
+                with transaction.atomic():
+                    ReplicationTask.objects.create(
+                        name=name, replica=replica, op=op, created_at=now, changed_at=now, next_attempt_at=now
+                    )
+            except IntegrityError:  # Queued concurrently
+                tasks.filter(replica=replica).update(op=op, changed_at=now)
+    metrics.incr('replication.enqueued', len(targets), op=op)
+
+
+def claim(limit, replicas):
+    """Up to `limit` due rows for the named replicas, oldest due first, leased to the caller."""
+    now = timezone.now()
+    until = now + _lease()
+    claimed = []
+    due = ReplicationTask.objects.filter(replica__in=replicas, next_attempt_at__lte=now).order_by('next_attempt_at')
+    for task in due[:limit]:
+        if ReplicationTask.objects.filter(pk=task.pk, next_attempt_at=task.next_attempt_at).update(
+            next_attempt_at=until
+        ):
+            task.next_attempt_at = until
+            claimed.append(task)
+    return claimed
+
+
+def _release(task):
+    ReplicationTask.objects.filter(pk=task.pk).update(next_attempt_at=timezone.now())
+
+
+def complete(task):
+    """Drop a claimed row that was applied; returns False if the blob changed meanwhile (the row is due again)."""
+    deleted, _ = ReplicationTask.objects.filter(pk=task.pk, changed_at=task.changed_at).delete()
+    if not deleted:
+        _release(task)
+    return bool(deleted)
+
+
+def fail(task, error):
+    """Schedule a claimed row for another attempt after its backoff."""
+    retried = ReplicationTask.objects.filter(pk=task.pk, changed_at=task.changed_at).update(
+        attempts=F('attempts') + 1,
+        next_attempt_at=timezone.now() + _backoff(task.attempts),
+        last_error=str(error)[:1000],
+    )
+    if not retried:
+        _release(task)  # Changed meanwhile; the new change gets a fresh attempt
+
+
+def status(now=None):
+    """{replica: {'pending', 'failing', 'lag_seconds'}} for every configured replica."""
+    now = now or timezone.now()
+    rows = {
+        row['replica']: row
+        for row in ReplicationTask.objects.values('replica').annotate(
+            pending=Count('id'), failing=Count('id', filter=Q(attempts__gt=0)), oldest=Min('created_at')
+        ).order_by()
+    }
+    result = {}
+    for replica in storage_tiers.replicas():
+        row = rows.get(replica.name)
+        result[replica.name] = {
+            'pending': row['pending'] if row else 0,
+            'failing': row['failing'] if row else 0,
+            'lag_seconds': max(0.0, (now - row['oldest']).total_seconds()) if row else 0.0,
+        }
+    return result
+
+
+def forget_unconfigured():
+    """Drop the rows of replicas no longer in STORAGE_REPLICAS; returns how many."""
+    deleted, _ = ReplicationTask.objects.exclude(
+        replica__in=[replica.name for replica in storage_tiers.replicas()]
+    ).delete()
+    return deleted
+
+
+def publish(now=None):
+    """Set the replication.pending and replication.lag_seconds gauges from the queue; returns status()."""
+    if not storage_tiers.replicas():
+        return {}
+    current = status(now)
+    for replica, row in current.items():
+        metrics.set_gauge('replication.pending', row['pending'], replica=replica)
+        metrics.set_gauge('replication.lag_seconds', row['lag_seconds'], replica=replica)
+    return current
@@ -0,0 +1,93 @@
+"""
+Proof of possession for deduplicated uploads.
+
+Knowing a file's SHA-256 is not the same as having the file, so a client
+asking to reference an existing blob by hash (files.views.create_file_reference)
+has to answer a challenge first:
+
+  1. The client POSTs the claimed hash and plaintext size to
+     /api/files/reference/challenge/ and gets back a signed challenge naming
+     a few random chunk indices. A challenge is issued whether or not the
+     content exists, so the endpoint is not an existence oracle.
+  2. For each challenged chunk the client sends the leaf hash and its
+     Merkle authentication path (sibling hashes, bottom-up).
+  3. The server checks every path against the Merkle root recorded on the
+     File rows of that content when it was first uploaded.
+
+Each proof is O(log n) hashes, so a 100 MB file costs a few kilobytes on
+the wire instead of a re-upload, and the server never reads the blob.
+
+The tree is the one in files/merkle.py over CHUNK_SIZE plaintext chunks;
+frontend/src/services/file.service.ts builds the same tree.
+"""
+import secrets
+
+from django.conf import settings
+from django.core import signing
+
+from . import merkle
+
+CHUNK_SIZE = 64 * 1024  # Part of the tree format; changing it invalidates stored roots
+
+_SALT = 'files.possession.challenge'
+
+
+class ProofError(Exception):
+    """A challenge or proof is malformed, expired or does not match"""
+
+
+def leaf_count(size):
+    return merkle.leaf_count(size, CHUNK_SIZE)
+
+
+def merkle_root(content):
+    """Hex Merkle root of a plaintext blob."""
+    return merkle.root(merkle.leaf_hashes(content, CHUNK_SIZE)).hex()
+
+
+def issue_challenge(user, file_hash, size):
+    """Return a signed challenge for `user` claiming content `file_hash` of `size` bytes."""
+    count = leaf_count(size)
+    wanted = min(count, getattr(settings, 'POSSESSION_CHALLENGE_LEAVES', 8))
+    indices = sorted(secrets.SystemRandom().sample(range(count), wanted))
+    token = signing.dumps({'u': str(user.pk), 'h': file_hash, 's': size, 'i': indices}, salt=_SALT, compress=True)
+    return {
+        'challenge': token,
+        'chunk_size': CHUNK_SIZE,
+        'ranges': [
+            {'index': i, 'offset': i * CHUNK_SIZE, 'length': min(CHUNK_SIZE, size - i * CHUNK_SIZE)}
+            for i in indices
+        ],
+    }
+
+
+def open_challenge(user, token):
+    """Return (file_hash, size, indices) of a challenge issued to `user`; raises ProofError."""
+    try:
+        data = signing.loads(token, salt=_SALT, max_age=getattr(settings, 'POSSESSION_CHALLENGE_TTL', 300))
+    except signing.BadSignature as e:  # Includes SignatureExpired
+        raise ProofError('Invalid or expired challenge.') from e
+    if data['u'] != str(user.pk):
+        raise ProofError('Invalid or expired challenge.')
+    return data['h'], data['s'], data['i']
+
+
+def verify_proofs(root, size, indices, proofs):
+    """
+    Check the client's answers to a challenge against a stored Merkle root.
+
+    `proofs` is a list, in challenge order, of {'leaf': hex, 'siblings': [hex, ...]}.
+    """
+    if not root or not isinstance(proofs, list) or len(proofs) != len(indices):
+        return False
+    count = leaf_count(size)
+    try:
+        expected = bytes.fromhex(root)
+        for index, proof in zip(indices, proofs):
+            leaf = bytes.fromhex(proof['leaf'])
+            siblings = [bytes.fromhex(s) for s in proof['siblings']]
+            if len(siblings) > 64 or not merkle.verify_path(expected, index, count, leaf, siblings):
+                return False
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
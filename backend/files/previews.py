@@ -0,0 +1,228 @@
+"""
+Thumbnails and previews.
+
+When a new blob is uploaded the plaintext is still in memory, so a small
+background pool (PREVIEW_WORKERS threads) renders it there and then:
+
+  thumb    PREVIEW_THUMB_SIZE px on the longest side, for file grids
+  preview  PREVIEW_LARGE_SIZE px, for a lightbox / detail view
+
+Images are handled by Pillow; plain text and source files get their first
+lines rendered onto an image. Other types (PDF, office documents) have no
+renderer and are recorded as unsupported.
+
+Previews are keyed by the content hash (File.file_hash), so every File row
+of a deduplicated blob shares them, and they never change: they are served
+with an immutable Cache-Control. Because several users may own the same
+content they cannot be encrypted with a user's key; they are encrypted
+with AES-GCM under a server key derived from PREVIEW_KEY (ENCRYPTION_KEY by
+default). That makes them readable by the server, so previews are off
+unless PREVIEWS_ENABLED is set.
+
+Queued jobs hold plaintext in memory, so the queue is bounded by bytes
+(PREVIEW_QUEUE_BYTES), not by job count, and text jobs only keep the
+prefix that gets rendered. Jobs are best effort: one that does not fit is
+dropped, and the generate_previews command fills in whatever is missing.
+"""
+import hashlib
+import io
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from PIL import Image, ImageDraw, ImageFont, ImageOps, features
+
+from core import metrics
+
+from .blobs import delete_blob, read_blob, save_blob
+from .ciphers import AES_GCM, get_engine
+from .models import File, Preview
+
+logger = logging.getLogger(__name__)
+
+THUMB = 'thumb'
+LARGE = 'preview'
+KINDS = (THUMB, LARGE)
+
+PREVIEW_PREFIX = 'previews'
+
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+TEXT_EXTENSIONS = {
+    'txt', 'md', 'csv', 'log', 'json', 'xml', 'yaml', 'yml', 'ini', 'cfg', 'py', 'js', 'ts', 'tsx',
+    'html', 'css', 'sql', 'sh', 'java', 'c', 'h', 'cpp', 'go', 'rs', 'rb',
+}
+TEXT_PREVIEW_BYTES = 8 * 1024
+TEXT_PREVIEW_LINES = 40
+
+_executor = None
+_executor_lock = threading.Lock()
+_queued_bytes = 0
+
+
+def enabled():
+    return getattr(settings, 'PREVIEWS_ENABLED', False)
+
+
+def _sizes():
+    return {
+        THUMB: getattr(settings, 'PREVIEW_THUMB_SIZE', 256),
+        LARGE: getattr(settings, 'PREVIEW_LARGE_SIZE', 1024),
+    }
+
+
+def _key():
+    secret = getattr(settings, 'PREVIEW_KEY', None) or settings.ENCRYPTION_KEY
+    return hashlib.sha256(f'preview:{secret}'.encode()).digest()
+
+
+def renderer_for(filename, content_type):
+    """'image', 'text' or None for content that cannot be previewed."""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if (content_type or '').lower() in IMAGE_TYPES or extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if (content_type or '').startswith('text/') or extension in TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+
+def storage_name(file_hash, kind):
+    return posixpath.join(PREVIEW_PREFIX, file_hash[:2], f'{file_hash}.{kind}')
+
+
+def _encode(image):
+    """Encode a rendered image as WebP (JPEG where Pillow lacks WebP support)."""
+    out = io.BytesIO()
+    if features.check('webp'):
+        image.save(out, 'WEBP', quality=80, method=4)
+        return out.getvalue(), 'image/webp'
+    image.convert('RGB').save(out, 'JPEG', quality=80, optimize=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+def render_image(content, max_px):
+    with Image.open(io.BytesIO(content)) as image:
+        image.draft('RGB', (max_px, max_px))  # Lets JPEG decode at a reduced scale
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image.thumbnail((max_px, max_px))
+        return image
+
+
+def render_text(content, max_px):
+    text = content[:TEXT_PREVIEW_BYTES].decode('utf-8', errors='replace')
+    lines = text.expandtabs(4).splitlines()[:TEXT_PREVIEW_LINES]
+    font_size = max(8, max_px // 40)
+    font = ImageFont.load_default(size=font_size)
+    image = Image.new('RGB', (max_px, max_px), 'white')
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((font_size // 2, font_size // 2 + i * (font_size + 2)), line, fill='black', font=font)
+    return image
+
+
+def generate(file_hash, content, filename, content_type):
+    """Render, encrypt and store all previews of one content; returns the resulting status."""
+    renderer = renderer_for(filename, content_type)
+    if renderer is None:
+        Preview.objects.get_or_create(file_hash=file_hash, kind=THUMB, defaults={'status': Preview.UNSUPPORTED})
+        return Preview.UNSUPPORTED
+    render = render_image if renderer == 'image' else render_text
+    engine = get_engine(AES_GCM)
+    try:
+        for kind, max_px in _sizes().items():
+            with metrics.timed('previews.render', kind=kind, renderer=renderer):
+                image = render(content, max_px)
+                data, mime = _encode(image)
+            name = save_blob(storage_name(file_hash, kind), engine.encrypt(_key(), data))
+            Preview.objects.update_or_create(file_hash=file_hash, kind=kind, defaults={
+                'status': Preview.READY, 'storage_name': name, 'content_type': mime,
+                'width': image.width, 'height': image.height, 'size': len(data),
+            })
+    except Exception as e:  # Undecodable or hostile input; do not retry it on every upload
+        logger.warning(f"Preview generation failed for {file_hash}: {e}")
+        metrics.incr('previews.jobs', result='failed')
+        Preview.objects.update_or_create(file_hash=file_hash, kind=THUMB, defaults={'status': Preview.FAILED})
+        return Preview.FAILED
+    metrics.incr('previews.jobs', result='ready')
+    return Preview.READY
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'PREVIEW_WORKERS', 2), thread_name_prefix='preview'
+            )
+        return _executor
+
+
+def _reserve(size):
+    """Count `size` bytes against PREVIEW_QUEUE_BYTES; False if they do not fit."""
+    global _queued_bytes
+    with _executor_lock:
+        if _queued_bytes + size > getattr(settings, 'PREVIEW_QUEUE_BYTES', 64 * 1024 * 1024):
+            return False
+        _queued_bytes += size
+        return True
+
+
+def _release(size):
+    global _queued_bytes
+    with _executor_lock:
+        _queued_bytes -= size
+
+
+def _run(file_hash, content, filename, content_type):
+    try:
+        generate(file_hash, content, filename, content_type)
+        # The content may have been replaced by a new version or deleted while
+        # this job was queued, after forget() had nothing to remove yet
+        if not File.objects.filter(file_hash=file_hash).exists():
+            forget(file_hash)
+    finally:
+        _release(len(content))
+        connections.close_all()  # This thread's connections would otherwise linger
+
+
+def schedule(file_hash, content, filename, content_type):
+    """Queue preview generation for newly stored content once the transaction commits."""
+    renderer = renderer_for(filename, content_type)
+    if not enabled() or not file_hash or renderer is None:
+        return
+    if renderer == 'text':
+        content = content[:TEXT_PREVIEW_BYTES]  # All render_text looks at
+    elif len(content) > getattr(settings, 'PREVIEW_MAX_SOURCE_BYTES', 25 * 1024 * 1024):
+        return
+    executor = _get_executor()
+
+    def submit():
+        if not _reserve(len(content)):  # Saturated; generate_previews catches up later
+            metrics.incr('previews.jobs', result='dropped')
+            return
+        executor.submit(_run, file_hash, content, filename, content_type)
+
+    transaction.on_commit(submit)
+
+
+def get(file_hash, kind):
+    """The ready Preview of `kind` for a content hash, or None."""
+    return Preview.objects.filter(file_hash=file_hash, kind=kind, status=Preview.READY).first()
+
+
+def read(preview):
+    """Decrypted image bytes of a Preview."""
+    return get_engine(AES_GCM).decrypt(_key(), read_blob(preview.storage_name))
+
+
+def forget(file_hash):
+    """Remove the previews of content whose last File row is gone."""
+    for preview in Preview.objects.filter(file_hash=file_hash):
+        if preview.storage_name:
+            delete_blob(preview.storage_name)
+        preview.delete()
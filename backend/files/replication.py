@@ -0,0 +1,202 @@
+"""
+Blob replication.
+
+With STORAGE_REPLICAS set (files/storage_tiers.py) every blob has copies on
+the replicas besides the one on its tier, the primary copy. Writes go to
+the primary synchronously, as before, and are queued for the replicas in the
+same transaction (files/outbox.py); the replicate_blobs command drains the
+queue in batches:
+
+  put     the blob is read from the primary, checked against its integrity
+          index as it is read, and written to the replica under the same
+          name, replacing what is there. A primary copy that does not match
+          its index is not copied, so corruption never spreads to a good
+          replica (scrub_blobs reports it; repair_replicas restores it).
+  delete  the blob is deleted from the replica.
+
+A change that fails (replica unreachable, blob missing from the primary or
+not matching its index) is retried with backoff, keeping its place in the
+lag; a blob changed meanwhile is simply queued again. Replicas have the blobs
+of every tier, and tier moves (files/tiering.py) are not replicated.
+
+The repair_replicas command compares every blob the database refers to
+across the primary and the replicas (sizes, or with --verify the content
+against the integrity index) with check(): replicas missing a blob or
+holding a wrong copy get it queued again, and a primary copy that is
+missing or wrong is restored from a replica holding a good one.
+
+Reads fail over to the replicas in files/blobs.py.
+"""
+import logging
+import time
+
+from django.contrib.auth import get_user_model
+
+from core import metrics
+from users import avatars
+
+from . import integrity, outbox, storage_tiers
+from .blobs import BlobNotFound, BlobWriter, blob_size_on, delete_blob, open_blob
+from .models import BlobIntegrity, BlobTier, File, FileVersion, Preview, ReplicationTask
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+QUEUED = 'queued'  # A replica copy was missing or wrong; queued for the worker
+RESTORED = 'restored'  # The primary copy was missing or wrong; copied back from a replica
+LOST = 'lost'  # No good copy anywhere
+
+
+def _copy(name, index, target, throttle, source=None):
+    """
+    Copy a blob to `target` under the same name: from `source`, or from the
+    primary copy (whichever tier holds it). Checked against `index` (if
+    any) as it is read; raises IntegrityFailure or BlobNotFound.
+    """
+    writer = BlobWriter(name, tier=target)
+    verifier = integrity.ChunkVerifier(index) if index is not None else None
+    try:
+        if source is not None:
+            f = open_blob(name, use_cache=False, tier=source)
+        else:
+            f = open_blob(name, use_cache=False, failover=False)
+        with f:
+            for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                writer.write(verifier.update(data) if verifier else data)
+                if throttle:
+                    throttle(len(data))
+        if verifier:
+            writer.write(verifier.finalize())
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def apply(task, throttle=None):
+    """Apply one queued change to its replica; raises if it could not be applied."""
+    replica = storage_tiers.replica(task.replica)
+    if task.op == ReplicationTask.DELETE:
+        delete_blob(task.name, tier=replica)
+        return
+    try:
+        _copy(task.name, integrity.get_index(task.name), replica, throttle)
+    except BlobNotFound:
+        raise BlobNotFound(f'{task.name} is missing from primary storage')
+
+
+def run(limit, throttle=None):
+    """Claim and apply up to `limit` queued changes; returns {'applied', 'requeued', 'failed'} counts."""
+    counts = {'applied': 0, 'requeued': 0, 'failed': 0}
+    for task in outbox.claim(limit, [replica.name for replica in storage_tiers.replicas()]):
+        started = time.perf_counter()
+        try:
+            apply(task, throttle)
+        except Exception as e:  # Storage unavailable etc.
+            logger.warning(f"Could not replicate {task.op} of {task.name} to {task.replica}: {e}")
+            metrics.incr('replication.failed', replica=task.replica, op=task.op)
+            outbox.fail(task, e)
+            counts['failed'] += 1
+            continue
+        metrics.observe('replication.apply', time.perf_counter() - started, replica=task.replica, op=task.op)
+        if outbox.complete(task):
+            metrics.incr('replication.applied', replica=task.replica, op=task.op)
+            counts['applied'] += 1
+        else:  # Changed while it was applied; the newer change is due now
+            counts['requeued'] += 1
+    return counts
+
+
+def referenced_names():
+    """Every blob name the database refers to: files, earlier versions, previews, profile photos and avatars."""
+    # order_by(): the default orderings would add their columns to the DISTINCT
+    files = File.objects.exclude(file='').order_by().values_list('file', flat=True).distinct()
+    yield from files.iterator(chunk_size=1000)
+    yield from (
+        FileVersion.objects.exclude(storage_name__in=File.objects.values('file'))
+        .order_by().values_list('storage_name', flat=True).distinct().iterator(chunk_size=1000)
+    )
+    yield from Preview.objects.exclude(storage_name='').values_list('storage_name', flat=True).iterator(chunk_size=1000)
+    users = get_user_model().objects.values_list('pk', 'profile_photo', 'avatar_digest')
+    for user_id, photo, photo_digest in users.iterator(chunk_size=1000):
+        if photo:
+            yield photo
+        if photo_digest:
+            for size in avatars.sizes():
+                yield avatars.storage_name(user_id, photo_digest, size)
+
+
+def _good(name, index, tier, size, verify, throttle):
+    """Whether the copy on `tier`, `size` bytes per a HEAD, is intact as far as can be told."""
+    if size is None or (index is not None and size != index.size):
+        return False
+    if not verify or index is None:
+        return True
+    verifier = integrity.ChunkVerifier(index)
+    try:
+        with open_blob(name, use_cache=False, tier=tier) as f:
+            for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                verifier.update(data)
+                if throttle:
+                    throttle(len(data))
+        verifier.finalize()
+    except (integrity.IntegrityFailure, BlobNotFound):
+        return False
+    return True
+
+
+def _home(name):
+    """The tier a blob should be on: the one BlobTier records, else hot."""
+    recorded = BlobTier.objects.filter(name=name).values_list('tier', flat=True).first()
+    return storage_tiers.get(recorded) if recorded else storage_tiers.hot()
+
+
+def check(name, verify=False, throttle=None, dry_run=False):
+    """
+    Compare the copies of one blob and repair what can be repaired; returns
+    OK, QUEUED, RESTORED or LOST. Without an integrity index the primary
+    copy is the reference, and only sizes can be compared.
+    """
+    index = integrity.get_index(name)
+    primary = None
+    for tier in storage_tiers.tiers():
+        size = blob_size_on(name, tier)
+        if size is not None:
+            primary = (tier, size)
+            break
+    copies = [(replica, blob_size_on(name, replica)) for replica in storage_tiers.replicas()]
+
+    def good(tier, size):
+        if index is None and primary is not None:
+            return size == primary[1]
+        return _good(name, index, tier, size, verify, throttle)
+
+    if primary is not None and good(*primary):
+        stale = [replica.name for replica, size in copies if not good(replica, size)]
+        if not stale:
+            return OK
+        if not dry_run:
+            outbox.enqueue(name, outbox.PUT, replicas=stale)
+        metrics.incr('replication.repairs', result=QUEUED)
+        return QUEUED
+
+    verdicts = [(replica, good(replica, size)) for replica, size in copies]
+    source = next((replica for replica, intact in verdicts if intact), None)
+    if source is None:
+        if index is not None:
+            integrity.report(index, BlobIntegrity.MISSING if primary is None else BlobIntegrity.CORRUPT,
+                             'no good copy on the primary storage or any replica')
+        metrics.incr('replication.repairs', result=LOST)
+        return LOST
+    if not dry_run:
+        target = _home(name)
+        _copy(name, index, target, throttle, source=source)
+        storage_tiers.found(name, target)
+        if index is not None:
+            integrity.report(index, BlobIntegrity.OK, f'restored from replica {source.name}')
+        logger.warning(f"Restored blob {name} on the {target.name} tier from replica {source.name}")
+        stale = [replica.name for replica, intact in verdicts if not intact]
+        if stale:
+            outbox.enqueue(name, outbox.PUT, replicas=stale)
+    metrics.incr('replication.repairs', result=RESTORED)
+    return RESTORED
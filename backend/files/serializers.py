@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import File, FileAccessLog
+from .models import File, FileAccessLog, FileVersion, Folder
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -20,6 +20,7 @@ class FileSerializer(serializers.ModelSerializer):
     upload_date = serializers.DateTimeField(source='uploaded_at', read_only=True)
     file_size = serializers.SerializerMethodField()
     download_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
     owner = UserSerializer(read_only=True)
     access_logs = FileAccessLogSerializer(many=True, read_only=True)
     
@@ -27,9 +28,13 @@ class FileSerializer(serializers.ModelSerializer):
         model = File
         fields = [
             'id', 'owner', 'original_filename', 'file_type', 'upload_date',
-            'file_size', 'is_encrypted', 'download_url', 'access_logs', 'file_hash'
+            'file_size', 'is_encrypted', 'download_url', 'access_logs', 'file_hash',
+            'compression', 'original_size', 'thumbnail_url', 'version', 'folder', 'download_count', 'last_accessed'
+        ]
+        read_only_fields = [
+            'owner', 'size', 'uploaded_at', 'last_accessed', 'download_count', 'compression', 'original_size',
+            'version', 'folder'
         ]
-        read_only_fields = ['owner', 'size', 'uploaded_at', 'last_accessed']
 
     def get_file_size(self, obj):
         """Convert size to human-readable format"""
@@ -45,7 +50,34 @@ class FileSerializer(serializers.ModelSerializer):
         if request and obj.file:
             return request.build_absolute_uri(f'/api/files/{obj.id}/download/')
 
+    def get_thumbnail_url(self, obj):
+        # Annotated by FileViewSet.get_queryset; previews are rendered in the background
+        request = self.context.get('request')
+        if request and getattr(obj, 'has_preview', False):
+            return request.build_absolute_uri(f'/api/files/{obj.id}/preview/')
+
     def create(self, validated_data):
         # Set the owner to the current user
         validated_data['owner'] = self.context['request'].user
-        return super().create(validated_data) 
\ No newline at end of file
+        return super().create(validated_data) 
+
+class FileVersionSerializer(serializers.ModelSerializer):
+    stored_size = serializers.IntegerField(source='size', read_only=True)
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FileVersion
+        fields = ['number', 'created_at', 'original_size', 'stored_size', 'kind', 'file_hash', 'download_url']
+        read_only_fields = fields
+
+    def get_download_url(self, obj):
+        request = self.context.get('request')
+        if request:
+            return request.build_absolute_uri(f'/api/files/{obj.file_id}/versions/{obj.number}/download/')
+
+
+class FolderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Folder
+        fields = ['id', 'name', 'parent', 'depth', 'total_size', 'file_count', 'created_at']
+        read_only_fields = fields
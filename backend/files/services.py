@@ -0,0 +1,427 @@
+"""
+Upload and download pipeline shared by the DRF views and the async views.
+
+Everything here is synchronous. Async callers offload it with
+sync_to_async / asyncio.to_thread.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from . import access, folders, integrity, previews, stats, storage_tiers
+from .blobs import delete_blob, locate_blob, record_write, save_blob
+from .ciphers import AES_CFB, CipherError, get_engine
+from .compression import DECOMPRESSION_ERRORS, choose_compression, compressor, decompressor
+from .layout import storage_name
+from .models import File, FileAccessLog
+from .possession import merkle_root
+
+logger = logging.getLogger(__name__)
+
+# Maximum file size (100MB)
+MAX_FILE_SIZE = 100 * 1024 * 1024
+
+# Read size used when streaming blobs out of storage
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class FileServiceError(Exception):
+    """An error that maps directly onto an API error response"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def _quota_exceeded(user):
+    available_space = user.storage_quota - user.used_storage
+    return FileServiceError(
+        f'Storage quota exceeded. Available space: {available_space / (1024*1024):.2f}MB'
+    )
+
+
+def check_upload_allowed(user, file_size):
+    """
+    Raise FileServiceError if the file is too large or would exceed the user's quota.
+
+    This is an early rejection before any work is done; the quota is only
+    actually enforced by reserve_storage() when the File row is created.
+    """
+    if file_size > MAX_FILE_SIZE:
+        raise FileServiceError(
+            f'File size ({file_size / (1024*1024):.2f}MB) exceeds maximum allowed size (100MB)'
+        )
+    if user.used_storage + file_size > user.storage_quota:
+        raise _quota_exceeded(user)
+
+
+def reserve_storage(user, size):
+    """
+    Atomically charge `size` bytes to the user's quota.
+
+    A single conditional UPDATE, so concurrent uploads cannot overshoot the
+    quota or lose each other's increments. Raises FileServiceError if the
+    bytes do not fit.
+    """
+    charged = get_user_model().objects.filter(
+        pk=user.pk, used_storage__lte=F('storage_quota') - size
+    ).update(used_storage=F('used_storage') + size)
+    if not charged:
+        user.refresh_from_db(fields=['used_storage', 'storage_quota'])
+        raise _quota_exceeded(user)
+    user.__dict__.pop('used_storage', None) # Stale now; reloaded from the DB on next access
+
+
+def release_storage(user, size):
+    """Atomically give `size` bytes back to the user's quota, never going below zero."""
+    get_user_model().objects.filter(pk=user.pk).update(
+        used_storage=Greatest(F('used_storage') - size, Value(0))
+    )
+    user.__dict__.pop('used_storage', None)
+
+
+def hash_content(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def find_duplicate(file_hash):
+    return File.objects.filter(file_hash=file_hash).first()
+
+
+def encode_content(user, content, filename, content_type):
+    """
+    Compress and encrypt plaintext for storage.
+
+    Returns a dict with the bytes to store and the metadata that has to be
+    recorded on the File row to read them back.
+    """
+    return encode_payload(user, content, choose_compression(filename, content_type, len(content)))
+
+
+def encode_payload(user, content, compression):
+    """encode_content() with the compression algorithm (or None) chosen by the caller."""
+    encoder = BlobEncoder(user, compression)
+    return {'content': encoder.update(content) + encoder.finalize(), **encoder.params}
+
+
+class BlobEncoder:
+    """
+    Incrementally turns plaintext into the bytes to store.
+
+    The counterpart of BlobDecoder: feed it plaintext chunks in order with
+    update() and call finalize() at the end. It compresses (if asked to)
+    before encrypting with the user's key, if they have one. `params` holds
+    what has to be recorded on the File row to read the blob back.
+    """
+
+    def __init__(self, user, compression):
+        derived_aes_key = user.get_derived_aes_key()
+        self.compressor = compressor(compression) if compression else None
+        if derived_aes_key:
+            engine = get_engine()
+            self.encryptor = engine.encryptor(derived_aes_key)
+            self.params = {
+                'is_encrypted': True,
+                'encryption_key_id': str(user.id) if getattr(user, 'encryption_key', None) else 'default',
+                'cipher': engine.name,
+                'compression': compression,
+            }
+        else:
+            self.encryptor = None
+            self.params = {'is_encrypted': False, 'encryption_key_id': None, 'cipher': None, 'compression': compression}
+
+    def _encrypt(self, data):
+        return self.encryptor.update(data) if self.encryptor is not None and data else data
+
+    def update(self, data):
+        # Compress before encrypting; ciphertext is incompressible
+        return self._encrypt(self.compressor.compress(data) if self.compressor is not None else data)
+
+    def finalize(self):
+        out = self._encrypt(self.compressor.flush()) if self.compressor is not None else b''
+        if self.encryptor is not None:
+            out += self.encryptor.finalize()
+        return out
+
+
+def new_storage_name(is_encrypted, content=None):
+    """Generate the storage key for a new blob, see files/layout.py."""
+    return storage_name(is_encrypted, content)
+
+
+def write_blob(encoded):
+    """Save the bytes of encode_content() as a new blob, index it and return its name."""
+    try:
+        name = save_blob(new_storage_name(encoded['is_encrypted'], encoded['content']), encoded['content'])
+    except Exception as e:
+        logger.error(f"Failed to save file to storage: {e}", exc_info=True)
+        raise FileServiceError('Failed to save file to storage.', status_code=500)
+    integrity.record(name, encoded['content'])
+    return name
+
+
+def overwrite_blob(name, content):
+    """Replace the content of an existing blob in place, keeping its name (and its storage tier)."""
+    storage = (locate_blob(name) or storage_tiers.hot()).storage
+    if isinstance(storage, FileSystemStorage):
+        # Write next to the target and rename over it so readers never see a partial blob
+        path = storage.path(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.overwrite-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    else:
+        # Object stores overwrite a key atomically; bypass get_available_name()
+        name = storage._save(name, ContentFile(content))
+    record_write(name, len(content))
+    integrity.record(name, content)
+    return name
+
+
+def cipher_name(file_instance):
+    """Cipher engine of an encrypted File; rows from before engines existed are AES-CFB."""
+    return file_instance.cipher or AES_CFB
+
+
+def log_access(file_instance, user, action, request_meta=None):
+    request_meta = request_meta or {}
+    if action == 'download':
+        access.record(file_instance.pk)  # Written to the File row in batches
+    return FileAccessLog.objects.create(
+        file=file_instance,
+        user=user,
+        action=action,
+        ip_address=request_meta.get('REMOTE_ADDR', ''),
+        user_agent=request_meta.get('HTTP_USER_AGENT', '') if action == 'download' else None
+    )
+
+
+def create_file_record(user, storage_name, original_filename, file_type, stored_size, original_size,
+                       file_hash, encoded, request_meta=None, root=None, folder=None):
+    """
+    Create the File row for a newly stored blob, charge quota and log the upload.
+
+    If the quota no longer has room the blob is removed again.
+    """
+    try:
+        with transaction.atomic():
+            reserve_storage(user, stored_size)
+            file_instance = File.objects.create(
+                owner=user,
+                file=storage_name, # Store the path returned by the storage system
+                original_filename=original_filename,
+                file_type=file_type,
+                size=stored_size, # Size of the content actually stored
+                is_encrypted=encoded['is_encrypted'],
+                encryption_key_id=encoded['encryption_key_id'],
+                cipher=encoded['cipher'],
+                file_hash=file_hash,
+                compression=encoded['compression'],
+                original_size=original_size,
+                merkle_root=root,
+                folder=folder
+            )
+            folders.adjust(folder, stored_size, 1)
+            stats.file_added(file_instance)
+    except FileServiceError:
+        delete_blob(storage_name)
+        integrity.forget(storage_name)
+        raise
+    log_access(file_instance, user, 'upload', request_meta)
+    return file_instance
+
+
+def backfill_merkle_root(existing_file, content=None, root=None, original_size=None):
+    """
+    Record the Merkle root on rows of a blob uploaded before roots existed.
+
+    Called when a full upload turns out to be a dedup hit, i.e. while the
+    plaintext (or, for streamed uploads, its root and size) is at hand
+    anyway, so such content becomes provable over time.
+    """
+    if existing_file.merkle_root:
+        return
+    existing_file.merkle_root = root or merkle_root(content)
+    existing_file.original_size = len(content) if content is not None else original_size
+    File.objects.filter(file_hash=existing_file.file_hash, merkle_root__isnull=True).update(
+        merkle_root=existing_file.merkle_root, original_size=existing_file.original_size
+    )
+
+
+def add_file_reference(user, existing_file, original_filename, file_type, action='upload', request_meta=None,
+                       folder=None):
+    """Add a File row pointing at an existing blob (dedup hit); no new storage is used."""
+    with transaction.atomic():
+        reserve_storage(user, existing_file.size)
+        file_instance = File.objects.create(
+            owner=user,
+            file=existing_file.file,  # reference existing file
+            original_filename=original_filename,
+            file_type=file_type,
+            size=existing_file.size,
+            is_encrypted=existing_file.is_encrypted,
+            encryption_key_id=existing_file.encryption_key_id,
+            cipher=existing_file.cipher,
+            file_hash=existing_file.file_hash,
+            compression=existing_file.compression,
+            original_size=existing_file.original_size,
+            merkle_root=existing_file.merkle_root,
+            folder=folder
+        )
+        folders.adjust(folder, existing_file.size, 1)
+        stats.file_added(file_instance)
+    log_access(file_instance, user, action, request_meta)
+    return file_instance
+
+
+def _forget_blob(name):
+    try:
+        delete_blob(name) # A single DELETE; missing blobs are fine
+        integrity.forget(name)
+        logger.info(f"Deleted physical file from storage: {name}")
+    except Exception as e:
+        logger.error(f"Error deleting physical file {name} from storage: {e}", exc_info=True)
+
+
+def delete_file(file_instance):
+    """
+    Delete a File row and everything hanging off it: its earlier versions,
+    the owner's quota and folder/statistics counters, and its blob once no
+    other File row points at it. Blobs are only removed after the database
+    changes are committed.
+    """
+    owner = file_instance.owner
+    name = file_instance.file.name if file_instance.file else ''
+    version_names, released = [], 0
+    hashes = {file_instance.file_hash}  # Contents whose previews may go with the row
+    for version_name, size, version_hash in file_instance.versions.values_list('storage_name', 'size', 'file_hash'):
+        version_names.append(version_name)
+        released += size
+        hashes.add(version_hash)
+    hashes.discard(None)
+    hashes.discard('')
+
+    with transaction.atomic():
+        File.objects.filter(pk=file_instance.pk).delete() # Cascades to versions and access logs
+        release_storage(owner, file_instance.size + released) # Clamped at 0
+        folders.adjust(file_instance.folder_id, -file_instance.size, -1)
+        stats.file_removed(file_instance)
+        stats.versions_changed(owner.pk, -len(version_names), -released)
+        shared = bool(name) and File.objects.filter(file=name).exists()
+        hashes -= set(File.objects.filter(file_hash__in=hashes).values_list('file_hash', flat=True))
+
+    if name and not shared:
+        _forget_blob(name)
+    elif name:
+        logger.info(f"Physical file {name} not deleted from storage due to other references.")
+    for file_hash in hashes:  # No File row has this content any more
+        previews.forget(file_hash)
+    for version_name in version_names:  # Earlier versions only ever belong to this row
+        _forget_blob(version_name)
+    logger.info(f"Deleted File DB record ID: {file_instance.pk}, Original Name: {file_instance.original_filename}")
+
+
+def store_upload(user, content, original_filename, file_type, request_meta=None, folder=None):
+    """
+    Store plaintext uploaded by `user` and return the new File row.
+
+    Dedup hits only add a reference to the existing blob.
+    """
+    check_upload_allowed(user, len(content))
+    file_hash = hash_content(content)
+
+    existing_file = find_duplicate(file_hash)
+    if existing_file:
+        backfill_merkle_root(existing_file, content)
+        return add_file_reference(
+            user, existing_file, original_filename, file_type, request_meta=request_meta, folder=folder
+        )
+
+    encoded = encode_content(user, content, original_filename, file_type)
+    stored_path = write_blob(encoded)
+
+    file_instance = create_file_record(
+        user, stored_path, original_filename, file_type, len(encoded['content']), len(content),
+        file_hash, encoded, request_meta, root=merkle_root(content), folder=folder
+    )
+    previews.schedule(file_hash, content, original_filename, file_type)
+    return file_instance
+
+
+class BlobDecoder:
+    """
+    Incrementally turns stored bytes back into plaintext.
+
+    Feed it stored chunks in order with update() and call finalize() at the
+    end; it handles decryption with the blob's cipher engine and decompression.
+    """
+
+    def __init__(self, file_instance, user):
+        key = None
+        if file_instance.is_encrypted:
+            key = user.get_derived_aes_key()
+            if not key: # File is encrypted, but user has no key or it's invalid
+                raise FileServiceError('File is encrypted, but a valid decryption key is not available.', status_code=403)
+        self._configure(cipher_name(file_instance) if key else None, key, file_instance.compression)
+
+    @classmethod
+    def from_params(cls, cipher=None, key=None, compression=None):
+        """Build a decoder from blob parameters alone, without File or User rows."""
+        decoder = cls.__new__(cls)
+        decoder._configure(cipher, key, compression)
+        return decoder
+
+    def _configure(self, cipher, key, compression):
+        self.decryptor = get_engine(cipher).decryptor(key) if key else None
+        self.decompressor = decompressor(compression) if compression else None
+
+    def _decompress(self, data):
+        if self.decompressor is not None and data:
+            return self.decompressor.decompress(data)
+        return data
+
+    def update(self, data):
+        try:
+            plain = self.decryptor.update(data) if self.decryptor else data
+            return self._decompress(plain)
+        except (CipherError, *DECOMPRESSION_ERRORS) as e:
+            raise FileServiceError('Decryption failed. Key might be incorrect or file corrupted.', status_code=500) from e
+
+    def finalize(self):
+        try:
+            plain = self._decompress(self.decryptor.finalize()) if self.decryptor else b''
+            if self.decompressor is not None:
+                plain += self.decompressor.flush()
+            return plain
+        except (CipherError, *DECOMPRESSION_ERRORS) as e:
+            raise FileServiceError('Decryption failed. Key might be incorrect or file corrupted.', status_code=500) from e
+
+
+def decode_content(file_instance, user, stored_content):
+    """Decrypt and decompress a whole stored blob."""
+    decoder = BlobDecoder(file_instance, user)
+    return decoder.update(stored_content) + decoder.finalize()
+
+
+def plaintext_size(file_instance):
+    """Size of the decoded content, if it can be known without reading the blob."""
+    if file_instance.original_size is not None:
+        return file_instance.original_size
+    if file_instance.compression:
+        return None
+    if file_instance.is_encrypted:
+        return get_engine(cipher_name(file_instance)).plaintext_size(file_instance.size)
+    return file_instance.size
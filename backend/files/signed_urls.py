@@ -0,0 +1,83 @@
+"""
+Short-lived signed download links.
+
+A link is a Fernet token (AES-CBC + HMAC-SHA256 under a server-side key)
+that names the file, the owner's key version at the time it was issued and
+an expiry, nothing else. No key material travels in the URL: the handler in
+files.async_views.signed_download loads the File row when the link is
+redeemed, derives the owner's file key on the server and streams the blob
+on the event loop.
+
+A link stops working when it expires, when the file is deleted and when
+the owner rotates their encryption key (the key version no longer matches).
+Keep SIGNED_URL_TTL short.
+"""
+import base64
+import hashlib
+import json
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+
+from .models import File
+from .services import BlobDecoder, FileServiceError
+
+
+class InvalidDownloadToken(Exception):
+    """The token is malformed, was not issued by this server, has been tampered with or was revoked"""
+
+
+class ExpiredDownloadToken(InvalidDownloadToken):
+    """The token was valid but its lifetime is over"""
+
+
+_fernet = None
+
+
+def _get_fernet():
+    global _fernet
+    if _fernet is None:
+        secret = getattr(settings, 'SIGNED_URL_KEY', None) or settings.SECRET_KEY
+        key = hashlib.sha256(f'signed-download:{secret}'.encode()).digest()
+        _fernet = Fernet(base64.urlsafe_b64encode(key))
+    return _fernet
+
+
+def issue(file_instance, user, ttl=None):
+    """Return (token, expires_at) for downloading `file_instance` as `user`."""
+    ttl = ttl or getattr(settings, 'SIGNED_URL_TTL', 300)
+    expires_at = int(time.time()) + ttl
+    if file_instance.is_encrypted and not user.get_derived_aes_key():
+        raise FileServiceError('File is encrypted, but a valid decryption key is not available.', status_code=403)
+    payload = {'id': str(file_instance.id), 'kv': user.key_version, 'exp': expires_at}
+    token = _get_fernet().encrypt(json.dumps(payload, separators=(',', ':')).encode()).decode()
+    return token, expires_at
+
+
+def verify(token):
+    """Decode a token; raises InvalidDownloadToken or ExpiredDownloadToken."""
+    try:
+        payload = json.loads(_get_fernet().decrypt(token.encode()))
+        expires_at = payload['exp']
+    except (InvalidToken, ValueError, TypeError, KeyError) as e:
+        raise InvalidDownloadToken() from e
+    if expires_at <= time.time():
+        raise ExpiredDownloadToken()
+    return payload
+
+
+def redeem(payload):
+    """
+    Return (file_instance, decoder) for a verified token's payload.
+
+    Raises InvalidDownloadToken when the owner's key has changed since the
+    link was issued, and FileServiceError when the file is gone.
+    """
+    file_instance = File.objects.select_related('owner').filter(pk=payload.get('id')).first()
+    if file_instance is None or not file_instance.file or not file_instance.file.name:
+        raise FileServiceError('File not found', status_code=404)
+    owner = file_instance.owner
+    if owner.key_version != payload.get('kv'):
+        raise InvalidDownloadToken()
+    return file_instance, BlobDecoder(file_instance, owner)
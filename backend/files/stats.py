@@ -0,0 +1,214 @@
+"""
+Per-user storage statistics.
+
+The storage dashboard breaks an owner's usage down by type and upload month,
+shows how much their own duplicate uploads save, and lists their largest
+files. Instead of aggregating over all of the owner's File rows on every
+load, StorageStat keeps one counter (count and stored bytes) per
+(dimension, bucket), adjusted in the same transaction as the change:
+
+  total     all File rows, as charged to the quota
+  physical  distinct contents among them; a reference to content the owner
+            already holds adds nothing (other owners' copies do not count,
+            which would reveal what they store)
+  versions  earlier versions kept by files/versions.py
+  type      per type bucket of file_type (type_bucket())
+  month     per upload month
+
+A File added or removed bumps total, its type and its month with a single
+UPDATE, plus physical when it is the owner's first or last copy of the
+content. summary() serves the result cache-aside from
+STORAGE_STATS_CACHE_ALIAS, invalidated on commit of every change; a miss
+costs two indexed queries (the counters and the largest files). Other
+processes see a change once their entry is invalidated, immediately with a
+shared cache backend, else within STORAGE_STATS_CACHE_TTL.
+
+The rebuild_storage_stats command recomputes everything from the tables.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import File, FileVersion, StorageStat
+
+LARGEST_FILES = 10
+
+OTHER = 'other'
+# First match wins; file_type is the MIME type sent with the upload
+TYPE_BUCKETS = (
+    ('image', ('image/',)),
+    ('video', ('video/',)),
+    ('audio', ('audio/',)),
+    ('pdf', ('application/pdf',)),
+    ('archive', (
+        'application/zip', 'application/gzip', 'application/x-tar', 'application/x-7z', 'application/x-rar',
+        'application/x-bzip', 'application/vnd.rar',
+    )),
+    ('document', (
+        'application/msword', 'application/rtf', 'application/vnd.openxmlformats', 'application/vnd.ms-',
+        'application/vnd.oasis.opendocument',
+    )),
+    ('text', ('text/', 'application/json', 'application/xml', 'application/javascript')),
+)
+
+
+def type_bucket(file_type):
+    file_type = (file_type or '').lower()
+    for bucket, prefixes in TYPE_BUCKETS:
+        if file_type.startswith(prefixes):
+            return bucket
+    return OTHER
+
+
+def month_bucket(moment):
+    return timezone.localtime(moment).strftime('%Y-%m')
+
+
+def _cache():
+    return caches[getattr(settings, 'STORAGE_STATS_CACHE_ALIAS', 'default')]
+
+
+def _cache_key(owner_id):
+    return f'storage-stats:{owner_id}'
+
+
+def invalidate(owner_id):
+    """Drop the cached summary once the current transaction commits."""
+    transaction.on_commit(lambda: _cache().delete(_cache_key(owner_id)))
+
+
+def _bump(owner_id, keys, count, nbytes):
+    """Add count and nbytes to each of the owner's (dimension, bucket) counters, creating missing ones."""
+    if not count and not nbytes:
+        return
+    match = Q()
+    for dimension, bucket in keys:
+        match |= Q(dimension=dimension, bucket=bucket)
+    counters = StorageStat.objects.filter(match, owner_id=owner_id)
+    if counters.update(count=F('count') + count, bytes=F('bytes') + nbytes) < len(keys):
+        existing = set(counters.values_list('dimension', 'bucket'))
+        for dimension, bucket in keys:
+            if (dimension, bucket) in existing:
+                continue
+            try:
+                with transaction.atomic():
+                    StorageStat.objects.create(
+                        owner_id=owner_id, dimension=dimension, bucket=bucket, count=count, bytes=nbytes
+                    )
+            except IntegrityError:  # Created concurrently
+                StorageStat.objects.filter(owner_id=owner_id, dimension=dimension, bucket=bucket).update(
+                    count=F('count') + count, bytes=F('bytes') + nbytes
+                )
+    invalidate(owner_id)
+
+
+def _file_changed(file_instance, sign):
+    owner_id = file_instance.owner_id
+    _bump(owner_id, [
+        (StorageStat.TOTAL, ''),
+        (StorageStat.TYPE, type_bucket(file_instance.file_type)),
+        (StorageStat.MONTH, month_bucket(file_instance.uploaded_at)),
+    ], sign, sign * file_instance.size)
+    other_copies = file_instance.file_hash and File.objects.filter(
+        owner_id=owner_id, file_hash=file_instance.file_hash
+    ).exclude(pk=file_instance.pk).exists()
+    if not other_copies:
+        _bump(owner_id, [(StorageStat.PHYSICAL, '')], sign, sign * file_instance.size)
+
+
+def file_added(file_instance):
+    """Count a new File row (call after it is saved)."""
+    _file_changed(file_instance, 1)
+
+
+def file_removed(file_instance):
+    """Uncount a File row, from its values before it was deleted or changed."""
+    _file_changed(file_instance, -1)
+
+
+def versions_changed(owner_id, count_delta, size_delta):
+    _bump(owner_id, [(StorageStat.VERSIONS, '')], count_delta, size_delta)
+
+
+def compute(files, versions):
+    """{(dimension, bucket): (count, bytes)} of one owner's File and FileVersion querysets."""
+    totals = {}
+
+    def add(key, count, nbytes):
+        old = totals.get(key, (0, 0))
+        totals[key] = (old[0] + count, old[1] + (nbytes or 0))
+
+    by_type_month = files.annotate(month=TruncMonth('uploaded_at')).values('file_type', 'month').annotate(
+        n=Count('id'), size=Sum('size')
+    ).order_by()
+    for row in by_type_month:
+        add((StorageStat.TOTAL, ''), row['n'], row['size'])
+        add((StorageStat.TYPE, type_bucket(row['file_type'])), row['n'], row['size'])
+        add((StorageStat.MONTH, month_bucket(row['month'])), row['n'], row['size'])
+    for row in files.exclude(file_hash=None).values('file_hash').annotate(size=Max('size')).order_by():
+        add((StorageStat.PHYSICAL, ''), 1, row['size'])
+    unhashed = files.filter(file_hash=None).aggregate(n=Count('id'), size=Sum('size'))
+    if unhashed['n']:
+        add((StorageStat.PHYSICAL, ''), unhashed['n'], unhashed['size'])
+    history = versions.aggregate(n=Count('id'), size=Sum('size'))
+    if history['n']:
+        add((StorageStat.VERSIONS, ''), history['n'], history['size'])
+    return totals
+
+
+def rebuild(owner_id):
+    """Recompute an owner's counters from their files; returns how many counters were wrong."""
+    with transaction.atomic():
+        totals = compute(File.objects.filter(owner_id=owner_id), FileVersion.objects.filter(file__owner_id=owner_id))
+        current = {
+            (row.dimension, row.bucket): (row.count, row.bytes)
+            for row in StorageStat.objects.filter(owner_id=owner_id)
+        }
+        wrong = sum(1 for key in set(totals) | set(current) if totals.get(key, (0, 0)) != current.get(key, (0, 0)))
+        if wrong:
+            StorageStat.objects.filter(owner_id=owner_id).delete()
+            StorageStat.objects.bulk_create([
+                StorageStat(owner_id=owner_id, dimension=dimension, bucket=bucket, count=count, bytes=nbytes)
+                for (dimension, bucket), (count, nbytes) in totals.items()
+            ])
+        invalidate(owner_id)
+    return wrong
+
+
+def _summarize(owner_id):
+    counters = {StorageStat.TYPE: {}, StorageStat.MONTH: {}}
+    for dimension, bucket, count, nbytes in StorageStat.objects.filter(owner_id=owner_id).values_list(
+        'dimension', 'bucket', 'count', 'bytes'
+    ):
+        if count or nbytes:
+            counters.setdefault(dimension, {})[bucket] = {'count': count, 'bytes': nbytes}
+    empty = {'count': 0, 'bytes': 0}
+    files = counters.get(StorageStat.TOTAL, {}).get('', empty)
+    physical = counters.get(StorageStat.PHYSICAL, {}).get('', empty)
+    largest = File.objects.filter(owner_id=owner_id).order_by('-size').values(
+        'id', 'original_filename', 'file_type', 'size'
+    )[:LARGEST_FILES]
+    return {
+        'files': files,
+        'physical': physical,
+        'dedup_savings': files['bytes'] - physical['bytes'],
+        'versions': counters.get(StorageStat.VERSIONS, {}).get('', empty),
+        'by_type': counters[StorageStat.TYPE],
+        'by_month': [
+            {'month': month, **value} for month, value in sorted(counters[StorageStat.MONTH].items(), reverse=True)
+        ],
+        'largest_files': [{**row, 'id': str(row['id'])} for row in largest],
+    }
+
+
+def summary(owner_id):
+    """The owner's storage breakdown, from the cache when possible."""
+    cache, key = _cache(), _cache_key(owner_id)
+    data = cache.get(key)
+    if data is None:
+        data = _summarize(owner_id)
+        cache.set(key, data, getattr(settings, 'STORAGE_STATS_CACHE_TTL', 300))
+    return data
@@ -0,0 +1,222 @@
+"""
+Storage tiers.
+
+Every blob is written to the hot tier, default_storage. With
+STORAGE_COLD_TIER set there is a second, cold tier for blobs nobody reads
+any more:
+
+  local  a directory, STORAGE_COLD_TIER_ROOT (e.g. large, slow disks)
+  s3     a second bucket, STORAGE_COLD_TIER_BUCKET, on the S3/MinIO server
+         of the hot tier (which must then be STORAGE_BACKEND=s3)
+
+files/tiering.py decides which blobs belong where and moves them; this
+module only knows how to reach the tiers. A blob keeps its name on either
+tier, so nothing that refers to it changes when it moves. files.blobs
+finds a blob by trying the tier it was last found on first, then the
+others, hot first; since a move copies a blob before deleting the source,
+a reader always finds one copy. Without STORAGE_COLD_TIER there is only the
+hot tier and every lookup costs what it did before.
+
+STORAGE_REPLICAS adds replicas: further backends that receive a copy of
+every blob, whatever its tier, after it was written (files/replication.py),
+and that reads fall back to when the tiers fail (files/blobs.py). They are
+listed as name=kind:target, comma separated, e.g.
+
+    STORAGE_REPLICAS=dr=local:/mnt/dr-vault,offsite=s3:vault-replica
+
+where a 'local' target is a directory and an 's3' one a bucket on the S3
+server of the hot tier. A replica's name identifies it in the replication
+queue, so it must not change while blobs are queued for it.
+"""
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from storages.utils import clean_name
+
+HOT = 'hot'
+COLD = 'cold'
+
+LOCAL = 'local'
+S3 = 's3'
+
+
+class Tier:
+    """One storage tier: its name, its Django storage and how to reach it."""
+
+    def __init__(self, name, storage, is_s3):
+        self.name = name
+        self.storage = storage
+        self.is_s3 = is_s3
+
+    @property
+    def is_filesystem(self):
+        return isinstance(self.storage, FileSystemStorage)
+
+    @property
+    def client(self):
+        return self.storage.connection.meta.client
+
+    @property
+    def bucket(self):
+        return self.storage.bucket_name
+
+    def s3_key(self, name):
+        """Object key of a blob under the storage's location prefix."""
+        return self.storage._normalize_name(clean_name(name))
+
+    def __repr__(self):
+        return f'<Tier {self.name}>'
+
+
+_tiers = None
+_tiers_lock = threading.Lock()
+
+
+def _build(name, kind, target, setting):
+    """A Tier named `name` on a `kind` backend: a directory (LOCAL) or a bucket of the hot tier's server (S3)."""
+    if kind == LOCAL:
+        os.makedirs(target, exist_ok=True)
+        return Tier(name, FileSystemStorage(location=target), is_s3=False)
+    if kind == S3:
+        if getattr(settings, 'STORAGE_BACKEND', 'local') != 's3' or not target:
+            raise ImproperlyConfigured(f'{setting}: an s3 backend needs STORAGE_BACKEND=s3 and a bucket.')
+        from storages.backends.s3boto3 import S3Boto3Storage
+        return Tier(name, S3Boto3Storage(bucket_name=target), is_s3=True)
+    raise ImproperlyConfigured(f"{setting}: the backend must be '{LOCAL}' or '{S3}', not {kind!r}.")
+
+
+def _cold_tier():
+    kind = getattr(settings, 'STORAGE_COLD_TIER', None)
+    target = settings.STORAGE_COLD_TIER_ROOT if kind == LOCAL else getattr(settings, 'STORAGE_COLD_TIER_BUCKET', '')
+    return _build(COLD, kind, target, 'STORAGE_COLD_TIER')
+
+
+def tiers():
+    """The configured tiers, hot first."""
+    global _tiers
+    if _tiers is None:
+        with _tiers_lock:
+            if _tiers is None:
+                found = [Tier(HOT, default_storage, getattr(settings, 'STORAGE_BACKEND', 'local') == 's3')]
+                if getattr(settings, 'STORAGE_COLD_TIER', None):
+                    found.append(_cold_tier())
+                _tiers = found
+    return _tiers
+
+
+def enabled():
+    return bool(getattr(settings, 'STORAGE_COLD_TIER', None))
+
+
+_replicas = None
+
+
+def from_spec(name, spec, setting):
+    """A Tier named `name` on the backend described by `spec`: 'local:<directory>' or 's3:<bucket>'."""
+    kind, _, target = spec.partition(':')
+    return _build(name, kind.strip(), target.strip(), setting)
+
+
+def _parse_replicas(spec):
+    found = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, backend = entry.partition('=')
+        name = name.strip()
+        if not name or not backend or name in (HOT, COLD) or any(replica.name == name for replica in found):
+            raise ImproperlyConfigured(f'STORAGE_REPLICAS: expected distinct name=kind:target entries, got {entry!r}.')
+        found.append(from_spec(name, backend, 'STORAGE_REPLICAS'))
+    return found
+
+
+def replicas():
+    """The configured replicas (Tiers), in the order of STORAGE_REPLICAS; empty without replication."""
+    global _replicas
+    if _replicas is None:
+        with _tiers_lock:
+            if _replicas is None:
+                _replicas = _parse_replicas(getattr(settings, 'STORAGE_REPLICAS', ''))
+    return _replicas
+
+
+def replica(name):
+    for candidate in replicas():
+        if candidate.name == name:
+            return candidate
+    raise ImproperlyConfigured(f'Storage replica {name!r} is not configured.')
+
+
+def get(name):
+    for tier in tiers():
+        if tier.name == name:
+            return tier
+    raise ImproperlyConfigured(f'Storage tier {name!r} is not configured.')
+
+
+def hot():
+    return tiers()[0]
+
+
+class _Placements:
+    """Which tier each recently used blob was found on; bounded, per process."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            return self._entries.get(name)
+
+    def set(self, name, tier_name):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()  # Only a hint; a miss costs one probe of the hot tier
+            self._entries[name] = tier_name
+
+    def forget(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+placements = _Placements()
+
+SETTINGS = {
+    'STORAGE_BACKEND', 'STORAGE_COLD_TIER', 'STORAGE_COLD_TIER_ROOT', 'STORAGE_COLD_TIER_BUCKET', 'STORAGE_REPLICAS',
+}
+
+
+@receiver(setting_changed)
+def _settings_changed(setting, **kwargs):
+    """Rebuild the tiers and replicas when their settings change (tests)."""
+    global _tiers, _replicas
+    if setting in SETTINGS:
+        with _tiers_lock:
+            _tiers = _replicas = None
+        placements.clear()
+
+
+def found(name, tier):
+    """Note that `name` is on `tier`, for the next lookup."""
+    if len(tiers()) > 1:
+        placements.set(name, tier.name)
+
+
+def candidates(name):
+    """The tiers to look for `name` on, most likely first."""
+    configured = tiers()
+    if len(configured) == 1:
+        return configured
+    last_seen = placements.get(name)
+    if last_seen is None or last_seen == HOT:
+        return configured
+    return sorted(configured, key=lambda tier: tier.name != last_seen)
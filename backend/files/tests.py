@@ -0,0 +1,1112 @@
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import types
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core import metrics
+
+from . import (
+    access, admission, backup, blob_cache, blobs, ciphers, compression, delta, integrity, layout, merkle, outbox,
+    possession, previews, replication, signed_urls, stats, storage_tiers, tiering, versions,
+)
+from .admin import EstimatedCountPaginator
+from .blobs import BlobWriter, blob_size, open_blob, save_blob
+from .models import BlobIntegrity, BlobTier, File, FileVersion, Preview, ReplicationTask, StorageStat
+from .services import FileServiceError, delete_file, store_upload
+
+MB = 1024 * 1024
+KEY = bytes(range(32))
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_burst_then_refill(self):
+        bucket = admission.TokenBucket(rate=2, burst=4, now=0)
+        self.assertEqual(bucket.wait_time(4, now=0), 0)
+        bucket.take(4)
+        self.assertEqual(bucket.wait_time(1, now=0), 0.5)
+        self.assertEqual(bucket.wait_time(1, now=0.5), 0)
+
+    def test_request_larger_than_burst_waits_for_a_full_bucket(self):
+        bucket = admission.TokenBucket(rate=1, burst=10, now=0)
+        bucket.take(5)
+        self.assertEqual(bucket.wait_time(100, now=0), 5)
+
+
+@override_settings(
+    ADMISSION_USER_REQUESTS_PER_SECOND=1, ADMISSION_USER_REQUEST_BURST=2,
+    ADMISSION_USER_BYTES_PER_SECOND=MB, ADMISSION_USER_BYTE_BURST=10 * MB,
+    ADMISSION_USER_MAX_CONCURRENT=4, ADMISSION_MAX_INFLIGHT_BYTES=100 * MB,
+)
+class AdmissionControllerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.controller = admission.AdmissionController()
+
+    def _rejected(self, key, nbytes):
+        with self.assertRaises(admission.Rejected) as rejected:
+            self.controller.acquire(key, nbytes)
+        return rejected.exception
+
+    def test_request_rate_is_limited_per_user(self):
+        self.controller.acquire('alice', 1)
+        self.controller.acquire('alice', 1)
+        rejected = self._rejected('alice', 1)
+        self.assertEqual((rejected.status_code, rejected.reason), (429, 'rate'))
+        self.assertGreaterEqual(rejected.retry_after, 1)
+        self.controller.acquire('bob', 1)  # Other users have their own buckets
+
+    def test_byte_rate_is_limited_per_user(self):
+        self.controller.acquire('alice', 10 * MB)
+        rejected = self._rejected('alice', 5 * MB)
+        self.assertEqual((rejected.status_code, rejected.reason), (429, 'rate'))
+        self.assertEqual(rejected.retry_after, 5)
+
+    @override_settings(ADMISSION_USER_MAX_CONCURRENT=1)
+    def test_concurrency_is_limited_until_release(self):
+        self.controller.acquire('alice', 1)
+        self.assertEqual(self._rejected('alice', 1).reason, 'concurrency')
+        self.controller.release('alice', 1)
+        self.controller.acquire('alice', 1)
+
+    @override_settings(ADMISSION_MAX_INFLIGHT_BYTES=10, ADMISSION_QUEUE_TIMEOUT=0.01)
+    def test_user_over_fair_share_of_a_full_budget_is_refused(self):
+        self.controller.acquire('alice', 8)
+        self.controller.acquire('bob', 2)
+        rejected = self._rejected('alice', 2)
+        self.assertEqual((rejected.status_code, rejected.reason), (429, 'fair_share'))
+        timed_out = self._rejected('bob', 2)  # Within its share, but nothing is freed in time
+        self.assertEqual((timed_out.status_code, timed_out.reason), (503, 'timeout'))
+
+
+@override_settings(FILE_CIPHER_SEGMENT_SIZE=1024)
+class CipherEngineTests(SimpleTestCase):
+    CONTENTS = (b'', b'x', os.urandom(1024), os.urandom(5000))
+
+    def test_round_trip(self):
+        for engine in ciphers.ENGINES.values():
+            for content in self.CONTENTS:
+                with self.subTest(engine=engine.name, size=len(content)):
+                    self.assertEqual(engine.decrypt(KEY, engine.encrypt(KEY, content)), content)
+
+    def test_engine_must_implement_every_operation(self):
+        class EncryptOnlyEngine(ciphers.CipherEngine):
+            name = 'encrypt-only'
+
+            def encryptor(self, key):
+                return ciphers.AESCFBEngine().encryptor(key)
+
+        with self.assertRaisesRegex(TypeError, 'decryptor'):
+            EncryptOnlyEngine()
+
+    def test_streamed_round_trip_in_odd_pieces(self):
+        content = os.urandom(5000)
+        for engine in ciphers.ENGINES.values():
+            with self.subTest(engine=engine.name):
+                encryptor = engine.encryptor(KEY)
+                stored = b''.join(encryptor.update(content[i:i + 333]) for i in range(0, len(content), 333))
+                stored += encryptor.finalize()
+                decryptor = engine.decryptor(KEY)
+                plain = b''.join(decryptor.update(stored[i:i + 777]) for i in range(0, len(stored), 777))
+                self.assertEqual(plain + decryptor.finalize(), content)
+                self.assertEqual(engine.plaintext_size(len(stored)), len(content))
+
+    def test_authenticated_engines_detect_tampering(self):
+        content = os.urandom(5000)
+        segment = 1024 + ciphers.SegmentedAEADEngine.TAG_SIZE
+        for engine in ciphers.ENGINES.values():
+            if not engine.authenticated:
+                continue
+            stored = engine.encrypt(KEY, content)
+            flipped = bytearray(stored)
+            flipped[len(stored) // 2] ^= 1
+            tampered = {
+                'flipped bit': bytes(flipped),
+                'truncated': stored[:-segment],
+                'reordered': stored[:12] + stored[12 + segment:12 + 2 * segment] + stored[12:12 + segment]
+                             + stored[12 + 2 * segment:],
+            }
+            for what, data in tampered.items():
+                with self.subTest(engine=engine.name, tampering=what):
+                    with self.assertRaises(ciphers.CipherError):
+                        engine.decrypt(KEY, data)
+            with self.subTest(engine=engine.name, tampering='wrong key'):
+                with self.assertRaises(ciphers.CipherError):
+                    engine.decrypt(bytes(32), stored)
+
+
+class CompressionPolicyTests(SimpleTestCase):
+
+    def test_policy_by_type_size_and_setting(self):
+        cases = [
+            (('notes.txt', 'text/plain', 5000), compression.ZLIB),
+            (('drawing.svg', 'image/svg+xml', 5000), compression.ZLIB),  # Compressible despite image/
+            (('photo.jpg', 'image/jpeg', 5000), None),
+            (('archive.bin', 'application/zip', 5000), None),
+            (('backup.tgz', 'application/octet-stream', 5000), None),  # By extension
+            (('notes.txt', 'text/plain', 100), None),  # Under FILE_COMPRESSION_MIN_SIZE
+        ]
+        for args, expected in cases:
+            with self.subTest(args=args):
+                self.assertEqual(compression.choose_compression(*args), expected)
+        with self.settings(FILE_COMPRESSION='none'):
+            self.assertIsNone(compression.choose_compression('notes.txt', 'text/plain', 5000))
+
+    def test_round_trip_in_pieces(self):
+        content = b'a compressible line of text\n' * 2000
+        for algorithm in compression.available_algorithms():
+            with self.subTest(algorithm=algorithm):
+                packed = compression.compress(content, algorithm)
+                self.assertLess(len(packed), len(content) // 10)
+                pieces = [packed[i:i + 100] for i in range(0, len(packed), 100)]
+                self.assertEqual(b''.join(compression.iter_decompress(pieces, algorithm)), content)
+
+
+def _proof(leaves, index):
+    """Sibling hashes from leaf `index` up to the root, as a client computes them."""
+    leaf, siblings, level = leaves[index], [], list(leaves)
+    while len(level) > 1:
+        if index % 2:
+            siblings.append(level[index - 1])
+        elif index + 1 < len(level):
+            siblings.append(level[index + 1])
+        paired = [merkle.node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level, index = paired, index // 2
+    return {'leaf': leaf.hex(), 'siblings': [s.hex() for s in siblings]}
+
+
+class MerkleProofTests(SimpleTestCase):
+
+    def setUp(self):
+        self.content = os.urandom(possession.CHUNK_SIZE * 4 + 100)  # Five leaves: an odd level
+        self.leaves = merkle.leaf_hashes(self.content, possession.CHUNK_SIZE)
+        self.root = possession.merkle_root(self.content)
+
+    def _proofs(self, indices):
+        return [_proof(self.leaves, index) for index in indices]
+
+    def test_valid_proofs_verify(self):
+        indices = list(range(len(self.leaves)))
+        self.assertTrue(possession.verify_proofs(self.root, len(self.content), indices, self._proofs(indices)))
+
+    def test_wrong_leaf_is_rejected(self):
+        proofs = self._proofs([1, 4])
+        proofs[0]['leaf'] = merkle.leaf_hash(b'forged').hex()
+        self.assertFalse(possession.verify_proofs(self.root, len(self.content), [1, 4], proofs))
+
+    def test_proof_for_another_index_is_rejected(self):
+        self.assertFalse(possession.verify_proofs(self.root, len(self.content), [2], self._proofs([3])))
+
+    def test_malformed_proofs_are_rejected(self):
+        valid = self._proofs([0])[0]
+        for proofs in ([], [{'leaf': valid['leaf']}], [{**valid, 'siblings': ['zz']}],
+                       [{**valid, 'siblings': valid['siblings'] + [valid['leaf']]}]):
+            with self.subTest(proofs=proofs):
+                self.assertFalse(possession.verify_proofs(self.root, len(self.content), [0], proofs))
+
+
+class IntegrityIndexTests(SimpleTestCase):
+
+    def _index(self, content):
+        built = integrity.IndexBuilder(chunk_size=1024)
+        built.update(content)
+        return types.SimpleNamespace(name='blob', **built.finish())
+
+    def test_intact_content_verifies(self):
+        content = os.urandom(5000)
+        integrity.verify_content(self._index(content), content)
+
+    def test_changed_or_truncated_content_fails(self):
+        content = os.urandom(5000)
+        index = self._index(content)
+        for damaged in (content[:100] + b'?' + content[101:], content[:4096], content + b'!'):
+            with self.subTest(size=len(damaged)):
+                with self.assertRaises(integrity.IntegrityFailure):
+                    integrity.verify_content(index, damaged)
+
+
+class _NotModified(Exception):
+    response = {'Error': {'Code': '304'}, 'ResponseMetadata': {'HTTPStatusCode': 304}}
+
+
+class _FakeS3:
+    """Just enough of an S3 client for blob_cache: get_object, honouring If-None-Match."""
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+
+    def put(self, key, data):
+        self.objects[key] = (data, f'"{hashlib.md5(data).hexdigest()}"')
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.requests.append((Key, IfNoneMatch))
+        data, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise _NotModified()
+        return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+
+class BlobCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp(prefix='vault-cache-test-')
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        cache = override_settings(BLOB_CACHE_DIR=cache_dir, BLOB_CACHE_MAX_BYTES=1000, BLOB_CACHE_TRUST_SECONDS=0)
+        cache.enable()
+        self.addCleanup(cache.disable)
+        self.s3 = _FakeS3()
+
+    def _read(self, name):
+        with blob_cache.open_s3(name, self.s3, 'bucket', name) as f:
+            return f.read()
+
+    def _age(self, name, seconds):
+        path = blob_cache.lookup(name)[1]
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+    def test_hit_is_revalidated_without_the_body(self):
+        self.s3.put('a', b'first')
+        self.assertEqual((self._read('a'), self._read('a')), (b'first', b'first'))
+        self.assertEqual(self.s3.requests, [('a', None), ('a', self.s3.objects['a'][1])])
+
+        self._age('a', 60)
+        self._read('a')
+        self.assertGreater(blob_cache.lookup('a')[3], time.time() - 60)  # The hit refreshed its LRU position
+
+        self.s3.put('a', b'rewritten')
+        self.assertEqual(self._read('a'), b'rewritten')
+        self.assertEqual(len(os.listdir(os.path.dirname(blob_cache.lookup('a')[1]))), 1)
+
+        blob_cache.evict('a')
+        self.assertIsNone(blob_cache.lookup('a'))
+
+    @override_settings(BLOB_CACHE_TRUST_SECONDS=60)
+    def test_trusted_hit_makes_no_request(self):
+        self.s3.put('a', b'cached')
+        self._read('a')
+
+        self.assertEqual(self._read('a'), b'cached')
+        self.assertEqual(len(self.s3.requests), 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for i in range(10):
+            self.s3.put(f'b{i}', bytes([i]) * 100)
+            self._read(f'b{i}')
+            self._age(f'b{i}', 100 - i)
+        self._age('b0', 10)  # Recently used
+        evictions = metrics.snapshot()['counters'].get('blob_cache.evictions', 0)
+
+        self.s3.put('b10', b'\n' * 100)  # 1100 bytes cached; sweeps down to 900
+        self._read('b10')
+
+        cached = {name for name in (f'b{i}' for i in range(11)) if blob_cache.lookup(name)}
+        self.assertEqual(cached, {'b0', 'b3', 'b4', 'b5', 'b6', 'b7', 'b8', 'b9', 'b10'})
+        self.assertEqual(metrics.snapshot()['counters']['blob_cache.evictions'], evictions + 2)
+
+    def test_large_blobs_are_not_cached(self):
+        self.s3.put('big', b'x' * 101)
+
+        self.assertEqual(self._read('big'), b'x' * 101)
+        self.assertIsNone(blob_cache.lookup('big'))
+
+
+class EstimatedCountTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser(
+            username='grace', email='grace@example.com', password='pw-123456789'
+        )
+        files = [
+            File.objects.create(owner=self.user, file=f'blobs/00/00/{i}', original_filename=f'{i}.txt', size=1,
+                                file_type='text/plain')
+            for i in range(3)
+        ]
+        files[1].delete()  # The estimate is an upper bound now
+
+    def _count(self, queryset):
+        return EstimatedCountPaginator(queryset, 10).count
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=1)
+    def test_unfiltered_count_comes_from_the_statistics(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self._count(File.objects.all()), 3)
+        self.assertEqual(self._count(File.objects.filter(file_type='text/plain')), 2)
+
+    def test_small_tables_are_counted_exactly(self):
+        self.assertEqual(self._count(File.objects.all()), 2)
+
+    @override_settings(
+        ADMIN_EXACT_COUNT_LIMIT=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'
+    )
+    def test_changelist_renders_with_estimated_counts(self):
+        self.client.force_login(self.user)
+
+        response = self.client.get('/admin/files/file/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertContains(response, '2.txt')
+
+
+class TempMediaTestCase(TestCase):
+    """Blobs go to a throwaway MEDIA_ROOT; previews are only made when a test asks for them."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='vault-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root, PREVIEWS_ENABLED=False)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(access.flush)  # Download counts belong to this test's database
+        self.user = get_user_model().objects.create_user(
+            username='erin', email='erin@example.com', password='pw-123456789'
+        )
+
+
+class DeleteFilePreviewTests(TempMediaTestCase):
+
+    def _preview(self, file_hash):
+        name = save_blob(previews.storage_name(file_hash, previews.THUMB), b'encrypted image')
+        Preview.objects.create(file_hash=file_hash, kind=previews.THUMB, status=Preview.READY, storage_name=name)
+        return name
+
+    def _file(self, file_hash, **fields):
+        return File.objects.create(
+            owner=self.user, file=save_blob(f'blobs/test/{file_hash}', b'stored'), original_filename='a.txt',
+            size=6, file_hash=file_hash, **fields
+        )
+
+    def test_previews_of_current_and_earlier_versions_go_with_the_file(self):
+        current = self._file('b' * 64, version=2)
+        FileVersion.objects.create(
+            file=current, number=1, kind=FileVersion.FULL, storage_name=save_blob('blobs/test/v1', b'old'),
+            size=3, original_size=3, file_hash='a' * 64, created_at=timezone.now(),
+        )
+        names = [self._preview('a' * 64), self._preview('b' * 64)]
+
+        delete_file(current)
+
+        self.assertFalse(Preview.objects.exists())
+        self.assertEqual([blob_size(name) for name in names], [None, None])
+
+    def test_previews_of_content_still_referenced_are_kept(self):
+        self._file('c' * 64)
+        other = self._file('c' * 64)
+        self._preview('c' * 64)
+
+        delete_file(other)
+
+        self.assertEqual(Preview.objects.filter(file_hash='c' * 64).count(), 1)
+
+
+class BackupTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backup_root = tempfile.mkdtemp(prefix='vault-backup-test-')
+        self.addCleanup(shutil.rmtree, self.backup_root, ignore_errors=True)
+        target = override_settings(BACKUP_TARGET=f'local:{self.backup_root}')
+        target.enable()
+        self.addCleanup(target.disable)
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        store_upload(self.user, b'ledger\n' * 1000, 'ledger.txt', 'text/plain')
+
+    def _verify(self):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('restore_vault', '--verify-only', '--workers', '1', stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_verify_only_checks_every_blob(self):
+        backup.create(backup.target(), threads=1)
+
+        out, err = self._verify()
+
+        self.assertIn('1 blob(s) intact', out)
+        self.assertEqual(err, '')
+
+    def test_verify_only_reports_a_corrupt_backup_blob(self):
+        backup.create(backup.target(), threads=1)
+        blobs_dir = os.path.join(self.backup_root, backup.BLOBS)
+        [path] = [os.path.join(d, f) for d, _, files in os.walk(blobs_dir) for f in files]
+        with open(path, 'r+b') as f:
+            f.write(b'X')
+
+        out, err = self._verify()
+
+        self.assertIn('1 blob(s) missing or corrupt', out)
+        self.assertIn('Corrupt:', err)
+
+    def test_snapshots_taken_in_the_same_second_are_kept_apart(self):
+        first = backup.create(backup.target(), threads=1)
+        second = backup.create(backup.target(), threads=1)
+
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(backup.snapshots(backup.target()), [first['id'], second['id']])
+        self.assertEqual(second['copied'], 0)  # Incremental: the blob is already there
+
+
+class StorageLayoutTests(TempMediaTestCase):
+
+    def test_sharded_names(self):
+        digest = 'abcdef' + '0' * 58
+        self.assertEqual(layout.sharded_name(digest), f'blobs/ab/cd/{digest}')
+        self.assertEqual(layout.sharded_name(digest, depth=3, width=1), f'blobs/a/b/c/{digest}')
+        self.assertEqual(
+            layout.storage_name(True, b'stored bytes'), layout.sharded_name(layout.content_digest(b'stored bytes'))
+        )
+        name = layout.storage_name(True)  # Streamed: the bytes are not known yet
+        self.assertTrue(layout.is_sharded(name))
+        self.assertRegex(name, r'^blobs/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{28}$')
+        with self.settings(STORAGE_LAYOUT='flat'):
+            self.assertRegex(layout.storage_name(True, b'stored bytes'), r'^ecry::[0-9a-f-]{8}$')
+
+    def test_migrate_storage_layout_moves_flat_blobs(self):
+        stored = os.urandom(3000)
+        flat = save_blob('ecry::0badc0de', stored)
+        integrity.record(flat, stored)
+        rows = [
+            File.objects.create(owner=self.user, file=flat, original_filename=f'{i}.bin', size=len(stored),
+                                is_encrypted=True)
+            for i in range(2)
+        ]
+        File.objects.create(owner=self.user, file='ecry::deadbeef', original_filename='gone.bin', size=1)
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('migrate_storage_layout', stdout=out, stderr=err)
+
+        target = layout.sharded_name(layout.content_digest(stored))
+        self.assertEqual({File.objects.get(pk=row.pk).file.name for row in rows}, {target})
+        self.assertEqual((blob_size(flat), blob_size(target)), (None, len(stored)))
+        self.assertIsNotNone(integrity.get_index(target))
+        self.assertIn('1 blob(s) moved, 2 File row(s) updated, 0 skipped, 1 missing', out.getvalue())
+        self.assertIn('ecry::deadbeef', err.getvalue())
+
+
+class CompressedUploadTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+
+    def test_text_is_compressed_before_encryption(self):
+        content = b'log line that repeats\n' * 5000
+        stored = store_upload(self.user, content, 'app.log', 'text/plain')
+
+        self.assertEqual((stored.compression, stored.is_encrypted), (compression.ZLIB, True))
+        self.assertLess(stored.size, len(content) // 10)
+        self.assertEqual(versions.current_content(stored, self.user), content)
+
+    def test_already_compressed_types_are_stored_as_is(self):
+        content = os.urandom(5000)
+        stored = store_upload(self.user, content, 'photo.jpg', 'image/jpeg')
+
+        self.assertIsNone(stored.compression)
+        self.assertEqual(versions.current_content(stored, self.user), content)
+
+
+class BlobMetadataCacheTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        blobs.metadata_cache.clear()
+        self.addCleanup(blobs.metadata_cache.clear)
+
+    def _round_trips(self, op):
+        return metrics.snapshot()['counters'].get(f'storage.round_trips{{op={op}}}', 0)
+
+    def test_size_is_answered_from_the_cache(self):
+        name = save_blob('blobs/meta/sized', b'x' * 10)
+        heads = self._round_trips('head')
+        self.assertEqual(blob_size(name), 10)  # Recorded by the write
+
+        blobs.metadata_cache.clear()
+        self.assertEqual((blob_size(name), blob_size(name)), (10, 10))
+        self.assertEqual(self._round_trips('head'), heads + 1)
+
+    def test_missing_blob_is_cached_until_written(self):
+        name = 'blobs/meta/missing'
+        heads = self._round_trips('head')
+        self.assertEqual((blob_size(name), blob_size(name)), (None, None))
+        self.assertEqual(self._round_trips('head'), heads + 1)
+
+        self.assertEqual(blob_size(save_blob(name, b'now here')), 8)
+        self.assertEqual(self._round_trips('head'), heads + 1)
+
+    def test_delete_records_the_blob_as_missing(self):
+        name = save_blob('blobs/meta/deleted', b'short-lived')
+        heads = self._round_trips('head')
+
+        blobs.delete_blob(name)
+
+        self.assertIsNone(blob_size(name))
+        self.assertEqual(self._round_trips('head'), heads)
+
+    def test_entries_expire(self):
+        name = save_blob('blobs/meta/expiring', b'x' * 10)
+        self.assertEqual(blobs.metadata_cache.get(name), (True, 10))
+        later = time.monotonic() + settings.STORAGE_META_CACHE_TTL + 1
+        with mock.patch('files.blobs.time.monotonic', return_value=later):
+            self.assertEqual(blobs.metadata_cache.get(name), (False, None))
+
+        with self.settings(STORAGE_META_NEGATIVE_TTL=0):  # Missing blobs are not remembered at all
+            self.assertIsNone(blob_size('blobs/meta/unremembered'))
+        self.assertEqual(blobs.metadata_cache.get('blobs/meta/unremembered'), (False, None))
+
+    def test_missing_blob_costs_a_single_get(self):
+        name = 'blobs/meta/never-written'
+        gets, heads = self._round_trips('get'), self._round_trips('head')
+
+        with self.assertRaises(blobs.BlobNotFound):
+            open_blob(name)
+
+        self.assertFalse(blobs.blob_exists(name))
+        self.assertEqual((self._round_trips('get'), self._round_trips('head')), (gets + 1, heads))
+
+
+class StreamingUploadTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _upload(self, content, name='notes.txt'):
+        return self.client.post('/api/files/', {
+            'file': SimpleUploadedFile(name, content, content_type='text/plain'),
+        }, format='multipart')
+
+    def _blobs(self):
+        return [f for _, _, files in os.walk(settings.MEDIA_ROOT) for f in files]
+
+    def test_upload_round_trips(self):
+        for content in (b'tiny', b'compressible line\n' * 5000):
+            response = self._upload(content)
+            self.assertEqual(response.status_code, 201, response.content)
+            stored = File.objects.get(pk=response.data['id'])
+            self.assertTrue(stored.is_encrypted)
+            self.assertEqual(stored.original_size, len(content))
+            download = self.client.get(f'/api/files/{stored.pk}/download/')
+            self.assertEqual(download.getvalue(), content)
+
+    def test_dedup_hit_writes_no_blob(self):
+        content = b'same bytes\n' * 5000
+        with mock.patch.object(BlobWriter, 'close', autospec=True, side_effect=BlobWriter.close) as close:
+            first = self._upload(content)
+            second = self._upload(content, name='copy.txt')
+
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(close.call_count, 1)
+        self.assertEqual(File.objects.get(pk=second.data['id']).file.name, File.objects.get(pk=first.data['id']).file.name)
+        self.assertEqual(len(self._blobs()), 1)
+
+    def test_upload_over_quota_leaves_nothing_behind(self):
+        self.user.storage_quota = 1024
+        self.user.save(update_fields=['storage_quota'])
+
+        response = self._upload(os.urandom(64 * 1024))
+
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertFalse(File.objects.exists())
+        self.assertEqual(self._blobs(), [])
+
+
+class SignedDownloadTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        self.content = b'signed contents\n' * 1000
+        self.file = store_upload(self.user, self.content, 'signed.txt', 'text/plain')
+
+    def _get(self, token):
+        response = self.client.get(f'/api/files/signed/{token}/')
+        if not response.streaming:
+            return response.status_code, response.content
+
+        async def consume():
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        return response.status_code, async_to_sync(consume)()
+
+    def test_link_downloads_the_file(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+
+        self.assertEqual(self._get(token), (200, self.content))
+
+    def test_link_carries_no_key_material(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+
+        payload = json.loads(signed_urls._get_fernet().decrypt(token.encode()))
+
+        self.assertEqual(set(payload), {'id', 'kv', 'exp'})
+
+    def test_expired_link_is_refused(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(self._get(token)[0], 410)
+
+    def test_tampered_link_is_refused(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+        tampered = token[:40] + ('A' if token[40] != 'A' else 'B') + token[41:]
+
+        self.assertEqual(self._get(tampered)[0], 403)
+
+    def test_link_stops_working_when_the_key_is_rotated(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+        self.user.set_raw_key('erin-new-key')
+        self.user.save()
+
+        self.assertEqual(self._get(token)[0], 403)
+
+    def test_link_to_a_deleted_file_is_not_found(self):
+        token, _ = signed_urls.issue(self.file, self.user)
+        delete_file(self.file)
+
+        self.assertEqual(self._get(token)[0], 404)
+
+
+@override_settings(PREVIEWS_ENABLED=True, PREVIEW_QUEUE_BYTES=20 * 1024)
+class PreviewQueueTests(TestCase):
+
+    def setUp(self):
+        self.executor = mock.Mock()
+        patcher = mock.patch.object(previews, '_get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, previews, '_queued_bytes', 0)
+
+    def _schedule(self, content, filename):
+        with self.captureOnCommitCallbacks(execute=True):
+            previews.schedule('f' * 64, content, filename, None)
+        return [call.args[2] for call in self.executor.submit.call_args_list]
+
+    def test_queue_is_bounded_by_bytes(self):
+        self._schedule(b'\x00' * 12 * 1024, 'a.png')
+        queued = self._schedule(b'\x00' * 12 * 1024, 'b.png')  # Would exceed 20 KiB
+
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(previews._queued_bytes, 12 * 1024)
+
+    def test_text_jobs_only_keep_what_is_rendered(self):
+        [content] = self._schedule(b'line\n' * 100000, 'notes.txt')
+
+        self.assertEqual(len(content), previews.TEXT_PREVIEW_BYTES)
+
+
+class DeltaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.base = random.Random(41).randbytes(1024 * 1024)
+
+    def _round_trip(self, base, target):
+        self.assertEqual(delta.apply(base, delta.encode(base, target)), target)
+
+    def test_round_trips(self):
+        edited = self.base[:50000] + b'inserted' * 100 + self.base[50000:150000] + self.base[160000:]
+        for base, target in ((self.base, edited), (edited, self.base), (b'', self.base), (self.base, b''),
+                             (b'', b''), (self.base, self.base), (self.base, os.urandom(1000))):
+            with self.subTest(base=len(base), target=len(target)):
+                self._round_trip(base, target)
+
+    def test_small_edit_gives_a_small_delta(self):
+        edited = self.base[:500000] + b'x' + self.base[500000:]
+
+        self.assertLess(len(delta.encode(self.base, edited)), 2 * delta.MAX_CHUNK)  # The chunks around the edit
+
+    def test_corrupt_deltas_are_rejected(self):
+        good = delta.encode(self.base, self.base[:1000] + b'new' + self.base[1000:])
+        corrupt = {
+            'bad magic': b'XXXX' + good[4:],
+            'truncated header': good[:5],
+            'truncated literal': good[:-1],
+            'unknown operation': good + b'Z',
+            'copy past the base': good[:-3] + b'C' + delta._varint(len(self.base)) + delta._varint(1),
+            'wrong length': delta.MAGIC + delta._varint(len(self.base)) + delta._varint(5) + b'L\x01a',
+        }
+        for what, data in corrupt.items():
+            with self.subTest(corruption=what):
+                with self.assertRaises(delta.DeltaError):
+                    delta.apply(self.base, data)
+        with self.assertRaises(delta.DeltaError):
+            delta.apply(self.base[:-1], good)  # A different base
+
+
+class FileVersionTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        base = os.urandom(100 * 1024)
+        self.contents = [base[:i * 1000] + f'edit {i}'.encode() + base[i * 1000:] for i in range(5)]
+        self.file = store_upload(self.user, self.contents[0], 'report.bin', 'application/octet-stream')
+        for content in self.contents[1:]:
+            self.file = versions.add_version(self.user, File.objects.get(pk=self.file.pk), content)
+
+    def _read_all(self):
+        return [versions.read(version, self.user) for version in self.file.versions.order_by('number')]
+
+    def test_every_version_is_rebuilt_through_the_chain(self):
+        self.assertEqual(set(self.file.versions.values_list('kind', flat=True)), {FileVersion.DELTA})
+        self.assertEqual(self._read_all(), self.contents[:-1])
+        self.assertEqual(versions.current_content(self.file, self.user), self.contents[-1])
+
+    def test_rebased_versions_read_the_same(self):
+        self.assertEqual(versions.rebase(self.file, limit=1), 2)
+
+        self.assertEqual(versions.chain_depth(list(self.file.versions.order_by('-number'))), 1)
+        self.assertEqual(self._read_all(), self.contents[:-1])
+
+    def test_rebuilt_content_must_match_the_version_hash(self):
+        version = self.file.versions.get(number=1)
+        FileVersion.objects.filter(pk=version.pk).update(file_hash='0' * 64)
+        version.refresh_from_db()
+
+        with self.assertRaises(FileServiceError) as raised:
+            versions.read(version, self.user)
+        self.assertEqual(raised.exception.status_code, 500)
+
+    def test_oversized_version_upload_is_not_read(self):
+        upload = mock.Mock(size=versions.MAX_FILE_SIZE + 1)
+
+        with self.assertRaises(FileServiceError):
+            versions.add_uploaded_version(self.user, self.file, upload)
+        upload.read.assert_not_called()
+
+
+class TieringTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cold_root = tempfile.mkdtemp(prefix='vault-cold-test-')
+        self.addCleanup(shutil.rmtree, self.cold_root, ignore_errors=True)
+        cold = override_settings(STORAGE_COLD_TIER='local', STORAGE_COLD_TIER_ROOT=self.cold_root, TIER_MIN_SIZE=0)
+        cold.enable()
+        self.addCleanup(cold.disable)
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        self.content = os.urandom(300 * 1024)
+        self.file = store_upload(self.user, self.content, 'archive.bin', 'application/octet-stream')
+        File.objects.filter(pk=self.file.pk).update(uploaded_at=timezone.now() - timedelta(days=90))
+        self.name = self.file.file.name
+
+    def _on(self, root):
+        return os.path.exists(os.path.join(root, self.name))
+
+    def _tier_blobs(self):
+        out = io.StringIO()
+        call_command('tier_blobs', '--rate-mb', '0', stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_idle_blob_moves_to_the_cold_tier(self):
+        self.assertIn('1 moved to cold', self._tier_blobs())
+
+        self.assertEqual((self._on(settings.MEDIA_ROOT), self._on(self.cold_root)), (False, True))
+        self.assertEqual(BlobTier.objects.get(name=self.name).tier, BlobTier.COLD)
+        self.assertEqual(list(tiering.demotion_candidates()), [])
+
+    def test_moved_blob_is_still_read(self):
+        with open_blob(self.name) as f:
+            stored = f.read()
+        self._tier_blobs()
+        storage_tiers.placements.clear()  # As in another process
+
+        with open_blob(self.name) as f:
+            self.assertEqual(f.read(), stored)
+        self.assertEqual(versions.current_content(self.file, self.user), self.content)
+
+    def test_deleting_a_file_deletes_its_cold_blob_and_prune_drops_the_row(self):
+        self._tier_blobs()
+
+        delete_file(self.file)
+
+        self.assertFalse(self._on(self.cold_root))
+        self.assertEqual(tiering.prune(), 1)
+        self.assertFalse(BlobTier.objects.exists())
+
+    def test_blob_downloaded_again_comes_back(self):
+        self._tier_blobs()
+        File.objects.filter(pk=self.file.pk).update(last_accessed=timezone.now())
+
+        self.assertIn('1 moved to hot', self._tier_blobs())
+        self.assertEqual((self._on(settings.MEDIA_ROOT), self._on(self.cold_root)), (True, False))
+        self.assertFalse(BlobTier.objects.exists())
+
+
+class ReplicationTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.replica_root = tempfile.mkdtemp(prefix='vault-replica-test-')
+        self.addCleanup(shutil.rmtree, self.replica_root, ignore_errors=True)
+        replicas = override_settings(STORAGE_REPLICAS=f'a=local:{self.replica_root}')
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        self.user.set_raw_key('erin-key')
+        self.user.save()
+        self.content = os.urandom(100 * 1024)
+        self.file = store_upload(self.user, self.content, 'data.bin', 'application/octet-stream')
+        self.name = self.file.file.name
+
+    def _path(self, root):
+        return os.path.join(root, self.name)
+
+    def _task(self):
+        return ReplicationTask.objects.get(name=self.name)
+
+    def test_changes_before_replication_are_coalesced(self):
+        outbox.enqueue(self.name, outbox.PUT)  # Rewritten
+        self.assertEqual(self._task().op, outbox.PUT)
+
+        delete_file(self.file)
+
+        self.assertEqual(ReplicationTask.objects.filter(name=self.name).count(), 1)
+        self.assertEqual(self._task().op, outbox.DELETE)
+        self.assertEqual(replication.run(10)['applied'], 1)
+        self.assertFalse(os.path.exists(self._path(self.replica_root)))
+
+    def test_replicated_blob_leaves_the_queue(self):
+        self.assertEqual(replication.run(10), {'applied': 1, 'requeued': 0, 'failed': 0})
+
+        with open(self._path(settings.MEDIA_ROOT), 'rb') as primary, open(self._path(self.replica_root), 'rb') as copy:
+            self.assertEqual(copy.read(), primary.read())
+        self.assertFalse(ReplicationTask.objects.exists())
+
+    def test_change_while_applied_is_due_again(self):
+        [task] = outbox.claim(10, ['a'])
+        with mock.patch('files.outbox.timezone.now', return_value=timezone.now() + timedelta(seconds=1)):
+            outbox.enqueue(self.name, outbox.PUT)
+
+        self.assertFalse(outbox.complete(task))
+        self.assertLessEqual(self._task().next_attempt_at, timezone.now())
+        [again] = outbox.claim(10, ['a'])
+        self.assertTrue(outbox.complete(again))
+        self.assertFalse(ReplicationTask.objects.exists())
+
+    @override_settings(REPLICATION_RETRY_MAX_SECONDS=30)
+    def test_failures_back_off_up_to_the_cap(self):
+        delays = []
+        for _ in range(3):
+            ReplicationTask.objects.update(next_attempt_at=timezone.now())
+            [task] = outbox.claim(10, ['a'])
+            outbox.fail(task, OSError('replica unreachable'))
+            delays.append(round((self._task().next_attempt_at - timezone.now()).total_seconds()))
+
+        self.assertEqual(delays, [10, 20, 30])
+        self.assertEqual((self._task().attempts, self._task().last_error), (3, 'replica unreachable'))
+        self.assertEqual(outbox.claim(10, ['a']), [])
+
+    def test_check_queues_restores_or_reports_lost(self):
+        replication.run(10)
+        self.assertEqual(replication.check(self.name, verify=True), replication.OK)
+
+        os.remove(self._path(self.replica_root))
+        self.assertEqual(replication.check(self.name, verify=True), replication.QUEUED)
+        self.assertEqual(self._task().op, outbox.PUT)
+        replication.run(10)
+
+        with open(self._path(settings.MEDIA_ROOT), 'r+b') as f:
+            f.write(b'\0' * 16)  # Same size: only --verify notices
+        self.assertEqual(replication.check(self.name), replication.OK)
+        self.assertEqual(replication.check(self.name, verify=True), replication.RESTORED)
+        self.assertEqual(versions.current_content(self.file, self.user), self.content)
+        self.assertEqual(replication.check(self.name, verify=True), replication.OK)
+
+        os.remove(self._path(settings.MEDIA_ROOT))
+        os.remove(self._path(self.replica_root))
+        self.assertEqual(replication.check(self.name), replication.LOST)
+        self.assertEqual(integrity.get_index(self.name).status, BlobIntegrity.MISSING)
+
+    def test_missing_primary_copy_is_read_from_a_replica(self):
+        replication.run(10)
+        os.remove(self._path(settings.MEDIA_ROOT))
+        blobs.metadata_cache.forget(self.name)
+
+        self.assertEqual(versions.current_content(self.file, self.user), self.content)
+        self.assertGreaterEqual(metrics.snapshot()['counters'].get('replication.failover{reason=missing}', 0), 1)
+        with self.assertRaises(blobs.BlobNotFound):
+            open_blob(self.name, failover=False)
+
+    @override_settings(STORAGE_REPLICA_HEDGE_MS=20)
+    def test_slow_primary_read_is_hedged_to_a_replica(self):
+        replication.run(10)
+        with open(self._path(self.replica_root), 'rb') as f:
+            stored = f.read()
+        slow_reads = []
+        open_tiers = blobs._open_tiers
+
+        def slow_primary(name, use_cache):
+            slow_reads.append(name)
+            time.sleep(0.5)
+            return open_tiers(name, use_cache)
+
+        slow = metrics.snapshot()['counters'].get('replication.failover{reason=slow}', 0)
+        with mock.patch.object(blobs, '_open_tiers', slow_primary):
+            with open_blob(self.name) as f:
+                self.assertEqual(f.read(), stored)
+
+        self.assertEqual(slow_reads, [self.name])
+        self.assertEqual(metrics.snapshot()['counters'].get('replication.failover{reason=slow}', 0), slow + 1)
+
+    def test_corrupt_primary_copy_is_not_replicated(self):
+        with open(self._path(settings.MEDIA_ROOT), 'r+b') as f:
+            f.write(b'\0' * 16)
+
+        self.assertEqual(replication.run(10)['failed'], 1)
+
+        self.assertFalse(os.path.exists(self._path(self.replica_root)))
+        self.assertEqual(self._task().attempts, 1)
+
+
+class ConditionalRequestTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.file = store_upload(self.user, b'conditional\n' * 100, 'c.txt', 'text/plain')
+
+    def _download(self, **headers):
+        return self.client.get(f'/api/files/{self.file.pk}/download/', headers=headers)
+
+    def test_download_answers_304_to_its_etag(self):
+        etag = self._download()['ETag']
+
+        self.assertEqual(self._download(if_none_match=etag).status_code, 304)
+        self.assertEqual(self._download(if_none_match='"other"').status_code, 200)
+
+    def test_download_answers_304_when_not_modified_since(self):
+        last_modified = self._download()['Last-Modified']
+
+        self.assertEqual(self._download(if_modified_since=last_modified).status_code, 304)
+        self.assertEqual(self._download(if_modified_since='Mon, 01 Jan 2001 00:00:00 GMT').status_code, 200)
+
+    def test_listing_answers_304_until_it_changes(self):
+        etag = self.client.get('/api/files/')['ETag']
+
+        with self.assertNumQueries(1):  # Only the validator's aggregate
+            self.assertEqual(self.client.get('/api/files/', headers={'if_none_match': etag}).status_code, 304)
+        store_upload(self.user, b'another', 'd.txt', 'text/plain')
+        self.assertEqual(self.client.get('/api/files/', headers={'if_none_match': etag}).status_code, 200)
+
+    def test_listing_changes_with_flushed_downloads(self):
+        etag = self.client.get('/api/files/')['ETag']
+        self._download()
+        access.flush()
+
+        self.assertEqual(self.client.get('/api/files/', headers={'if_none_match': etag}).status_code, 200)
+
+    def test_listing_ignores_if_modified_since(self):
+        # A deletion cannot advance a Last-Modified, so the listing only has an ETag
+        response = self.client.get('/api/files/')
+        self.assertNotIn('Last-Modified', response)
+
+        later = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        self.assertEqual(self.client.get('/api/files/', headers={'if_modified_since': later}).status_code, 200)
+
+
+class StorageStatTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches[settings.STORAGE_STATS_CACHE_ALIAS].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _counters(self):
+        return {
+            (row.dimension, row.bucket): (row.count, row.bytes)
+            for row in StorageStat.objects.filter(owner=self.user) if row.count or row.bytes
+        }
+
+    def test_counters_follow_uploads_references_and_deletes(self):
+        month = stats.month_bucket(timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            notes = store_upload(self.user, b'notes\n' * 100, 'notes.txt', 'text/plain')
+            copy = store_upload(self.user, b'notes\n' * 100, 'copy.txt', 'text/plain')  # A reference
+            photo = store_upload(self.user, os.urandom(2000), 'photo.png', 'image/png')
+        self.assertEqual(copy.file.name, notes.file.name)
+        text, image = notes.size, photo.size
+
+        self.assertEqual(self._counters(), {
+            (StorageStat.TOTAL, ''): (3, 2 * text + image),
+            (StorageStat.PHYSICAL, ''): (2, text + image),
+            (StorageStat.TYPE, 'text'): (2, 2 * text),
+            (StorageStat.TYPE, 'image'): (1, image),
+            (StorageStat.MONTH, month): (3, 2 * text + image),
+        })
+        summary = self.client.get('/api/auth/storage/stats/').json()
+        self.assertEqual(summary['dedup_savings'], text)
+        self.assertEqual([row['original_filename'] for row in summary['largest_files']][0], 'photo.png')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_file(notes)  # The reference still holds the content
+        self.assertEqual(self._counters()[StorageStat.PHYSICAL, ''], (2, text + image))
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_file(copy)
+        self.assertEqual(self._counters()[StorageStat.PHYSICAL, ''], (1, image))
+        self.assertEqual(self._counters()[StorageStat.TOTAL, ''], (1, image))
+        self.assertEqual(self.client.get('/api/auth/storage/stats/').json()['files'], {'count': 1, 'bytes': image})
+        self.assertEqual(stats.rebuild(self.user.pk), 0)  # Nothing drifted
+
+    def test_rebuild_repairs_drift(self):
+        store_upload(self.user, b'drift', 'drift.txt', 'text/plain')
+        StorageStat.objects.filter(owner=self.user, dimension=StorageStat.TOTAL).update(count=7)
+
+        self.assertEqual(stats.rebuild(self.user.pk), 1)
+        self.assertEqual(self._counters()[StorageStat.TOTAL, ''][0], 1)
+
+
+class DownloadCounterTests(TempMediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.file = store_upload(self.user, b'counted', 'counted.txt', 'text/plain')
+
+    def test_downloads_are_written_by_a_flush(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get(f'/api/files/{self.file.pk}/download/').status_code, 200)
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.download_count, self.file.last_accessed), (0, None))
+
+        self.assertEqual(access.flush(), 1)
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.download_count, 3)
+        self.assertIsNotNone(self.file.last_accessed)
+
+    def test_exit_hook_does_nothing_when_nothing_is_pending(self):
+        access.flush()
+
+        with mock.patch.object(access, 'flush') as flush:
+            access._flush_at_exit()
+        flush.assert_not_called()
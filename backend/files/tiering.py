@@ -0,0 +1,212 @@
+"""
+Hot/cold tiering of blobs.
+
+files/storage_tiers.py gives the blob layer a cold tier next to the hot one;
+this module decides what belongs where and moves it. The tier_blobs command
+runs the policy in rate-limited batches:
+
+  demote   a blob goes cold once none of its File rows has been downloaded
+           (File.last_accessed, see files/access.py) or uploaded for
+           TIER_COLD_AFTER_DAYS, and it is at least TIER_MIN_SIZE stored
+           bytes. Blobs of earlier versions go cold that long after their
+           content was uploaded. Largest first, as they free the most hot
+           space per move.
+  promote  a cold blob comes back once one of its File rows is downloaded
+           or referenced again, within TIER_PROMOTE_WITHIN_HOURS.
+
+Small blobs stay hot: they take little space, and a cold read costs a
+round trip (or a disk seek) however small the blob is.
+
+A move copies the blob to the other tier, checking the source against its
+integrity index (files/integrity.py) as it is read. It then reads the copy
+back against the index as it is at that point, records the new tier and
+deletes the source. Only indexed blobs are moved (scrub_blobs --adopt
+indexes old ones), so corruption at rest is reported instead of copied. A
+blob rewritten during its move (key rotation) no longer matches the index
+it was copied with; the copy is dropped and the move retried next pass.
+BlobTier has a row for each blob that is not on the hot tier. An
+interrupted move leaves at most a spare copy, which reads never see as
+long as the recorded tier holds the blob too.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core import metrics
+
+from . import integrity, storage_tiers
+from .blobs import BlobNotFound, BlobWriter, delete_blob, locate_blob, open_blob
+from .models import BlobIntegrity, BlobTier, File, FileVersion
+
+logger = logging.getLogger(__name__)
+
+MOVED = 'moved'
+SKIPPED = 'skipped'  # Changed or deleted during the move; tried again next pass
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+
+
+def cold_after():
+    return timedelta(days=getattr(settings, 'TIER_COLD_AFTER_DAYS', 30))
+
+
+def min_size():
+    return getattr(settings, 'TIER_MIN_SIZE', 1024 * 1024)
+
+
+def promote_within():
+    return timedelta(hours=getattr(settings, 'TIER_PROMOTE_WITHIN_HOURS', 24))
+
+
+def _last_used():
+    # Rows never downloaded count from their upload (a new dedup reference included)
+    return Coalesce('last_accessed', 'uploaded_at')
+
+
+def demotion_candidates(now=None):
+    """(name, stored size) of hot blobs due for the cold tier: File blobs largest first, then version blobs."""
+    cutoff = (now or timezone.now()) - cold_after()
+    moved = BlobTier.objects.values('name')
+    indexed = BlobIntegrity.objects.filter(status=BlobIntegrity.OK).values('name')
+    files = (
+        File.objects.exclude(file='').exclude(file__in=moved).filter(file__in=indexed)
+        .values('file').annotate(used=Max(_last_used()), stored=Max('size'))
+        .filter(used__lt=cutoff, stored__gte=min_size()).order_by('-stored')
+    )
+    for row in files.iterator(chunk_size=500):
+        yield row['file'], row['stored']
+    history = (
+        FileVersion.objects.exclude(storage_name__in=moved).filter(storage_name__in=indexed)
+        .exclude(storage_name__in=File.objects.values('file'))
+        .values('storage_name').annotate(used=Max('created_at'), stored=Max('size'))
+        .filter(used__lt=cutoff, stored__gte=min_size()).order_by('-stored')
+    )
+    for row in history.iterator(chunk_size=500):
+        yield row['storage_name'], row['stored']
+
+
+def promotion_candidates(now=None):
+    """(name, stored size) of cold blobs used again since they were moved, most recently moved first."""
+    since = (now or timezone.now()) - promote_within()
+    used_again = File.objects.filter(file=OuterRef('name')).annotate(used=_last_used()).filter(
+        used__gt=OuterRef('moved_at'), used__gte=since
+    )
+    cold = BlobTier.objects.exclude(tier=BlobTier.HOT).filter(Exists(used_again)).order_by('-moved_at')
+    for name, size in cold.values_list('name', 'size').iterator(chunk_size=500):
+        yield name, size
+
+
+def _referenced(name):
+    return File.objects.filter(file=name).exists() or FileVersion.objects.filter(storage_name=name).exists()
+
+
+def _copy(name, index, source, target, throttle):
+    """Copy the blob from `source` to `target`, verifying it on the way; raises IntegrityFailure."""
+    writer = BlobWriter(name, tier=target)
+    verifier = integrity.ChunkVerifier(index)
+    try:
+        with open_blob(name, use_cache=False, tier=source) as f:
+            for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+                writer.write(verifier.update(data))
+                if throttle:
+                    throttle(len(data))
+        writer.write(verifier.finalize())
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def _verify_copy(name, index, tier, throttle):
+    verifier = integrity.ChunkVerifier(index)
+    with open_blob(name, use_cache=False, tier=tier) as f:
+        for data in iter(lambda: f.read(integrity.READ_CHUNK_SIZE), b''):
+            verifier.update(data)
+            if throttle:
+                throttle(len(data))
+    verifier.finalize()
+
+
+def _record(name, tier, size):
+    if tier.name == BlobTier.HOT:
+        BlobTier.objects.filter(name=name).delete()
+    else:
+        BlobTier.objects.update_or_create(
+            name=name, defaults={'tier': tier.name, 'size': size, 'moved_at': timezone.now()}
+        )
+
+
+def move(name, target, throttle=None):
+    """
+    Move a blob to the `target` tier (a storage_tiers.Tier); returns MOVED,
+    SKIPPED, CORRUPT or MISSING. `throttle(nbytes)` is called after every
+    read so the caller can rate limit.
+    """
+    index = integrity.get_index(name)
+    if index is None:
+        return SKIPPED
+    source = locate_blob(name)
+    if source is None:
+        integrity.report(index, BlobIntegrity.MISSING, 'blob is missing from storage')
+        return MISSING
+    copied = source.name != target.name  # Else an earlier move got as far as the copy
+    if copied:
+        try:
+            _copy(name, index, source, target, throttle)
+        except BlobNotFound:
+            return SKIPPED  # Deleted meanwhile
+        except integrity.IntegrityFailure as e:
+            current = integrity.get_index(name)
+            if current is None or current.root != index.root:
+                return SKIPPED  # Rewritten while it was read
+            integrity.report(index, BlobIntegrity.CORRUPT, e.detail)
+            return CORRUPT
+
+    # The copy must match the index as it is now, or the blob changed meanwhile
+    current = integrity.get_index(name)
+    try:
+        if current is None or current.root != index.root or not _referenced(name):
+            raise integrity.IntegrityFailure(name, 'changed during the move')
+        _verify_copy(name, current, target, throttle)
+    except (integrity.IntegrityFailure, BlobNotFound) as e:
+        if copied:
+            delete_blob(name, tier=target)
+        logger.warning(f"Not moving blob {name} to the {target.name} tier: {e}")
+        metrics.incr('tiering.moves', tier=target.name, result=SKIPPED)
+        return SKIPPED
+
+    with transaction.atomic():
+        _record(name, target, current.size)
+    storage_tiers.found(name, target)
+    for tier in storage_tiers.tiers():
+        if tier is not target:
+            delete_blob(name, tier=tier)
+    metrics.incr('tiering.moves', tier=target.name, result=MOVED)
+    metrics.incr('tiering.bytes', current.size, tier=target.name)
+    return MOVED
+
+
+def prune():
+    """Delete blobs off the hot tier that nothing refers to any more (and their rows); returns how many."""
+    stale = BlobTier.objects.exclude(
+        Q(name__in=File.objects.values('file')) | Q(name__in=FileVersion.objects.values('storage_name'))
+    )
+    pruned = 0
+    for row in stale.iterator(chunk_size=500):
+        delete_blob(row.name)
+        row.delete()
+        pruned += 1
+    return pruned
+
+
+def summary():
+    """{tier: {'count', 'bytes'}} of the blobs recorded off the hot tier."""
+    return {
+        row['tier']: {'count': row['count'], 'bytes': row['bytes'] or 0}
+        for row in BlobTier.objects.values('tier').annotate(count=Count('id'), bytes=Sum('size')).order_by()
+    }
@@ -0,0 +1,238 @@
+"""
+Uploads stored while the request body is parsed.
+
+With Django's default upload handlers a file upload is written to a temp
+file (or held in memory) by the multipart parser, then read back in full by
+the view to be hashed, compressed, encrypted and sent to storage: every
+byte crosses local disk twice before it reaches MinIO, and the view holds
+the whole plaintext in memory. StreamingUploadHandler instead takes the
+`file` field's chunks as the parser produces them and, in one pass:
+
+  * hashes the plaintext (SHA-256 for dedup, the possession Merkle tree),
+  * compresses and encrypts it (services.BlobEncoder),
+  * indexes the stored bytes for integrity checks,
+  * and writes them to their final blob (blobs.BlobWriter).
+
+What the view gets in request.FILES['file'] is a StoredUpload: the blob is
+already written and the upload carries everything needed to record it
+(store()). Its content is not kept; only image and text uploads small enough
+for previews (PREVIEW_MAX_SOURCE_BYTES) are held back for rendering.
+
+Content that is already stored (a dedup hit) is recognised once its hash
+is final, before the blob is committed: the blob is dropped unfinished
+(a temp file, or on S3 no PUT at all, or an aborted multipart upload for
+files over S3_UPLOAD_PART_SIZE) and the upload becomes a reference.
+
+The size and quota limits are checked as bytes arrive, so an oversized
+upload stops being written at the limit. A blob that is not recorded (error,
+rejected request) is deleted again by discard().
+
+UPLOAD_STREAMING=False restores the default handlers.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from . import integrity, possession, previews
+from .blobs import BlobWriter, delete_blob
+from .compression import choose_compression
+from .services import (
+    BlobEncoder, FileServiceError, add_file_reference, backfill_merkle_root, check_upload_allowed,
+    create_file_record, find_duplicate, new_storage_name, store_upload,
+)
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FIELD = 'file'
+
+
+def enabled():
+    return getattr(settings, 'UPLOAD_STREAMING', True)
+
+
+class StoredUpload(UploadedFile):
+    """An upload whose content StreamingUploadHandler has already written to storage (unless it was a dedup hit)."""
+
+    def __init__(self, name, content_type, size, charset=None, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.file_hash = None
+        self.merkle_root = None
+        self.stored_name = None
+        self.stored_size = 0
+        self.encoded = None  # BlobEncoder.params
+        self.integrity_index = None
+        self.preview_content = None
+        self.error = None  # FileServiceError that ended the upload
+
+    def discard(self):
+        """Delete the blob again, if one was written."""
+        if self.stored_name:
+            delete_blob(self.stored_name)
+            self.stored_name = None
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """Hashes, encodes and stores the `file` field of a multipart upload as it is parsed."""
+
+    def __init__(self, request, user):
+        super().__init__(request)
+        self.user = user
+        self.upload = None
+        self._receiving = False  # Between new_file() and file_complete() of the field we handle
+        self._writer = None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        if field_name != UPLOAD_FIELD or self.upload is not None:
+            return  # Left to the default handlers
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.upload = StoredUpload(file_name, content_type, 0, charset, content_type_extra)
+        self._receiving = True
+        self._sha256 = hashlib.sha256()
+        self._tree = integrity.IndexBuilder(possession.CHUNK_SIZE)
+        self._index = integrity.IndexBuilder()
+        self._encoder = None
+        # Whether to compress depends on the size, so the first bytes wait until that is clear
+        self._pending = bytearray()
+        keep_preview = previews.enabled() and previews.renderer_for(file_name, content_type) is not None
+        self._preview = bytearray() if keep_preview else None
+        raise StopFutureHandlers()
+
+    def _start(self):
+        compression = choose_compression(self.upload.name, self.upload.content_type, len(self._pending))
+        self._encoder = BlobEncoder(self.user, compression)
+        self._writer = BlobWriter(new_storage_name(self._encoder.params['is_encrypted']))
+        self._store(self._encoder.update(bytes(self._pending)))
+        self._pending = None
+
+    def _store(self, stored):
+        if stored:
+            self._index.update(stored)
+            self._writer.write(stored)
+
+    def _fail(self, error):
+        self.upload.error = error
+        self._preview = None
+        if self._writer is not None:
+            self._writer.abort()
+
+    def _storage_failed(self, e):
+        logger.error(f"Failed to save file to storage: {e}", exc_info=True)
+        self._fail(FileServiceError('Failed to save file to storage.', status_code=500))
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self._receiving:
+            return raw_data
+        if self.upload.error is not None:
+            return None  # The rest of the field is read and dropped
+        self.upload.size += len(raw_data)
+        try:
+            check_upload_allowed(self.user, self.upload.size)
+            self._sha256.update(raw_data)
+            self._tree.update(raw_data)
+            if self._preview is not None:
+                self._preview += raw_data
+                if len(self._preview) > getattr(settings, 'PREVIEW_MAX_SOURCE_BYTES', 25 * 1024 * 1024):
+                    self._preview = None
+            if self._encoder is not None:
+                self._store(self._encoder.update(raw_data))
+            else:
+                self._pending += raw_data
+                if len(self._pending) >= getattr(settings, 'FILE_COMPRESSION_MIN_SIZE', 1024):
+                    self._start()
+        except FileServiceError as e:
+            self._fail(e)
+        except Exception as e:
+            self._storage_failed(e)
+        return None
+
+    def file_complete(self, file_size):
+        if not self._receiving:
+            return None
+        self._receiving = False  # A second `file` field goes to the default handlers
+        upload = self.upload
+        if upload.error is not None:
+            return upload
+        upload.file_hash = self._sha256.hexdigest()
+        upload.merkle_root = self._tree.finish()['root']
+        try:
+            if find_duplicate(upload.file_hash):  # store() only needs a reference
+                if self._writer is not None:
+                    self._writer.abort()
+                return upload
+            if self._encoder is None:  # Smaller than the compression threshold
+                self._start()
+            self._store(self._encoder.finalize())
+            upload.stored_name = self._writer.close()
+        except Exception as e:
+            self._storage_failed(e)
+            return upload
+        upload.integrity_index = self._index.finish()
+        upload.stored_size = upload.integrity_index['size']
+        upload.encoded = self._encoder.params
+        upload.preview_content = bytes(self._preview) if self._preview is not None else None
+        return upload
+
+    def upload_interrupted(self):
+        if self._receiving and self._writer is not None:
+            self._writer.abort()
+
+
+def install(request, user):
+    """
+    Have `request`'s upload parsed by StreamingUploadHandler (a Django or
+    DRF request, before its data or files are first accessed).
+    """
+    if enabled():
+        django_request = getattr(request, '_request', request)
+        django_request.upload_handlers.insert(0, StreamingUploadHandler(django_request, user))
+
+
+def store(user, upload, request_meta=None, folder=None):
+    """Record a StoredUpload as the user's File, or as a reference to identical content; returns the File."""
+    if upload.error is not None:
+        raise upload.error
+    try:
+        check_upload_allowed(user, upload.size)
+        existing_file = find_duplicate(upload.file_hash)
+        if existing_file:
+            upload.discard()
+            backfill_merkle_root(existing_file, root=upload.merkle_root, original_size=upload.size)
+            return add_file_reference(
+                user, existing_file, upload.name, upload.content_type, request_meta=request_meta, folder=folder
+            )
+        if upload.stored_name is None:  # A dedup hit while parsed whose content has been deleted since
+            raise FileServiceError('Identical content was deleted during the upload; please retry.', status_code=409)
+        integrity.record(upload.stored_name, index=upload.integrity_index)
+        file_instance = create_file_record(
+            user, upload.stored_name, upload.name, upload.content_type, upload.stored_size, upload.size,
+            upload.file_hash, upload.encoded, request_meta, root=upload.merkle_root, folder=folder
+        )
+    except Exception:
+        if upload.stored_name:
+            integrity.forget(upload.stored_name)
+            upload.discard()
+        raise
+    if upload.preview_content is not None:
+        previews.schedule(upload.file_hash, upload.preview_content, upload.name, upload.content_type)
+    return file_instance
+
+
+def store_uploaded_file(user, uploaded_file, request_meta=None, folder=None):
+    """store() for StoredUploads, the classic read-and-store path for any other UploadedFile."""
+    if isinstance(uploaded_file, StoredUpload):
+        return store(user, uploaded_file, request_meta, folder)
+    # Reject oversized uploads before reading them into memory
+    check_upload_allowed(user, uploaded_file.size)
+    return store_upload(
+        user, uploaded_file.read(), uploaded_file.name, uploaded_file.content_type,
+        request_meta=request_meta, folder=folder
+    )
+
+
+def discard(uploaded_file):
+    """Drop an upload that will not be stored (e.g. the request turned out invalid)."""
+    if isinstance(uploaded_file, StoredUpload):
+        uploaded_file.discard()
@@ -1,12 +1,22 @@
 from django.urls import path
-from rest_framework.routers import DefaultRouter
-from .views import FileViewSet, check_file_hash, create_file_reference
+from rest_framework.routers import DefaultRouter, SimpleRouter
+from .views import FileViewSet, FolderViewSet, check_file_hash, create_file_reference, possession_challenge
+from . import async_views
 import os
 
 router = DefaultRouter()
 router.register(r'', FileViewSet, basename='file')
 
+# Registered apart so the file routes' <pk> pattern does not shadow 'folders/';
+# a SimpleRouter, as a second API root view would shadow the file list
+folder_router = SimpleRouter()
+folder_router.register(r'folders', FolderViewSet, basename='folder')
+
 urlpatterns = [
     path('check_hash/', check_file_hash, name='check_file_hash'),
     path('reference/', create_file_reference, name='create_file_reference'),
-] + router.urls
\ No newline at end of file
+    path('reference/challenge/', possession_challenge, name='possession_challenge'),
+    path('async/upload/', async_views.upload, name='async_file_upload'),
+    path('async/<uuid:pk>/download/', async_views.download, name='async_file_download'),
+    path('signed/<str:token>/', async_views.signed_download, name='signed_file_download'),
+] + folder_router.urls + router.urls
\ No newline at end of file
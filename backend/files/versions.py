@@ -0,0 +1,282 @@
+"""
+File versions.
+
+Uploading a new version of a File keeps the File row (id, name, access log)
+and moves the previous content into a FileVersion. The current content is
+always a normal full blob, so downloads, signed links, previews and
+dedup references do not know about versions at all. Earlier versions are
+stored as reverse deltas (files/delta.py): version n holds what it takes to
+rebuild it from version n+1 (or from the current content), compressed and
+encrypted with the owner's key like any other blob. Only changed chunks
+take space, and that is what counts against the owner's quota.
+
+A delta that would not save much (over VERSION_DELTA_MAX_RATIO of the full
+stored size) is not used; the version is kept in full instead, reusing the
+previous blob where no other File row shares it.
+
+Reading version n applies the deltas from the nearest full content above
+it, so reads get slower as history grows. The rebase_versions command,
+meant to run periodically, rewrites every version more than
+VERSION_MAX_CHAIN deltas away from full content as a full snapshot, which
+bounds that cost.
+
+Listing history only reads FileVersion rows.
+
+Adding a version holds the previous and the new plaintext in memory at
+once (the delta is computed between them), so a new version is limited to
+MAX_FILE_SIZE and a request can use up to twice that. Version uploads are
+therefore not stored by the streaming upload handler (files/uploads.py);
+they arrive through Django's default handlers, which spool large bodies to
+a temp file, and add_uploaded_version checks the size before reading it.
+"""
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import delta, folders, integrity, previews, stats
+from .blobs import BlobNotFound, delete_blob, read_blob
+from .ciphers import get_engine
+from .compression import ZLIB
+from .models import File, FileVersion
+from .possession import merkle_root
+from .services import (
+    MAX_FILE_SIZE, FileServiceError, cipher_name, decode_content, encode_content, encode_payload, find_duplicate,
+    hash_content, log_access, overwrite_blob, release_storage, reserve_storage, write_blob,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def max_chain():
+    return getattr(settings, 'VERSION_MAX_CHAIN', 8)
+
+
+def _max_ratio():
+    return getattr(settings, 'VERSION_DELTA_MAX_RATIO', 0.5)
+
+
+def _read_stored(name, user, row):
+    try:
+        return decode_content(row, user, read_blob(name))
+    except BlobNotFound:
+        raise FileServiceError('File not found on storage backend', status_code=404)
+
+
+def current_content(file_instance, user):
+    return _read_stored(file_instance.file.name, user, file_instance)
+
+
+def _discard(names):
+    for name in names:
+        delete_blob(name)
+        integrity.forget(name)
+
+
+def _check_size(size):
+    if size > MAX_FILE_SIZE:
+        raise FileServiceError(
+            f'File size ({size / (1024*1024):.2f}MB) exceeds maximum allowed size (100MB)'
+        )
+
+
+def add_uploaded_version(user, file_instance, uploaded_file, request_meta=None):
+    """add_version() for an UploadedFile, rejecting oversized files before they are read into memory."""
+    _check_size(uploaded_file.size)
+    return add_version(user, file_instance, uploaded_file.read(), request_meta)
+
+
+def add_version(user, file_instance, content, request_meta=None):
+    """Make `content` the current version of `file_instance`, keeping the previous one; returns the File."""
+    _check_size(len(content))
+    new_hash = hash_content(content)
+    if new_hash == file_instance.file_hash:
+        raise FileServiceError('This content is already the current version.')
+
+    old_name, old_hash = file_instance.file.name, file_instance.file_hash
+    old_content = current_content(file_instance, user)
+    shared = File.objects.filter(file=old_name).exclude(pk=file_instance.pk).exists()
+    written = []  # Blobs to remove again if the version cannot be recorded
+
+    # The previous content, preferably as a delta against the new one
+    encoded = encode_payload(user, delta.encode(content, old_content), ZLIB)
+    kind = FileVersion.DELTA
+    if len(encoded['content']) > _max_ratio() * file_instance.size:
+        kind = FileVersion.FULL
+        encoded = None if not shared else encode_content(
+            user, old_content, file_instance.original_filename, file_instance.file_type
+        )
+    if encoded is None:  # The previous blob becomes the version's own
+        version_name = old_name
+        version_fields = {
+            'size': file_instance.size, 'is_encrypted': file_instance.is_encrypted,
+            'cipher': file_instance.cipher, 'compression': file_instance.compression,
+        }
+    else:
+        version_name = write_blob(encoded)
+        written.append(version_name)
+        version_fields = {
+            'size': len(encoded['content']), 'is_encrypted': encoded['is_encrypted'],
+            'cipher': encoded['cipher'], 'compression': encoded['compression'],
+        }
+
+    # The new content, stored like an upload (dedup hits reuse the blob)
+    existing_file = find_duplicate(new_hash)
+    if existing_file:
+        current_fields = {
+            'file': existing_file.file.name, 'size': existing_file.size,
+            'is_encrypted': existing_file.is_encrypted, 'encryption_key_id': existing_file.encryption_key_id,
+            'cipher': existing_file.cipher, 'compression': existing_file.compression,
+            'merkle_root': existing_file.merkle_root or merkle_root(content),
+        }
+    else:
+        new_encoded = encode_content(user, content, file_instance.original_filename, file_instance.file_type)
+        current_fields = {
+            'file': write_blob(new_encoded), 'size': len(new_encoded['content']),
+            'is_encrypted': new_encoded['is_encrypted'], 'encryption_key_id': new_encoded['encryption_key_id'],
+            'cipher': new_encoded['cipher'], 'compression': new_encoded['compression'],
+            'merkle_root': merkle_root(content),
+        }
+        written.append(current_fields['file'])
+
+    try:
+        with transaction.atomic():
+            # Conditional on the version we read, so concurrent uploads cannot both build on it
+            updated = File.objects.filter(pk=file_instance.pk, version=file_instance.version).update(
+                file_hash=new_hash, original_size=len(content), version=F('version') + 1,
+                uploaded_at=timezone.now(),  # Last-Modified of downloads
+                **current_fields
+            )
+            if not updated:
+                raise FileServiceError('The file was changed concurrently; try again.', status_code=409)
+            folders.adjust(file_instance.folder_id, current_fields['size'] - file_instance.size)
+            charge = current_fields['size'] + version_fields['size'] - file_instance.size
+            if charge > 0:
+                reserve_storage(user, charge)
+            elif charge < 0:
+                release_storage(user, -charge)
+            FileVersion.objects.create(
+                file=file_instance, number=file_instance.version, kind=kind, storage_name=version_name,
+                original_size=len(old_content), file_hash=old_hash, created_at=file_instance.uploaded_at,
+                **version_fields
+            )
+            stats.versions_changed(user.pk, 1, version_fields['size'])
+            stats.file_removed(file_instance)  # Still holds the previous content's values
+            file_instance.refresh_from_db()
+            stats.file_added(file_instance)
+    except FileServiceError:
+        _discard(written)
+        raise
+
+    if version_name != old_name and not shared:
+        _discard([old_name])
+    if not File.objects.filter(file_hash=old_hash).exists():
+        previews.forget(old_hash)
+    if not existing_file:
+        previews.schedule(new_hash, content, file_instance.original_filename, file_instance.file_type)
+    log_access(file_instance, user, 'version', request_meta)
+    return file_instance
+
+
+def read(version, user):
+    """Plaintext of an earlier version: the nearest full content above it with the deltas in between applied."""
+    file_instance = version.file
+    chain = []
+    for newer in file_instance.versions.filter(number__gte=version.number).order_by('number'):
+        chain.append(newer)
+        if newer.kind == FileVersion.FULL:
+            break
+    if chain[-1].kind == FileVersion.FULL:
+        full = chain.pop()
+        content = _read_stored(full.storage_name, user, full)
+    else:
+        content = current_content(file_instance, user)
+    try:
+        for newer in reversed(chain):
+            content = delta.apply(content, _read_stored(newer.storage_name, user, newer))
+    except delta.DeltaError as e:
+        logger.error(f"Could not rebuild {version}: {e}")
+        raise FileServiceError('This version could not be rebuilt.', status_code=500) from e
+    if hash_content(content) != version.file_hash:
+        logger.error(f"Rebuilt {version} does not match its hash")
+        raise FileServiceError('This version could not be rebuilt.', status_code=500)
+    return content
+
+
+def _adjust_usage(user, size_delta):
+    """Charge or refund storage without a quota check (maintenance, not uploads)."""
+    if size_delta > 0:
+        get_user_model().objects.filter(pk=user.pk).update(used_storage=F('used_storage') + size_delta)
+    elif size_delta < 0:
+        release_storage(user, -size_delta)
+
+
+def chain_depth(versions):
+    """Longest run of deltas in newest-first `versions` (the deltas read to reach the oldest of them)."""
+    deepest = depth = 0
+    for version in versions:
+        depth = 0 if version.kind == FileVersion.FULL else depth + 1
+        deepest = max(deepest, depth)
+    return deepest
+
+
+def rebase(file_instance, limit=None):
+    """
+    Rewrite every version more than `limit` (VERSION_MAX_CHAIN) deltas away
+    from full content as a full snapshot; returns how many were rewritten.
+    """
+    limit = max_chain() if limit is None else limit
+    versions = list(file_instance.versions.order_by('-number'))
+    if chain_depth(versions) <= limit:
+        return 0
+    user = file_instance.owner
+    content = current_content(file_instance, user)
+    depth = rewritten = 0
+    for version in versions:
+        if version.kind == FileVersion.FULL:
+            content = _read_stored(version.storage_name, user, version)
+            depth = 0
+            continue
+        content = delta.apply(content, _read_stored(version.storage_name, user, version))
+        depth += 1
+        if depth <= limit:
+            continue
+        encoded = encode_content(user, content, file_instance.original_filename, file_instance.file_type)
+        name = write_blob(encoded)
+        old_name, old_size = version.storage_name, version.size
+        with transaction.atomic():
+            version.kind = FileVersion.FULL
+            version.storage_name = name
+            version.size = len(encoded['content'])
+            version.is_encrypted = encoded['is_encrypted']
+            version.cipher = encoded['cipher']
+            version.compression = encoded['compression']
+            version.save()
+            _adjust_usage(user, version.size - old_size)
+            stats.versions_changed(user.pk, 0, version.size - old_size)
+        _discard([old_name])
+        depth = 0
+        rewritten += 1
+    return rewritten
+
+
+def reencrypt(user, old_key, new_key, engine):
+    """Re-encrypt the owner's version blobs during key rotation; returns failures like the rotation view's."""
+    failed = []
+    for version in FileVersion.objects.filter(file__owner=user, is_encrypted=True).select_related('file'):
+        try:
+            stored = read_blob(version.storage_name)
+            plain = get_engine(cipher_name(version)).decrypt(old_key, stored)
+            new_stored = engine.encrypt(new_key, plain)
+            overwrite_blob(version.storage_name, new_stored)
+            _adjust_usage(user, len(new_stored) - version.size)
+            FileVersion.objects.filter(pk=version.pk).update(cipher=engine.name, size=len(new_stored))
+        except Exception as e:
+            failed.append({
+                "id": str(version.file_id), "name": f"{version.file.original_filename} (version {version.number})",
+                "error": str(e),
+            })
+    return failed
@@ -1,33 +1,33 @@
-from django.shortcuts import render
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-from django.conf import settings
-from django.http import FileResponse, HttpResponse
-import os
-import uuid
-import shutil
+from django.http import FileResponse, Http404, HttpResponse
 import mimetypes
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
-import hashlib
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
 
-from .models import File, FileAccessLog
-from .serializers import FileSerializer
+from django.db.models import Exists, F, OuterRef
+from django.urls import reverse
+
+from . import folders, integrity, possession, previews, signed_urls, uploads, versions
+from .models import BlobIntegrity, File, Folder, Preview
+from .serializers import FileSerializer, FileVersionSerializer, FolderSerializer
+from .blobs import BlobNotFound, open_blob, read_blob
+from .conditional import IMMUTABLE_CACHE_CONTROL, file_etag, listing_etag, not_modified, set_validators
+from .services import FileServiceError, add_file_reference, decode_content, delete_file, log_access
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
-# Maximum file size (100MB)
-MAX_FILE_SIZE = 100 * 1024 * 1024
-
 # Create your views here.
 
+# Counters are flushed in batches (files/access.py), so these lag downloads by up to ACCESS_FLUSH_INTERVAL
+LISTING_ORDERINGS = {
+    'popular': ('-download_count', '-uploaded_at'),
+    'recent_access': (F('last_accessed').desc(nulls_last=True), '-uploaded_at'),
+}
+
 class FileViewSet(viewsets.ModelViewSet):
     serializer_class = FileSerializer
     permission_classes = [IsAuthenticated]
@@ -60,174 +60,71 @@ class FileViewSet(viewsets.ModelViewSet):
             except ValueError:
                 # Handle invalid date format if necessary, or log an error
                 pass
-            
+
+        # ?ordering=popular (most downloaded first) or recent_access (last downloaded first)
+        ordering = self.request.query_params.get('ordering', None)
+        if ordering in LISTING_ORDERINGS:
+            queryset = queryset.order_by(*LISTING_ORDERINGS[ordering])
+
+        # ?folder=<id> lists one folder (?folder=root the top level); with &recursive=1 its whole subtree
+        folder_id = self.request.query_params.get('folder', None)
+        if folder_id == 'root':
+            queryset = queryset.filter(folder=None)
+        elif folder_id:
+            try:
+                folder = folders.owned(self.request.user, folder_id)
+            except folders.FolderError:
+                raise Http404('No such folder')
+            if self.request.query_params.get('recursive') in ('1', 'true'):
+                queryset = queryset.filter(folders.subtree_q(folder.path, prefix='folder__'))
+            else:
+                queryset = queryset.filter(folder=folder)
+
+        if self.action in ('list', 'retrieve'):
+            # For the serializer's thumbnail_url, without a query per row
+            queryset = queryset.annotate(has_preview=Exists(Preview.objects.filter(
+                file_hash=OuterRef('file_hash'), kind=previews.THUMB, status=Preview.READY
+            )))
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        # The frontend polls the listing; let unchanged polls end in a 304
+        queryset = self.filter_queryset(self.get_queryset())
+        etag = listing_etag(queryset, request.user, request.META.get('QUERY_STRING', ''))
+        not_modified_response = not_modified(request, etag)
+        if not_modified_response is not None:
+            return not_modified_response
+        return set_validators(super().list(request, *args, **kwargs), etag)
+
     def create(self, request, *args, **kwargs):
+        # Hash, encrypt and store the file while the body is parsed
+        uploads.install(request, request.user)
         uploaded_file = request.FILES.get('file')
         if not uploaded_file:
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Check file size
-        file_size = uploaded_file.size
-        if file_size > MAX_FILE_SIZE:
-            return Response({
-                'error': f'File size ({file_size / (1024*1024):.2f}MB) exceeds maximum allowed size (100MB)'
-            }, status=status.HTTP_400_BAD_REQUEST)
-            
-        # Check file size against user's remaining quota
-        user = request.user
-        if user.used_storage + file_size > user.storage_quota:
-            available_space = user.storage_quota - user.used_storage
-            return Response({
-                'error': f'Storage quota exceeded. Available space: {available_space / (1024*1024):.2f}MB'
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-        # Read file content for hashing and encryption
-        file_content = uploaded_file.read()
-        file_hash = hashlib.sha256(file_content).hexdigest()
-
-        # Check for duplicate by hash
-        existing_file = File.objects.filter(file_hash=file_hash).first()
-        if existing_file:
-            # Just add a reference (new File object, same file_hash, no new storage)
-            file_instance = File.objects.create(
-                owner=user,
-                file=existing_file.file,  # reference existing file
-                original_filename=uploaded_file.name,
-                file_type=uploaded_file.content_type,
-                size=existing_file.size,
-                is_encrypted=existing_file.is_encrypted,
-                encryption_key_id=existing_file.encryption_key_id,
-                file_hash=file_hash
-            )
-            user.used_storage += existing_file.size
-            user.save()
-            FileAccessLog.objects.create(
-                file=file_instance,
-                user=user,
-                action='upload',
-                ip_address=request.META.get('REMOTE_ADDR', '')
-            )
-            serializer = self.get_serializer(file_instance)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        # Get encryption key (user-level or from .env)
-        # encryption_key = get_encryption_key(user) # Old method
-        derived_aes_key = user.get_derived_aes_key()
-
-        # Encrypt file content if key is present, else store as plain
-        if derived_aes_key:
-            iv = get_random_bytes(16)
-            cipher = AES.new(derived_aes_key, AES.MODE_CFB, iv=iv)
-            encrypted_content = iv + cipher.encrypt(file_content)
-            content_to_store = encrypted_content
-            is_encrypted = True
-            encryption_key_id = str(user.id) if getattr(user, 'encryption_key', None) else 'default'
-        else:
-            content_to_store = file_content
-            is_encrypted = False
-            encryption_key_id = None
-
-        # Generate the custom filename for storage
-        short_uuid = str(uuid.uuid4())[:8]
-        if is_encrypted:
-            stored_filename_stem = f"ecry::{short_uuid}"
-        else:
-            stored_filename_stem = short_uuid
-        
-        storage_path = stored_filename_stem
+        try:
+            folder = folders.owned(request.user, request.data.get('folder'))
+        except folders.FolderError as e:
+            uploads.discard(uploaded_file)
+            return Response({'error': e.message}, status=e.status_code)
 
-        # Save the file using Django's default storage system
         try:
-            actual_stored_path = default_storage.save(storage_path, ContentFile(content_to_store))
-        except Exception as e:
-            # Log the exception
-            logger.error(f"Failed to save file to storage: {e}", exc_info=True)
-            return Response({'error': 'Failed to save file to storage.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        # Create the File model instance
-        file_instance = File.objects.create(
-            owner=user,
-            file=actual_stored_path, # Store the path returned by the storage system
-            original_filename=uploaded_file.name,
-            file_type=uploaded_file.content_type,
-            size=len(content_to_store), # Use length of content_to_store, as file_size was from original
-            is_encrypted=is_encrypted,
-            encryption_key_id=encryption_key_id, # This might still be relevant for user-level key id
-            file_hash=file_hash
-        )
-        
-        user.used_storage += len(content_to_store) # Ensure this uses the size of the content actually stored
-        user.save()
-        
-        FileAccessLog.objects.create(
-            file=file_instance,
-            user=user,
-            action='upload',
-            ip_address=request.META.get('REMOTE_ADDR', '')
-        )
+            file_instance = uploads.store_uploaded_file(
+                request.user,
+                uploaded_file,
+                request_meta=request.META,
+                folder=folder
+            )
+        except FileServiceError as e:
+            return Response({'error': e.message}, status=e.status_code)
+
         serializer = self.get_serializer(file_instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
         
     def destroy(self, request, *args, **kwargs):
-        file_instance = self.get_object()
-        
-        # Attempt to delete from storage only if this is the last reference to the physical file.
-        # The File model's `file` field stores the path.
-        # The logic for `other_refs` using `file_hash` is for deduplication of *content*.
-        # The actual file on storage corresponds to `file_instance.file.name` (the path).
-        
-        can_delete_physical_file = False
-        if file_instance.file and file_instance.file.name:
-            # Count how many File objects point to this exact file path/name
-            # This assumes that if file_hash is the same, existing_file.file is reused.
-            # If create_file_reference directly copies existing_file.file (the path string), this is fine.
-            # If a new file is saved even for references (it shouldn't be), this logic needs adjustment.
-            
-            # Let's refine: the critical part is if other File records use the *same file_hash*
-            # and we assume that means they point to the same physical data.
-            # The physical deletion should happen if no other File record shares this file_hash.
-            
-            other_hash_refs = File.objects.filter(file_hash=file_instance.file_hash).exclude(id=file_instance.id).count()
-            if other_hash_refs == 0:
-                can_delete_physical_file = True
-
-        if can_delete_physical_file:
-            try:
-                if default_storage.exists(file_instance.file.name):
-                    default_storage.delete(file_instance.file.name)
-                    logger.info(f"Deleted physical file from storage: {file_instance.file.name}")
-            except Exception as e:
-                logger.error(f"Error deleting physical file {file_instance.file.name} from storage: {e}", exc_info=True)
-        else:
-            if file_instance.file and file_instance.file.name:
-                logger.info(f"Physical file {file_instance.file.name} not deleted from storage due to other references (hash-based).")
-            else:
-                logger.info("No physical file associated with this record or path is empty.")
-
-
-        # Update user's storage usage (this part seems okay)
-        user_to_update = request.user
-        original_file_size = file_instance.size # Size stored in DB
-        user_to_update.used_storage -= original_file_size
-        if user_to_update.used_storage < 0:
-            logger.warning(f"User {user_to_update.username} used_storage was about to become negative ({user_to_update.used_storage}) due to subtracting {original_file_size}. Clamping to 0.")
-            user_to_update.used_storage = 0
-        user_to_update.save()
-        
-        FileAccessLog.objects.create(
-            file=file_instance,
-            user=request.user,
-            action='delete',
-            ip_address=request.META.get('REMOTE_ADDR', '')
-        )
-        # Delete the database record for the File instance
-        file_instance_id_for_log = file_instance.id
-        file_original_name_for_log = file_instance.original_filename
-        response = super().destroy(request, *args, **kwargs) # This deletes the DB record
-        logger.info(f"Deleted File DB record ID: {file_instance_id_for_log}, Original Name: {file_original_name_for_log}")
-        return response
+        delete_file(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
@@ -239,43 +136,64 @@ class FileViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        # Revalidation is answered from the row alone, before any storage I/O or decryption
+        etag, last_modified = file_etag(file_instance, request.user), file_instance.uploaded_at
+        not_modified_response = not_modified(request, etag, last_modified)
+        if not_modified_response is not None:
+            return not_modified_response
+
+        index = integrity.get_index(file_instance.file.name) if integrity.verify_downloads() else None
         try:
-            # Use default_storage to open the file
-            if not default_storage.exists(file_instance.file.name):
+            # Stored bytes are the plaintext: hand the open blob (a local file or a
+            # disk cache entry where possible) to FileResponse so it can use sendfile
+            if not file_instance.is_encrypted and not file_instance.compression:
+                try:
+                    blob = open_blob(file_instance.file.name)
+                except BlobNotFound:
+                    return Response(
+                        {'error': 'File not found on storage backend'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                log_access(file_instance, request.user, 'download', request.META)
+                content_type, _ = mimetypes.guess_type(file_instance.original_filename)
+                if index is not None:
+                    # Verified while it streams; this gives up sendfile
+                    blob = integrity.VerifyingReader(blob, index)
+                response = FileResponse(
+                    blob, as_attachment=True, filename=file_instance.original_filename,
+                    content_type=content_type or 'application/octet-stream'
+                )
+                if index is not None:
+                    response['Content-Length'] = str(index.size)
+                return set_validators(response, etag, last_modified)
+
+            # Read the blob with a single GET; a missing blob surfaces as BlobNotFound
+            try:
+                file_content_from_storage = read_blob(file_instance.file.name)
+            except BlobNotFound:
                 return Response(
                     {'error': 'File not found on storage backend'},
                     status=status.HTTP_404_NOT_FOUND
                 )
-            
-            # Open the file from storage
-            with default_storage.open(file_instance.file.name, 'rb') as f:
-                file_content_from_storage = f.read()
+
+            if index is not None:
+                try:
+                    integrity.verify_content(index, file_content_from_storage)
+                except integrity.IntegrityFailure as e:
+                    integrity.report(index, BlobIntegrity.CORRUPT, e.detail)
+                    return Response(
+                        {'error': 'File failed its integrity check and may be corrupted.'},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                    )
 
             # Log the download
-            FileAccessLog.objects.create(
-                file=file_instance,
-                user=request.user,
-                action='download',
-                ip_address=request.META.get('REMOTE_ADDR', ''),
-                user_agent=request.META.get('HTTP_USER_AGENT', '')
-            )
+            log_access(file_instance, request.user, 'download', request.META)
 
-            user = request.user
-            derived_aes_key = user.get_derived_aes_key()
-            
-            content_to_send = file_content_from_storage
-            if file_instance.is_encrypted:
-                if derived_aes_key:
-                    iv = file_content_from_storage[:16]
-                    ciphertext = file_content_from_storage[16:]
-                    cipher = AES.new(derived_aes_key, AES.MODE_CFB, iv=iv)
-                    try:
-                        content_to_send = cipher.decrypt(ciphertext)
-                    except ValueError as e: # Possible padding error or incorrect key
-                        print(f"[ERROR] Decryption failed for file {file_instance.original_filename}: {e}")
-                        return Response({'error': 'Decryption failed. Key might be incorrect or file corrupted.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-                else: # File is encrypted, but user has no key or it's invalid
-                    return Response({'error': 'File is encrypted, but a valid decryption key is not available.'}, status=status.HTTP_403_FORBIDDEN)
+            try:
+                content_to_send = decode_content(file_instance, request.user, file_content_from_storage)
+            except FileServiceError as e:
+                logger.error(f"Decryption failed for file {file_instance.original_filename}: {e.message}")
+                return Response({'error': e.message}, status=e.status_code)
             
             content_type, _ = mimetypes.guess_type(file_instance.original_filename)
             if not content_type:
@@ -286,60 +204,235 @@ class FileViewSet(viewsets.ModelViewSet):
                 content_type=content_type
             )
             response['Content-Disposition'] = f'attachment; filename="{file_instance.original_filename}"'
-            return response
+            return set_validators(response, etag, last_modified)
 
         except Exception as e:
-            print(f"[ERROR] Failed to download file {file_instance.original_filename}: {str(e)}")
+            logger.error(f"Failed to download file {file_instance.original_filename}: {e}", exc_info=True)
             return Response(
                 {'error': f'Failed to download file: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=['get', 'post'], url_path='versions')
+    def versions(self, request, pk=None):
+        """History of the file (GET), or upload a new version of it (POST, multipart `file`)."""
+        file_instance = self.get_object()
+        if request.method == 'GET':
+            serializer = FileVersionSerializer(file_instance.versions.all(), many=True, context={'request': request})
+            return Response(serializer.data)
+
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            file_instance = versions.add_uploaded_version(
+                request.user, file_instance, uploaded_file, request_meta=request.META
+            )
+        except FileServiceError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(self.get_serializer(file_instance).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'])
+    def move(self, request, pk=None):
+        """Move the file into another folder (`folder`: id, or null for the top level)."""
+        file_instance = self.get_object()
+        try:
+            folders.move_file(file_instance, folders.owned(request.user, request.data.get('folder')))
+        except folders.FolderError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(self.get_serializer(file_instance).data)
+
+    def _get_version(self, file_instance, number):
+        version = file_instance.versions.filter(number=number).first()
+        if version is None:
+            raise Http404('No such version')
+        return version
+
+    @action(detail=True, methods=['get'], url_path=r'versions/(?P<number>[0-9]+)/download')
+    def download_version(self, request, pk=None, number=None):
+        file_instance = self.get_object()
+        version = self._get_version(file_instance, number)
+
+        # A version's content never changes
+        etag, last_modified = file_etag(version, request.user), version.created_at
+        not_modified_response = not_modified(request, etag, last_modified)
+        if not_modified_response is not None:
+            return not_modified_response
+        try:
+            content = versions.read(version, request.user)
+        except FileServiceError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        log_access(file_instance, request.user, 'download', request.META)
+
+        content_type, _ = mimetypes.guess_type(file_instance.original_filename)
+        response = HttpResponse(content, content_type=content_type or 'application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="{file_instance.original_filename}"'
+        return set_validators(response, etag, last_modified)
+
+    @action(detail=True, methods=['post'], url_path=r'versions/(?P<number>[0-9]+)/restore')
+    def restore_version(self, request, pk=None, number=None):
+        """Make an earlier version current again; it is added as a new version."""
+        file_instance = self.get_object()
+        version = self._get_version(file_instance, number)
+        try:
+            content = versions.read(version, request.user)
+            file_instance = versions.add_version(request.user, file_instance, content, request_meta=request.META)
+        except FileServiceError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(self.get_serializer(file_instance).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def preview(self, request, pk=None):
+        """Thumbnail (?size=thumb, default) or larger preview image of the file."""
+        file_instance = self.get_object()
+        kind = request.query_params.get('size', previews.THUMB)
+        if kind not in previews.KINDS:
+            return Response({'error': f"size must be one of: {', '.join(previews.KINDS)}"}, status=400)
+        preview = previews.get(file_instance.file_hash, kind) if file_instance.file_hash else None
+        if preview is None:
+            return Response({'error': 'No preview available'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Previews are content-addressed and never change
+        etag = f'"{file_instance.file_hash[:32]}-{kind}"'
+        not_modified_response = not_modified(request, etag, cache_control=IMMUTABLE_CACHE_CONTROL)
+        if not_modified_response is not None:
+            return not_modified_response
+        try:
+            image = previews.read(preview)
+        except BlobNotFound:
+            return Response({'error': 'No preview available'}, status=status.HTTP_404_NOT_FOUND)
+        return set_validators(
+            HttpResponse(image, content_type=preview.content_type), etag, cache_control=IMMUTABLE_CACHE_CONTROL
+        )
+
+    @action(detail=True, methods=['post'], url_path='download-token')
+    def download_token(self, request, pk=None):
+        """Issue a short-lived link that downloads the file without a bearer token."""
+        file_instance = self.get_object()
+        if not file_instance.file or not file_instance.file.name:
+            return Response(
+                {'error': 'File not found or path is missing'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        try:
+            token, expires_at = signed_urls.issue(file_instance, request.user)
+        except FileServiceError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        log_access(file_instance, request.user, 'download_link', request.META)
+        return Response({
+            'url': request.build_absolute_uri(reverse('signed_file_download', args=[token])),
+            'expires_at': datetime.fromtimestamp(expires_at, tz=timezone.utc).isoformat(),
+        })
+
+class FolderViewSet(viewsets.ModelViewSet):
+    """
+    Folders of the current user (files/folders.py). List with ?parent=<id>
+    (?parent=root for the top level); PATCH `name` renames, PATCH `parent`
+    moves (null for the top level). Only empty folders can be deleted.
+    """
+    serializer_class = FolderSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = Folder.objects.filter(owner=self.request.user)
+        parent = self.request.query_params.get('parent', None)
+        if parent == 'root':
+            queryset = queryset.filter(parent=None)
+        elif parent:
+            try:
+                queryset = queryset.filter(parent=folders.owned(self.request.user, parent))
+            except folders.FolderError:
+                raise Http404('No such folder')
+        return queryset
+
+    def create(self, request, *args, **kwargs):
+        try:
+            parent = folders.owned(request.user, request.data.get('parent'))
+            folder = folders.create(request.user, request.data.get('name'), parent)
+        except folders.FolderError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(self.get_serializer(folder).data, status=status.HTTP_201_CREATED)
+
+    def update(self, request, *args, **kwargs):
+        folder = self.get_object()
+        try:
+            if 'name' in request.data:
+                folder = folders.rename(folder, request.data['name'])
+            if 'parent' in request.data:
+                folder = folders.move(folder, folders.owned(request.user, request.data['parent']))
+        except folders.FolderError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(self.get_serializer(folder).data)
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            folders.delete(self.get_object())
+        except folders.FolderError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        """The folder and every folder below it, parents before children."""
+        folder = self.get_object()
+        serializer = self.get_serializer(folders.subtree(folder).order_by('path'), many=True)
+        return Response(serializer.data)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def check_file_hash(request):
     file_hash = request.GET.get('hash')
     if not file_hash:
         return Response({'exists': False, 'error': 'No hash provided'}, status=400)
-    exists = File.objects.filter(file_hash=file_hash).exists()
-    # print("Hello")
+    # Only the caller's own files: answering for other users' files would reveal what they store
+    exists = File.objects.filter(file_hash=file_hash, owner=request.user).exists()
     return Response({'exists': exists})
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def create_file_reference(request):
+def possession_challenge(request):
+    """Challenge the caller to prove they hold the content behind a hash (see files/possession.py)."""
     file_hash = request.data.get('hash')
+    size = request.data.get('size')
+    if not file_hash or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return Response({'error': 'Missing required fields.'}, status=400)
+    # Issued whether or not the content exists, so this is not an existence oracle
+    return Response(possession.issue_challenge(request.user, file_hash, size))
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_file_reference(request):
     original_filename = request.data.get('original_filename')
     file_type = request.data.get('file_type')
+    challenge = request.data.get('challenge')
+    proofs = request.data.get('proofs')
     user = request.user
 
-    if not file_hash or not original_filename or not file_type:
+    if not original_filename or not file_type or not challenge or proofs is None:
         return Response({'error': 'Missing required fields.'}, status=400)
 
-    existing_file = File.objects.filter(file_hash=file_hash).first()
-    if not existing_file:
-        return Response({'error': 'No file with this hash exists.'}, status=404)
-
-    file_instance = File.objects.create(
-        owner=user,
-        file=existing_file.file,
-        original_filename=original_filename,
-        file_type=file_type,
-        size=existing_file.size,
-        is_encrypted=existing_file.is_encrypted,
-        encryption_key_id=existing_file.encryption_key_id,
-        file_hash=file_hash
-    )
-    # Update user's storage
-    user.used_storage += existing_file.size
-    user.save()
-
-    FileAccessLog.objects.create(
-        file=file_instance,
-        user=user,
-        action='reference',
-        ip_address=request.META.get('REMOTE_ADDR', '')
-    )
+    try:
+        file_hash, size, indices = possession.open_challenge(user, challenge)
+    except possession.ProofError as e:
+        return Response({'error': str(e)}, status=400)
+
+    # Unknown content and a failed proof get the same answer
+    existing_file = File.objects.filter(
+        file_hash=file_hash, original_size=size, merkle_root__isnull=False
+    ).first()
+    if not existing_file or not possession.verify_proofs(existing_file.merkle_root, size, indices, proofs):
+        return Response({'error': 'Could not verify the content; upload the file instead.'}, status=404)
+
+    try:
+        folder = folders.owned(user, request.data.get('folder'))
+        file_instance = add_file_reference(
+            user, existing_file, original_filename, file_type, action='reference', request_meta=request.META,
+            folder=folder
+        )
+    except folders.FolderError as e:
+        return Response({'error': e.message}, status=e.status_code)
+    except FileServiceError as e:
+        return Response({'error': e.message}, status=e.status_code)
     serializer = FileSerializer(file_instance, context={'request': request})
     return Response(serializer.data, status=201)
 
@@ -0,0 +1,157 @@
+"""
+JWT authentication with a cached user lookup.
+
+simplejwt's JWTAuthentication loads the user row on every request, which
+dominates cheap endpoints such as check_hash and reference that the
+frontend calls once per file. CachedJWTAuthentication keeps a snapshot of
+the user's row in a small in-process LRU for AUTH_USER_CACHE_TTL seconds.
+
+Two kinds of fields are deliberately left out of the snapshot and stay
+deferred, so Django loads them fresh from the database on first access
+(both in one query, see User.refresh_from_db):
+
+  used_storage    changed with F() updates that fire no signals; quota
+                  checks must see the current value.
+  encryption_key  a stale key would encrypt new uploads with a rotated key.
+
+Everything else is invalidated on User post_save/post_delete. Each entry
+carries a per-user version; with AUTH_USER_CACHE_ALIAS pointing at a shared
+cache backend, invalidating in one worker process bumps the version that
+all others check, otherwise other processes catch up within the TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# Fields that must always be read from the database
+UNCACHED_FIELDS = ('used_storage', 'encryption_key')
+
+
+class UserSnapshotCache:
+    """Thread-safe LRU of raw user rows with a TTL and a version per entry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    @property
+    def generation(self):
+        """Changes on every eviction; pass it to set() to avoid caching a row read before one."""
+        return self._evictions
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, entry_version, values = entry
+            if entry_version != version or expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return values
+
+    def set(self, key, version, values, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._evictions:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, version, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._evictions += 1
+
+
+user_cache = UserSnapshotCache(
+    max_size=getattr(settings, 'AUTH_USER_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'AUTH_USER_CACHE_TTL', 30),
+)
+
+
+def _version_backend():
+    alias = getattr(settings, 'AUTH_USER_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+def _version_key(user_id):
+    return f'auth-user-version:{user_id}'
+
+
+def get_user_version(user_id):
+    backend = _version_backend()
+    return backend.get(_version_key(user_id), 0) if backend is not None else 0
+
+
+def invalidate_user(user_id):
+    """Drop the cached snapshot of a user in this process and, if shared, in all others."""
+    user_cache.evict(str(user_id))
+    backend = _version_backend()
+    if backend is not None:
+        key = _version_key(user_id)
+        backend.add(key, 0, timeout=None)
+        try:
+            backend.incr(key)
+        except ValueError:  # evicted between add() and incr()
+            backend.set(key, 1, timeout=None)
+
+
+def snapshot_fields():
+    User = get_user_model()
+    return [f.attname for f in User._meta.concrete_fields if f.attname not in UNCACHED_FIELDS]
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that serves the user from a short-lived snapshot cache."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        key = str(user_id)
+        version = get_user_version(key)
+        fields = snapshot_fields()
+        values = user_cache.get(key, version)
+        if values is None:
+            generation = user_cache.generation
+            lookup = {api_settings.USER_ID_FIELD: user_id}
+            values = self.user_model.objects.filter(**lookup).values_list(*fields).first()
+            if values is None:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            user_cache.set(key, version, values, generation)
+
+        # A fresh instance per request; the uncached fields are deferred and
+        # load lazily (together), and save() on it only writes the loaded fields.
+        user = self.user_model.from_db(router.db_for_read(self.user_model), fields, values)
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
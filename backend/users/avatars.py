@@ -0,0 +1,92 @@
+"""
+Profile photo variants.
+
+Avatar widgets show profile photos at a few fixed sizes, so when a photo is
+uploaded (UserProfileUpdateSerializer.update) it is cropped square and
+stored once per AVATAR_SIZES entry as WebP, once the user row pointing at
+them is committed:
+
+  avatars/<user id>/<digest>/<size>.webp
+
+The digest is a prefix of the SHA-256 of the uploaded photo. It is part of
+the URL (UserSerializer.get_profile_photo_url), so a variant never changes
+under its URL and is served with an immutable, publicly cacheable
+Cache-Control; a new photo gets a new URL. The original upload stays in
+User.profile_photo as the source for regenerating variants
+(generate_avatars command).
+"""
+import hashlib
+import io
+import posixpath
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from files.blobs import delete_blob, save_blob
+
+AVATAR_PREFIX = 'avatars'
+CONTENT_TYPE = 'image/webp'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'  # Variants are addressed by content digest
+DIGEST_LENGTH = 16
+
+
+class AvatarError(Exception):
+    """The uploaded photo could not be decoded or resized"""
+
+
+def sizes():
+    return tuple(getattr(settings, 'AVATAR_SIZES', (32, 64, 256)))
+
+
+def digest(content):
+    return hashlib.sha256(content).hexdigest()[:DIGEST_LENGTH]
+
+
+def storage_name(user_id, photo_digest, size):
+    return posixpath.join(AVATAR_PREFIX, str(user_id), photo_digest, f'{size}.webp')
+
+
+def render(content, size):
+    """Square-crop a photo to `size` px and encode it as WebP; raises AvatarError."""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.draft('RGB', (size, size))  # Lets JPEG decode at a reduced scale
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarError(str(e)) from e
+    out = io.BytesIO()
+    image.save(out, 'WEBP', quality=85, method=4)
+    return out.getvalue()
+
+
+def render_all(content):
+    """Every variant of a photo by size, rendered in memory; raises AvatarError."""
+    return {size: render(content, size) for size in sizes()}
+
+
+def write(user_id, photo_digest, rendered):
+    """Store variants from render_all() under the photo's digest."""
+    for size, data in rendered.items():
+        name = storage_name(user_id, photo_digest, size)
+        delete_blob(name)  # Same photo uploaded again; keep the name stable
+        save_blob(name, data)
+
+
+def store(user_id, content):
+    """Render and store every variant of a photo; returns its digest. Raises AvatarError."""
+    photo_digest = digest(content)
+    write(user_id, photo_digest, render_all(content))  # Fails before writing anything
+    return photo_digest
+
+
+def delete(user_id, photo_digest):
+    if photo_digest:
+        for size in sizes():
+            delete_blob(storage_name(user_id, photo_digest, size))
+
+
+def url_path(user_id, photo_digest, size):
+    return f'/api/auth/avatars/{user_id}/{photo_digest}/{size}.webp'
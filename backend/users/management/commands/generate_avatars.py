@@ -0,0 +1,35 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from files.blobs import BlobNotFound, read_blob
+from users import avatars
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Stores the resized avatar variants (users/avatars.py) of profile photos uploaded before '
+        'they existed, or re-renders all of them with --all (e.g. after changing AVATAR_SIZES).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Also re-render users that already have variants.')
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(profile_photo='').exclude(profile_photo=None)
+        if not options['all']:
+            users = users.filter(avatar_digest=None)
+        done = 0
+        for user in users.iterator(chunk_size=100):
+            try:
+                photo_digest = avatars.store(user.pk, read_blob(user.profile_photo.name))
+            except (BlobNotFound, avatars.AvatarError) as e:
+                self.stderr.write(self.style.WARNING(f"Skipping {user.username}: {e}"))
+                continue
+            if photo_digest != user.avatar_digest:
+                avatars.delete(user.pk, user.avatar_digest)
+                user.avatar_digest = photo_digest
+                user.save(update_fields=['avatar_digest'])
+            done += 1
+        self.stdout.write(self.style.SUCCESS(f"Stored avatar variants for {done} user(s)."))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_encryption_key_user_profile_photo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='key_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
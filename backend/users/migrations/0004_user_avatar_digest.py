@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_key_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avatar_digest',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
@@ -15,6 +15,8 @@ class User(AbstractUser):
     updated_at = models.DateTimeField(auto_now=True)
     encryption_key = models.CharField(max_length=255, null=True, blank=True)
     profile_photo = models.ImageField(upload_to='profile_photos/', null=True, blank=True)
+    avatar_digest = models.CharField(max_length=16, null=True, blank=True)  # Addresses the resized variants (users/avatars.py)
+    key_version = models.PositiveIntegerField(default=0)  # Bumped whenever encryption_key changes; part of download ETags
 
     # Additional fields can be added here
     storage_quota = models.BigIntegerField(default=1 * 1024 * 1024 * 1024)  # 1GB default
@@ -26,6 +28,14 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # Users from the authentication cache defer the fields that must be read
+        # fresh (users/authentication.py); load them all in one query, not one each
+        if fields is not None:
+            fields = list(fields)
+            fields += [name for name in self.get_deferred_fields() if name not in fields]
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+
     def get_storage_usage_percentage(self):
         """Calculate storage usage percentage"""
         if self.storage_quota == 0:
@@ -38,6 +48,7 @@ class User(AbstractUser):
 
     def set_raw_key(self, raw_key_string: str):
         """Encrypt and store the user's raw encryption key string"""
+        self.key_version = (self.key_version or 0) + 1
         if not raw_key_string:
             self.encryption_key = None
             return
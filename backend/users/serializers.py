@@ -2,8 +2,13 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
 from rest_framework.validators import UniqueValidator
+from django.db import transaction
 import os
 
+from files import outbox
+
+from . import avatars
+
 User = get_user_model()
 
 class UserSerializer(serializers.ModelSerializer):
@@ -14,15 +19,16 @@ class UserSerializer(serializers.ModelSerializer):
     storage_usage_percentage = serializers.SerializerMethodField()
     has_encryption_key = serializers.SerializerMethodField()
     profile_photo_url = serializers.SerializerMethodField()
+    profile_photo_urls = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'storage_quota', 'used_storage', 
                  'storage_usage_percentage', 'date_joined', 'last_login',
-                 'has_encryption_key', 'profile_photo_url')
+                 'has_encryption_key', 'profile_photo_url', 'profile_photo_urls')
         read_only_fields = ('id', 'date_joined', 'last_login', 'storage_quota', 
                           'used_storage', 'storage_usage_percentage', 'has_encryption_key',
-                          'profile_photo_url')
+                          'profile_photo_url', 'profile_photo_urls')
 
     def get_storage_usage_percentage(self, obj):
         return obj.get_storage_usage_percentage()
@@ -30,13 +36,27 @@ class UserSerializer(serializers.ModelSerializer):
     def get_has_encryption_key(self, obj):
         return obj.has_encryption_key()
 
+    def _absolute(self, url_path):
+        request = self.context.get('request')
+        return request.build_absolute_uri(url_path) if request else url_path
+
     def get_profile_photo_url(self, obj):
-      if obj.profile_photo and hasattr(obj.profile_photo, 'name'):
-          request = self.context.get('request')
-          filename = os.path.basename(obj.profile_photo.name)
-          url_path = f"/api/auth/profile_photos/{filename}"
-          return request.build_absolute_uri(url_path) if request else url_path
-      return None
+        if obj.avatar_digest:
+            # Largest variant; the digest in the URL changes with the photo
+            return self._absolute(avatars.url_path(obj.pk, obj.avatar_digest, max(avatars.sizes())))
+        if obj.profile_photo and hasattr(obj.profile_photo, 'name'):
+            filename = os.path.basename(obj.profile_photo.name)
+            return self._absolute(f"/api/auth/profile_photos/{filename}")
+        return None
+
+    def get_profile_photo_urls(self, obj):
+        """Variant URLs by size in px, for avatar widgets that need a smaller one"""
+        if not obj.avatar_digest:
+            return None
+        return {
+            str(size): self._absolute(avatars.url_path(obj.pk, obj.avatar_digest, size))
+            for size in avatars.sizes()
+        }
 
 class UserProfileUpdateSerializer(serializers.ModelSerializer):
     email = serializers.EmailField(
@@ -66,8 +86,18 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
 
         # Handle profile photo separately
         profile_photo = validated_data.pop('profile_photo', None)
+        old_digest = instance.avatar_digest
         if profile_photo:
+            # Render the avatar variants first so an undecodable photo changes nothing
+            content = profile_photo.read()
+            profile_photo.seek(0)
+            try:
+                rendered = avatars.render_all(content)
+            except avatars.AvatarError:
+                raise serializers.ValidationError({'profile_photo': 'Could not process this image.'})
+            instance.avatar_digest = avatars.digest(content)
             # Delete old profile photo if it exists
+            old_photo = instance.profile_photo.name if instance.profile_photo else None
             if instance.profile_photo:
                 instance.profile_photo.delete(save=False)
             instance.profile_photo = profile_photo
@@ -77,6 +107,16 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
             setattr(instance, attr, value)
 
         instance.save()
+        if profile_photo:
+            # The ImageField writes to storage itself, not through files.blobs
+            outbox.enqueue(instance.profile_photo.name, outbox.PUT)
+            if old_photo:
+                outbox.enqueue(old_photo, outbox.DELETE)
+            # Variants are stored once the row pointing at them is, so a failed save leaves none behind
+            photo_digest = instance.avatar_digest
+            transaction.on_commit(lambda: avatars.write(instance.pk, photo_digest, rendered))
+        if old_digest and old_digest != instance.avatar_digest:
+            transaction.on_commit(lambda: avatars.delete(instance.pk, old_digest))
         return instance
 
 class RotateKeySerializer(serializers.Serializer):
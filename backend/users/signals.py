@@ -0,0 +1,14 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import invalidate_user
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User, dispatch_uid='users.invalidate_cached_user_on_save')
+@receiver(post_delete, sender=User, dispatch_uid='users.invalidate_cached_user_on_delete')
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Profile, quota, password or key changed; drop the cached auth snapshot"""
+    invalidate_user(instance.pk)
@@ -1,3 +1,220 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from files import access
+from files.models import File
+
+from . import avatars
+from .authentication import CachedJWTAuthentication, user_cache
+from .models import User
+from .serializers import UserProfileUpdateSerializer
+
+
+class RotateEncryptionKeyTests(TestCase):
+    """Key rotation must never touch another owner's copy of a dedup'd blob."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='vault-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root, PREVIEWS_ENABLED=False)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(access.flush)  # Download counts belong to this test's database
+
+    def _user(self, name, raw_key):
+        user = User.objects.create_user(username=name, email=f'{name}@example.com', password='pw-123456789')
+        user.set_raw_key(raw_key)
+        user.save()
+        return user
+
+    def _client(self, user):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=user.pk))
+        return client
+
+    def _upload(self, user, content):
+        response = self._client(user).post('/api/files/', {
+            'file': SimpleUploadedFile('report.txt', content, content_type='text/plain'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return File.objects.get(pk=response.data['id'])
+
+    def _download(self, user, file_obj):
+        response = self._client(user).get(f'/api/files/{file_obj.pk}/download/')
+        return response.status_code, response.getvalue() if response.status_code == 200 else None
+
+    def _rotate(self, user, new_key):
+        return self._client(user).post('/api/auth/rotate-key/', {'new_encryption_key': new_key}, format='json')
+
+    def _assert_shared_blob_survives(self, cipher):
+        content = b'quarterly numbers\n' * 500
+        with self.settings(FILE_CIPHER=cipher):
+            alice = self._user('alice', 'alice-key')
+            bob = self._user('bob', 'bob-key')
+            original = self._upload(alice, content)
+            reference = self._upload(bob, content)
+            self.assertEqual(reference.file.name, original.file.name)  # Dedup'd across users
+            alice_used = User.objects.get(pk=alice.pk).used_storage
+
+            response = self._rotate(bob, 'bob-new-key')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self._download(alice, original), (200, content))
+        kept = File.objects.get(pk=original.pk)
+        self.assertEqual((kept.file.name, kept.cipher, kept.size), (original.file.name, original.cipher, original.size))
+        self.assertEqual(User.objects.get(pk=alice.pk).used_storage, alice_used)
+
+    def test_rotation_leaves_other_owners_blob_alone_aes_cfb(self):
+        self._assert_shared_blob_survives('aes-cfb')
+
+    def test_rotation_leaves_other_owners_blob_alone_aes_gcm(self):
+        self._assert_shared_blob_survives('aes-gcm')
+
+    def test_readable_shared_blob_is_copied_under_new_key(self):
+        content = b'shared notes\n' * 500
+        alice = self._user('alice', 'same-key')
+        bob = self._user('bob', 'same-key')
+        original = self._upload(alice, content)
+        reference = self._upload(bob, content)
+
+        response = self._rotate(bob, 'bob-new-key')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        moved = File.objects.get(pk=reference.pk)
+        self.assertNotEqual(moved.file.name, original.file.name)
+        self.assertEqual(File.objects.get(pk=original.pk).file.name, original.file.name)
+        self.assertEqual(self._download(alice, original), (200, content))
+        self.assertEqual(self._download(bob, moved), (200, content))
+
+    def test_unshared_blob_is_rewritten_in_place(self):
+        content = b'private\n' * 500
+        alice = self._user('alice', 'alice-key')
+        original = self._upload(alice, content)
+
+        response = self._rotate(alice, 'alice-new-key')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(File.objects.get(pk=original.pk).file.name, original.file.name)
+        self.assertEqual(self._download(alice, original), (200, content))
+
+
+class DeleteUserTests(TestCase):
+
+    def test_user_with_files_in_folders_can_be_deleted(self):
+        from files.models import Folder
+
+        user = User.objects.create_user(username='carol', email='carol@example.com', password='pw-123456789')
+        folder = Folder.objects.create(owner=user, name='docs', path='docs')
+        File.objects.create(owner=user, file='blobs/00/00/missing', original_filename='a.txt', size=1, folder=folder)
+
+        user.delete()
+
+        self.assertFalse(Folder.objects.filter(pk=folder.pk).exists())
+        self.assertFalse(File.objects.filter(owner_id=user.pk).exists())
+
+
+class CachedJWTAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='dave', email='dave@example.com', password='pw-123456789')
+        self.user.set_raw_key('dave-key')
+        self.user.save()
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+
+    def _authenticate(self):
+        return CachedJWTAuthentication().get_user(AccessToken.for_user(self.user))
+
+    def test_cached_lookup_needs_no_query(self):
+        self._authenticate()
+        with self.assertNumQueries(0):
+            self.assertEqual(self._authenticate().username, 'dave')
+
+    def test_uncached_fields_load_in_one_query(self):
+        self._authenticate()
+        User.objects.filter(pk=self.user.pk).update(used_storage=123)
+        user = self._authenticate()
+        with self.assertNumQueries(1):
+            self.assertEqual(user.used_storage, 123)
+            self.assertIsNotNone(user.get_derived_aes_key())
+
+
+class AvatarTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='vault-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root, AVATAR_SIZES=(32, 64))
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = User.objects.create_user(username='frank', email='frank@example.com', password='pw-123456789')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _photo(self, size=(300, 200)):
+        out = io.BytesIO()
+        Image.new('RGB', size, (200, 40, 40)).save(out, 'PNG')
+        return SimpleUploadedFile('me.png', out.getvalue(), content_type='image/png')
+
+    def _variants(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, name), settings.MEDIA_ROOT)
+            for dirpath, _, names in os.walk(os.path.join(settings.MEDIA_ROOT, avatars.AVATAR_PREFIX))
+            for name in names
+        )
+
+    def test_upload_serves_square_immutable_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch('/api/auth/profile/', {'profile_photo': self._photo()}, format='multipart')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        urls = response.data['profile_photo_urls']
+        self.assertEqual(set(urls), {'32', '64'})
+        self.assertEqual(response.data['profile_photo_url'], urls['64'])
+        variant = self.client.get(urls['32'])
+        self.assertEqual((variant.status_code, variant['Content-Type']), (200, avatars.CONTENT_TYPE))
+        self.assertEqual(variant['Cache-Control'], avatars.CACHE_CONTROL)
+        with Image.open(io.BytesIO(variant.getvalue())) as image:
+            self.assertEqual(image.size, (32, 32))
+        self.assertEqual(self.client.get(urls['32'], headers={'if-none-match': variant['ETag']}).status_code, 304)
+
+    def test_new_photo_replaces_the_old_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch('/api/auth/profile/', {'profile_photo': self._photo()}, format='multipart')
+        old_digest = User.objects.get(pk=self.user.pk).avatar_digest
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch('/api/auth/profile/', {'profile_photo': self._photo((100, 100))}, format='multipart')
+
+        new_digest = User.objects.get(pk=self.user.pk).avatar_digest
+        self.assertNotEqual(new_digest, old_digest)
+        self.assertEqual(self._variants(), [avatars.storage_name(self.user.pk, new_digest, size) for size in (32, 64)])
+
+    def test_failed_save_stores_no_variants(self):
+        serializer = UserProfileUpdateSerializer(self.user, data={'profile_photo': self._photo()}, partial=True)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch.object(User, 'save', side_effect=DatabaseError('disk full')):
+            with self.assertRaises(DatabaseError):
+                serializer.save()
+
+        self.assertEqual(self._variants(), [])
+
+    def test_undecodable_photo_is_rejected(self):
+        photo = SimpleUploadedFile('me.png', b'\x89PNG\r\n\x1a\n' + b'\0' * 64, content_type='image/png')
+
+        response = self.client.patch('/api/auth/profile/', {'profile_photo': photo}, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(User.objects.get(pk=self.user.pk).avatar_digest)
@@ -1,6 +1,9 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from .views import RegisterView, UserProfileView, UserStorageView, RotateEncryptionKeyView, ServeProfilePhoto
+from .views import (
+    RegisterView, UserProfileView, UserStorageView, UserStorageStatsView, RotateEncryptionKeyView, ServeProfilePhoto,
+    ServeAvatar,
+)
 
 app_name = 'users'
 
@@ -10,6 +13,8 @@ urlpatterns = [
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('profile/', UserProfileView.as_view(), name='profile'),
     path('storage/', UserStorageView.as_view(), name='storage'),
+    path('storage/stats/', UserStorageStatsView.as_view(), name='storage_stats'),
     path('rotate-key/', RotateEncryptionKeyView.as_view(), name='rotate_key'),
-    path('profile_photos/<str:filename>', ServeProfilePhoto.as_view(), name='serve_profile_photo')
+    path('profile_photos/<str:filename>', ServeProfilePhoto.as_view(), name='serve_profile_photo'),
+    path('avatars/<uuid:user_id>/<str:digest>/<int:size>.webp', ServeAvatar.as_view(), name='serve_avatar'),
 ] 
\ No newline at end of file
@@ -3,20 +3,40 @@ from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.contrib.auth import get_user_model
+from . import avatars
 from .serializers import UserSerializer, RegisterSerializer, UserProfileUpdateSerializer, RotateKeySerializer
 from core.views import BaseAPIView
-from files.models import File # For accessing user's files
-from Crypto.Cipher import AES # For AES operations
-from Crypto.Random import get_random_bytes # For generating IVs
+from files.models import File, FileVersion # For accessing user's files
+from files.ciphers import CipherError, get_engine # Pluggable cipher engines
+from files.blobs import BlobNotFound, open_blob, read_blob
+from files.conditional import not_modified, set_validators
+from files.services import BlobDecoder, FileServiceError, cipher_name, hash_content, overwrite_blob, write_blob
+from files import folders, stats as file_stats, versions as file_versions
 import os # For file path operations
+import mimetypes
+import posixpath
+import re
 from django.conf import settings # For BASE_DIR
 import hashlib # For SHA256 hashing
-from django.core.files.storage import default_storage # Ensure this is imported
-from django.core.files.base import ContentFile # For saving raw bytes
+from django.db.models import Count, F
 from django.http import FileResponse, Http404
 
 User = get_user_model()
 
+
+def _is_content_of(file_obj, payload):
+    """Whether decrypted `payload` decodes to the content the File row was uploaded with."""
+    if payload is None:
+        return False
+    if not file_obj.file_hash:
+        return True  # Nothing to compare with
+    try:
+        decoder = BlobDecoder.from_params(compression=file_obj.compression)
+        return hash_content(decoder.update(payload) + decoder.finalize()) == file_obj.file_hash
+    except FileServiceError:
+        return False
+
+
 class RegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
     permission_classes = (permissions.AllowAny,)
@@ -73,6 +93,13 @@ class UserStorageView(BaseAPIView):
             'available_storage': available_storage
         })
 
+class UserStorageStatsView(BaseAPIView):
+    """Breakdown of the user's storage (files/stats.py); served from precomputed counters and a cache."""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request):
+        return Response(file_stats.summary(request.user.pk))
+
 class RotateEncryptionKeyView(BaseAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     # serializer_class = RotateKeySerializer # Keep for reference or remove if not used by DRF's generic mechanisms
@@ -108,7 +135,7 @@ class RotateEncryptionKeyView(BaseAPIView):
 
         # 3. Identify files to re-encrypt
         files_to_reencrypt = File.objects.filter(owner=user, is_encrypted=True)
-        if not files_to_reencrypt.exists():
+        if not files_to_reencrypt.exists() and not FileVersion.objects.filter(file__owner=user, is_encrypted=True).exists():
             user.set_raw_key(new_raw_key_string)
             user.save()
             return Response({"message": "Encryption key updated. No encrypted files found to re-encrypt."}, status=status.HTTP_200_OK)
@@ -122,6 +149,11 @@ class RotateEncryptionKeyView(BaseAPIView):
         # self.stdout.write(f"Starting re-encryption for user {user.username}...") # Placeholder for logging
         print(f"[INFO] Starting re-encryption for user {user.username}...")
 
+        new_engine = get_engine() # New blobs and rotated blobs use the configured default engine
+        rotated_paths = set()
+        skipped_paths = set()
+        resized_owners = {user.pk} # Owners whose storage statistics change with blob sizes
+
         for file_obj in files_to_reencrypt:
             try:
                 # file_path = os.path.join(settings.BASE_DIR, str(file_obj.file)) # Old local path logic
@@ -132,33 +164,60 @@ class RotateEncryptionKeyView(BaseAPIView):
                     failed_files.append({"id": str(file_obj.id), "name": file_obj.original_filename, "error": "File path missing in database"})
                     continue
 
-                if not default_storage.exists(storage_file_path):
+                # Dedup'd files can share one blob; it must only be re-encrypted once
+                if storage_file_path in rotated_paths:
+                    successful_files_count += 1
+                    continue
+                if storage_file_path in skipped_paths:
+                    continue
+
+                try:
+                    stored_content = read_blob(storage_file_path)
+                except BlobNotFound:
                     print(f"[ERROR] File not found in storage at path: {storage_file_path} for file ID {file_obj.id}")
                     failed_files.append({"id": str(file_obj.id), "name": file_obj.original_filename, "error": "File not found in storage"})
                     continue
 
-                with default_storage.open(storage_file_path, 'rb') as f:
-                    encrypted_content_with_iv = f.read()
-                
-                old_iv = encrypted_content_with_iv[:16]
-                old_ciphertext = encrypted_content_with_iv[16:]
+                # Dedup across users can point other owners' rows at this blob too. Their
+                # blob is left alone; this user's rows get a copy under the new key.
+                shared = File.objects.filter(file=storage_file_path).exclude(owner=user).exists()
 
-                # Decrypt with old key
-                decrypt_cipher = AES.new(old_aes_key, AES.MODE_CFB, iv=old_iv)
-                decrypted_content = decrypt_cipher.decrypt(old_ciphertext)
+                # Decrypt with old key using the engine the blob was written with
+                try:
+                    decrypted_content = get_engine(cipher_name(file_obj)).decrypt(old_aes_key, stored_content)
+                except CipherError:
+                    if not shared:
+                        raise
+                    decrypted_content = None
+                if shared and not _is_content_of(file_obj, decrypted_content):
+                    # Encrypted with another owner's key, so it never was readable with this one
+                    print(f"[WARNING] Skipping {file_obj.original_filename} (Path: {storage_file_path}): shared blob not encrypted with this user's key")
+                    skipped_paths.add(storage_file_path)
+                    continue
 
                 # Encrypt with new key
-                new_iv = get_random_bytes(16)
-                encrypt_cipher = AES.new(new_aes_key, AES.MODE_CFB, iv=new_iv)
-                new_ciphertext = encrypt_cipher.encrypt(decrypted_content)
-                new_encrypted_content_with_iv = new_iv + new_ciphertext
-
-                # Overwrite the file in storage with the new encrypted content
-                # First, delete the old one to ensure an overwrite if the storage backend doesn't do it by default on save.
-                # Some backends might version, others might overwrite. default_storage.save usually overwrites.
-                # To be safe, explicitly delete then save, or ensure your backend overwrites.
-                # For S3Boto3Storage, save typically overwrites.
-                default_storage.save(storage_file_path, ContentFile(new_encrypted_content_with_iv))
+                new_stored_content = new_engine.encrypt(new_aes_key, decrypted_content)
+
+                blob_refs = File.objects.filter(file=storage_file_path)
+                changes = {'cipher': new_engine.name, 'size': len(new_stored_content)}
+                if shared:
+                    blob_refs = blob_refs.filter(owner=user)
+                    changes['file'] = write_blob({'is_encrypted': True, 'content': new_stored_content})
+                    changes['encryption_key_id'] = str(user.id)
+                else:
+                    # Overwrite the blob in place so every File row pointing at it stays valid
+                    overwrite_blob(storage_file_path, new_stored_content)
+                rotated_paths.add(storage_file_path)
+
+                # The engine (and with it the stored size) may have changed
+                size_delta = len(new_stored_content) - file_obj.size
+                if size_delta:
+                    for ref in blob_refs.values('owner').annotate(n=Count('id')):
+                        User.objects.filter(pk=ref['owner']).update(used_storage=F('used_storage') + size_delta * ref['n'])
+                    for ref in blob_refs.exclude(folder=None).values('folder').annotate(n=Count('id')):
+                        folders.adjust(ref['folder'], size_delta * ref['n'])
+                    resized_owners.update(blob_refs.values_list('owner', flat=True).distinct())
+                blob_refs.update(**changes)
                 
                 successful_files_count += 1
                 print(f"[INFO] Successfully re-encrypted: {file_obj.original_filename} (Path: {storage_file_path})")
@@ -167,11 +226,16 @@ class RotateEncryptionKeyView(BaseAPIView):
                 print(f"[ERROR] Failed to re-encrypt file {file_obj.original_filename} (ID: {file_obj.id}, Path: {storage_file_path if 'storage_file_path' in locals() else 'unknown'}): {e}")
                 failed_files.append({"id": str(file_obj.id), "name": file_obj.original_filename, "error": str(e)})
         
+        # Earlier file versions are encrypted with the same key
+        failed_files += file_versions.reencrypt(user, old_aes_key, new_aes_key, new_engine)
+        for owner_id in resized_owners:
+            file_stats.rebuild(owner_id)
+
         # --- End of Synchronous Re-encryption --- 
 
         if not failed_files:
             user.set_raw_key(new_raw_key_string)
-            user.save()
+            user.save(update_fields=['encryption_key', 'key_version']) # used_storage may have been adjusted above
             return Response({
                 "message": f"Successfully re-encrypted {successful_files_count} file(s) and updated encryption key."
             }, status=status.HTTP_200_OK)
@@ -185,12 +249,41 @@ class RotateEncryptionKeyView(BaseAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class ServeProfilePhoto(APIView):
+    """Original uploads, for users whose photo predates the resized variants"""
     permission_classes = (permissions.AllowAny,)
+    authentication_classes = ()
 
     def get(self, request, filename):
-        file_path = os.path.join(settings.MEDIA_ROOT, 'profile_photos', filename)
+        name = posixpath.join('profile_photos', os.path.basename(filename))
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
 
-        if default_storage.exists(file_path):
-            return FileResponse(default_storage.open(file_path, 'rb'), content_type='image/jpeg')
-        else:
-            raise Http404("File not found")
\ No newline at end of file
+        try:
+            response = FileResponse(open_blob(name), content_type=content_type)
+        except BlobNotFound:
+            raise Http404("File not found")
+        response['Cache-Control'] = 'public, max-age=3600'  # Same name may be reused by a later upload
+        return response
+
+
+class ServeAvatar(APIView):
+    """
+    Resized profile photo variants (users/avatars.py), streamed from storage.
+    The URL carries the photo's digest, so responses never change and need
+    no database lookup.
+    """
+    permission_classes = (permissions.AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request, user_id, digest, size):
+        if size not in avatars.sizes() or not re.fullmatch(r'[0-9a-f]{%d}' % avatars.DIGEST_LENGTH, digest):
+            raise Http404("File not found")
+        etag = f'"{digest}-{size}"'
+        response = not_modified(request, etag=etag, cache_control=avatars.CACHE_CONTROL)
+        if response is not None:
+            return response
+        try:
+            response = FileResponse(open_blob(avatars.storage_name(user_id, digest, size)),
+                                    content_type=avatars.CONTENT_TYPE)
+        except BlobNotFound:
+            raise Http404("File not found")
+        return set_validators(response, etag=etag, cache_control=avatars.CACHE_CONTROL)
\ No newline at end of file
@@ -19,6 +19,31 @@ const IconFileArchive = FaIcons.FaFileArchive as unknown as React.FC<React.SVGPr
 const IconFilm = FaIcons.FaFilm as unknown as React.FC<React.SVGProps<SVGSVGElement>>;
 const IconMusic = FaIcons.FaMusic as unknown as React.FC<React.SVGProps<SVGSVGElement>>;
 
+// Thumbnail of a file, falling back to its type icon until (or unless) a preview exists
+const Thumbnail: React.FC<{ file: FileResponse; fallback: React.ReactNode }> = ({ file, fallback }) => {
+    const [src, setSrc] = useState<string | null>(null);
+
+    useEffect(() => {
+        if (!file.thumbnail_url) return;
+        let objectUrl: string | null = null;
+        let cancelled = false;
+        fileService.getThumbnail(file.thumbnail_url)
+            .then((blob) => {
+                if (cancelled) return;
+                objectUrl = URL.createObjectURL(blob);
+                setSrc(objectUrl);
+            })
+            .catch(() => setSrc(null));
+        return () => {
+            cancelled = true;
+            if (objectUrl) URL.revokeObjectURL(objectUrl);
+        };
+    }, [file.thumbnail_url]);
+
+    if (!src) return <>{fallback}</>;
+    return <img src={src} alt="" className="h-10 w-10 rounded object-cover" loading="lazy" />;
+};
+
 export interface FileListHandle {
     fetchFiles: (filters?: Record<string, string>) => Promise<void>;
 }
@@ -185,14 +210,13 @@ const FileList = forwardRef<FileListHandle>((_, ref) => {
 
     const handleDownload = async (fileId: string, filename: string) => {
         try {
-            const blob = await fileService.downloadFile(fileId);
-            const url = window.URL.createObjectURL(blob);
+            // The browser streams the file straight to disk instead of buffering it in memory
+            const { url } = await fileService.getDownloadLink(fileId);
             const a = document.createElement('a');
             a.href = url;
             a.download = filename;
             document.body.appendChild(a);
             a.click();
-            window.URL.revokeObjectURL(url);
             document.body.removeChild(a);
         } catch (err: any) {
             setError('Failed to download file');
@@ -320,7 +344,7 @@ const FileList = forwardRef<FileListHandle>((_, ref) => {
                             >
                                 <div className="flex items-center justify-between">
                                     <div className="flex items-center">
-                                        {getIconForMimeType(file.file_type)}
+                                        <Thumbnail file={file} fallback={getIconForMimeType(file.file_type)} />
                                         <div className="ml-3">
                                             <p className="text-sm font-medium text-gray-900 flex items-center">
                                                 {file.original_filename}
@@ -12,12 +12,14 @@ export const Layout: React.FC<{ children: React.ReactNode }> = ({ children }) =>
     const { user, logout } = useAuth();
     const navigate = useNavigate();
     // State for the profile image URL in the nav
-    const [navProfilePhotoUrl, setNavProfilePhotoUrl] = useState(user?.profile_photo_url || '/images/default-avatar.jpg');
+    // The nav avatar is tiny; use the 64px variant where the photo has resized variants
+    const navPhotoSource = user?.profile_photo_urls?.['64'] || user?.profile_photo_url;
+    const [navProfilePhotoUrl, setNavProfilePhotoUrl] = useState(navPhotoSource || '/images/default-avatar.jpg');
 
     useEffect(() => {
         // Update the nav profile photo URL when the user object or its photo URL changes
-        setNavProfilePhotoUrl(user?.profile_photo_url || '/images/default-avatar.jpg');
-    }, [user?.profile_photo_url]);
+        setNavProfilePhotoUrl(navPhotoSource || '/images/default-avatar.jpg');
+    }, [navPhotoSource]);
 
     const handleLogout = () => {
         logout();
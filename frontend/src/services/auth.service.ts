@@ -29,6 +29,22 @@ export interface UserProfile {
     profile_photo?: string;
     has_encryption_key?: boolean;
     profile_photo_url?: string;
+    profile_photo_urls?: Record<string, string> | null; // Resized variants by size in px
+}
+
+interface StorageCounter {
+    count: number;
+    bytes: number;
+}
+
+export interface StorageStats {
+    files: StorageCounter;
+    physical: StorageCounter;  // Distinct contents; duplicates of your own files count once
+    dedup_savings: number;
+    versions: StorageCounter;
+    by_type: Record<string, StorageCounter>;
+    by_month: Array<StorageCounter & { month: string }>;
+    largest_files: Array<{ id: string; original_filename: string; file_type: string; size: number }>;
 }
 
 class AuthService {
@@ -124,6 +140,13 @@ class AuthService {
         return response.data;
     }
 
+    async getStorageStats(): Promise<StorageStats> {
+        const response = await axios.get(`${API_URL}/auth/storage/stats/`, {
+            headers: this.authHeader()
+        });
+        return response.data;
+    }
+
     logout(): void {
         localStorage.removeItem('access_token');
         localStorage.removeItem('refresh_token');
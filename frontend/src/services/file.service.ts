@@ -21,7 +21,32 @@ export interface FileResponse {
     file_size: string;
     is_encrypted: boolean;
     download_url: string;
+    thumbnail_url: string | null;
     access_logs: AccessLog[];
+    version: number;
+    folder: string | null;
+    download_count: number;  // Updated in batches, may lag a few seconds
+    last_accessed: string | null;  // Last download
+}
+
+export interface Folder {
+    id: string;
+    name: string;
+    parent: string | null;
+    depth: number;
+    total_size: number;  // Stored bytes of the whole subtree
+    file_count: number;
+    created_at: string;
+}
+
+export interface FileVersion {
+    number: number;
+    created_at: string;
+    original_size: number;
+    stored_size: number;
+    kind: 'full' | 'delta';
+    file_hash: string;
+    download_url: string;
 }
 
 class FileService {
@@ -34,13 +59,46 @@ class FileService {
 
     // Calculate SHA-256 hash of a file
     async calculateFileHash(file: File): Promise<string> {
-        const arrayBuffer = await file.arrayBuffer();
-        const hashBuffer = await window.crypto.subtle.digest('SHA-256', arrayBuffer);
-        const hashArray = Array.from(new Uint8Array(hashBuffer));
-        return hashArray.map(b => b.toString(16).padStart(2, '0')).join('');
+        return this.toHex(await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer()));
+    }
+
+    private toHex(buffer: ArrayBuffer | Uint8Array): string {
+        return Array.from(new Uint8Array(buffer)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    private async sha256(prefix: number, ...parts: Uint8Array[]): Promise<Uint8Array> {
+        const data = new Uint8Array(1 + parts.reduce((n, p) => n + p.length, 0));
+        data[0] = prefix;
+        let offset = 1;
+        for (const part of parts) {
+            data.set(part, offset);
+            offset += part.length;
+        }
+        return new Uint8Array(await window.crypto.subtle.digest('SHA-256', data));
     }
 
-    // Check for duplicate hash via backend
+    // All levels of the Merkle tree over the file's chunks, leaves first (see backend files/possession.py)
+    private async merkleLevels(content: Uint8Array, chunkSize: number): Promise<Uint8Array[][]> {
+        const leaves: Uint8Array[] = [];
+        for (let i = 0; i < Math.max(content.length, 1); i += chunkSize) {
+            leaves.push(await this.sha256(0, content.subarray(i, i + chunkSize)));
+        }
+        const levels = [leaves];
+        while (levels[levels.length - 1].length > 1) {
+            const level = levels[levels.length - 1];
+            const next: Uint8Array[] = [];
+            for (let i = 0; i + 1 < level.length; i += 2) {
+                next.push(await this.sha256(1, level[i], level[i + 1]));
+            }
+            if (level.length % 2) {
+                next.push(level[level.length - 1]);
+            }
+            levels.push(next);
+        }
+        return levels;
+    }
+
+    // Check for duplicate hash among the current user's files
     async checkDuplicateHash(hash: string): Promise<boolean> {
         const response = await axios.get(`/files/check_hash/?hash=${hash}`, {
             headers: this.getHeaders(),
@@ -48,36 +106,84 @@ class FileService {
         return response.data.exists;
     }
 
-    // Create a reference to an existing file by hash
-    async createFileReference(hash: string, file: File): Promise<FileResponse> {
-        const response = await axios.post('/files/reference/', {
+    // Reference an existing blob by proving possession of its content; null if the server can't verify it
+    async createFileReference(hash: string, file: File, folderId?: string): Promise<FileResponse | null> {
+        const challenge = await axios.post('/files/reference/challenge/', {
             hash,
-            original_filename: file.name,
-            file_type: file.type,
+            size: file.size,
         }, {
             headers: this.getHeaders(),
         });
-        return response.data;
+        const { chunk_size, ranges } = challenge.data;
+        const levels = await this.merkleLevels(new Uint8Array(await file.arrayBuffer()), chunk_size);
+        const proofs = ranges.map(({ index }: { index: number }) => {
+            const siblings: string[] = [];
+            let i = index;
+            for (const level of levels.slice(0, -1)) {
+                if (i % 2) {
+                    siblings.push(this.toHex(level[i - 1]));
+                } else if (i + 1 < level.length) {
+                    siblings.push(this.toHex(level[i + 1]));
+                }
+                i = Math.floor(i / 2);
+            }
+            return { leaf: this.toHex(levels[0][index]), siblings };
+        });
+        try {
+            const response = await axios.post('/files/reference/', {
+                original_filename: file.name,
+                file_type: file.type,
+                challenge: challenge.data.challenge,
+                proofs,
+                folder: folderId ?? null,
+            }, {
+                headers: this.getHeaders(),
+            });
+            return response.data;
+        } catch (error: any) {
+            if (error.response?.status === 404) {
+                return null;
+            }
+            throw error;
+        }
     }
 
-    async uploadFile(file: File): Promise<FileResponse> {
-        // Calculate hash and check for duplicate before uploading
+    async uploadFile(file: File, folderId?: string): Promise<FileResponse> {
+        // Content already on the server only needs a proof of possession, not the bytes
         const hash = await this.calculateFileHash(file);
-        const isDuplicate = await this.checkDuplicateHash(hash);
-        if (isDuplicate) {
-            // Instead of error, create a reference
-            return await this.createFileReference(hash, file);
+        const reference = await this.createFileReference(hash, file, folderId);
+        if (reference) {
+            return reference;
         }
         const formData = new FormData();
         formData.append('file', file);
+        if (folderId) {
+            formData.append('folder', folderId);
+        }
 
-        const response = await axios.post(API_URL + '/', formData, {
-            headers: {
-                ...this.getHeaders(),
-                'Content-Type': 'multipart/form-data',
-            },
-        });
-        return response.data;
+        return this.postUpload(API_URL + '/', formData);
+    }
+
+    // The server turns away uploads over the per-user limits with 429/503 and a Retry-After
+    private async postUpload(url: string, formData: FormData, attempts = 5): Promise<FileResponse> {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await axios.post(url, formData, {
+                    headers: {
+                        ...this.getHeaders(),
+                        'Content-Type': 'multipart/form-data',
+                    },
+                });
+                return response.data;
+            } catch (error: any) {
+                const status = error.response?.status;
+                if ((status !== 429 && status !== 503) || attempt >= attempts) {
+                    throw error;
+                }
+                const seconds = Number(error.response.headers?.['retry-after']) || attempt;
+                await new Promise((resolve) => setTimeout(resolve, seconds * 1000));
+            }
+        }
     }
 
     async getFiles(filters?: Record<string, string>): Promise<FileResponse[]> {
@@ -122,6 +228,88 @@ class FileService {
         
         return response.data;
     }
+
+    // Thumbnails are immutable, so the browser cache answers repeat requests
+    async getThumbnail(url: string): Promise<Blob> {
+        const response = await axios.get(url, {
+            headers: this.getHeaders(),
+            responseType: 'blob',
+        });
+        return response.data;
+    }
+
+    // Short-lived link the browser can download directly, without the bearer token
+    async getDownloadLink(fileId: string): Promise<{ url: string; expires_at: string }> {
+        const response = await axios.post(`${API_URL}/${fileId}/download-token/`, null, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    async getVersions(fileId: string): Promise<FileVersion[]> {
+        const response = await axios.get(`${API_URL}/${fileId}/versions/`, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    // Replaces the file's content; the previous content stays available as a version
+    async uploadVersion(fileId: string, file: File): Promise<FileResponse> {
+        const formData = new FormData();
+        formData.append('file', file);
+        return this.postUpload(`${API_URL}/${fileId}/versions/`, formData);
+    }
+
+    async downloadVersion(fileId: string, number: number): Promise<Blob> {
+        const response = await axios.get(`${API_URL}/${fileId}/versions/${number}/download/`, {
+            headers: this.getHeaders(),
+            responseType: 'blob',
+        });
+        return response.data;
+    }
+
+    async restoreVersion(fileId: string, number: number): Promise<FileResponse> {
+        const response = await axios.post(`${API_URL}/${fileId}/versions/${number}/restore/`, null, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    // parentId 'root' lists the top level; omitted lists every folder
+    async getFolders(parentId?: string): Promise<Folder[]> {
+        const url = parentId ? `${API_URL}/folders/?parent=${parentId}` : `${API_URL}/folders/`;
+        const response = await axios.get(url, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    async createFolder(name: string, parentId: string | null = null): Promise<Folder> {
+        const response = await axios.post(`${API_URL}/folders/`, { name, parent: parentId }, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    async updateFolder(folderId: string, changes: { name?: string; parent?: string | null }): Promise<Folder> {
+        const response = await axios.patch(`${API_URL}/folders/${folderId}/`, changes, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
+
+    async deleteFolder(folderId: string): Promise<void> {
+        await axios.delete(`${API_URL}/folders/${folderId}/`, {
+            headers: this.getHeaders(),
+        });
+    }
+
+    async moveFile(fileId: string, folderId: string | null): Promise<FileResponse> {
+        const response = await axios.post(`${API_URL}/${fileId}/move/`, { folder: folderId }, {
+            headers: this.getHeaders(),
+        });
+        return response.data;
+    }
 }
 
 export const fileService = new FileService(); 
\ No newline at end of file